@@ -0,0 +1,147 @@
+# -*- coding: utf-8 -*-
+## This file is part of DistrIM.
+##
+## DistrIM is a DHT-based network for secured messaging.
+##
+##     Author: Graham Armstrong
+## Student ID: 11004764
+##      Email: graham.armstrong@northumbria.ac.uk
+##
+## Product for CM0645 Individual Project, academic year 2014/15.
+##
+## This product has been developed in partial fulfilment of the regulations
+## governing the award of the Degree of BSc (Honours) Computer Science
+## at the University of Northumbria at Newcastle.
+
+
+"""
+    Admission Control, decides which incoming connections are handled.
+"""
+
+from time import time
+from collections import OrderedDict
+
+from .utils.config import (CFG_ADMISSION_RATE, CFG_ADMISSION_BURST,
+                           CFG_ADMISSION_SOURCES, CFG_ADMISSION_MAX_AGE)
+
+
+class TokenBucket(object):
+    """
+    Limits the rate of events, while allowing short bursts.
+
+    The bucket holds up to `burst` tokens and gains `rate` tokens a second.
+    Each event takes a token, and is refused if there are none.
+    """
+    __slots__ = ('rate', 'burst', 'tokens', 'stamp')
+
+    def __init__(self, rate, burst, now=None):
+        """
+        :param rate: Tokens gained each second.
+        :param burst: Most tokens held.
+        :param now: Time the bucket is created at, defaults to now.
+        """
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.stamp = time() if now is None else now
+
+    def take(self, now=None):
+        """
+        Take a token from the bucket.
+
+        :param now: Time of the event, defaults to now.
+        :return: True if there was a token to take, else False.
+        """
+        self._refill(time() if now is None else now)
+        if self.tokens < 1:
+            return False
+        self.tokens -= 1
+        return True
+
+    def full(self, now=None):
+        """True if the bucket has refilled completely."""
+        self._refill(time() if now is None else now)
+        return self.tokens >= self.burst
+
+    def _refill(self, now):
+        """Add the tokens gained since the last refill."""
+        elapsed = max(now - self.stamp, 0)
+        self.tokens = min(self.burst, self.tokens + elapsed * self.rate)
+        self.stamp = now
+
+
+class AdmissionControl(object):
+    """
+    Decides if incoming connections are worth handling.
+
+    Each source address has a :class:`TokenBucket`, so one node can't flood
+    the pool. A connection that waited in the queue for longer than
+    `max_age` seconds is shed, as its node has likely given up on it, and
+    decrypting its request would be wasted work.
+
+    Only the listening thread should call :func:`admit`.
+    """
+    def __init__(self, rate=CFG_ADMISSION_RATE, burst=CFG_ADMISSION_BURST,
+                 max_sources=CFG_ADMISSION_SOURCES,
+                 max_age=CFG_ADMISSION_MAX_AGE):
+        """
+        :param rate: Connections a second allowed from one address.
+        :param burst: Connections allowed at once from one address.
+        :param max_sources: Most addresses to keep buckets for.
+        :param max_age: Seconds a connection may wait in the queue.
+        """
+        self.rate = rate
+        self.burst = burst
+        self.max_sources = max_sources
+        self.max_age = max_age
+        self._buckets = OrderedDict()  # Least recently used first
+
+        self.count_limited = 0
+        self.count_shed = 0
+
+    def admit(self, address):
+        """
+        Take a token for a connection from an address.
+
+        :param address: IP address of the connecting node.
+        :return: True if the connection is admitted, else False.
+        """
+        now = time()
+        bucket = self._buckets.pop(address, None)
+        if bucket is not None:
+            self._buckets[address] = bucket
+        else:
+            if len(self._buckets) >= self.max_sources:
+                self._prune(now)
+            bucket = self._buckets[address] = TokenBucket(
+                self.rate, self.burst, now)
+        if bucket.take(now):
+            return True
+        self.count_limited += 1
+        return False
+
+    def expired(self, queued):
+        """
+        Check if a queued connection should be shed.
+
+        :param queued: Time the connection was queued at.
+        :return: True if it has waited too long, else False.
+        """
+        if time() - queued <= self.max_age:
+            return False
+        self.count_shed += 1
+        return True
+
+    def _prune(self, now):
+        """
+        Forget addresses with full buckets, as new buckets start full.
+
+        If every bucket is in use, forget the least recently used one rather
+        than grow. An address being limited keeps its bucket as long as it
+        keeps connecting, so new addresses can't reset its limit.
+        """
+        for address, bucket in self._buckets.items():
+            if bucket.full(now):
+                del self._buckets[address]
+        if len(self._buckets) >= self.max_sources:
+            self._buckets.popitem(last=False)
@@ -48,10 +48,28 @@ class ProcedureError(ProtocolError):
     """Raised during communications if data sent at incorrect time."""
 
 
+class BusyError(ProtocolError):
+    """Raised if a foreign node is too busy to handle the connection."""
+
+
 class AuthError(ProtocolError):
     """Raised if authentication with a foreign node fails."""
 
 
+class RelayDownError(ProtocolError):
+    """Raised if a relay reports the next node of a route is down."""
+    def __init__(self, ident):
+        """
+        :param ident: Ident of the node that is down.
+        """
+        super(RelayDownError, self).__init__("Node %s is down." % (ident,))
+        self.ident = ident
+
+
+class MailboxError(ProtocolError):
+    """Raised if no node could hold mail for an offline node."""
+
+
 class FingerError(Exception):
     """Raised by creating a finger with invalid data"""
 
@@ -60,6 +78,10 @@ class CipherError(Exception):
     """Raised by improper use of the CipherWrap class."""
 
 
+class ExecutorError(Exception):
+    """Raised if a task can't be queued, or its result isn't ready."""
+
+
 class SockWrapError(Exception):
     """Raised by improper use of the SocketWrapper class or to wrap the rather
     ghastly `socket.error` exception."""
@@ -0,0 +1,355 @@
+# -*- coding: utf-8 -*-
+## This file is part of DistrIM.
+##
+## DistrIM is a DHT-based network for secured messaging.
+##
+##     Author: Graham Armstrong
+## Student ID: 11004764
+##      Email: graham.armstrong@northumbria.ac.uk
+##
+## Product for CM0645 Individual Project, academic year 2014/15.
+##
+## This product has been developed in partial fulfilment of the regulations
+## governing the award of the Degree of BSc (Honours) Computer Science
+## at the University of Northumbria at Newcastle.
+
+
+"""
+    Circuits, paths built once and reused for many messages.
+
+    Building a circuit passes an onion along its path, leaving each node
+    with a circuit ID and a symmetric key, and the ID it's known by at the
+    next node. Messages then travel along it as cells, which each node
+    peels with AES alone, so only the build pays for RSA.
+
+    A cell is the circuit ID at the node receiving it, a nonce, and the
+    rest encrypted with that node's key and the nonce. Peeled, it's a flag,
+    the nonce for the next node, and the cell for it. Each node pads what it
+    forwards back to the length it received.
+"""
+
+import os
+import pickle
+import struct
+
+from time import time
+from threading import Lock
+
+from Crypto.Cipher import AES
+from Crypto.Util import Counter
+
+from .assets.errors import BusyError, ProtocolError
+from .utils.config import (CFG_PICKLE_PROTOCOL, CFG_STRUCT_FMT,
+                           CFG_CIRCUIT_LIFETIME, CFG_CIRCUIT_MESSAGES,
+                           CFG_CIRCUIT_LIMIT)
+
+ID_SIZE = 8
+NONCE_SIZE = 8
+KEY_SIZE = 16
+LENGTH_SIZE = struct.calcsize(CFG_STRUCT_FMT)
+# Bytes each node peels from a cell, and pads it with again.
+_OVERHEAD = 1 + NONCE_SIZE
+
+# Cell flags.
+MESSAGE = 'M'
+DESTROY = 'D'
+
+
+class Circuit(object):
+    """
+    A circuit built by this node.
+
+    Only its first node knows it was built here, and only its last knows
+    what it carries.
+    """
+    def __init__(self, route):
+        """
+        :param route: List of the Fingers of the nodes of the circuit, in
+            the order they are passed through, the last being the recipient.
+        """
+        self.route = route
+        self.ids = [os.urandom(ID_SIZE) for _ in route]
+        self.keys = [os.urandom(KEY_SIZE) for _ in route]
+        self.created = time()
+        self.count_sent = 0
+        self._package = None
+
+    @property
+    def recipient(self):
+        """Finger of the last node of the circuit."""
+        return self.route[-1]
+
+    def expired(self, lifetime=CFG_CIRCUIT_LIFETIME,
+                messages=CFG_CIRCUIT_MESSAGES):
+        """
+        Check if the circuit should be torn down.
+
+        :param lifetime: Seconds a circuit is used for.
+        :param messages: Messages a circuit is used for.
+        :return: True if it's too old or has carried too many messages.
+        """
+        return (time() - self.created >= lifetime
+                or self.count_sent >= messages)
+
+    def create_package(self):
+        """
+        Construct the onion building the circuit, to send to its first node.
+
+        Each layer is encrypted with the public key of its node, and holds
+        the ID and key of the circuit at the node, and where to extend it.
+        The onion is built once, so it can be built ahead of time.
+        """
+        if self._package is not None:
+            return self._package
+        package = None
+        for idx in reversed(xrange(len(self.route))):
+            last = idx == len(self.route) - 1
+            contents = {
+                'CIRCUIT': self.ids[idx],
+                'KEY': self.keys[idx],
+                'NEXT': None if last else self.route[idx + 1].all,
+                'NEXT_CIRCUIT': None if last else self.ids[idx + 1],
+                'PACKAGE': package,
+            }
+            package = self.route[idx].get_cipher().encrypt(
+                pickle.dumps(contents, CFG_PICKLE_PROTOCOL))
+        self._package = package
+        return package
+
+    def cell(self, flag, body=''):
+        """
+        Construct a cell to send along the circuit.
+
+        :param flag: :data:`MESSAGE`, or :data:`DESTROY` to tear the circuit
+            down.
+        :param body: String of the body for the recipient.
+        :return: String of the cell for the first node.
+        """
+        data = struct.pack(CFG_STRUCT_FMT, len(body)) + body
+        nonce = '\0' * NONCE_SIZE
+        for key in reversed(self.keys):
+            layer_nonce = os.urandom(NONCE_SIZE)
+            data = _cipher(key, layer_nonce).encrypt(flag + nonce + data)
+            nonce = layer_nonce
+        self.count_sent += 1
+        return self.ids[0] + nonce + data
+
+
+class CircuitTable(object):
+    """
+    The circuits passing through this node, or ending at it.
+
+    A circuit not used for `lifetime` seconds is forgotten, which is longer
+    than its builder uses it for. Circuits are held in memory only, so a
+    listener shard doesn't know of circuits built through another process.
+    """
+    def __init__(self, lifetime=CFG_CIRCUIT_LIFETIME,
+                 limit=CFG_CIRCUIT_LIMIT):
+        """
+        :param lifetime: Seconds before an idle circuit is forgotten.
+        :param limit: Most circuits held at once.
+        """
+        self.lifetime = lifetime
+        self.limit = limit
+        self._circuits = {}
+        self._lock = Lock()
+
+        self.count_created = 0
+        self.count_destroyed = 0
+        self.count_expired = 0
+        self.count_cells = 0
+
+    def __len__(self):
+        """Number of circuits held."""
+        with self._lock:
+            return len(self._circuits)
+
+    def add(self, circuit_id, key, next_finger=None, next_id=None):
+        """
+        Hold a circuit being built through this node.
+
+        Raises a :class:`BusyError` if too many circuits are held.
+
+        :param circuit_id: ID of the circuit at this node.
+        :param key: Key of this node's layers of the circuit's cells.
+        :param next_finger: Finger of the next node, None if this node is
+            the recipient.
+        :param next_id: ID of the circuit at the next node.
+        """
+        with self._lock:
+            if len(self._circuits) >= self.limit:
+                self._purge()
+            if len(self._circuits) >= self.limit:
+                raise BusyError("Too many circuits held.")
+            self._circuits[circuit_id] = [key, next_finger, next_id, time()]
+            self.count_created += 1
+
+    def remove(self, circuit_id):
+        """
+        Forget a circuit.
+
+        :param circuit_id: ID of the circuit at this node.
+        """
+        with self._lock:
+            if self._circuits.pop(circuit_id, None) is not None:
+                self.count_destroyed += 1
+
+    def peel(self, cell):
+        """
+        Remove this node's layer from a cell.
+
+        A cell tearing the circuit down makes this node forget it.
+
+        Raises a :class:`ProtocolError` if the circuit isn't known.
+
+        :param cell: String of the cell.
+        :return: Tuple of the cell's flag, the Finger of the next node and
+            the cell for it, or the flag, None and the body if this node is
+            the recipient.
+        """
+        circuit_id = cell[:ID_SIZE]
+        nonce = cell[ID_SIZE:ID_SIZE + NONCE_SIZE]
+        with self._lock:
+            entry = self._circuits.get(circuit_id)
+            if entry is not None and time() - entry[3] >= self.lifetime:
+                del self._circuits[circuit_id]
+                self.count_expired += 1
+                entry = None
+            if entry is None:
+                raise ProtocolError("Cell for an unknown circuit.")
+            entry[3] = time()
+            self.count_cells += 1
+        key, next_finger, next_id = entry[:3]
+        data = _cipher(key, nonce).decrypt(cell[ID_SIZE + NONCE_SIZE:])
+        flag, next_nonce, data = data[0], data[1:_OVERHEAD], data[_OVERHEAD:]
+        if flag == DESTROY:
+            self.remove(circuit_id)
+        if next_finger is None:
+            length = struct.unpack(CFG_STRUCT_FMT, data[:LENGTH_SIZE])[0]
+            return flag, None, data[LENGTH_SIZE:LENGTH_SIZE + length]
+        return (flag, next_finger,
+                next_id + next_nonce + data + os.urandom(_OVERHEAD))
+
+    def metrics(self):
+        """
+        Get the metrics of the circuit table.
+
+        :return: Dictionary of the number of circuits held, and the counts
+            of circuits and cells.
+        """
+        with self._lock:
+            return {'circuits': len(self._circuits),
+                    'created': self.count_created,
+                    'destroyed': self.count_destroyed,
+                    'expired': self.count_expired,
+                    'cells': self.count_cells}
+
+    def _purge(self):
+        """Forget expired circuits, the lock must be held."""
+        now = time()
+        for circuit_id, entry in self._circuits.items():
+            if now - entry[3] >= self.lifetime:
+                del self._circuits[circuit_id]
+                self.count_expired += 1
+
+
+class CircuitPool(object):
+    """
+    The circuits built by this node, one for each recipient.
+    """
+    def __init__(self, lifetime=CFG_CIRCUIT_LIFETIME,
+                 messages=CFG_CIRCUIT_MESSAGES):
+        """
+        :param lifetime: Seconds a circuit is used for.
+        :param messages: Messages a circuit is used for.
+        """
+        self.lifetime = lifetime
+        self.messages = messages
+        self._circuits = {}
+        self._lock = Lock()
+
+        self.count_built = 0
+        self.count_failed = 0
+        self.count_sent = 0
+
+    def get(self, ident):
+        """
+        Get the open circuit to a recipient.
+
+        :param ident: Ident of the recipient.
+        :return: The :class:`Circuit`, or None if there isn't one, or it
+            has expired.
+        """
+        with self._lock:
+            circuit = self._circuits.get(ident)
+            if circuit is None or circuit.expired(self.lifetime,
+                                                  self.messages):
+                return None
+            return circuit
+
+    def add(self, circuit):
+        """
+        Hold a newly built circuit, in place of any to the same recipient.
+
+        :param circuit: The :class:`Circuit`.
+        :return: The :class:`Circuit` replaced, or None.
+        """
+        with self._lock:
+            self.count_built += 1
+            replaced = self._circuits.get(circuit.recipient.ident)
+            self._circuits[circuit.recipient.ident] = circuit
+            return replaced
+
+    def discard(self, ident, failed=False):
+        """
+        Stop using the circuit to a recipient.
+
+        :param ident: Ident of the recipient.
+        :param failed: True if the circuit failed.
+        :return: The :class:`Circuit` discarded, or None.
+        """
+        with self._lock:
+            if failed:
+                self.count_failed += 1
+            return self._circuits.pop(ident, None)
+
+    def stale(self):
+        """
+        Stop using expired circuits.
+
+        :return: List of the expired circuits, to be torn down.
+        """
+        with self._lock:
+            expired = [ident for ident, circuit in self._circuits.items()
+                       if circuit.expired(self.lifetime, self.messages)]
+            return [self._circuits.pop(ident) for ident in expired]
+
+    def clear(self):
+        """
+        Stop using every circuit.
+
+        :return: List of the circuits, to be torn down.
+        """
+        with self._lock:
+            circuits = self._circuits.values()
+            self._circuits.clear()
+            return circuits
+
+    def metrics(self):
+        """
+        Get the metrics of the circuit pool.
+
+        :return: Dictionary of the number of open circuits, and the counts
+            of circuits built and failed and messages sent.
+        """
+        with self._lock:
+            return {'open': len(self._circuits),
+                    'built': self.count_built,
+                    'failed': self.count_failed,
+                    'sent': self.count_sent}
+
+
+def _cipher(key, nonce):
+    """Create an AES cipher in counter mode, for one layer of a cell."""
+    return AES.new(key, AES.MODE_CTR,
+                   counter=Counter.new(64, prefix=nonce))
@@ -19,26 +19,67 @@
 """
 
 
+import os
 import socket
 import traceback
 
-from time import sleep
+from functools import partial
+from time import sleep, time
 from threading import Thread
-from thread_pool import ThreadPool
 
-from .protocol import IncomingConnection, MessageHandler, Boostrapper, Leaver
-from .utils.config import CFG_THREAD_POOL_LENGTH, CFG_LISTENING_QUEUE
+from .admission import AdmissionControl
+from .circuits import CircuitTable, CircuitPool
+from .inbox import Inbox
+from .mailbox import Mailboxes
+from .precompute import Precomputer
+from .receipts import Receipts
+from .transfer import Transfers
+from .relay import RelayQueues
+from .protocol import (IncomingConnection, MessageHandler, Boostrapper,
+                       Leaver, Reconciler, Protocol)
+from .reactor import EventLoop, AsyncSocket, Accept
+from .shards import ListenerShards, SO_REUSEPORT
+from .assets.errors import (FingerSpaceError, SockWrapError, ExecutorError,
+                            BusyError, ProtocolError, RelayDownError)
+from .utils.config import (CFG_LISTENING_QUEUE, CFG_SYNC_INTERVAL,
+                           CFG_TIMEOUT, CFG_LANES, CFG_STREAM_THRESHOLD,
+                           CFG_CIRCUITS, CFG_RECEIVED_DIR, CFG_RECEIPTS,
+                           CFG_SEND_ATTEMPTS, CFG_INBOX_DIR)
+from .utils.executor import ScalingExecutor
+from .utils.utilities import SocketWrapper
 
 
 class ConnectionsManager(object):
     """
     The ConnectionsManager class is responsible for all incoming connections
     from other nodes.
+
+    Incoming sockets are multiplexed by an :class:`EventLoop` in the listening
+    thread, which reads the first frame from each without blocking. Only once
+    a frame is complete is the connection handed to the thread pool to be
+    decrypted and handled, so slow foreign nodes don't tie up pool threads.
+
+    Listening can also be sharded over worker processes, see
+    :class:`ListenerShards`.
+
+    Connections refused by :class:`AdmissionControl`, or by a full pool, are
+    sent a busy reply without decrypting anything.
+
+    Each cost class of the request handlers is a priority lane with its own
+    pool. A request is classified in the 'control' pool from its framing,
+    see :func:`IncomingConnection.classify`, and passed to the pool of its
+    cost class to be deciphered and handled there. Untagged requests are
+    deciphered in the 'control' pool, then handled there if their handler
+    may run inline, else passed on. A storm of relaying then can't hold up
+    control messages.
     """
     def __init__(self, parent_log, local_ip, local_port,
-                 fingerspace, finger, keys):
+                 fingerspace, finger, keys, processes=0, data_dir=''):
         """
         :param parent_log:
+        :param processes: Number of extra processes to listen in.
+        :param data_dir: Directory of the node's data, received transfers
+            and messages are kept under it.
         """
         self.log = parent_log.getChild(__name__.rpartition('.')[2])
         self.local_ip = local_ip
@@ -49,31 +90,106 @@ class ConnectionsManager(object):
         self._running = False
 
         # Listener
-        self._pool = ThreadPool(CFG_THREAD_POOL_LENGTH)
-        self._thread = Thread(target=self._listen, name='Thread-Listener')
+        self._lanes = dict((lane, ScalingExecutor(self.log, *budget))
+                           for lane, budget in CFG_LANES.items())
+        self.admission = AdmissionControl()
+        self.relays = RelayQueues(self.log, fingerspace, finger, keys)
+        self.circuit_table = CircuitTable()
+        self._loop = EventLoop(self.log)
+        self._thread = Thread(target=self._loop.run, name='Thread-Listener')
         self._thread.daemon = True
         self._sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self._sock.setblocking(0)
+
+        # Anti-entropy
+        self._reconciler = Thread(target=self._reconciling,
+                                  name='Thread-Reconciler')
+        self._reconciler.daemon = True
+
+        # Circuits built by this node
+        self.circuits = CircuitPool()
+        self.precomputer = Precomputer(self.log, fingerspace, self._prepare)
+        self.transfers = Transfers(
+            self.log, fingerspace, finger, keys,
+            os.path.join(data_dir, CFG_RECEIVED_DIR) if data_dir else None)
+        self.receipts = Receipts(self.log, fingerspace, finger, keys)
+        self.mailboxes = Mailboxes(self.log, fingerspace, finger, keys,
+                                   self._perform, self._deliver)
+        self.inbox = None
+        if data_dir:
+            self.inbox = Inbox(self.log, os.path.join(data_dir, CFG_INBOX_DIR))
 
-        # Cleaner
-        self._cleaner = Thread(target=self._cleaning, name='Thread-Cleaner')
-        self._cleaner.daemon = True
+        # State changed by incoming requests, by their keyword arguments of
+        # IncomingConnection. Listener shards call this process's copy.
+        self.state = {'circuits': self.circuit_table,
+                      'transfers': self.transfers, 'receipts': self.receipts,
+                      'inbox': self.inbox, 'mail': self.mailboxes.held}
+
+        # Sharding
+        self._shards = None
+        if processes:
+            self._shards = ListenerShards(self.log, self, processes)
 
         # Some nice stats, because why not
         self.count_conn_success = 0
         self.count_conn_failure = 0
+        self.count_conn_refused = 0
+        self.count_rerouted = 0
 
     def start(self):
-        """Begin the listening and cleaning threads of this node."""
+        """
+        Begin the listening and reconciling threads.
+
+        Any listener shards are forked first, before this process binds.
+        """
+        if self.inbox:
+            self.inbox.start()
+        if self._shards:
+            self._shards.start()
+        self.listen(reuse_port=bool(self._shards))
+        self._reconciler.start()
+        self.precomputer.start()
+        self.transfers.start()
+        self.receipts.start()
+
+    def listen(self, reuse_port=False):
+        """
+        Begin the listening thread.
+
+        :param reuse_port: If True, allow other processes to bind the port.
+        """
         self._running = True
+        if reuse_port:
+            self._sock.setsockopt(socket.SOL_SOCKET, SO_REUSEPORT, 1)
         self._sock.bind((self.local_ip, self.local_port))
         self._sock.listen(CFG_LISTENING_QUEUE)
         self._thread.start()
-        self._cleaner.start()
+        self._loop.spawn(self._accepting())
         self.log.info("Listening for connections on %s:%d", self.local_ip,
                       self.local_port)
 
-    def stop(self):
+    def close(self):
         """Stop listening for connections and end the listening thread."""
+        self._close_socket()
+        self._finish()
+
+    def stop(self):
+        """Stop listening for connections, and leave the network."""
+        self._close_socket()
+        if self._shards:
+            self._shards.stop()
+        for circuit in self.circuits.clear():
+            self._destroy_circuit(circuit)
+
+        # Announce leaving to everyone.
+        for finger in self.fingerspace.get_all():
+            leaver = Leaver(self.log, self.local_finger, self.local_keys,
+                            finger)
+            self._perform(leaver, 'leave')
+        self._finish()
+
+    def _close_socket(self):
+        """Stop accepting connections."""
         self._running = False
         try:
             self._sock.shutdown(socket.SHUT_RD)
@@ -81,14 +197,20 @@ class ConnectionsManager(object):
         except socket.error:
             pass
 
-        # Announce leaving to everyone.
-        for finger in self.fingerspace.get_all():
-            leaver = Leaver(self.log, self.local_finger, self.local_keys,
-                            finger)
-            leaver.leave()
-
-        while not self._pool.out_queue.empty():
-            sleep(0.2)
+    def _finish(self):
+        """Wait for handled connections, then end the listening thread."""
+        # Requests are passed on from the control lane, so it stops first.
+        self._lanes['control'].shutdown()
+        for lane, pool in self._lanes.items():
+            if lane != 'control':
+                pool.shutdown()
+        self.relays.stop()
+        self.precomputer.stop()
+        self.transfers.stop()
+        self.receipts.stop()
+        if self.inbox:
+            self.inbox.stop()
+        self._loop.stop()
 
     def bootstrap(self, remote_ip, remote_port):
         """
@@ -96,39 +218,390 @@ class ConnectionsManager(object):
         """
         connection = Boostrapper(self.log, self.fingerspace, self.local_finger,
                                  self.local_keys)
-        connection.bootstrap((remote_ip, remote_port))
+        self._perform(connection, 'bootstrap', (remote_ip, remote_port))
+
+    def rejoin(self):
+        """
+        Rejoin the network through nodes known from a previous run.
+
+        Known nodes are tried in a random order until one of them can be
+        bootstrapped against.
+
+        :return: True if the network was rejoined, else False.
+        """
+        for finger in self.fingerspace.get_random_fingers(
+                len(self.fingerspace)):
+            try:
+                self.bootstrap(finger.addr, finger.port)
+                return True
+            except Exception as exc:  # pylint: disable=broad-except
+                self.log.warning("Couldn't rejoin through %s: %s",
+                                 finger.ident, exc.message)
+        self.log.error("No known node could be rejoined through.")
+        return False
 
-    def send_message(self, recipient, message):
+    def send_message(self, recipient, message, receipt=CFG_RECEIPTS):
         """
         Send a message via relays.
 
+        Long messages are sent as a streamed onion, which relays forward as
+        it arrives. Others are sent along a circuit to the recipient, see
+        :func:`send_by_circuit`.
+
+        If the recipient is offline, having left or been found down, the
+        message is left in its mailboxes instead, see :class:`Mailboxes`.
+
         :param recipient: Finger of the node to send the message to.
         :param message: Plaintext message to send.
+        :param receipt: If True, ask the recipient for a delivery receipt,
+            see :class:`Receipts`.
+        :return: The ID of the receipt to wait for in `receipts`, or None.
+        """
+        if self._offline(recipient):
+            self.mailboxes.deposit(recipient, message)
+            return None
+        receipt_id, fields, routed = None, None, None
+        if receipt:
+            receipt_id, fields = self.receipts.request(recipient)
+            routed = partial(self.receipts.sent, receipt_id)
+        try:
+            self._send(recipient, message, fields, routed)
+        except (SockWrapError, ProtocolError):
+            if receipt_id:
+                self.receipts.cancel(receipt_id)
+            if not self._offline(recipient):
+                raise
+            self.mailboxes.deposit(recipient, message)
+            return None
+        except Exception:
+            if receipt_id:
+                self.receipts.cancel(receipt_id)
+            raise
+        return receipt_id
+
+    def _offline(self, recipient):
+        """
+        Check whether a recipient has left or been found down.
+
+        :param recipient: Finger of the recipient.
+        :return: True if the recipient is offline, else False.
+        """
+        return (recipient.ident in self.fingerspace.dead
+                or self.fingerspace.get(recipient.ident) is None)
+
+    def _deliver(self, sender, message):
+        """
+        Receive a message collected from a mailbox, in the same way as
+        :func:`IncomingConnection._deliver`.
+
+        :param sender: Ident of the sender.
+        :param message: The message.
+        """
+        self.log.info('Message collected from %s', sender)
+        if self.inbox:
+            self.inbox.add(sender, message)
+        print '## Message: %s' % message
+
+    def _send(self, recipient, message, fields=None, routed=None):
+        """
+        Send a message the way that suits its length.
+
+        :param recipient: Finger of the node to send the message to.
+        :param message: Plaintext message to send.
+        :param fields: Dictionary of other fields for the recipient, if any.
+        :param routed: Called with the route of each attempt at sending,
+            before anything is sent, see :attr:`MessageHandler.routed`.
+        :return: List of the Fingers the message was sent through.
+        """
+        if len(message) < CFG_STREAM_THRESHOLD and CFG_CIRCUITS:
+            return self.send_by_circuit(recipient, message, fields, routed)
+        return self._send_routed(recipient, message, fields, routed)
+
+    def _send_routed(self, recipient, message, fields=None, routed=None):
+        """
+        Send a message without a circuit, as a packet, an onion or a
+        streamed onion.
+
+        If the first node of the route is down, it's marked as down and the
+        message sent along a fresh route, up to `CFG_SEND_ATTEMPTS` times.
+
+        :param recipient: Finger of the node to send the message to.
+        :param message: Plaintext message to send.
+        :param fields: Dictionary of other fields for the recipient, if any.
+        :param routed: Called with the route of each attempt.
+        :return: List of the Fingers the message was sent through.
+        """
+        for attempt in xrange(CFG_SEND_ATTEMPTS):
+            postman = MessageHandler(
+                self.log, self.fingerspace, self.local_finger,
+                self.local_keys)
+            postman.routed = routed
+            try:
+                if len(message) >= CFG_STREAM_THRESHOLD:
+                    self._perform(postman, 'send_stream', recipient, message,
+                                  fields)
+                else:
+                    self._perform(postman, 'send_message', recipient,
+                                  message, self._packet_header(recipient),
+                                  fields)
+                return postman.route
+            except SockWrapError as exc:
+                if (not self._note_failure(recipient, postman.foreign_finger,
+                                           exc)
+                        or attempt == CFG_SEND_ATTEMPTS - 1):
+                    raise
+                self.count_rerouted += 1
+
+    def _packet_header(self, recipient):
+        """
+        Take a packet header prepared for a recipient.
+
+        When messages are sent along circuits the stock holds circuits
+        instead, see :func:`MessageHandler.prepare`, and those are left for
+        :func:`send_by_circuit` to build.
+
+        :param recipient: Finger of the recipient.
+        :return: A :class:`PacketHeader`, or None if none are in stock.
+        """
+        if CFG_CIRCUITS:
+            return None
+        return self.precomputer.take(recipient)
+
+    def _note_failure(self, recipient, finger, exc):
+        """
+        Note why sending to a recipient failed, marking any node found down
+        so that fresh routes leave it out.
+
+        :param recipient: Finger of the recipient being sent to.
+        :param finger: Finger of the first node of the route, if known.
+        :param exc: The error sending failed with.
+        :return: True if a fresh route may get around the failure, False if
+            the recipient itself is down.
+        """
+        if isinstance(exc, RelayDownError):
+            ident = exc.ident
+        elif isinstance(exc, SockWrapError) and finger is not None:
+            ident = finger.ident
+        else:
+            return True
+        self.log.warning("Node %s is down: %s", ident, exc.message)
+        self.fingerspace.dead.mark(ident)
+        return ident != recipient.ident
+
+    def send_transfer(self, recipient, data, name=''):
+        """
+        Send a large payload, striped over several circuits.
+
+        :param recipient: Finger of the node to send the payload to.
+        :param data: String of the payload.
+        :param name: Name of the payload, such as its file name.
+        :return: True if the recipient holds the payload, else False.
+        """
+        return self.transfers.send(recipient, data, name)
+
+    def send_by_circuit(self, recipient, message, fields=None, routed=None):
+        """
+        Send a message along a circuit to the recipient.
+
+        The circuit is built by the first message, and reused by the rest
+        until it expires. A circuit that fails, or passes through a node
+        found down since it was built, is discarded and rebuilt along a
+        fresh route. So is one whose receipts come back slowly, see
+        :func:`Receipts.slow`. Nodes that are down are marked, whether this
+        node found them or a relay reported them. If every attempt fails,
+        the message is sent without a circuit.
+
+        :param recipient: Finger of the node to send the message to.
+        :param message: Plaintext message to send.
+        :param fields: Dictionary of other fields for the recipient, if any.
+        :param routed: Called with the route of each attempt, before
+            anything is sent, see :attr:`MessageHandler.routed`.
+        :return: List of the Fingers the message was sent through.
+        """
+        for circuit in self.circuits.stale():
+            self._destroy_circuit(circuit)
+        for attempt in xrange(CFG_SEND_ATTEMPTS):
+            circuit = self.circuits.get(recipient.ident)
+            if circuit and any(finger.ident in self.fingerspace.dead
+                               for finger in circuit.route[:-1]):
+                # Its relays forget it once it expires.
+                self.circuits.discard(recipient.ident, failed=True)
+                circuit = None
+            elif circuit and self.receipts.slow(circuit.route):
+                self.log.info("Circuit to %s is slow, rebuilding it",
+                              recipient.ident)
+                self.circuits.discard(recipient.ident)
+                self._destroy_circuit(circuit)
+                circuit = None
+            postman = MessageHandler(self.log, self.fingerspace,
+                                     self.local_finger, self.local_keys)
+            try:
+                if circuit is None:
+                    circuit = self._perform(
+                        postman, 'build_circuit', recipient,
+                        self.precomputer.take(recipient) if not attempt
+                        else None)
+                    self.circuits.add(circuit)
+                    postman = MessageHandler(
+                        self.log, self.fingerspace, self.local_finger,
+                        self.local_keys)
+                postman.routed = routed
+                self._perform(postman, 'send_cell', circuit, message, fields)
+                self.circuits.count_sent += 1
+                return circuit.route
+            except (SockWrapError, ProtocolError, BusyError) as exc:
+                self.log.warning("Circuit to %s failed, attempt %d: %s",
+                                 recipient.ident, attempt + 1, exc.message)
+                self.circuits.discard(recipient.ident, failed=True)
+                if not self._note_failure(recipient, postman.foreign_finger,
+                                          exc):
+                    raise
+                self.count_rerouted += 1
+        return self._send_routed(recipient, message, fields, routed)
+
+    def _prepare(self, recipient):
+        """
+        Prepare a route to a recipient, for the :class:`Precomputer`.
+
+        :param recipient: Finger of the recipient.
         """
         postman = MessageHandler(
             self.log, self.fingerspace, self.local_finger, self.local_keys)
-        postman.send_message(recipient, message)
+        return postman.prepare(recipient)
 
-    def pool_new_connection(self, sock, address):
+    def _destroy_circuit(self, circuit):
+        """
+        Tear down a circuit, failing quietly as its nodes forget it anyway.
+
+        :param circuit: The :class:`Circuit`.
+        """
+        postman = MessageHandler(
+            self.log, self.fingerspace, self.local_finger, self.local_keys)
+        try:
+            self._perform(postman, 'destroy_circuit', circuit)
+        except (SockWrapError, ProtocolError) as exc:
+            self.log.debug("Couldn't tear down circuit to %s: %s",
+                           circuit.recipient.ident, exc.message)
+
+    def ping(self, finger):
+        """
+        Check that a foreign node is alive.
+
+        :param finger: Finger of the foreign node.
+        :return: The round trip time in seconds.
+        """
+        pinger = MessageHandler(self.log, self.fingerspace, self.local_finger,
+                                self.local_keys, finger)
+        return self._perform(pinger, 'ping')
+
+    def reconcile(self):
+        """
+        Reconcile the FingerSpace with a random foreign node.
+
+        :return: True if reconciliation happened, else False.
+        """
+        try:
+            finger = self.fingerspace.get_random_fingers(1)[0]
+        except FingerSpaceError:
+            return False
+        try:
+            reconciler = Reconciler(self.log, self.fingerspace,
+                                    self.local_finger, self.local_keys,
+                                    finger)
+            self._perform(reconciler, 'reconcile')
+        except Exception as exc:  # pylint: disable=broad-except
+            self.log.error("Reconciliation with %s failed: %s",
+                           finger.ident, exc.message)
+            return False
+        return True
+
+    def pool_metrics(self):
+        """
+        Get the metrics of the pools handling incoming connections.
+
+        :return: Dictionary of the name of each lane to the dictionary from
+            its :func:`ScalingExecutor.metrics`.
+        """
+        return dict((lane, pool.metrics())
+                    for lane, pool in self._lanes.items())
+
+    def _perform(self, handler, procedure, *args):
+        """
+        Perform a procedure of a protocol handler.
+
+        :param handler: The :class:`ConnectionHandler` instance.
+        :param procedure: Name of the method to call.
+        :param args: Arguments of the method.
+        :return: The return value of the method.
+        """
+        return getattr(handler, procedure)(*args)
+
+    def pool_new_connection(self, sock, address, frame=None):
         """
         Handle incoming connection, puts socket into seperate thread.
+
+        :return: False if the pool is full, else True.
+        """
+        try:
+            future = self._lanes['control'].submit(
+                self.accept_new_connetion, sock, address, frame, time())
+        except ExecutorError as exc:
+            self.log.warning("Refusing connection from %s: %s", address,
+                             exc.message)
+            return False
+        future.add_done_callback(self._handled)
+        return True
+
+    def _handled(self, future):
+        """
+        Count the outcome of a connection handled in a pool.
+
+        None is the outcome of a connection passed to another lane.
         """
-        self._pool.add_task(self.accept_new_connetion, sock, address)
+        result = future.result()
+        if result:
+            self.count_conn_success += 1
+        elif result is not None:
+            self.count_conn_failure += 1
 
-    def accept_new_connetion(self, sock, address):
+    def accept_new_connetion(self, sock, address, frame=None, queued=None):
         """
         Handle incoming connections
 
         :param sock: The socket of the incoming connection.
         :param address: Address of the connecting node.
+        :param frame: The first frame, if already received from the socket.
+        :param queued: Time the connection was queued at, if it was.
+        :return: True if handled, False if failed, or None if passed to
+            another lane.
         """
+        if queued and self.admission.expired(queued):
+            self.log.warning("Shedding connection from %s, queued %.1fs",
+                             address, time() - queued)
+            self._shed(sock)
+            return False
         try:
-            self.log.info('New Connection from: %s', address)
             connection = IncomingConnection(
                 self.log, sock, address, self.fingerspace, self.local_finger,
-                self.local_keys)
-            connection.handle()
+                self.local_keys, self.relays, **self.state)
+            if frame is None:
+                frame = connection.conn.receive()
+            lane = connection.classify(frame)
+            if lane != 'control' and lane in self._lanes:
+                return self._pass_to_lane(lane, connection, frame=frame)
+            request = connection.read_request(frame)
+            if request:
+                handler = connection.handler(request[0])
+                if not handler.inline:
+                    return self._pass_to_lane(handler.cost, connection,
+                                              request)
+                connection.dispatch(*request)
             connection.close()
+        except BusyError as exc:
+            self.log.warning("Refusing request from %s: %s", address,
+                             exc.message)
+            self._shed(sock)
+            return False
         except Exception as exc:  # pylint: disable=broad-except
             traceback.print_exc()
             self.log.error("Exception occured during connection with %s:\n%s",
@@ -136,43 +609,187 @@ class ConnectionsManager(object):
             return False
         return True
 
-    def _listen(self):
+    def _pass_to_lane(self, lane, connection, request=None, frame=None):
+        """
+        Queue a request in the pool of its lane.
+
+        :param lane: Name of the lane.
+        :param connection: The :class:`IncomingConnection`.
+        :param request: Tuple of the message type and its parameters, if
+            already deciphered.
+        :param frame: The frame of the request, if not yet deciphered.
+        :return: None, or False if the pool is full.
+        """
+        try:
+            future = self._lanes[lane].submit(
+                self.dispatch_connection, connection, request, time(), frame)
+        except ExecutorError as exc:
+            self.log.warning("Refusing %s request: %s", lane, exc.message)
+            self._shed(connection.conn.sock)
+            return False
+        future.add_done_callback(self._handled)
+        return None
+
+    def dispatch_connection(self, connection, request=None, queued=None,
+                            frame=None):
         """
-        Listen for incoming connections.
+        Handle a request, in the pool of its lane.
 
-        This method is the target of `self._thread`
+        :param connection: The :class:`IncomingConnection`.
+        :param request: Tuple of the message type and its parameters, or
+            None to decipher it from `frame` first.
+        :param queued: Time the request was queued at, if it was.
+        :param frame: The frame of the request, if not yet deciphered.
+        :return: True if handled, else False.
         """
+        label = request[0] if request else 'undeciphered'
+        if queued and self.admission.expired(queued):
+            self.log.warning("Shedding %s request, queued %.1fs",
+                             label, time() - queued)
+            self._shed(connection.conn.sock)
+            return False
+        try:
+            if request is None:
+                request = connection.read_request(frame)
+            if request:
+                label = request[0]
+                connection.dispatch(*request)
+            connection.close()
+        except BusyError as exc:
+            self.log.warning("Refusing %s request: %s", label, exc.message)
+            self._shed(connection.conn.sock)
+            return False
+        except Exception as exc:  # pylint: disable=broad-except
+            traceback.print_exc()
+            self.log.error("Exception occured during %s request:\n%s",
+                           label, exc.message)
+            return False
+        return True
+
+    def _accepting(self):
+        """Coroutine accepting incoming connections."""
         while self._running:
             try:
-                sock, addr = self._sock.accept()
-                self.pool_new_connection(sock, addr)
-            except socket.error as exc:
-                if exc.errno != 22:
-                    self.log.error("Socket error: %s", exc.strerror)
-        self.log.debug("Listening thread stopped.")
+                sock, address = yield Accept(self._sock)
+            except SockWrapError as exc:
+                if self._running:
+                    self.log.error("Socket error: %s", exc.message)
+                continue
+            if not self.admission.admit(address[0]):
+                self.log.warning("Rate limiting connection from %s", address)
+                self._loop.spawn(self._refusing(AsyncSocket(sock)))
+                continue
+            self.log.info('New Connection from: %s', address)
+            self._loop.spawn(self._receiving(sock, address),
+                             callback=self._received)
+        self.log.debug("Accepting coroutine stopped.")
+
+    def _receiving(self, sock, address):
+        """
+        Coroutine receiving the first frame of an incoming connection, then
+        handing the connection to the thread pool.
+
+        The protocol is request and response, so no more data is sent by the
+        foreign node until it has been replied to.
+        """
+        stream = AsyncSocket(sock)
+        try:
+            frame = yield stream.receive()
+        except SockWrapError:
+            stream.close()
+            raise
+        if not self.pool_new_connection(sock, address, frame):
+            yield self._refusing(stream, received=True)
+
+    def _refusing(self, stream, received=False):
+        """
+        Coroutine sending the busy reply to a connection, then closing it.
+
+        The request is read first, so that closing the socket doesn't reset
+        the connection before the reply is read.
+
+        :param stream: The :class:`AsyncSocket` of the connection.
+        :param received: True if the request has already been read.
+        """
+        self.count_conn_refused += 1
+        try:
+            if not received:
+                yield stream.receive()
+            yield stream.send(Protocol.Busy)
+        except SockWrapError:
+            pass
+        finally:
+            stream.close()
 
-    def _cleaning(self):
+    def _shed(self, sock):
         """
-        Removes completed connection results from the thread pool.
+        Send the busy reply to a connection from the pool, then close it.
 
-        This method is the target of `self._cleaner`
+        :param sock: The socket of the connection.
+        """
+        self.count_conn_refused += 1
+        conn = SocketWrapper(sock)
+        try:
+            conn.send(Protocol.Busy)
+            conn.close()
+        except SockWrapError:
+            pass
+
+    def _received(self, task):
+        """Count connections that failed before reaching the pool."""
+        if task.error:
+            self.log.error("Exception occured during connection:\n%s",
+                           task.error)
+            self.count_conn_failure += 1
+
+    def _reconciling(self):
+        """
+        Periodically reconcile the FingerSpace with a random foreign node.
+
+        This method is the target of `self._reconciler`
         """
         while self._running:
-            result = self._pool.get_task()
-            try:
-                self._pool.out_queue.task_done()
-            except ValueError:
-                self.log.error("_pool.out_queue error")
-            if result:
-                self.count_conn_success += 1
-            else:
-                self.count_conn_failure += 1
-
-            # It'll be satisfactory for the time being to pend on get_task
-            # Hopefully errors will be rare
-            try:
-                while not self._pool.err_queue.empty():
-                    self._pool.err_queue.get_nowait()
-            except Exception as exc:  # pylint: disable=broad-except
-                self.log.error("Cleaning errors: %s", exc.message)
-        self.log.debug("Cleaning thread stopped.")
+            sleep(CFG_SYNC_INTERVAL)
+            if self._running:
+                self.reconcile()
+        self.log.debug("Reconciling thread stopped.")
+
+
+class AsyncConnectionsManager(ConnectionsManager):
+    """
+    A ConnectionsManager that handles every connection in one event loop.
+
+    Instead of a blocking thread per connection, all sockets are
+    non-blocking and waited on together by an :class:`EventLoop`, which runs
+    the coroutine versions of the protocol procedures. A slow foreign node
+    only holds up its own coroutine, so many concurrent connections fit in a
+    single thread.
+    """
+    def _perform(self, handler, procedure, *args):
+        """
+        Perform a procedure of a protocol handler in the event loop.
+
+        The coroutine version of the procedure is run, and this blocks until
+        it has finished.
+        """
+        coroutine = getattr(handler, 'co_' + procedure)(*args)
+        return self._loop.spawn(coroutine).wait(CFG_TIMEOUT * 4)
+
+    def _receiving(self, sock, address):
+        """Coroutine handling an incoming connection."""
+        connection = IncomingConnection(
+            self.log, AsyncSocket(sock), address, self.fingerspace,
+            self.local_finger, self.local_keys, **self.state)
+        try:
+            yield connection.co_handle()
+        finally:
+            connection.close()
+
+    def _received(self, task):
+        """Count the outcome of a finished connection task."""
+        if task.error:
+            self.log.error("Exception occured during connection:\n%s",
+                           task.error)
+            self.count_conn_failure += 1
+        else:
+            self.count_conn_success += 1
@@ -0,0 +1,168 @@
+# -*- coding: utf-8 -*-
+## This file is part of DistrIM.
+##
+## DistrIM is a DHT-based network for secured messaging.
+##
+##     Author: Graham Armstrong
+## Student ID: 11004764
+##      Email: graham.armstrong@northumbria.ac.uk
+##
+## Product for CM0645 Individual Project, academic year 2014/15.
+##
+## This product has been developed in partial fulfilment of the regulations
+## governing the award of the Degree of BSc (Honours) Computer Science
+## at the University of Northumbria at Newcastle.
+
+
+"""
+    Crypto Pool, performs RSA work in worker processes.
+"""
+
+import os
+
+from multiprocessing import Pool
+from Crypto import Random
+
+from .utils.config import CFG_CRYPTO_PROCESSES, CFG_TIMEOUT
+from .utils.utilities import CipherWrap
+
+# Keys of a worker process, loaded once when the worker starts.
+_LOCAL_KEYS = None
+
+
+class CryptoPool(object):
+    """
+    A pool of processes for RSA decryption.
+
+    Decrypting with the private key is by far the slowest part of handling a
+    connection, and holds the GIL while it runs. Work submitted to the pool
+    runs on every core instead, leaving the threads doing socket I/O free.
+
+    The private key is exported to each worker once as it starts.
+    """
+    def __init__(self, parent_log, keys, processes=CFG_CRYPTO_PROCESSES):
+        """
+        :param parent_log: Logger of the node.
+        :param keys: The :class:`CipherWrap` of this node.
+        :param processes: Number of worker processes, None for one per CPU.
+        """
+        self.log = parent_log.getChild(__name__.rpartition('.')[2])
+        self.keys = keys
+        self.processes = processes
+        self._pool = None
+        self._pid = None
+
+        self.count_submitted = 0
+
+    @property
+    def available(self):
+        """
+        True if work can be submitted to the pool.
+
+        A pool belongs to the process that started it, so it isn't available
+        in a process forked from that one.
+        """
+        return self._pool is not None and self._pid == os.getpid()
+
+    def start(self):
+        """Start the worker processes."""
+        self._pool = Pool(self.processes, _load_keys,
+                          (self.keys.export(key_type=1),))
+        self._pid = os.getpid()
+        self.log.info("Crypto pool started")
+
+    def stop(self):
+        """Wait for submitted work, then stop the worker processes."""
+        if not self.available:
+            return
+        pool, self._pool = self._pool, None
+        pool.close()
+        pool.join()
+
+    def submit_decrypt(self, cryptic_data, callback=None):
+        """
+        Decrypt data with the private key of this node.
+
+        :param cryptic_data: The encrypted data.
+        :param callback: Called with the decrypted data once it's ready.
+        :return: :class:`multiprocessing.pool.AsyncResult` of the data.
+        """
+        self.count_submitted += 1
+        return self._pool.apply_async(_decrypt, (cryptic_data,),
+                                      callback=callback)
+
+    def submit_decrypt_block(self, block, callback=None):
+        """
+        Decrypt a single block with the private key of this node.
+
+        :param block: The block, see :func:`CipherWrap.encrypt_block`.
+        :param callback: Called with the decrypted data once it's ready.
+        :return: :class:`multiprocessing.pool.AsyncResult` of the data.
+        """
+        self.count_submitted += 1
+        return self._pool.apply_async(_decrypt_block, (block,),
+                                      callback=callback)
+
+
+class PooledCipher(object):
+    """
+    Stands in for the :class:`CipherWrap` of this node, decrypting in a
+    :class:`CryptoPool`.
+
+    Decryption waits for its result, so callers are unchanged, but the wait
+    releases the GIL for other threads. Where the pool isn't available, such
+    as in a listener shard, decryption is done inline.
+    """
+    def __init__(self, keys, pool):
+        """
+        :param keys: The :class:`CipherWrap` of this node.
+        :param pool: The :class:`CryptoPool` to decrypt in.
+        """
+        self.keys = keys
+        self.pool = pool
+
+    def export(self, text=False, key_type=0):
+        """See :func:`CipherWrap.export`."""
+        return self.keys.export(text, key_type)
+
+    def encrypt(self, data):
+        """See :func:`CipherWrap.encrypt`."""
+        return self.keys.encrypt(data)
+
+    def decrypt(self, cryptic_data):
+        """See :func:`CipherWrap.decrypt`."""
+        if not self.pool.available:
+            return self.keys.decrypt(cryptic_data)
+        return self.pool.submit_decrypt(cryptic_data).get(CFG_TIMEOUT)
+
+    def encrypt_block(self, data):
+        """See :func:`CipherWrap.encrypt_block`."""
+        return self.keys.encrypt_block(data)
+
+    def decrypt_block(self, block):
+        """See :func:`CipherWrap.decrypt_block`."""
+        if not self.pool.available:
+            return self.keys.decrypt_block(block)
+        return self.pool.submit_decrypt_block(block).get(CFG_TIMEOUT)
+
+
+def _load_keys(private_key):
+    """
+    Initialiser of a worker process, loading the private key.
+
+    :param private_key: The private key in DER format.
+    """
+    global _LOCAL_KEYS  # pylint: disable=global-statement
+    # PyCrypto's random pool must be reseeded after a fork.
+    Random.atfork()
+    _LOCAL_KEYS = CipherWrap(private_key)
+
+
+def _decrypt(cryptic_data):
+    """Decrypt data in a worker process."""
+    return _LOCAL_KEYS.decrypt(cryptic_data)
+
+
+def _decrypt_block(block):
+    """Decrypt a single block in a worker process."""
+    return _LOCAL_KEYS.decrypt_block(block)
@@ -20,14 +20,25 @@
 
 import random
 
+from time import time
+from collections import deque, OrderedDict
+from multiprocessing import Pool, current_process
 from hashlib import sha256
-from threading import Semaphore
+from threading import Semaphore, Lock
 from Crypto.PublicKey import RSA
 
 from .assets.errors import (HashMissmatchError, FingerSpaceError,
                             FingerError)
+from .utils.config import (CFG_CHANGELOG_LENGTH, CFG_IDENT_LENGTH,
+                           CFG_IMPORT_PARALLEL_MIN, CFG_IMPORT_PROCESSES,
+                           CFG_DEAD_NODE_TTL, CFG_DEPARTED_NODES,
+                           CFG_TOMBSTONE_TTL, CFG_TOMBSTONES)
 from .utils.utilities import SocketWrapper, CipherWrap
 
+# Imported public keys, shared by every Finger with the same key.
+_CIPHERS = {}
+_CIPHERS_MAX = 1024
+
 
 class Finger(object):
     """
@@ -80,6 +91,14 @@ class Finger(object):
             return True
         return False
 
+    def __ne__(self, other):
+        """
+        Check if this finger is not equal to another.
+
+        :param other: The other finger.
+        """
+        return not self == other
+
     def __repr__(self):
         """
         Representation of this object by text.
@@ -101,16 +120,45 @@ class Finger(object):
         Get an RSA cipher for message encryption.
 
         Returns an instance of an RSA cipher of the Public Key of this Node.
+        Keys are imported once and the instance is shared, as importing is
+        a noticeable part of building an onion.
 
         :return: RSA Public Key instance of type :class:`CipherWrap`.
         """
-        return CipherWrap(self.key)
+        cipher = _CIPHERS.get(self.key)
+        if cipher is None:
+            if len(_CIPHERS) >= _CIPHERS_MAX:
+                _CIPHERS.clear()
+            cipher = _CIPHERS[self.key] = CipherWrap(self.key)
+        return cipher
 
 
 class FingerSpace(object):
     """
     The FingerSpace class is responsible for storing information about nodes.
     Access to the Key Space is managed through this class.
+
+    Every change to the Key Space increments a version number and is noted in
+    a bounded changelog. Together with the epoch, a random token chosen when
+    the FingerSpace is created, the version forms a *sync point*. A node that
+    remembers the sync point of a foreign FingerSpace can later ask for only
+    the changes made since then, see :func:`changes_since`.
+
+    For anti-entropy with other nodes a digest is kept for every prefix of the
+    ident space, see :func:`digest`. The local finger is counted in the
+    digests so that two nodes with the same view of the network agree.
+
+    A node that leaves is marked by a tombstone holding the time it was
+    removed at, which is counted in the digests too, so that reconciliation
+    passes the removal on rather than bringing the node back. Tombstones
+    expire after `CFG_TOMBSTONE_TTL` seconds, see :func:`apply_tombstones`.
+
+    Nodes found to be down are kept in `dead`, see :class:`DeadNodes`, and
+    left out of random fingers until they've had time to come back.
+
+    The fingers of the last `CFG_DEPARTED_NODES` nodes removed are kept too,
+    so that mail can still be left for a node that has left, see
+    :func:`get_departed`.
     """
     def __init__(self, parent_log, local_finger):
         """
@@ -123,6 +171,21 @@ class FingerSpace(object):
         self._keyspace = {}
         random.seed()
 
+        # Versioning, for delta synchronisation with rejoining nodes
+        self.epoch = '%08x' % random.getrandbits(32)
+        self.version = 0
+        self._changelog = deque(maxlen=CFG_CHANGELOG_LENGTH)
+        self.sync_points = {}
+        self.observers = []
+        self.dead = DeadNodes()
+        self._departed = OrderedDict()
+
+        # Prefix digests, for anti-entropy
+        self._digests = {}
+        self._update_digest(local_finger.ident)
+        self._tombstones = OrderedDict()
+        self._added = {}
+
         # Some nice stats
         self.count_added = 0
         self.count_removed = 0
@@ -137,18 +200,47 @@ class FingerSpace(object):
         Import a list of nodes.
 
         Receives a list of tuples, typically from a foreign node exporting
-        their list, and adds those nodes to the FingerSpace.
+        their list, and adds those nodes to the FingerSpace. Nodes with a
+        tombstone are left out, having left since the list was made.
 
         Data is expected to be (ip address, port, public key[, ident])
         The ident is optional.
 
+        Validating a finger imports its public key, so large lists are
+        validated in parallel by worker processes and then all placed into
+        the FingerSpace at once. A daemonic process, such as a listener shard,
+        can't start workers, so validates them itself.
+
         :param nodes: List of nodes to import.
+        :return: List of tuples of the values and error message for each
+            node that could not be imported.
         """
-        for values in nodes_list:
+        if (len(nodes_list) < CFG_IMPORT_PARALLEL_MIN or
+                current_process().daemon):
+            results = [_build_finger(values) for values in nodes_list]
+        else:
+            pool = Pool(CFG_IMPORT_PROCESSES)
             try:
-                self.put(*values)  # Star-input allows us to use 3 or 4 args
-            except FingerError as exc:
-                self.log.error("Error importing finger: %s", exc.message)
+                results = pool.map(_build_finger, nodes_list)
+            finally:
+                pool.close()
+                pool.join()
+
+        fingers = []
+        failures = []
+        for values, (finger, error) in zip(nodes_list, results):
+            if finger:
+                fingers.append(finger)
+            else:
+                self.log.error("Error importing finger: %s", error)
+                failures.append((values, error))
+
+        with self.access:
+            for finger in fingers:
+                if (self.local_finger != finger
+                        and finger.ident not in self._tombstones):
+                    self._insert(finger)
+        return failures
 
     def export_nodes(self):
         """
@@ -164,6 +256,101 @@ class FingerSpace(object):
         with self.access:
             return [finger.all for finger in self._keyspace.itervalues()]
 
+    def export_state(self):
+        """
+        Export a list of all nodes along with the current sync point.
+
+        Both are taken together so the sync point describes exactly the list
+        of nodes returned.
+
+        :return: Tuple of the sync point and the list from
+            :func:`export_nodes`.
+        """
+        with self.access:
+            nodes = [finger.all for finger in self._keyspace.itervalues()]
+            return (self.epoch, self.version), nodes
+
+    def sync_point(self):
+        """
+        Get the current sync point of this FingerSpace.
+
+        :return: Tuple of the epoch and the version.
+        """
+        with self.access:
+            return self.epoch, self.version
+
+    def renew_epoch(self):
+        """
+        Begin a new epoch, so sync points handed out before aren't trusted.
+
+        A process forked from the node renews its epoch, as its versions
+        then count the same changes applied in another order.
+        """
+        with self.access:
+            random.seed()
+            self.epoch = '%08x' % random.getrandbits(32)
+            self._changelog.clear()
+
+    def changes_since(self, sync_point):
+        """
+        Get the changes made to the FingerSpace since a sync point.
+
+        Changes to a single ident are coalesced, so only the latest change to
+        each node is reported. If the sync point belongs to another epoch, or
+        the changelog no longer reaches back that far, then `None` is returned
+        and a full export is needed instead.
+
+        :param sync_point: Tuple of epoch and version last seen by the foreign
+            node.
+        :return: Tuple of the current sync point, a list of added nodes in the
+            format of :func:`export_nodes`, and a list of removed idents. Or
+            `None` if the changes can't be determined.
+        """
+        epoch, version = sync_point
+        with self.access:
+            if epoch != self.epoch or version > self.version:
+                return None
+            if version < self.version - len(self._changelog):
+                return None  # Changelog has been truncated
+            latest = {}
+            for change_version, operation, values in self._changelog:
+                if change_version > version:
+                    ident = values[-1] if operation == 'ADD' else values
+                    latest[ident] = (operation, values)
+            current = (self.epoch, self.version)
+
+        added = [vals for opr, vals in latest.itervalues() if opr == 'ADD']
+        removed = [vals for opr, vals in latest.itervalues() if opr == 'DEL']
+        return current, added, removed
+
+    def restore(self, fingers, sync_point):
+        """
+        Restore previously saved fingers and versioning.
+
+        The fingers are trusted and not validated again.
+
+        :param fingers: List of :class:`Finger` instances.
+        :param sync_point: Tuple of the epoch and version when saved.
+        """
+        with self.access:
+            for finger in fingers:
+                if self.local_finger != finger:
+                    self._insert(finger)
+            self.epoch, self.version = sync_point
+            self._changelog.clear()
+
+    def apply_changes(self, added, removed):
+        """
+        Apply changes given by a foreign node's :func:`changes_since`.
+
+        :param added: List of nodes to import.
+        :param removed: List of idents to remove.
+        """
+        for ident in removed:
+            self.remove(ident, mark=False)
+        self.import_nodes([values for values in added
+                           if values[-1] != self.local_finger.ident])
+
     def get_all(self):
         """
         Gets a list of all fingers.
@@ -181,10 +368,24 @@ class FingerSpace(object):
         with self.access:
             return self._keyspace.get(h2i(ident), None)
 
+    def get_departed(self, ident):
+        """
+        Retrieve the Finger of a node removed from the FingerSpace.
+
+        :param ident: ident of the Finger to fetch.
+        :return: Finger of the node, or `None` if it hasn't departed or has
+            been forgotten.
+        """
+        with self.access:
+            return self._departed.get(h2i(ident), None)
+
     def put(self, ip_address, listening_port, public_key, existing_ident=''):
         """
         Place a new node into the Finger Space.
 
+        The node is known to be up, such as by announcing itself, so any
+        tombstone it has is removed.
+
         Expect a :class:`FingerError` exception be raised if the data passed
         in is not valid. Also expect a :class:`HashMissmatchError` exception
         if the generated ident does not match one passed in, do try to pass
@@ -201,43 +402,234 @@ class FingerSpace(object):
             self.log.warning("Can't place local finger in FingerSpace")
             return
 
-        ident = h2i(finger.ident)
         with self.access:
-            if ident not in self._keyspace:
-                self._keyspace[ident] = finger
-                self.count_added += 1
-            else:
-                if not self._keyspace[ident] == finger:
-                    self.log.warning(
-                        "Attempted adding non-matching finger with matching "
-                        + "ident %s.", finger.ident)
+            self._insert(finger, _timestamp())
 
-    def remove(self, ident):
+    def _insert(self, finger, added_at=0):
+        """
+        Place a validated finger into the Key Space. Must be called with
+        `access` held.
+
+        :param finger: The :class:`Finger` to insert.
+        :param added_at: Time the node was last known to be up at, 0 if it
+            was only heard of from other nodes.
+        """
+        ident = h2i(finger.ident)
+        if ident not in self._keyspace:
+            self._departed.pop(ident, None)
+            self._unbury(finger.ident)
+            self._keyspace[ident] = finger
+            self._added[ident] = added_at
+            self._record('ADD', finger.all)
+            self.count_added += 1
+        else:
+            if not self._keyspace[ident] == finger:
+                self.log.warning(
+                    "Attempted adding non-matching finger with matching "
+                    + "ident %s.", finger.ident)
+            elif added_at > self._added.get(ident, 0):
+                self._added[ident] = added_at
+
+    def remove(self, ident, mark=True):
         """
         Delete a Node Finger from the FingerSpace
 
         :param ident: ident of the Finger to remove.
+        :param mark: If True, leave a tombstone so that the removal is passed
+            on by reconciliation. Removals replayed from the past aren't.
         :return: True if succesfully removed, false if otherwise.
         """
-        try:
-            with self.access:
-                self._keyspace.pop(h2i(ident))
-            self.count_removed += 1
-            return True
-        except KeyError:
-            return False
+        with self.access:
+            if h2i(ident) not in self._keyspace:
+                return False
+            self._delete(ident)
+            if mark:
+                self._bury(ident, _timestamp())
+        return True
+
+    def _delete(self, ident):
+        """
+        Delete a finger, keeping it as departed. Must be called with `access`
+        held.
+
+        :param ident: ident of the Finger, which must be held.
+        """
+        finger = self._keyspace.pop(h2i(ident))
+        self._added.pop(h2i(ident), None)
+        self._record('DEL', finger.ident)
+        self._departed[h2i(ident)] = finger
+        if len(self._departed) > CFG_DEPARTED_NODES:
+            self._departed.popitem(last=False)
+        self.count_removed += 1
+
+    def get_tombstones(self, prefix):
+        """
+        Export the tombstones of nodes with a given prefix.
+
+        :param prefix: Hexadecimal prefix of the idents.
+        :return: List of tuples of the ident and the time it was removed at.
+        """
+        with self.access:
+            return [(ident, removed_at) for ident, removed_at
+                    in self._tombstones.iteritems()
+                    if ident.startswith(prefix)]
+
+    def apply_tombstones(self, tombstones):
+        """
+        Apply the tombstones given by a foreign node's :func:`get_tombstones`.
+
+        A node is removed if it was added before it was removed at the
+        foreign node. One added since has come back, and keeps its place.
+        Where both nodes hold a tombstone, the later removal is kept.
+        Expired tombstones are ignored.
+
+        :param tombstones: List of tuples of an ident and a removal time.
+        :return: Number of nodes removed.
+        """
+        removed = 0
+        now = time()
+        with self.access:
+            for ident, removed_at in tombstones:
+                if (not isinstance(ident, str)
+                        or len(ident) != CFG_IDENT_LENGTH
+                        or not isinstance(removed_at, float)
+                        or ident == self.local_finger.ident
+                        or not 0 <= now - removed_at < CFG_TOMBSTONE_TTL):
+                    continue
+                key = h2i(ident)
+                if key in self._keyspace:
+                    if self._added.get(key, 0) > removed_at:
+                        continue
+                    self._delete(ident)
+                    removed += 1
+                self._bury(ident, removed_at)
+        return removed
+
+    def _bury(self, ident, removed_at):
+        """
+        Hold the tombstone of a removed node, keeping the later of two. Must
+        be called with `access` held.
+
+        :param ident: ident of the node.
+        :param removed_at: Time the node was removed at.
+        """
+        previous = self._tombstones.get(ident)
+        if previous is not None:
+            if previous >= removed_at:
+                return
+            self._unbury(ident)
+        self._tombstones[ident] = removed_at
+        self._update_digest(ident, 0, removed_at)
+        if len(self._tombstones) > CFG_TOMBSTONES:
+            self._unbury(next(iter(self._tombstones)))
+
+    def _unbury(self, ident):
+        """
+        Forget the tombstone of a node, if it has one. Must be called with
+        `access` held.
+
+        :param ident: ident of the node.
+        """
+        removed_at = self._tombstones.pop(ident, None)
+        if removed_at is not None:
+            self._update_digest(ident, 0, removed_at)
+
+    def _expire_tombstones(self):
+        """Forget expired tombstones. Must be called with `access` held."""
+        now = time()
+        for ident, removed_at in self._tombstones.items():
+            if now - removed_at >= CFG_TOMBSTONE_TTL:
+                self._unbury(ident)
+
+    def digest(self, prefix):
+        """
+        Get the digest of all idents starting with a prefix.
+
+        The digest is the count of idents with the prefix, and the XOR of the
+        hashes of those idents and of their tombstones. It is maintained as
+        fingers are added and removed, so getting it is cheap. Expired
+        tombstones are forgotten when the digest of all idents is taken, as
+        each reconciliation begins.
+
+        :param prefix: Hexadecimal prefix of the idents, '' for all idents.
+        :return: Tuple of the count and the hash.
+        """
+        with self.access:
+            if not prefix:
+                self._expire_tombstones()
+            return tuple(self._digests.get(prefix, (0, 0)))
+
+    def get_by_prefix(self, prefix):
+        """
+        Export all nodes, including the local node, with a given prefix.
+
+        :param prefix: Hexadecimal prefix of the idents.
+        :return: List of tuples as with :func:`export_nodes`.
+        """
+        with self.access:
+            nodes = [finger.all for finger in self._keyspace.itervalues()
+                     if finger.ident.startswith(prefix)]
+        if self.local_finger.ident.startswith(prefix):
+            nodes.append(self.local_finger.all)
+        return nodes
+
+    def _update_digest(self, ident, change=1, removed_at=None):
+        """
+        Toggle an ident in the digests of all of its prefixes.
+
+        Since the digest hashes are combined by XOR, this is used for both
+        adding and removing an ident. Must be called with `access` held.
+
+        :param ident: The ident which was added or removed.
+        :param change: 1 if the ident was added, -1 if it was removed, 0 for
+            a tombstone.
+        :param removed_at: Removal time of a tombstone, hashed with the
+            ident.
+        """
+        if removed_at is not None:
+            ident_hash = int(sha256('%s/%.3f' % (ident, removed_at))
+                             .hexdigest()[:16], 16)
+        else:
+            ident_hash = int(sha256(ident).hexdigest()[:16], 16)
+        for idx in xrange(len(ident) + 1):
+            digest = self._digests.setdefault(ident[:idx], [0, 0])
+            digest[0] += change
+            digest[1] ^= ident_hash
+
+    def _record(self, operation, values):
+        """
+        Note a change in the changelog and tell any observers about it. Must
+        be called with `access` held.
+
+        Observers are called with the version, operation and values of the
+        change, so they should be quick.
+
+        :param operation: Either 'ADD' or 'DEL'.
+        :param values: The `all` tuple of an added finger, or the ident of a
+            removed finger.
+        """
+        self.version += 1
+        self._changelog.append((self.version, operation, values))
+        for observer in self.observers:
+            observer(self.version, operation, values)
+        if operation == 'ADD':
+            self._update_digest(values[-1], 1)
+        else:
+            self._update_digest(values, -1)
 
     def get_random_fingers(self, number):
         """
-        Get random fingers.
+        Get random fingers, leaving out nodes found to be down.
 
         :param number: How many fingers to return.
-        :return: The *number* of instances of :class:`Finger`.
+        :return: The *number* of instances of :class:`Finger`, or fewer if
+            there aren't enough nodes up.
         """
         with self.access:
-            idents = self._keyspace.keys()
             if not self._keyspace:
                 raise FingerSpaceError("DHT is empty.")
+            idents = [key for key, finger in self._keyspace.items()
+                      if finger.ident not in self.dead]
 
         if number < 1:
             raise ValueError("Number of keys must be positive")
@@ -253,6 +645,116 @@ class FingerSpace(object):
                 idents.remove(key)
         return route
 
+    def get_closest(self, ident, number):
+        """
+        Get the fingers closest to an ident, by the XOR of their idents.
+
+        The local finger is included, while nodes found to be down and the
+        node of the ident itself are left out.
+
+        :param ident: ident to measure the distance from.
+        :param number: How many fingers to return.
+        :return: Up to *number* instances of :class:`Finger`, closest first.
+        """
+        target = h2i(ident)
+        with self.access:
+            fingers = [finger for key, finger in self._keyspace.items()
+                       if key != target and finger.ident not in self.dead]
+        if h2i(self.local_finger.ident) != target:
+            fingers.append(self.local_finger)
+        fingers.sort(key=lambda finger: h2i(finger.ident) ^ target)
+        return fingers[:number]
+
+
+class DeadNodes(object):
+    """
+    Nodes found to be down, routed around for `ttl` seconds.
+
+    A node is marked when connecting to it fails, whether by this node or by
+    a relay reporting it, and forgotten once `ttl` has passed, so one that
+    comes back is used again without having to be noticed.
+    """
+    def __init__(self, ttl=CFG_DEAD_NODE_TTL):
+        """
+        :param ttl: Seconds a node is routed around.
+        """
+        self.ttl = ttl
+        self._marked = {}
+        self._lock = Lock()
+
+        self.count_marked = 0
+        self.count_expired = 0
+
+    def __contains__(self, ident):
+        """Check a node is marked as down, forgetting it if it's expired."""
+        with self._lock:
+            marked = self._marked.get(ident)
+            if marked is None:
+                return False
+            if time() - marked < self.ttl:
+                return True
+            del self._marked[ident]
+            self.count_expired += 1
+            return False
+
+    def __len__(self):
+        """Number of nodes marked, including any expired."""
+        with self._lock:
+            return len(self._marked)
+
+    def mark(self, ident):
+        """
+        Mark a node as down.
+
+        :param ident: Ident of the node.
+        """
+        with self._lock:
+            self._marked[ident] = time()
+            self.count_marked += 1
+
+    def metrics(self):
+        """
+        Get the metrics of the nodes marked.
+
+        :return: Dictionary of the number of nodes marked, and the counts of
+            nodes marked and expired.
+        """
+        with self._lock:
+            now = time()
+            return {'dead': sum(1 for marked in self._marked.values()
+                                if now - marked < self.ttl),
+                    'marked': self.count_marked,
+                    'expired': self.count_expired}
+
+
+def _build_finger(values):
+    """
+    Create a finger from exported node values, catching validation errors.
+
+    This is a module level function so it may be used by worker processes.
+
+    :param values: Tuple of (ip address, port, public key[, ident]).
+    :return: Tuple of the :class:`Finger` and `None`, or of `None` and the
+        error message if the values are not valid.
+    """
+    try:
+        return Finger(*values), None
+    except (FingerError, HashMissmatchError, TypeError) as exc:
+        return None, str(exc)
+
+
+def _timestamp():
+    """
+    The current time, truncated to the millisecond.
+
+    Tombstones are hashed into digests with their time in milliseconds.
+    Truncating, rather than rounding, keeps the time from being ahead of
+    :func:`time.time`, so a tombstone never has a negative age.
+
+    :return: Float of the time in seconds.
+    """
+    return int(time() * 1000) / 1000.0
+
 
 def generate_hash(ip_address, listening_port, public_key):
     """
@@ -273,7 +775,7 @@ def generate_hash(ip_address, listening_port, public_key):
     finger_type_test(ip_address, listening_port, public_key)
     concated = "%s%d%s" % (ip_address, listening_port, public_key)
     ash = sha256(concated)
-    return ash.hexdigest()[:4]
+    return ash.hexdigest()[:CFG_IDENT_LENGTH]
 
 
 def finger_type_test(ip_address, listening_port, public_key):
@@ -0,0 +1,216 @@
+# -*- coding: utf-8 -*-
+## This file is part of DistrIM.
+##
+## DistrIM is a DHT-based network for secured messaging.
+##
+##     Author: Graham Armstrong
+## Student ID: 11004764
+##      Email: graham.armstrong@northumbria.ac.uk
+##
+## Product for CM0645 Individual Project, academic year 2014/15.
+##
+## This product has been developed in partial fulfilment of the regulations
+## governing the award of the Degree of BSc (Honours) Computer Science
+## at the University of Northumbria at Newcastle.
+
+
+"""
+    Handlers, a registry of the procedures handling each message type.
+"""
+
+from time import time
+from threading import Lock, BoundedSemaphore
+
+from .assets.errors import BusyError, ProcedureError
+
+
+class Handler(object):
+    """
+    The procedure handling requests of one message type.
+
+    A handler declares its cost class, which names the pool it runs in, the
+    most requests it may handle at once, and whether it is cheap enough to
+    run inline in whichever thread deciphered the request. Each run is
+    counted and timed.
+    """
+    def __init__(self, msg_type, function, cost='control', limit=0,
+                 inline=False):
+        """
+        :param msg_type: The message type defined in :class:`Protocol`.
+        :param function: Function taking the connection and the parameters.
+        :param cost: Name of the cost class.
+        :param limit: Most requests handled at once, 0 for no limit.
+        :param inline: True if it may run without being queued.
+        """
+        self.msg_type = msg_type
+        self.function = function
+        self.coroutine = None
+        self.cost = cost
+        self.limit = limit
+        self.inline = inline
+        self._slots = BoundedSemaphore(limit) if limit else None
+        self._lock = Lock()
+
+        self.count_calls = 0
+        self.count_errors = 0
+        self.count_rejected = 0
+        self.total_time = 0.0
+        self.max_time = 0.0
+
+    def run(self, connection, parameters):
+        """
+        Handle a request.
+
+        Raises a :class:`BusyError` if the handler is at its limit.
+
+        :param connection: The :class:`IncomingConnection`.
+        :param parameters: Parameters of the message.
+        """
+        started = self._enter()
+        try:
+            return self.function(connection, parameters)
+        except Exception:
+            self.count_errors += 1
+            raise
+        finally:
+            self._leave(started)
+
+    def co_run(self, connection, parameters):
+        """
+        Coroutine of :func:`run`.
+
+        The coroutine of the handler is used if it has one, else the
+        function is called.
+        """
+        started = self._enter()
+        try:
+            if self.coroutine:
+                yield self.coroutine(connection, parameters)
+            else:
+                self.function(connection, parameters)
+        except Exception:
+            self.count_errors += 1
+            raise
+        finally:
+            self._leave(started)
+
+    def metrics(self):
+        """
+        Get the metrics of the handler.
+
+        :return: Dictionary of the counts, and the mean and max run times.
+        """
+        with self._lock:
+            return {'calls': self.count_calls,
+                    'errors': self.count_errors,
+                    'rejected': self.count_rejected,
+                    'mean_time': self.total_time / (self.count_calls or 1),
+                    'max_time': self.max_time}
+
+    def _enter(self):
+        """Take a slot to run in, and get the time."""
+        if self._slots and not self._slots.acquire(False):
+            self.count_rejected += 1
+            raise BusyError("%s handler is at its limit of %d."
+                            % (self.msg_type, self.limit))
+        return time()
+
+    def _leave(self, started):
+        """Give back the slot, and note the time taken."""
+        elapsed = time() - started
+        if self._slots:
+            self._slots.release()
+        with self._lock:
+            self.count_calls += 1
+            self.total_time += elapsed
+            self.max_time = max(self.max_time, elapsed)
+
+
+class HandlerRegistry(object):
+    """
+    The handlers of each message type.
+
+    Handlers are registered with decorators, so adding a message type
+    doesn't need the dispatch changed::
+
+        @HANDLERS.register(Protocol.Ping, inline=True)
+        def handle_ping(self, params):
+            ...
+
+        @HANDLERS.register_coroutine(Protocol.Ping)
+        def co_handle_ping(self, params):
+            ...
+    """
+    def __init__(self):
+        self._handlers = {}
+
+    def __contains__(self, msg_type):
+        return msg_type in self._handlers
+
+    def register(self, msg_type, cost='control', limit=0, inline=False):
+        """
+        Decorator registering the function handling a message type.
+
+        :param msg_type: The message type defined in :class:`Protocol`.
+        :param cost: Name of the cost class.
+        :param limit: Most requests handled at once, 0 for no limit.
+        :param inline: True if it may run without being queued.
+        :return: The decorator, which returns the function unchanged.
+        """
+        def decorator(function):
+            """Register the function."""
+            self._handlers[msg_type] = Handler(msg_type, function, cost,
+                                               limit, inline)
+            return function
+        return decorator
+
+    def register_coroutine(self, msg_type):
+        """
+        Decorator registering the coroutine version of a handler.
+
+        The handler must already be registered.
+
+        :param msg_type: The message type defined in :class:`Protocol`.
+        :return: The decorator, which returns the function unchanged.
+        """
+        def decorator(function):
+            """Register the coroutine."""
+            self._handlers[msg_type].coroutine = function
+            return function
+        return decorator
+
+    def get(self, msg_type):
+        """
+        Get the handler of a message type.
+
+        Raises a :class:`ProcedureError` if there is no handler, as the
+        message type isn't one that can be requested.
+
+        :param msg_type: The message type defined in :class:`Protocol`.
+        :return: The :class:`Handler`.
+        """
+        try:
+            return self._handlers[msg_type]
+        except KeyError:
+            raise ProcedureError("No handler for '%s' requests." % msg_type)
+
+    def cost(self, msg_type):
+        """
+        Get the cost class of a message type.
+
+        :param msg_type: The message type defined in :class:`Protocol`.
+        :return: Name of the cost class of its handler, or 'control' if it
+            has none.
+        """
+        handler = self._handlers.get(msg_type)
+        return handler.cost if handler else 'control'
+
+    def metrics(self):
+        """
+        Get the metrics of every handler.
+
+        :return: Dictionary of each message type to the dictionary from
+            :func:`Handler.metrics`.
+        """
+        return dict((msg_type, handler.metrics())
+                    for msg_type, handler in self._handlers.items())
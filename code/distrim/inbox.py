@@ -0,0 +1,610 @@
+# -*- coding: utf-8 -*-
+## This file is part of DistrIM.
+##
+## DistrIM is a DHT-based network for secured messaging.
+##
+##     Author: Graham Armstrong
+## Student ID: 11004764
+##      Email: graham.armstrong@northumbria.ac.uk
+##
+## Product for CM0645 Individual Project, academic year 2014/15.
+##
+## This product has been developed in partial fulfilment of the regulations
+## governing the award of the Degree of BSc (Honours) Computer Science
+## at the University of Northumbria at Newcastle.
+
+
+
+"""
+    Inbox, a local store of the messages received by this node.
+"""
+
+import os
+import mmap
+import pickle
+import struct
+
+from time import time, sleep
+from bisect import bisect_left
+from functools import partial
+from threading import Thread, Lock
+
+from .utils.config import (CFG_IDENT_LENGTH, CFG_PICKLE_PROTOCOL,
+                           CFG_STRUCT_FMT, CFG_INBOX_SEGMENT_SIZE,
+                           CFG_INBOX_MAX_AGE, CFG_INBOX_MAX_SIZE,
+                           CFG_INBOX_SYNC_INTERVAL, CFG_INBOX_COMPACT_INTERVAL)
+from .utils.records import (RecordLog, HEADER_SIZE, read_records_at,
+                            write_records)
+
+# Entry of an index: sender, time received and offset of the record.
+ENTRY = struct.Struct('>%dsdL' % CFG_IDENT_LENGTH)
+# Header of an index: entries, first and last times, and segment size.
+INDEX_HEADER = struct.Struct('>LddQ')
+
+
+class Segment(object):
+    """
+    A full segment of the inbox, with its index kept on disk.
+
+    The index holds two runs of fixed size entries, the first sorted by time
+    and the second by sender then time. Both are binary searched through a
+    memory map, so only the header of the index is kept in memory.
+    """
+    def __init__(self, path):
+        """
+        :param path: Path of the segment, its index must have been written.
+        """
+        self.path = path
+        self.index_path = os.path.splitext(path)[0] + '.idx'
+        with open(self.index_path, 'rb') as handle:
+            header = handle.read(INDEX_HEADER.size)
+        self.count, self.first, self.last, self.size = \
+            INDEX_HEADER.unpack(header)
+
+    @classmethod
+    def seal(cls, path, entries):
+        """
+        Write the index of a segment.
+
+        The index is written to a temporary file and renamed over the old
+        one, and holds the size of the segment it was written for. An index
+        that doesn't match its segment can then be told apart, and rebuilt.
+
+        :param path: Path of the segment.
+        :param entries: List of tuples of the time received, sender and
+            offset of each record.
+        :return: The sealed :class:`Segment`.
+        """
+        by_time = sorted(entries)
+        by_sender = sorted(entries, key=lambda entry: (entry[1], entry[0]))
+        first, last = (by_time[0][0], by_time[-1][0]) if entries else (0, 0)
+        index_path = os.path.splitext(path)[0] + '.idx'
+        temp_path = index_path + '.tmp'
+        with open(temp_path, 'wb') as handle:
+            handle.write(INDEX_HEADER.pack(len(entries), first, last,
+                                           os.path.getsize(path)))
+            for received, sender, offset in by_time + by_sender:
+                handle.write(ENTRY.pack(sender, received, offset))
+            handle.flush()
+            os.fsync(handle.fileno())
+        os.rename(temp_path, index_path)
+        return cls(path)
+
+    def find(self, sender, since, until):
+        """
+        Find the records received from a sender between two times.
+
+        :param sender: Ident of the sender, or None for any sender.
+        :param since: Earliest time received.
+        :param until: Latest time received.
+        :return: List of the offsets of the records, in order of time.
+        """
+        if not self.count or since > self.last or until < self.first:
+            return []
+        with open(self.index_path, 'rb') as handle:
+            mapped = mmap.mmap(handle.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            if sender is None:
+                start, end, key = 0, self.count, (since,)
+            else:
+                start, end, key = self.count, self.count * 2, (sender, since)
+            # Binary search for the first entry at or after the key.
+            while start < end:
+                middle = (start + end) // 2
+                entry = _entry(mapped, middle)
+                if (entry[1:2] if sender is None else entry[:2]) < key:
+                    start = middle + 1
+                else:
+                    end = middle
+            offsets = []
+            last = self.count if sender is None else self.count * 2
+            for number in xrange(start, last):
+                entry = _entry(mapped, number)
+                if entry[1] > until:
+                    break
+                if sender is not None and entry[0] != sender:
+                    break
+                offsets.append(entry[2])
+            return offsets
+        finally:
+            mapped.close()
+
+    def remove(self):
+        """Delete the files of the segment."""
+        for path in (self.path, self.index_path):
+            if os.path.exists(path):
+                os.remove(path)
+
+
+class Inbox(object):
+    """
+    The messages received by this node, kept on disk.
+
+    Messages are appended to the newest segment, a :class:`RecordLog` synced
+    every `sync_interval` seconds, whose index is held in memory. Once it
+    grows past `segment_size` a new one is begun, and the full one is sealed
+    by the syncing thread, its index being written next to it as a
+    :class:`Segment`. The memory used then depends on the size of a segment
+    and not of the inbox.
+
+    Adding a message never waits on the disk. Syncing, sealing and merging
+    segments only take the lock to swap in their results.
+
+    Messages can be found by sender and by the time they were received. A
+    search only reads the indexes of the segments received in the times
+    asked for, then reads the records found straight from the page cache.
+
+    Every `compact_interval` seconds, segments older than `max_age` are
+    dropped, as are the oldest segments while the inbox holds more than
+    `max_size` bytes, and neighbouring segments shrunk by deleting messages
+    are merged.
+    """
+    def __init__(self, parent_log, directory,
+                 segment_size=CFG_INBOX_SEGMENT_SIZE,
+                 max_age=CFG_INBOX_MAX_AGE, max_size=CFG_INBOX_MAX_SIZE,
+                 sync_interval=CFG_INBOX_SYNC_INTERVAL,
+                 compact_interval=CFG_INBOX_COMPACT_INTERVAL):
+        """
+        :param parent_log: Logger of the :class:`ConnectionsManager`.
+        :param directory: Directory to keep the segments in.
+        :param segment_size: Bytes of a segment before it's sealed.
+        :param max_age: Seconds messages are kept for.
+        :param max_size: Bytes of segments kept.
+        :param sync_interval: Seconds between syncs of the newest segment.
+        :param compact_interval: Seconds between compactions.
+        """
+        self.log = parent_log.getChild(__name__.rpartition('.')[2])
+        self.directory = directory
+        self.segment_size = segment_size
+        self.max_age = max_age
+        self.max_size = max_size
+        self.sync_interval = sync_interval
+        self.compact_interval = compact_interval
+        self._segments = []
+        self._full = []
+        self._number = 0
+        self._log = None
+        self._entries = []
+        self._senders = {}
+        self._latest = 0
+        self._dirty = False
+        self._lock = Lock()
+        self._writing = Lock()
+        self._running = False
+        self._thread = Thread(target=self._syncing, name='Thread-InboxSync')
+        self._thread.daemon = True
+
+        self.count_added = 0
+        self.count_deleted = 0
+        self.count_expired = 0
+        self.count_merged = 0
+
+    def load(self):
+        """
+        Open the segments kept by a previous run.
+
+        Indexes that don't match their segments are rebuilt, and a record
+        left partly written at the end of the newest segment is cut off.
+
+        :return: The number of messages kept.
+        """
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        for name in os.listdir(self.directory):
+            if name.endswith(('.tmp', '.seg.idx')):
+                os.remove(os.path.join(self.directory, name))  # Unfinished
+        numbers = sorted(int(name[:-4]) for name in os.listdir(self.directory)
+                         if name.endswith('.seg'))
+        with self._lock:
+            for number in numbers[:-1]:
+                segment = self._restore(self._path(number))
+                if segment.count:
+                    self._segments.append(segment)
+                    self._latest = segment.last
+                else:
+                    segment.remove()
+            self._open(numbers[-1] if numbers else 1, recover=True)
+            kept = sum(segment.count for segment in self._segments)
+            kept += len(self._entries)
+        if kept:
+            self.log.info("Opened inbox of %d messages.", kept)
+        return kept
+
+    def start(self):
+        """Open the segments, and begin the syncing thread."""
+        self.load()
+        self._running = True
+        self._thread.start()
+
+    def stop(self):
+        """Stop the syncing thread, and close the newest segment."""
+        self._running = False
+        if self._thread.is_alive():
+            self._thread.join()
+        with self._writing:
+            self._seal()
+        with self._lock:
+            if self._log:
+                self._log.close()
+
+    def add(self, sender, message):
+        """
+        Keep a received message.
+
+        :param sender: Ident of the sender.
+        :param message: The message.
+        :return: The time the message was received, which never goes back.
+        """
+        with self._lock:
+            received = max(time(), self._latest)
+            offset = self._log.append(pickle.dumps((received, sender, message),
+                                                   CFG_PICKLE_PROTOCOL))
+            self._entries.append((received, sender, offset))
+            self._senders.setdefault(sender, []).append((received, offset))
+            self._latest = received
+            self._dirty = True
+            self.count_added += 1
+            if self._log.size() >= self.segment_size:
+                self._roll()
+        return received
+
+    def query(self, sender=None, since=None, until=None, limit=None):
+        """
+        Find received messages.
+
+        :param sender: Ident of the sender, or None for any sender.
+        :param since: Earliest time received, in seconds since the epoch.
+        :param until: Latest time received.
+        :param limit: Most messages to return, the latest being kept.
+        :return: List of tuples of the time received, sender and message, in
+            order of time.
+        """
+        since = since or 0
+        until = float('inf') if until is None else until
+        found = []
+        with self._lock:
+            self._log.flush()
+            sources = [(self._log.path, self._find)]
+            sources.extend(
+                (log.path, partial(_find, entries, senders))
+                for log, entries, senders in reversed(self._full))
+            sources.extend((segment.path, segment.find)
+                           for segment in reversed(self._segments))
+            for path, find in sources:
+                offsets = find(sender, since, until)
+                if limit is not None:
+                    needed = limit - len(found)
+                    if needed <= 0:
+                        break
+                    offsets = offsets[max(len(offsets) - needed, 0):]
+                if offsets:
+                    found.extend(reversed(_read(path, offsets)))
+        found.reverse()
+        return found
+
+    def delete(self, sender=None, until=None):
+        """
+        Delete received messages.
+
+        The segments holding any are rewritten without them.
+
+        :param sender: Ident of the sender, or None for any sender.
+        :param until: Latest time received, or None for any time.
+        :return: The number of messages deleted.
+        """
+        until = float('inf') if until is None else until
+        match = lambda values: (values[0] <= until and
+                                (sender is None or values[1] == sender))
+        deleted = 0
+        with self._writing:
+            self._seal()
+            with self._lock:
+                for segment in list(self._segments):
+                    if not segment.find(sender, 0, until):
+                        continue
+                    records = [values for _, values in _scan(segment.path)]
+                    kept = [values for values in records if not match(values)]
+                    deleted += len(records) - len(kept)
+                    index = self._segments.index(segment)
+                    if kept:
+                        entries = _write_segment(segment.path, kept)
+                        self._segments[index] = Segment.seal(segment.path,
+                                                             entries)
+                    else:
+                        segment.remove()
+                        del self._segments[index]
+                if self._find(sender, 0, until):
+                    self._log.close()
+                    records = [values for _, values in _scan(self._log.path)]
+                    kept = [values for values in records if not match(values)]
+                    deleted += len(records) - len(kept)
+                    _write_segment(self._log.path, kept)
+                    self._open(self._number)
+                self.count_deleted += deleted
+        return deleted
+
+    def compact(self):
+        """
+        Drop old segments and merge small ones.
+
+        Merged segments are written aside, then renamed over the first of
+        them before the second is removed, so a crash in between leaves its
+        messages twice. Only the renames are done with the lock held.
+        """
+        with self._writing:
+            self._seal()
+            with self._lock:
+                self._expire(time() - self.max_age)
+            number = 0
+            while number + 1 < len(self._segments):
+                first, second = self._segments[number:number + 2]
+                if first.size + second.size > self.segment_size:
+                    number += 1
+                    continue
+                records = [values for path in (first.path, second.path)
+                           for _, values in _scan(path)]
+                temp_path = first.path + '.tmp'
+                merged = Segment.seal(temp_path,
+                                      _write_segment(temp_path, records))
+                with self._lock:
+                    os.rename(merged.path, first.path)
+                    os.rename(merged.index_path, first.index_path)
+                    self._segments[number] = Segment(first.path)
+                    del self._segments[number + 1]
+                    self.count_merged += 1
+                second.remove()
+
+    def metrics(self):
+        """
+        Statistics of the inbox.
+
+        :return: Dictionary of the segments and messages kept, and the bytes
+            they take, and the messages added, deleted and expired.
+        """
+        with self._lock:
+            return {
+                'segments': len(self._segments) + len(self._full) + 1,
+                'messages': (len(self._entries) + sum(
+                    len(entries) for _, entries, _ in self._full) + sum(
+                        segment.count for segment in self._segments)),
+                'bytes': self._size(),
+                'added': self.count_added,
+                'deleted': self.count_deleted,
+                'expired': self.count_expired,
+                'merged': self.count_merged,
+            }
+
+    def _path(self, number):
+        """Path of a segment."""
+        return os.path.join(self.directory, '%08d.seg' % number)
+
+    def _size(self):
+        """Bytes of all the segments."""
+        return (self._log.size()
+                + sum(log.size() for log, _, _ in self._full)
+                + sum(segment.size for segment in self._segments))
+
+    def _restore(self, path):
+        """
+        Open a full segment, rebuilding its index if it doesn't match.
+
+        :param path: Path of the segment.
+        :return: The :class:`Segment`.
+        """
+        try:
+            segment = Segment(path)
+            if segment.size == os.path.getsize(path):
+                return segment
+        except (IOError, OSError, struct.error):
+            pass
+        self.log.warning("Rebuilding index of %s", path)
+        entries = [(values[0], values[1], offset)
+                   for offset, values in _scan(path)]
+        return Segment.seal(path, entries)
+
+    def _open(self, number, recover=False):
+        """
+        Open the newest segment, indexing any records it holds.
+
+        :param number: Number of the segment.
+        :param recover: If True, cut off a partly written record.
+        """
+        path = self._path(number)
+        self._number = number
+        self._entries = []
+        self._senders = {}
+        end = 0
+        for offset, values in _scan(path):
+            self._entries.append((values[0], values[1], offset))
+            self._senders.setdefault(values[1], []).append((values[0],
+                                                            offset))
+            self._latest = max(self._latest, values[0])
+            end = offset
+        if recover and os.path.exists(path):
+            if self._entries:
+                with open(path, 'rb') as handle:
+                    handle.seek(end)
+                    length = struct.unpack(CFG_STRUCT_FMT,
+                                           handle.read(HEADER_SIZE))[0]
+                end += HEADER_SIZE + length
+            if os.path.getsize(path) > end:
+                self.log.warning("Cutting partial record from %s", path)
+                with open(path, 'r+b') as handle:
+                    handle.truncate(end)
+        self._log = RecordLog(path)
+
+    def _roll(self):
+        """
+        Begin a new segment, leaving the full one to be sealed by
+        :func:`_seal`. Lock must be held.
+        """
+        self._log.flush()
+        self._full.append((self._log, self._entries, self._senders))
+        self._open(self._number + 1)
+
+    def _seal(self):
+        """
+        Sync the full segments and write their indexes, then swap them in
+        as :class:`Segment`. `_writing` must be held, and not the lock.
+        """
+        with self._lock:
+            full = list(self._full)
+        for log, entries, senders in full:
+            log.close()
+            segment = Segment.seal(log.path, entries)
+            with self._lock:
+                self._full.remove((log, entries, senders))
+                self._segments.append(segment)
+
+    def _find(self, sender, since, until):
+        """
+        Find records in the newest segment, see :func:`Segment.find`.
+        """
+        return _find(self._entries, self._senders, sender, since, until)
+
+    def _expire(self, oldest):
+        """
+        Drop segments of old messages, and segments over the size limit.
+
+        The newest segment is never dropped.
+
+        :param oldest: Time received of the oldest message to keep.
+        """
+        size = self._size()
+        while self._segments and (self._segments[0].last < oldest or
+                                  size > self.max_size):
+            segment = self._segments.pop(0)
+            segment.remove()
+            size -= segment.size
+            self.count_expired += segment.count
+
+    def _syncing(self):
+        """
+        Sync the newest segment, and compact the inbox now and then.
+
+        This method is the target of `self._thread`
+        """
+        compacted = time()
+        while self._running:
+            with self._writing:
+                with self._lock:
+                    log, dirty = self._log, self._dirty
+                    self._dirty = False
+                if dirty:
+                    log.sync()
+                self._seal()
+            if time() - compacted >= self.compact_interval:
+                compacted = time()
+                try:
+                    self.compact()
+                except (IOError, OSError) as exc:
+                    self.log.error("Couldn't compact the inbox: %s", exc)
+            sleep(self.sync_interval)
+        self.log.debug("Inbox sync thread stopped.")
+
+
+def _find(entries, senders, sender, since, until):
+    """
+    Find records in a segment indexed in memory, see :func:`Segment.find`.
+
+    :param entries: List of tuples of the time received, sender and offset
+        of each record.
+    :param senders: Dictionary of lists of tuples of the time received and
+        offset of each record, by sender.
+    """
+    if sender is not None:
+        entries = senders.get(sender, [])
+    offsets = []
+    for number in xrange(bisect_left(entries, (since,)), len(entries)):
+        if entries[number][0] > until:
+            break
+        offsets.append(entries[number][-1])
+    return offsets
+
+
+def _entry(mapped, number):
+    """
+    Read an entry of an index.
+
+    :param mapped: The memory mapped index.
+    :param number: Number of the entry.
+    :return: Tuple of the sender, time received and offset.
+    """
+    sender, received, offset = ENTRY.unpack_from(
+        mapped, INDEX_HEADER.size + number * ENTRY.size)
+    return sender.rstrip('\0'), received, offset
+
+
+def _scan(path):
+    """
+    Read the records of a segment.
+
+    :param path: Path of the segment.
+    :return: Generator of tuples of the offset, and a tuple of the time
+        received, sender and message.
+    """
+    for offset, record in read_records_at(path):
+        yield offset, pickle.loads(record)
+
+
+def _read(path, offsets):
+    """
+    Read records of a segment.
+
+    :param path: Path of the segment.
+    :param offsets: Offsets of the records to read.
+    :return: List of tuples of the time received, sender and message.
+    """
+    with open(path, 'rb') as handle:
+        mapped = mmap.mmap(handle.fileno(), 0, access=mmap.ACCESS_READ)
+    try:
+        found = []
+        for offset in offsets:
+            start = offset + HEADER_SIZE
+            length = struct.unpack(CFG_STRUCT_FMT, mapped[offset:start])[0]
+            found.append(pickle.loads(mapped[start:start + length]))
+        return found
+    finally:
+        mapped.close()
+
+
+def _write_segment(path, records):
+    """
+    Atomically replace a segment.
+
+    :param path: Path of the segment.
+    :param records: List of tuples of the time received, sender and message.
+    :return: List of tuples of the time received, sender and offset of each
+        record, to index the segment with.
+    """
+    entries = []
+    data = []
+    offset = 0
+    for received, sender, message in records:
+        record = pickle.dumps((received, sender, message),
+                              CFG_PICKLE_PROTOCOL)
+        entries.append((received, sender, offset))
+        data.append(record)
+        offset += HEADER_SIZE + len(record)
+    write_records(path, data)
+    return entries
@@ -0,0 +1,181 @@
+# -*- coding: utf-8 -*-
+## This file is part of DistrIM.
+##
+## DistrIM is a DHT-based network for secured messaging.
+##
+##     Author: Graham Armstrong
+## Student ID: 11004764
+##      Email: graham.armstrong@northumbria.ac.uk
+##
+## Product for CM0645 Individual Project, academic year 2014/15.
+##
+## This product has been developed in partial fulfilment of the regulations
+## governing the award of the Degree of BSc (Honours) Computer Science
+## at the University of Northumbria at Newcastle.
+
+
+
+"""
+    Key Store, persists the identity of a node between runs.
+"""
+
+import os
+
+from time import time
+from threading import Thread, Lock
+from Crypto.PublicKey import RSA
+
+from .assets.errors import CipherError
+from .utils.config import CFG_KEY_LENGTH, CFG_KEY_SPARES
+from .utils.utilities import CipherWrap
+
+
+class KeyStore(object):
+    """
+    Stores the key pair of a node so that its ident survives a restart.
+
+    The key pair is kept as a PEM file, optionally encrypted with a
+    passphrase. Generating a key pair is slow, so spare key pairs are
+    generated in the background and kept alongside it. When a new identity is
+    wanted, :func:`rotate` promotes a spare instead of generating one.
+    """
+    def __init__(self, parent_log, data_dir, passphrase=None):
+        """
+        :param parent_log: logger object from Node instance.
+        :param data_dir: Directory to keep the key files in.
+        :param passphrase: If given, key files are encrypted with this.
+        """
+        self.log = parent_log.getChild(__name__.rpartition('.')[2])
+        self.key_path = os.path.join(data_dir, 'identity.pem')
+        self.spares_dir = os.path.join(data_dir, 'spares')
+        self.passphrase = passphrase
+        self._spares_lock = Lock()
+        self._thread = None
+        if not os.path.isdir(self.spares_dir):
+            os.makedirs(self.spares_dir)
+
+    def load(self):
+        """
+        Load the stored key pair.
+
+        :return: A :class:`CipherWrap` of the key pair, or `None` if no key
+            pair has been stored.
+        """
+        if not os.path.exists(self.key_path):
+            return None
+        return self._read(self.key_path)
+
+    def load_or_create(self):
+        """
+        Load the stored key pair, or create and store one if there is none.
+
+        :return: A :class:`CipherWrap` of the key pair.
+        """
+        keys = self.load()
+        if keys:
+            self.log.debug("Loaded stored identity.")
+            return keys
+        return self.rotate()
+
+    def rotate(self):
+        """
+        Replace the stored key pair with a new one.
+
+        A spare key pair is used if there is one, else one is generated.
+
+        :return: A :class:`CipherWrap` of the new key pair.
+        """
+        keys = self._take_spare()
+        if not keys:
+            self.log.info("No spare identity, generating a new one.")
+            keys = CipherWrap(RSA.generate(CFG_KEY_LENGTH))
+        self._write(self.key_path, keys)
+        return keys
+
+    def spares(self):
+        """
+        Get the paths of the spare key pairs.
+
+        :return: Sorted list of file paths.
+        """
+        return sorted(os.path.join(self.spares_dir, name)
+                      for name in os.listdir(self.spares_dir)
+                      if name.endswith('.pem'))
+
+    def pregenerate(self):
+        """
+        Generate spare key pairs in a background thread until there are
+        `CFG_KEY_SPARES` of them.
+        """
+        if self._thread and self._thread.is_alive():
+            return
+        self._thread = Thread(target=self._generating,
+                              name='Thread-KeyGenerator')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _take_spare(self):
+        """
+        Remove the oldest spare key pair from the store.
+
+        :return: A :class:`CipherWrap` of the key pair, or `None` if there
+            are no spares.
+        """
+        with self._spares_lock:
+            for path in self.spares():
+                try:
+                    keys = self._read(path)
+                except CipherError as exc:
+                    self.log.error("Discarding spare identity: %s",
+                                   exc.message)
+                    keys = None
+                os.remove(path)
+                if keys:
+                    return keys
+        return None
+
+    def _generating(self):
+        """
+        Generate spare key pairs.
+
+        This method is the target of `self._thread`
+        """
+        while len(self.spares()) < CFG_KEY_SPARES:
+            keys = CipherWrap(RSA.generate(CFG_KEY_LENGTH))
+            with self._spares_lock:
+                name = 'spare-%.6f.pem' % (time(),)
+                self._write(os.path.join(self.spares_dir, name), keys)
+        self.log.debug("Spare identities ready.")
+
+    def _read(self, path):
+        """
+        Read a key pair from a file.
+
+        :param path: Path of the PEM file.
+        :return: A :class:`CipherWrap` of the key pair.
+        """
+        with open(path, 'rb') as handle:
+            pem = handle.read()
+        try:
+            return CipherWrap(RSA.importKey(pem, self.passphrase))
+        except (ValueError, IndexError, TypeError):
+            raise CipherError("Can't read key pair from '%s', wrong "
+                              "passphrase?" % (path,))
+
+    def _write(self, path, keys):
+        """
+        Atomically write a key pair to a file only readable by this user.
+
+        :param path: Path of the PEM file.
+        :param keys: A :class:`CipherWrap` of the key pair.
+        """
+        pem = keys.rsa_instance.exportKey('PEM', self.passphrase)
+        temp_path = path + '.tmp'
+        handle = os.open(temp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC,
+                         0600)
+        try:
+            os.write(handle, pem)
+            os.fsync(handle)
+        finally:
+            os.close(handle)
+        os.rename(temp_path, path)
@@ -0,0 +1,336 @@
+# -*- coding: utf-8 -*-
+## This file is part of DistrIM.
+##
+## DistrIM is a DHT-based network for secured messaging.
+##
+##     Author: Graham Armstrong
+## Student ID: 11004764
+##      Email: graham.armstrong@northumbria.ac.uk
+##
+## Product for CM0645 Individual Project, academic year 2014/15.
+##
+## This product has been developed in partial fulfilment of the regulations
+## governing the award of the Degree of BSc (Honours) Computer Science
+## at the University of Northumbria at Newcastle.
+
+
+
+"""
+    Mailboxes, store and forward of messages for offline nodes.
+
+    A message for a node that is down is encrypted for it alone, as an onion
+    of one layer, and left at the nodes closest to its ident. The node
+    collects its mail from them when it next joins the network.
+"""
+
+import os
+import pickle
+
+from time import time
+from heapq import heappush, heappop
+from collections import OrderedDict
+from threading import Lock
+
+from .onion import build_onion, OnionLayer
+from .protocol import MessageHandler
+from .assets.errors import (SockWrapError, ProtocolError, MailboxError,
+                            FingerError, HashMissmatchError)
+from .utils.config import (CFG_PICKLE_PROTOCOL, CFG_MAIL_REPLICAS,
+                           CFG_MAIL_TTL, CFG_MAILBOX_ITEMS, CFG_MAILBOX_SIZE,
+                           CFG_MAIL_STORE_SIZE)
+
+
+class MailStore(object):
+    """
+    Mail held by this node for offline nodes.
+
+    Messages are held for at most `ttl` seconds. A node may be left at most
+    `box_items` messages and `box_size` bytes, and all the mail held takes
+    at most `size` bytes, so a flood of mail for one node or many can't
+    fill this node's memory. Mail that doesn't fit is refused, and the
+    sender leaves it with other nodes.
+    """
+    def __init__(self, ttl=CFG_MAIL_TTL, box_items=CFG_MAILBOX_ITEMS,
+                 box_size=CFG_MAILBOX_SIZE, size=CFG_MAIL_STORE_SIZE):
+        """
+        :param ttl: Most seconds a message is held for.
+        :param box_items: Most messages held for one node.
+        :param box_size: Most bytes held for one node.
+        :param size: Most bytes held for all nodes.
+        """
+        self.ttl = ttl
+        self.box_items = box_items
+        self.box_size = box_size
+        self.size = size
+        self._boxes = {}
+        self._box_sizes = {}
+        self._expiry = []
+        self._held = 0
+        self._lock = Lock()
+
+        self.count_stored = 0
+        self.count_refused = 0
+        self.count_fetched = 0
+        self.count_expired = 0
+
+    def store(self, ident, item_id, item, ttl):
+        """
+        Hold a message for an offline node.
+
+        :param ident: Ident of the offline node.
+        :param item_id: ID of the message.
+        :param item: Tuple of the header and payload of the message.
+        :param ttl: Seconds the sender asks for the message to be held.
+        :return: True if the message is held, False if it's refused.
+        """
+        size = sum(len(part) for part in item)
+        with self._lock:
+            self._purge(time())
+            box = self._boxes.setdefault(ident, OrderedDict())
+            if item_id in box:
+                return True
+            box_size = self._box_sizes.get(ident, 0)
+            if (len(box) >= self.box_items
+                    or box_size + size > self.box_size
+                    or self._held + size > self.size):
+                self.count_refused += 1
+                if not box:
+                    del self._boxes[ident]
+                return False
+            expires = time() + min(ttl, self.ttl)
+            box[item_id] = (expires, item)
+            heappush(self._expiry, (expires, ident, item_id))
+            self._box_sizes[ident] = box_size + size
+            self._held += size
+            self.count_stored += 1
+            return True
+
+    def peek(self, ident):
+        """
+        Get the mail held for a node, without dropping it.
+
+        :param ident: Ident of the node.
+        :return: List of tuples of the ID and item of each message, oldest
+            first.
+        """
+        with self._lock:
+            self._purge(time())
+            box = self._boxes.get(ident, {})
+            return [(item_id, item) for item_id, (_, item) in box.items()]
+
+    def take(self, ident, item_ids):
+        """
+        Drop mail that a node has collected.
+
+        :param ident: Ident of the node.
+        :param item_ids: IDs of the messages collected.
+        """
+        with self._lock:
+            for item_id in item_ids:
+                if self._drop(ident, item_id):
+                    self.count_fetched += 1
+
+    def metrics(self):
+        """
+        Statistics of the mail held.
+
+        :return: Dictionary of the nodes held for, the messages and bytes
+            held, and the messages stored, refused, fetched and expired.
+        """
+        with self._lock:
+            return {
+                'boxes': len(self._boxes),
+                'items': sum(len(box) for box in self._boxes.values()),
+                'bytes': self._held,
+                'stored': self.count_stored,
+                'refused': self.count_refused,
+                'fetched': self.count_fetched,
+                'expired': self.count_expired,
+            }
+
+    def _purge(self, now):
+        """
+        Drop messages held past their time. Must be called with `_lock` held.
+
+        :param now: The current time.
+        """
+        while self._expiry and self._expiry[0][0] <= now:
+            _, ident, item_id = heappop(self._expiry)
+            if self._drop(ident, item_id):
+                self.count_expired += 1
+
+    def _drop(self, ident, item_id):
+        """
+        Drop a message. Must be called with `_lock` held.
+
+        :param ident: Ident of the node it's held for.
+        :param item_id: ID of the message.
+        :return: True if it was held, else False.
+        """
+        box = self._boxes.get(ident)
+        if not box or item_id not in box:
+            return False
+        size = sum(len(part) for part in box.pop(item_id)[1])
+        self._held -= size
+        self._box_sizes[ident] -= size
+        if not box:
+            del self._boxes[ident]
+            del self._box_sizes[ident]
+        return True
+
+
+class Mailboxes(object):
+    """
+    Mail left by this node for offline nodes, and collected for this node.
+
+    Each message is left with the `replicas` nodes closest to the ident of
+    its recipient, which may include this node, so it survives some of them
+    leaving. The recipient collects from twice as many of the nodes closest
+    to it, since the sender may have known of nodes it doesn't, and drops
+    the copies it has already had.
+
+    Mail held for other nodes is kept in `held`, see :class:`MailStore`.
+    """
+    def __init__(self, parent_log, fingerspace, local_finger, local_keys,
+                 perform, deliver, replicas=CFG_MAIL_REPLICAS,
+                 ttl=CFG_MAIL_TTL):
+        """
+        :param parent_log: Logger of the :class:`ConnectionsManager`.
+        :param fingerspace: The FingerSpace instance of this node.
+        :param local_finger: The Finger of this node.
+        :param local_keys: The CipherWrapper of this node.
+        :param perform: Called with a :class:`MessageHandler`, the name of a
+            procedure and its arguments to run it, returning its result.
+        :param deliver: Called with the ident of the sender and the message
+            for each message collected.
+        :param replicas: Nodes each message is left with.
+        :param ttl: Seconds messages are asked to be held for.
+        """
+        self.log = parent_log.getChild(__name__.rpartition('.')[2])
+        self.fingerspace = fingerspace
+        self.local_finger = local_finger
+        self.local_keys = local_keys
+        self.perform = perform
+        self.deliver = deliver
+        self.replicas = replicas
+        self.ttl = ttl
+        self.held = MailStore()
+
+        self.count_deposited = 0
+        self.count_collected = 0
+        self.count_unreadable = 0
+
+    def deposit(self, recipient, message):
+        """
+        Leave a message for an offline node.
+
+        Raises a :class:`MailboxError` if no node would hold it.
+
+        :param recipient: Finger of the recipient.
+        :param message: The message.
+        :return: The number of nodes holding the message.
+        """
+        contents = {'SENDER': self.local_finger.all, 'MESSAGE': message,
+                    'SENT': time()}
+        item = build_onion([recipient],
+                           pickle.dumps(contents, CFG_PICKLE_PROTOCOL))
+        item_id = os.urandom(8).encode('hex')
+        holders = 0
+        for finger in self.fingerspace.get_closest(recipient.ident,
+                                                   self.replicas):
+            if finger == self.local_finger:
+                stored = self.held.store(recipient.ident, item_id, item,
+                                         self.ttl)
+            else:
+                handler = MessageHandler(self.log, self.fingerspace,
+                                         self.local_finger, self.local_keys,
+                                         finger)
+                try:
+                    stored = self.perform(handler, 'store', recipient.ident,
+                                          item_id, item, self.ttl)
+                except (SockWrapError, ProtocolError) as exc:
+                    self.log.warning("Couldn't leave mail with %s: %s",
+                                     finger.ident, exc.message)
+                    if isinstance(exc, SockWrapError):
+                        self.fingerspace.dead.mark(finger.ident)
+                    continue
+            holders += int(bool(stored))
+        if not holders:
+            raise MailboxError("No node would hold mail for %s."
+                               % (recipient.ident,))
+        self.log.info("Left mail for %s with %d nodes", recipient.ident,
+                      holders)
+        self.count_deposited += 1
+        return holders
+
+    def collect(self):
+        """
+        Collect the mail left for this node, and deliver it.
+
+        Each node holding mail hands over all of it at once. The messages
+        are delivered in the order they were sent.
+
+        :return: The number of messages delivered.
+        """
+        collected = {}
+        for finger in self.fingerspace.get_closest(self.local_finger.ident,
+                                                   self.replicas * 2):
+            if finger == self.local_finger:
+                continue
+            handler = MessageHandler(self.log, self.fingerspace,
+                                     self.local_finger, self.local_keys,
+                                     finger)
+            try:
+                items = self.perform(handler, 'fetch')
+            except (SockWrapError, ProtocolError) as exc:
+                self.log.warning("Couldn't collect mail from %s: %s",
+                                 finger.ident, exc.message)
+                continue
+            for item_id, item in items:
+                if item_id not in collected:
+                    collected[item_id] = self._open(item)
+        messages = sorted(contents for contents in collected.values()
+                          if contents)
+        for _, sender, message in messages:
+            self.deliver(sender[-1], message)
+        if messages:
+            self.log.info("Collected %d messages", len(messages))
+        self.count_collected += len(messages)
+        return len(messages)
+
+    def metrics(self):
+        """
+        Statistics of the mail left and collected by this node.
+
+        :return: Dictionary of the messages deposited, collected and found
+            unreadable.
+        """
+        return {
+            'deposited': self.count_deposited,
+            'collected': self.count_collected,
+            'unreadable': self.count_unreadable,
+        }
+
+    def _open(self, item):
+        """
+        Decrypt a message collected, and note its sender.
+
+        :param item: Tuple of the header and payload of the message.
+        :return: Tuple of the time sent, the values of the sender's finger
+            and the message, or None if it couldn't be read.
+        """
+        try:
+            header, payload = item
+            contents = pickle.loads(
+                OnionLayer(self.local_keys, header).decrypt(payload))
+            sender = contents['SENDER']
+        except Exception:  # pylint: disable=broad-except
+            # Garbage from the wrong key can fail to unpickle in many ways.
+            self.log.warning("Collected mail that couldn't be read.")
+            self.count_unreadable += 1
+            return None
+        try:
+            self.fingerspace.put(*sender)
+        except (FingerError, HashMissmatchError, TypeError) as exc:
+            self.log.warning("Mail from an invalid sender: %s", exc)
+        return contents['SENT'], sender, contents['MESSAGE']
@@ -19,15 +19,25 @@
 """
 
 
+import os
+
+from time import time
 from Crypto.PublicKey import RSA
 from datetime import datetime as dto
 
-from .connections import ConnectionsManager
+from .connections import ConnectionsManager, AsyncConnectionsManager
+from .cryptopool import CryptoPool, PooledCipher
 from .fingerspace import Finger, FingerSpace
+from .keystore import KeyStore
+from .outbox import Outbox
+from .snapshot import FingerStore
 
-from .utils.config import CFG_LISTENING_PORT, CFG_LOGGER_PORT, CFG_KEY_LENGTH
-from .utils.logger import create_logger
+from .utils.config import (CFG_LISTENING_PORT, CFG_LOGGER_PORT,
+                           CFG_KEY_LENGTH, CFG_LISTENER_PROCESSES,
+                           CFG_CRYPTO_PROCESSES)
+from .utils.logger import create_logger, add_remote_handler
 from .utils.utilities import CipherWrap
+from .assets.errors import FingerSpaceError
 
 
 class Node(object):
@@ -35,7 +45,10 @@ class Node(object):
     Representation of a single Node in the DistrIM network.
     """
     def __init__(self, local_ip, local_port=CFG_LISTENING_PORT, log_ip='',
-                 log_port=CFG_LOGGER_PORT):
+                 log_port=CFG_LOGGER_PORT, data_dir='', passphrase=None,
+                 new_identity=False, event_loop=False,
+                 processes=CFG_LISTENER_PROCESSES,
+                 crypto_processes=CFG_CRYPTO_PROCESSES):
         """
         A node within the peer-to-peer network.
 
@@ -43,57 +56,211 @@ class Node(object):
         :param local_port: Listening port of this node.
         :param log_ip: IP address of a remote logger.
         :param log_port: Port of the remote logger.
+        :param data_dir: Directory to persist the key pair, FingerSpace,
+            outbox and inbox in. If not given, nothing is kept between runs,
+            and messages are sent straight away.
+        :param passphrase: Passphrase to encrypt the stored key pair with.
+        :param new_identity: If True, replace the stored key pair.
+        :param event_loop: If True, handle connections in an event loop
+            rather than with a pool of threads.
+        :param processes: Number of extra processes to listen for
+            connections in.
+        :param crypto_processes: Number of processes to decrypt in, 0 to
+            decrypt inline, or None for one per CPU.
         """
         self.local_ip = local_ip
         self.local_port = local_port
+        self.data_dir = data_dir
+        if data_dir and not os.path.isdir(data_dir):
+            os.makedirs(data_dir)
+        # Get Logging!
+        # __name__ is distrim.node
+        self.log = create_logger(__name__)
+
         # Cryptographic Settings
         # https://pythonhosted.org/pycrypto/
-        crypto_key = RSA.generate(CFG_KEY_LENGTH)
-        self.keys = CipherWrap(crypto_key)
+        self.keystore = None
+        if data_dir:
+            self.keystore = KeyStore(self.log, data_dir, passphrase)
+            if new_identity:
+                self.keys = self.keystore.rotate()
+            else:
+                self.keys = self.keystore.load_or_create()
+        else:
+            crypto_key = RSA.generate(CFG_KEY_LENGTH)
+            self.keys = CipherWrap(crypto_key)
 
         # Identity
         self.finger = Finger(local_ip, local_port,
                              self.keys.export(text=False, key_type=0))
 
-        # Get Logging!
-        # __name__ is distrim.node
-        self.log = create_logger(__name__, log_ip, log_port,
-                                 ident=self.finger.ident)
+        # The remote logger identifies messages by the node's ident
+        if log_ip:
+            add_remote_handler(self.log, log_ip, log_port, self.finger.ident)
 
         self.fingerspace = FingerSpace(self.log, self.finger)
-        self.conn_manager = ConnectionsManager(self.log, local_ip, local_port,
-                                               self.fingerspace, self.finger,
-                                               self.keys)
+        self.store = None
+        if data_dir:
+            self.store = FingerStore(self.log, self.fingerspace, data_dir)
+            self.store.load()
+        self.crypto = None
+        local_keys = self.keys
+        if crypto_processes != 0:
+            self.crypto = CryptoPool(self.log, self.keys, crypto_processes)
+            local_keys = PooledCipher(self.keys, self.crypto)
+        manager = AsyncConnectionsManager if event_loop else ConnectionsManager
+        self.conn_manager = manager(self.log, local_ip, local_port,
+                                    self.fingerspace, self.finger, local_keys,
+                                    processes, data_dir)
+        self.outbox = None
+        if data_dir:
+            self.outbox = Outbox(self.log, data_dir, self._send_queued)
 
     def start(self, remote_ip='', remote_port=CFG_LISTENING_PORT):
         """
+        Start the node and join the network.
+
+        If no bootstrap node is given but fingers were loaded from a previous
+        run, then the node rejoins through one of those. Once joined, the
+        mail left for the node while it was offline is collected.
+
         :param remote_ip: IP address of a remote note to bootstrap against.
         :param remote_port: Listening port of the remote node.
         """
         self.log.info("Node started %s @ %s:%d", self.finger.ident,
                       self.local_ip, self.local_port)
         self.start_time = dto.now()
+        if self.crypto:
+            self.crypto.start()
+        if self.keystore:
+            self.keystore.pregenerate()
+        if self.store:
+            self.store.start()
         self.conn_manager.start()
         if remote_ip:
             self.log.info("Boostrapping to %s:%d", remote_ip, remote_port)
             self.conn_manager.bootstrap(remote_ip, remote_port)
+        elif len(self.fingerspace):
+            self.log.info("Rejoining through known nodes")
+            self.conn_manager.rejoin()
+        if len(self.fingerspace):
+            self.conn_manager.mailboxes.collect()
+        if self.outbox:
+            self.outbox.start()
 
     def stop(self):
         """
         Stop the node and exit from the network.
         """
         self.log.info("Node Stopping...")
+        if self.outbox:
+            self.outbox.stop()
         self.conn_manager.stop()
+        if self.store:
+            self.store.stop()
+        if self.crypto:
+            self.crypto.stop()
 
     def send_message(self, recipient, message):
         """
         Send a message.
 
+        If the node has an outbox, the message is queued in it and sent in
+        the background, see :class:`Outbox`. A recipient that has left can
+        still be sent to, the message being left in its mailboxes.
+
         :param recipient: Ident of the recipient.
         :param message: The message to send.
+        :return: The ID of the message in the outbox if there is one, else
+            the ID of the delivery receipt, if one is asked for. Either can
+            be passed to :func:`wait_delivered`.
         """
-        rec = self.fingerspace.get(recipient)
+        rec = self._recipient(recipient)
         if not rec:
             self.log.error("No such node: %s", recipient)
             return
+        if self.outbox:
+            return self.outbox.enqueue(recipient, message)
         return self.conn_manager.send_message(rec, message)
+
+    def wait_delivered(self, receipt_id, timeout=None):
+        """
+        Wait for a message sent with a delivery receipt to be delivered, see
+        :func:`Receipts.wait`.
+
+        If the node has an outbox, the message is waited on to be sent
+        first, and the ID of its receipt taken from what sending it
+        returned, see :func:`Outbox.wait`.
+
+        :param receipt_id: The ID returned by :func:`send_message`.
+        :param timeout: Seconds to wait, the receipt timeout if None.
+        :return: The round trip time in seconds, or None if the message
+            hasn't been delivered.
+        """
+        receipts = self.conn_manager.receipts
+        if self.outbox:
+            started = time()
+            receipt_id = self.outbox.wait(
+                receipt_id, receipts.timeout if timeout is None else timeout)
+            if receipt_id is None:
+                return None
+            if timeout is not None:
+                timeout = max(timeout - (time() - started), 0)
+        return receipts.wait(receipt_id, timeout)
+
+    def _send_queued(self, recipient, message):
+        """
+        Send a message from the outbox.
+
+        :param recipient: Ident of the recipient.
+        :param message: The message to send.
+        :return: The ID of the delivery receipt, if one is asked for.
+        """
+        rec = self._recipient(recipient)
+        if not rec:
+            raise FingerSpaceError("No such node: %s" % (recipient,))
+        return self.conn_manager.send_message(rec, message)
+
+    def _recipient(self, ident):
+        """
+        Find the Finger of a recipient, whether it's online or has left.
+
+        :param ident: Ident of the recipient.
+        :return: The :class:`Finger`, or None if the node isn't known.
+        """
+        return (self.fingerspace.get(ident)
+                or self.fingerspace.get_departed(ident))
+
+    def read_messages(self, sender=None, since=None, until=None,
+                      limit=None):
+        """
+        Read back received messages, see :func:`Inbox.query`.
+
+        :param sender: Ident of the sender, or None for any sender.
+        :param since: Earliest time received, in seconds since the epoch.
+        :param until: Latest time received.
+        :param limit: Most messages to return, the latest being kept.
+        :return: List of tuples of the time received, sender and message, in
+            order of time. Empty if the node has no data directory.
+        """
+        inbox = self.conn_manager.inbox
+        if not inbox:
+            return []
+        return inbox.query(sender, since, until, limit)
+
+    def send_file(self, recipient, path):
+        """
+        Send a file, striped over several circuits.
+
+        :param recipient: Ident of the recipient.
+        :param path: Path of the file to send.
+        :return: True if the recipient received the file, else False.
+        """
+        rec = self.fingerspace.get(recipient)
+        if not rec:
+            self.log.error("No such node: %s", recipient)
+            return False
+        with open(path, 'rb') as handle:
+            data = handle.read()
+        return self.conn_manager.send_transfer(rec, data,
+                                               os.path.basename(path))
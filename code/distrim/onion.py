@@ -0,0 +1,139 @@
+# -*- coding: utf-8 -*-
+## This file is part of DistrIM.
+##
+## DistrIM is a DHT-based network for secured messaging.
+##
+##     Author: Graham Armstrong
+## Student ID: 11004764
+##      Email: graham.armstrong@northumbria.ac.uk
+##
+## Product for CM0645 Individual Project, academic year 2014/15.
+##
+## This product has been developed in partial fulfilment of the regulations
+## governing the award of the Degree of BSc (Honours) Computer Science
+## at the University of Northumbria at Newcastle.
+
+
+"""
+    Onion, a streaming format for relaying large packages.
+
+    Each layer of the onion is a small header, encrypted with the RSA key of
+    the node it is for, followed by the payload, encrypted with AES in
+    counter mode under a key given in the header::
+
+        layer = header + AES(next header + next payload)
+
+    A relaying node decrypts its header first, then removes its layer of
+    the payload chunk by chunk, forwarding each chunk to the next node as
+    soon as it has arrived. Only the header and one chunk are ever held.
+"""
+
+import os
+import struct
+import pickle
+
+from Crypto.Cipher import AES
+from Crypto.Util import Counter
+
+from .assets.errors import ProtocolError
+from .utils.config import CFG_PICKLE_PROTOCOL, CFG_STRUCT_FMT
+
+HEADER_SIZE = struct.calcsize(CFG_STRUCT_FMT)
+KEY_SIZE = 16
+NONCE_SIZE = 8
+
+
+class OnionLayer(object):
+    """
+    A layer of a streamed onion, for removing it from the payload.
+    """
+    def __init__(self, local_keys, header):
+        """
+        Raises a :class:`ProtocolError` if the header isn't valid.
+
+        :param local_keys: The CipherWrapper of this node.
+        :param header: The encrypted header of the layer.
+        """
+        try:
+            contents = pickle.loads(local_keys.decrypt(header))
+            self.next = contents['NEXT']
+            self._cipher = _counter_cipher(contents['KEY'],
+                                           contents['NONCE'])
+        except Exception:  # pylint: disable=broad-except
+            # Garbage from the wrong key can fail to unpickle in many ways.
+            raise ProtocolError("Invalid onion header.")
+
+    def decrypt(self, chunk):
+        """
+        Remove the layer from the next chunk of the payload.
+
+        Chunks must be given in order, but may be of any size.
+
+        :param chunk: String of the payload.
+        :return: String of the payload inside the layer.
+        """
+        return self._cipher.decrypt(chunk)
+
+
+class HeaderReader(object):
+    """
+    Reads the header of the next layer from the start of a payload.
+
+    The header is packed with its length in front of it, in the same way
+    as :class:`SocketWrapper` frames data.
+    """
+    def __init__(self):
+        self.header = None
+        self.leftover = ''
+        self.size = None
+        self._data = ''
+
+    def feed(self, data):
+        """
+        Add data from the start of the payload.
+
+        :param data: String of the payload.
+        :return: True once the header is complete, else False.
+        """
+        self._data += data
+        if self.size is None and len(self._data) >= HEADER_SIZE:
+            length = struct.unpack(CFG_STRUCT_FMT,
+                                   self._data[:HEADER_SIZE])[0]
+            self.size = HEADER_SIZE + length
+        if self.size is None or len(self._data) < self.size:
+            return False
+        self.header = self._data[HEADER_SIZE:self.size]
+        self.leftover = self._data[self.size:]
+        return True
+
+
+def build_onion(route, package):
+    """
+    Build a streamed onion.
+
+    :param route: List of the Fingers of the nodes to pass through, in the
+        order they are passed through, the last being the recipient.
+    :param package: String of the package for the recipient.
+    :return: Tuple of the header and payload for the first node.
+    """
+    header = None
+    payload = package
+    next_values = None
+    for finger in reversed(route):
+        if header is not None:
+            payload = struct.pack(CFG_STRUCT_FMT, len(header)) + header \
+                + payload
+        key = os.urandom(KEY_SIZE)
+        nonce = os.urandom(NONCE_SIZE)
+        contents = {'NEXT': next_values, 'KEY': key, 'NONCE': nonce}
+        header = finger.get_cipher().encrypt(
+            pickle.dumps(contents, CFG_PICKLE_PROTOCOL))
+        payload = _counter_cipher(key, nonce).encrypt(payload)
+        next_values = finger.all
+    return header, payload
+
+
+def _counter_cipher(key, nonce):
+    """Create an AES cipher in counter mode."""
+    counter = Counter.new(128 - NONCE_SIZE * 8, prefix=nonce)
+    return AES.new(key, AES.MODE_CTR, counter=counter)
@@ -0,0 +1,354 @@
+# -*- coding: utf-8 -*-
+## This file is part of DistrIM.
+##
+## DistrIM is a DHT-based network for secured messaging.
+##
+##     Author: Graham Armstrong
+## Student ID: 11004764
+##      Email: graham.armstrong@northumbria.ac.uk
+##
+## Product for CM0645 Individual Project, academic year 2014/15.
+##
+## This product has been developed in partial fulfilment of the regulations
+## governing the award of the Degree of BSc (Honours) Computer Science
+## at the University of Northumbria at Newcastle.
+
+
+
+"""
+    Outbox, a durable spool of messages waiting to be sent.
+"""
+
+import os
+import pickle
+
+from time import time, sleep
+from heapq import heappush, heappop
+from itertools import chain
+from collections import OrderedDict
+from threading import Thread, Condition
+
+from .assets.errors import ExecutorError
+from .utils.config import (CFG_TIMEOUT, CFG_OUTBOX_WORKERS, CFG_OUTBOX_RETRIES,
+                           CFG_OUTBOX_RETRY_DELAY, CFG_OUTBOX_LIMIT,
+                           CFG_OUTBOX_SYNC_INTERVAL, CFG_OUTBOX_COMPACT_SIZE)
+from .utils.records import RecordLog, read_records
+
+# Results of sent messages, remembered for :func:`Outbox.wait`.
+_RESULTS_MAX = 1024
+
+
+class Outbox(object):
+    """
+    Messages queued to be sent, kept on disk until they have been.
+
+    Queueing a message appends a record to the spool, a :class:`RecordLog`
+    in the data directory, and returns without waiting on the network.
+    Records are synced to disk by a thread every `sync_interval` seconds, so
+    a burst of messages shares one `fsync`, and only those queued since the
+    last sync can be lost if the process dies.
+
+    Worker threads send the messages. One that fails is tried again after a
+    delay, doubled each time, and given up on after `retries` retries. A
+    record is appended once a message is done with, and the messages not
+    yet done with are read back from the spool when the node restarts. Once
+    the spool grows past `compact_size` it's rewritten with only those.
+    Records appended while it's rewritten go to a second spool, which is
+    joined onto the rewritten one once it's on disk, so queueing isn't held
+    up by the rewrite.
+    """
+    def __init__(self, parent_log, data_dir, send,
+                 workers=CFG_OUTBOX_WORKERS, retries=CFG_OUTBOX_RETRIES,
+                 delay=CFG_OUTBOX_RETRY_DELAY, limit=CFG_OUTBOX_LIMIT,
+                 sync_interval=CFG_OUTBOX_SYNC_INTERVAL,
+                 compact_size=CFG_OUTBOX_COMPACT_SIZE):
+        """
+        :param parent_log: logger object from Node instance.
+        :param data_dir: Directory to keep the spool in.
+        :param send: Called with the ident of the recipient and the message
+            to send it, raising an exception if it couldn't be. What it
+            returns is kept for :func:`wait`.
+        :param workers: Number of sending threads.
+        :param retries: Retries before a message is given up on.
+        :param delay: Seconds before the first retry.
+        :param limit: Most messages waiting to be sent.
+        :param sync_interval: Seconds between syncs of the spool.
+        :param compact_size: Bytes of spool before it's compacted.
+        """
+        self.log = parent_log.getChild(__name__.rpartition('.')[2])
+        self.path = os.path.join(data_dir, 'outbox.log')
+        self.next_path = self.path + '.next'
+        self.send = send
+        self.workers = workers
+        self.retries = retries
+        self.delay = delay
+        self.limit = limit
+        self.sync_interval = sync_interval
+        self.compact_size = compact_size
+        self._spool = None
+        self._compact_at = compact_size
+        self._pending = {}
+        self._results = OrderedDict()
+        self._due = []
+        self._condition = Condition()
+        self._running = False
+        self._threads = []
+        self._syncer = Thread(target=self._syncing, name='Thread-OutboxSync')
+        self._syncer.daemon = True
+
+        self.count_queued = 0
+        self.count_restored = 0
+        self.count_sent = 0
+        self.count_retried = 0
+        self.count_failed = 0
+
+    def load(self):
+        """
+        Read back the messages not done with from the spool, and compact it.
+
+        :return: The number of messages restored.
+        """
+        pending = {}
+        for record in chain(read_records(self.path),
+                            read_records(self.next_path)):
+            values = pickle.loads(record)
+            if values[0] == 'PUT':
+                pending[values[1]] = values
+            else:
+                pending.pop(values[1], None)
+        with self._condition:
+            for message_id, values in pending.items():
+                self._pending[message_id] = [values[2], values[3], 0,
+                                             values[4]]
+                heappush(self._due, (values[4], message_id))
+            self.count_restored += len(pending)
+        self._compact()
+        if pending:
+            self.log.info("Restored %d queued messages.", len(pending))
+        return len(pending)
+
+    def start(self):
+        """Load the spool, and begin the sending and syncing threads."""
+        self.load()
+        self._running = True
+        for number in xrange(self.workers):
+            worker = Thread(target=self._sending,
+                            name='Thread-Outbox-%d' % number)
+            worker.daemon = True
+            worker.start()
+            self._threads.append(worker)
+        self._syncer.start()
+
+    def stop(self):
+        """
+        Stop the threads, and sync the spool.
+
+        Messages being sent are finished, those still waiting are sent when
+        the node next starts.
+        """
+        with self._condition:
+            self._running = False
+            self._condition.notify_all()
+        for thread in self._threads + [self._syncer]:
+            if thread.is_alive():
+                thread.join(CFG_TIMEOUT)
+        with self._condition:
+            if self._spool:
+                self._spool.close()
+                self._spool = None
+
+    def enqueue(self, recipient, message):
+        """
+        Queue a message to be sent.
+
+        Raises an :class:`ExecutorError` if the outbox is stopped or full.
+
+        :param recipient: Ident of the recipient.
+        :param message: The message to send.
+        :return: The ID of the queued message.
+        """
+        message_id = os.urandom(8).encode('hex')
+        queued = time()
+        record = pickle.dumps(('PUT', message_id, recipient, message, queued),
+                              pickle.HIGHEST_PROTOCOL)
+        with self._condition:
+            if not self._running:
+                raise ExecutorError("Outbox has been stopped.")
+            if len(self._pending) >= self.limit:
+                raise ExecutorError("Outbox is full.")
+            self._spool.append(record)
+            self._pending[message_id] = [recipient, message, 0, queued]
+            heappush(self._due, (queued, message_id))
+            self.count_queued += 1
+            self._condition.notify()
+        return message_id
+
+    def wait(self, message_id, timeout=CFG_TIMEOUT):
+        """
+        Wait for a queued message to be done with.
+
+        :param message_id: ID of the message, from :func:`enqueue`.
+        :param timeout: Most seconds to wait.
+        :return: What `send` returned for the message, or None if it hasn't
+            been sent.
+        """
+        deadline = time() + timeout
+        with self._condition:
+            while message_id in self._pending and time() < deadline:
+                self._condition.wait(deadline - time())
+            return self._results.get(message_id)
+
+    def metrics(self):
+        """
+        Get the metrics of the outbox.
+
+        :return: Dictionary of the number of messages waiting, and the counts
+            of messages.
+        """
+        with self._condition:
+            return {'waiting': len(self._pending),
+                    'queued': self.count_queued,
+                    'restored': self.count_restored,
+                    'sent': self.count_sent,
+                    'retried': self.count_retried,
+                    'failed': self.count_failed}
+
+    def _next(self):
+        """
+        Wait for a message to be due. Lock must be held.
+
+        :return: Tuple of its ID, recipient, message and attempts, or None
+            if the outbox has been stopped.
+        """
+        while self._running:
+            if not self._due:
+                self._condition.wait(1)
+                continue
+            due, message_id = self._due[0]
+            if due > time():
+                self._condition.wait(min(due - time(), 1))
+                continue
+            heappop(self._due)
+            entry = self._pending.get(message_id)
+            if entry is not None:
+                return message_id, entry[0], entry[1], entry[2]
+        return None
+
+    def _sending(self):
+        """
+        Send the messages as they fall due.
+
+        This method is the target of each sending thread.
+        """
+        while True:
+            with self._condition:
+                entry = self._next()
+            if entry is None:
+                break
+            message_id, recipient, message, attempts = entry
+            try:
+                result = self.send(recipient, message)
+            except Exception as exc:  # pylint: disable=broad-except
+                self._failed(message_id, recipient, attempts, exc)
+                continue
+            with self._condition:
+                self._done(message_id, result)
+                self.count_sent += 1
+        self.log.debug("Outbox worker stopped.")
+
+    def _failed(self, message_id, recipient, attempts, exc):
+        """
+        Retry a message that couldn't be sent, or give up on it.
+
+        :param message_id: ID of the message.
+        :param recipient: Ident of the recipient.
+        :param attempts: Attempts made before this one.
+        :param exc: The error sending failed with.
+        """
+        with self._condition:
+            if attempts >= self.retries:
+                self._done(message_id)
+                self.count_failed += 1
+                self.log.error("Giving up on message to %s after %d "
+                               "attempts: %s", recipient, attempts + 1, exc)
+                return
+            self._pending[message_id][2] = attempts + 1
+            heappush(self._due, (time() + self.delay * 2 ** attempts,
+                                 message_id))
+            self.count_retried += 1
+        self.log.warning("Message to %s failed, attempt %d: %s", recipient,
+                         attempts + 1, exc)
+
+    def _done(self, message_id, result=None):
+        """
+        Forget a message once it's done with. Lock must be held.
+
+        :param message_id: ID of the message.
+        :param result: What `send` returned, if the message was sent.
+        """
+        del self._pending[message_id]
+        self._results[message_id] = result
+        if len(self._results) > _RESULTS_MAX:
+            self._results.popitem(last=False)
+        self._condition.notify_all()
+        if self._spool:
+            self._spool.append(pickle.dumps(('DONE', message_id),
+                                            pickle.HIGHEST_PROTOCOL))
+
+    def _compact(self):
+        """
+        Rewrite the spool with only the messages not done with, including
+        those being sent.
+
+        The lock is only held to switch appends to a second spool, and to
+        join that onto the rewritten spool once it's synced. The spool is
+        next compacted once it's grown to twice this size, so a spool of
+        messages all waiting isn't rewritten over and over.
+        """
+        with self._condition:
+            entries = sorted(self._pending.items(),
+                             key=lambda item: item[1][3])
+            spool = self._spool
+            if os.path.exists(self.next_path):
+                os.remove(self.next_path)
+            self._spool = RecordLog(self.next_path)
+        if spool:
+            spool.close()
+        temp_path = self.path + '.tmp'
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        compacted = RecordLog(temp_path)
+        for message_id, entry in entries:
+            compacted.append(pickle.dumps(
+                ('PUT', message_id, entry[0], entry[1], entry[3]),
+                pickle.HIGHEST_PROTOCOL))
+        compacted.sync()
+        with self._condition:
+            spool = self._spool
+            for record in spool:
+                compacted.append(record)
+            compacted.flush()
+            os.rename(temp_path, self.path)
+            self._spool = RecordLog(self.path)
+            os.remove(self.next_path)
+            self._compact_at = max(self.compact_size,
+                                   2 * self._spool.size())
+        spool.close()
+        compacted.close()
+
+    def _syncing(self):
+        """
+        Sync the spool to disk, and compact it once it grows too large.
+
+        This method is the target of `self._syncer`
+        """
+        while self._running:
+            sleep(self.sync_interval)
+            with self._condition:
+                spool = self._spool
+                compact = spool.size() > self._compact_at
+            if compact:
+                self._compact()
+                continue
+            spool.sync()
+        self.log.debug("Outbox sync thread stopped.")
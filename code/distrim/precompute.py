@@ -0,0 +1,191 @@
+# -*- coding: utf-8 -*-
+## This file is part of DistrIM.
+##
+## DistrIM is a DHT-based network for secured messaging.
+##
+##     Author: Graham Armstrong
+## Student ID: 11004764
+##      Email: graham.armstrong@northumbria.ac.uk
+##
+## Product for CM0645 Individual Project, academic year 2014/15.
+##
+## This product has been developed in partial fulfilment of the regulations
+## governing the award of the Degree of BSc (Honours) Computer Science
+## at the University of Northumbria at Newcastle.
+
+
+"""
+    Precomputation, routes prepared in the background for likely recipients.
+"""
+
+from time import time
+from collections import OrderedDict, deque
+from threading import Thread, Condition
+
+from .utils.config import (CFG_PRECOMPUTE_STOCK, CFG_PRECOMPUTE_RECIPIENTS,
+                           CFG_PRECOMPUTE_MAX_AGE, CFG_PRECOMPUTE_IDLE)
+
+
+class Precomputer(object):
+    """
+    A stock of prepared routes for the recipients most recently sent to.
+
+    Preparing a route chooses its nodes and does the RSA work that doesn't
+    depend on the message, such as building the header of a packet or the
+    onion building a circuit. Sending to a recipient with a route in stock
+    then only has to wrap the message.
+
+    A thread refills the stock once no route has been taken for `idle`
+    seconds, so it doesn't compete with sending. Routes older than `max_age`,
+    or through a node that has left, are thrown away.
+    """
+    def __init__(self, parent_log, fingerspace, prepare,
+                 stock=CFG_PRECOMPUTE_STOCK,
+                 recipients=CFG_PRECOMPUTE_RECIPIENTS,
+                 max_age=CFG_PRECOMPUTE_MAX_AGE, idle=CFG_PRECOMPUTE_IDLE):
+        """
+        :param parent_log: Logger of the :class:`ConnectionsManager`.
+        :param fingerspace: The FingerSpace instance of this node.
+        :param prepare: Called with the Finger of a recipient to prepare a
+            route to it. The route returned has `route` and `created`
+            attributes.
+        :param stock: Routes kept for each recipient.
+        :param recipients: Most recipients routes are kept for.
+        :param max_age: Seconds a route is kept for.
+        :param idle: Seconds without a route taken before refilling.
+        """
+        self.log = parent_log.getChild(__name__.rpartition('.')[2])
+        self.fingerspace = fingerspace
+        self.prepare = prepare
+        self.stock = stock
+        self.recipients = recipients
+        self.max_age = max_age
+        self.idle = idle
+        self._routes = OrderedDict()
+        self._condition = Condition()
+        self._last_taken = 0
+        self._running = False
+        self._thread = Thread(target=self._refilling,
+                              name='Thread-Precompute')
+        self._thread.daemon = True
+
+        self.count_hits = 0
+        self.count_misses = 0
+        self.count_prepared = 0
+        self.count_discarded = 0
+
+    def start(self):
+        """Begin the refilling thread."""
+        self._running = True
+        self._thread.start()
+
+    def stop(self):
+        """End the refilling thread, and throw the stock away."""
+        with self._condition:
+            self._running = False
+            self._routes.clear()
+            self._condition.notify()
+
+    def take(self, recipient):
+        """
+        Take a prepared route to a recipient, and note it as likely to be
+        sent to again.
+
+        :param recipient: Finger of the recipient.
+        :return: The prepared route, or None if none are in stock.
+        """
+        with self._condition:
+            routes = self._routes.pop(recipient.ident, None)
+            if routes is None:
+                routes = deque()
+                if len(self._routes) >= self.recipients:
+                    self.count_discarded += len(
+                        self._routes.popitem(last=False)[1])
+            self._routes[recipient.ident] = routes
+            self._last_taken = time()
+            self._condition.notify()
+            while routes:
+                route = routes.popleft()
+                if self._valid(route, recipient):
+                    self.count_hits += 1
+                    return route
+                self.count_discarded += 1
+            self.count_misses += 1
+            return None
+
+    def metrics(self):
+        """
+        Get the metrics of the stock.
+
+        :return: Dictionary of the numbers of recipients and routes in stock,
+            and the counts of routes.
+        """
+        with self._condition:
+            return {'recipients': len(self._routes),
+                    'stocked': sum(len(routes)
+                                   for routes in self._routes.values()),
+                    'hits': self.count_hits,
+                    'misses': self.count_misses,
+                    'prepared': self.count_prepared,
+                    'discarded': self.count_discarded}
+
+    def _valid(self, route, recipient):
+        """Check a route is fresh and all of its nodes are known and up."""
+        if time() - route.created >= self.max_age:
+            return False
+        if route.route[-1] != recipient:
+            return False
+        return all(self.fingerspace.get(finger.ident) == finger
+                   and finger.ident not in self.fingerspace.dead
+                   for finger in route.route)
+
+    def _wanted(self):
+        """
+        Find a recipient whose stock is short, the lock must be held.
+
+        Stale routes are thrown away on the way.
+
+        :return: Ident of the recipient, or None if every stock is full.
+        """
+        now = time()
+        for ident, routes in self._routes.items():
+            while routes and now - routes[0].created >= self.max_age:
+                routes.popleft()
+                self.count_discarded += 1
+            if len(routes) < self.stock:
+                return ident
+        return None
+
+    def _refilling(self):
+        """
+        Prepare routes while any stock is short.
+
+        This method is the target of `self._thread`
+        """
+        while self._running:
+            with self._condition:
+                waiting = self.idle - (time() - self._last_taken)
+                ident = self._wanted() if waiting <= 0 else None
+                if ident is None:
+                    self._condition.wait(max(waiting, 0) or self.max_age / 2)
+                    continue
+            recipient = self.fingerspace.get(ident)
+            if recipient is None:
+                with self._condition:
+                    self.count_discarded += len(
+                        self._routes.pop(ident, ()))
+                continue
+            try:
+                route = self.prepare(recipient)
+            except Exception as exc:  # pylint: disable=broad-except
+                self.log.warning("Couldn't prepare a route to %s: %s",
+                                 ident, exc)
+                with self._condition:
+                    self._condition.wait(self.max_age / 2)
+                continue
+            with self._condition:
+                routes = self._routes.get(ident)
+                if routes is not None and len(routes) < self.stock:
+                    routes.append(route)
+                    self.count_prepared += 1
+        self.log.debug("Precompute thread stopped.")
@@ -18,16 +18,27 @@
     Protocol, handlers for connections with other nodes
 """
 
+from time import time
 from hashlib import md5
+from itertools import chain
 
 import pickle
 from pickle import UnpicklingError
 
 from .fingerspace import Finger
+from .onion import OnionLayer, HeaderReader, build_onion
+from .circuits import Circuit, MESSAGE, DESTROY, ID_SIZE, NONCE_SIZE
+from .sphinx import PacketHeader, peel_packet, PACKET_SIZE, MAX_BODY
+from .reactor import AsyncSocket, Return, Spawn
 from .assets.errors import (ProtocolError, ProcedureError, AuthError,
-                            SockWrapError)
-from .utils.config import CFG_PICKLE_PROTOCOL, CFG_PATH_LENGTH
-from .utils.utilities import SocketWrapper, generate_padding
+                            BusyError, SockWrapError, RelayDownError)
+from .handlers import HandlerRegistry
+from .utils.config import (CFG_PICKLE_PROTOCOL, CFG_PATH_LENGTH,
+                           CFG_IDENT_LENGTH, CFG_SYNC_LEAF_SIZE,
+                           CFG_SYNC_LIMIT, CFG_STREAM_LIMIT,
+                           CFG_STREAM_CHUNK_SIZE, CFG_CIRCUIT_BUILD_LIMIT,
+                           CFG_CIRCUITS)
+from .utils.utilities import SocketWrapper, generate_padding, split_chunks
 
 
 class Protocol(object):
@@ -38,13 +49,29 @@ class Protocol(object):
     4 characters in length.
     """
     Announce = "ANNO"
+    Busy = "BUSY"
+    Cell = "CELL"
+    Circuit = "CIRC"
+    Down = "DOWN"
+    Fetch = "FTCH"
+    Lane = "LANE"
+    Mail = "MAIL"
     Message = "MESG"
+    Packet = "PCKT"
     Ping = "PING"
     Pong = "PONG"
     Quit = "QUIT"
     Relay = "RELY"
+    Store = "STOR"
+    Stream = "STRM"
+    Sync = "SYNC"
     Welcome = "WELC"
-    ALL = [Announce, Message, Ping, Pong, Quit, Relay, Welcome]
+    ALL = [Announce, Busy, Cell, Circuit, Down, Fetch, Lane, Mail, Message,
+           Packet, Ping, Pong, Quit, Relay, Store, Stream, Sync, Welcome]
+
+
+# Handlers of the requests made to an IncomingConnection.
+HANDLERS = HandlerRegistry()
 
 
 class ConnectionHandler(object):
@@ -71,6 +98,9 @@ class ConnectionHandler(object):
     The sender's information will contain the sender's finger and any nonces
     used for the transaction which are checked for consistency. The padding
     is used for cryptographic scrambling and is discarded.
+
+    Methods prefixed with `co_` are coroutine versions of the procedures, for
+    running in an :class:`EventLoop` on an :class:`AsyncSocket`.
     """
     def __init__(self):
         raise NotImplementedError("ConnectionHandler is abstract!")
@@ -94,7 +124,27 @@ class ConnectionHandler(object):
         :return: A message type, and its parameters
         """
         cryptic_data = self.conn.receive()  # Receive foreign data
+        return self._read_message(cryptic_data, expected)
+
+    def co_send(self, message_type, parameters):
+        """Coroutine of :func:`send`."""
+        self._verify_message(message_type, parameters)
+        cryptic_data = self.package(message_type, parameters)
+        yield self.conn.send(cryptic_data)
 
+    def co_receive(self, expected=None):
+        """Coroutine of :func:`receive`."""
+        cryptic_data = yield self.conn.receive()
+        yield Return(self._read_message(cryptic_data, expected))
+
+    def _read_message(self, cryptic_data, expected=None):
+        """
+        Unpack and verify a message received from the foreign node.
+
+        :param cryptic_data: The encrypted data received.
+        :param expected: If given, the message type that must be received.
+        :return: A message type, and its parameters
+        """
         try:
             foreign, message_type, parameters = self.unpack(cryptic_data)
         except ValueError:
@@ -107,6 +157,10 @@ class ConnectionHandler(object):
         """
         Construct a message for sending to a foreign node.
 
+        Messages handled outside of the 'control' lane are tagged with their
+        lane, so that the foreign node can queue them there before
+        deciphering them.
+
         :param message_type: Type of message from the Protocol class.
         :param parameters: Parameters of the message, as a dict.
         """
@@ -122,12 +176,19 @@ class ConnectionHandler(object):
         data_pack = data + generate_padding()
 
         cryptic_data = self.foreign_key.encrypt(data_pack)
-        return cryptic_data
+        return tag_lane(cryptic_data, HANDLERS.cost(message_type))
 
     def unpack(self, cryptic_data):
         """
         Unpack data sent to this node by a foreign node.
+
+        A foreign node too busy to handle the connection replies with just
+        :attr:`Protocol.Busy`, unencrypted, and a :class:`BusyError` is
+        raised.
         """
+        if cryptic_data == Protocol.Busy:
+            raise BusyError("Foreign node is too busy.")
+        _, cryptic_data = split_lane(cryptic_data)
         data = self.local_keys.decrypt(cryptic_data)
 
         try:
@@ -166,6 +227,91 @@ class ConnectionHandler(object):
             if key.upper() != key:
                 raise ProtocolError("Invalid key in parameters '%s'." % (key,))
 
+    def _reconcile(self, params):
+        """
+        Exchange Sync messages until both FingerSpaces agree.
+
+        Each Sync message holds the parameters:
+
+         - DIGESTS: Prefixes mapped to the sender's digest of that prefix.
+         - NODES: Nodes the sender has, which the receiver may not.
+         - REMOVED: Tombstones of the nodes the sender has removed, see
+           :func:`FingerSpace.apply_tombstones`.
+         - WANT: Prefixes the sender wants the receiver's nodes and
+           tombstones for.
+
+        A message without DIGESTS or WANT ends the exchange.
+
+        :param params: Parameters of the Sync message received.
+        """
+        while True:
+            reply = self._sync_step(params)
+            if not (params['DIGESTS'] or params['WANT']):
+                return
+            self.send(Protocol.Sync, reply)
+            if not (reply['DIGESTS'] or reply['WANT']):
+                return
+            params = self.receive(Protocol.Sync)[1]
+
+    def _co_reconcile(self, params):
+        """Coroutine of :func:`_reconcile`."""
+        while True:
+            reply = self._sync_step(params)
+            if not (params['DIGESTS'] or params['WANT']):
+                return
+            yield self.co_send(Protocol.Sync, reply)
+            if not (reply['DIGESTS'] or reply['WANT']):
+                return
+            params = (yield self.co_receive(Protocol.Sync))[1]
+
+    def _sync_step(self, params):
+        """
+        Process one Sync message and construct the reply.
+
+        Matching prefixes are ignored. Mismatching prefixes are split into
+        their children until few enough nodes are under the prefix, at which
+        point the nodes and tombstones themselves are exchanged. Tombstones
+        are applied before nodes, so a removed node isn't brought back.
+
+        :param params: Parameters of the Sync message received.
+        :return: Parameters of the reply.
+        """
+        removed = params.get('REMOVED', [])
+        if removed:
+            self.log.debug("Reconciled %d tombstones, removing %d nodes.",
+                           len(removed),
+                           self.fingerspace.apply_tombstones(removed))
+        local_ident = self.local_finger.ident
+        nodes = [values for values in params['NODES']
+                 if values[-1] != local_ident]
+        if nodes:
+            self.log.debug("Reconciled %d nodes.", len(nodes))
+            self.fingerspace.import_nodes(nodes)
+
+        reply = {'DIGESTS': {}, 'NODES': [], 'REMOVED': [], 'WANT': []}
+        for prefix in params['WANT']:
+            reply['NODES'].extend(self.fingerspace.get_by_prefix(prefix))
+            reply['REMOVED'].extend(self.fingerspace.get_tombstones(prefix))
+        for prefix, (count, digest) in params['DIGESTS'].iteritems():
+            local_count, local_digest = self.fingerspace.digest(prefix)
+            if (count, digest) == (local_count, local_digest):
+                continue
+            if (len(prefix) >= CFG_IDENT_LENGTH
+                    or max(count, local_count) <= CFG_SYNC_LEAF_SIZE):
+                # A hash without a count is of tombstones alone.
+                if local_count or local_digest:
+                    reply['NODES'].extend(
+                        self.fingerspace.get_by_prefix(prefix))
+                    reply['REMOVED'].extend(
+                        self.fingerspace.get_tombstones(prefix))
+                if count or digest:
+                    reply['WANT'].append(prefix)
+            else:
+                for char in '0123456789abcdef':
+                    reply['DIGESTS'][prefix + char] = \
+                        self.fingerspace.digest(prefix + char)
+        return reply
+
     def connect(self, remote_address=None):
         """Establish connection with foreign node"""
         if remote_address:
@@ -175,6 +321,19 @@ class ConnectionHandler(object):
         else:
             raise ProtocolError("No address to connect to.")
 
+    def co_connect(self, remote_address=None):
+        """
+        Coroutine of :func:`connect`.
+
+        The connection is replaced by a new :class:`AsyncSocket`.
+        """
+        if not remote_address:
+            if not getattr(self, 'foreign_finger', None):
+                raise ProtocolError("No address to connect to.")
+            remote_address = self.foreign_finger.address
+        self.conn = AsyncSocket()
+        yield self.conn.connect(remote_address)
+
     def close(self):
         """Terminate the connection"""
         try:
@@ -222,13 +381,33 @@ class Boostrapper(ConnectionHandler):
         """
         self.conn.connect(remote_address)
         self.log.debug("Bootstrap connection established.")
-        boot_package = pickle.dumps(self.local_finger.all,
-                                    protocol=CFG_PICKLE_PROTOCOL)
-        self.conn.send(boot_package)
+        self.conn.send(self._boot_package(remote_address))
         self.log.debug("Bootstrap package sent.")
 
         # Expect back a welcome message.
         cryptic_data = self.conn.receive()  # Receive foreign data
+        return self._welcomed(cryptic_data)
+
+    def _boot_package(self, remote_address):
+        """
+        Construct the unencrypted package introducing this node.
+
+        :param remote_address: IP and Port tuple of bootstrap node.
+        """
+        boot_info = self.local_finger.all
+        sync_point = self.fingerspace.sync_points.get(remote_address)
+        if sync_point:
+            self.log.debug("Rejoining from sync point %s:%d", *sync_point)
+            boot_info += (sync_point,)
+        return pickle.dumps(boot_info, protocol=CFG_PICKLE_PROTOCOL)
+
+    def _welcomed(self, cryptic_data):
+        """
+        Unpack the welcome message from the bootstrap node.
+
+        :param cryptic_data: The encrypted data received.
+        :return: The parameters of the welcome message.
+        """
         foreign, message_type, parameters = self.unpack(cryptic_data)
         if message_type != Protocol.Welcome:
             raise ProcedureError("Expected welcome from bootstrap node.")
@@ -243,28 +422,74 @@ class Boostrapper(ConnectionHandler):
         during which the node will rendezvous with a bootstrap node, an
         existing node in the network, and attain a list of nodes.
 
+        If this node has bootstrapped against the same node before then only
+        the changes since then are received, unless the bootstrap node can no
+        longer provide them, in which case the full list is sent.
+
         :param remote_address: IP and Port tuple of bootstrap node.
         """
         welcome_params = self._init_connection(remote_address)
-        # We will add your technological distinctiveness to our own.
-        nodes_list = welcome_params.get('NODES')
-        if nodes_list:
-            self.fingerspace.import_nodes(nodes_list)
+        if self._join(remote_address, welcome_params):
             self.announce()
         self.log.info("SUCCESS! Rendezvous occured.")
 
+    def co_bootstrap(self, remote_address):
+        """
+        Coroutine of :func:`bootstrap`, announcements are made concurrently.
+        """
+        yield self.co_connect(remote_address)
+        try:
+            yield self.conn.send(self._boot_package(remote_address))
+            cryptic_data = yield self.conn.receive()
+        finally:
+            self.close()
+        welcome_params = self._welcomed(cryptic_data)
+        if self._join(remote_address, welcome_params):
+            for finger in self._announce_to():
+                announcer = Announcer(self.log, self.local_finger,
+                                      self.local_keys, finger)
+                yield Spawn(announcer.co_announce())
+        self.log.info("SUCCESS! Rendezvous occured.")
+
+    def _join(self, remote_address, welcome_params):
+        """
+        Take in the nodes sent in the welcome message.
+
+        :param remote_address: IP and Port tuple of bootstrap node.
+        :param welcome_params: The parameters of the welcome message.
+        :return: True if other nodes should be announced to.
+        """
+        # We will add your technological distinctiveness to our own.
+        if 'ADDED' in welcome_params:
+            self.log.info("Received %d additions and %d removals.",
+                          len(welcome_params['ADDED']),
+                          len(welcome_params['REMOVED']))
+            self.fingerspace.apply_changes(welcome_params['ADDED'],
+                                           welcome_params['REMOVED'])
+        else:
+            nodes_list = welcome_params.get('NODES')
+            if nodes_list:
+                self.fingerspace.import_nodes(nodes_list)
+        if welcome_params.get('VERSION'):
+            self.fingerspace.sync_points[remote_address] = \
+                welcome_params['VERSION']
+        return len(self.fingerspace) > 1
+
     def announce(self):
         """
         Make presence of this node known to others.
         """
-        for finger in self.fingerspace.get_all():
-            if finger == self.foreign_finger:
-                continue
+        for finger in self._announce_to():
             self.log.info("Announce to %s" % finger)
             announcer = Announcer(self.log, self.local_finger, self.local_keys,
                                   finger)
             announcer.announce()
 
+    def _announce_to(self):
+        """Get the fingers to announce to, all but the bootstrap node."""
+        return [finger for finger in self.fingerspace.get_all()
+                if finger != self.foreign_finger]
+
 
 class Announcer(ConnectionHandler):
     """Handler for announcing ourselves to foreign nodes."""
@@ -292,6 +517,16 @@ class Announcer(ConnectionHandler):
             self.log.error("Announcement Error: %s", exc.message)
         self.close()
 
+    def co_announce(self):
+        """Coroutine of :func:`announce`."""
+        yield self.co_connect()
+        try:
+            yield self.co_send(Protocol.Announce,
+                               {'NODE': self.local_finger.all})
+        except Exception as exc:
+            self.log.error("Announcement Error: %s", exc.message)
+        self.close()
+
 
 class Leaver(ConnectionHandler):
     """Handler for announcing departure to foreign nodes."""
@@ -319,6 +554,66 @@ class Leaver(ConnectionHandler):
             self.log.error("Announcement Error: %s", exc.message)
         self.close()
 
+    def co_leave(self):
+        """Coroutine of :func:`leave`."""
+        yield self.co_connect()
+        try:
+            yield self.co_send(Protocol.Quit,
+                               {'IDENT': self.local_finger.ident})
+        except Exception as exc:
+            self.log.error("Announcement Error: %s", exc.message)
+        self.close()
+
+
+class Reconciler(ConnectionHandler):
+    """
+    Handler for anti-entropy between FingerSpaces.
+
+    Announcements and departures can be lost, so the FingerSpaces of nodes
+    drift apart. The Reconciler compares digests of the ident space with a
+    foreign node, descending only into the prefixes that differ, and the two
+    nodes exchange just the fingers the other is missing.
+    """
+    def __init__(self, log, fingerspace, local_finger, local_keys,
+                 foreign_finger):
+        """
+        :param log: Logger instance to output to.
+        :param fingerspace: The FingerSpace instance of this node.
+        :param local_finger: The Finger of this node.
+        :param local_keys: The CipherWrapper of this node.
+        :param foreign_finger: The Finger of the foreign node.
+        """
+        self.log = log.getChild("reconciler@%s" % foreign_finger.ident)
+        self.conn = SocketWrapper()
+        self.fingerspace = fingerspace
+        self.local_finger = local_finger
+        self.local_keys = local_keys
+        self.foreign_finger = foreign_finger
+        self.foreign_key = foreign_finger.get_cipher()
+
+    def reconcile(self):
+        """Reconcile the local FingerSpace with the foreign node's."""
+        self.connect()
+        try:
+            params = {'DIGESTS': {'': self.fingerspace.digest('')},
+                      'NODES': [], 'REMOVED': [], 'WANT': []}
+            self.send(Protocol.Sync, params)
+            self._reconcile(self.receive(Protocol.Sync)[1])
+        finally:
+            self.close()
+
+    def co_reconcile(self):
+        """Coroutine of :func:`reconcile`."""
+        yield self.co_connect()
+        try:
+            params = {'DIGESTS': {'': self.fingerspace.digest('')},
+                      'NODES': [], 'REMOVED': [], 'WANT': []}
+            yield self.co_send(Protocol.Sync, params)
+            reply = yield self.co_receive(Protocol.Sync)
+            yield self._co_reconcile(reply[1])
+        finally:
+            self.close()
+
 
 class IncomingConnection(ConnectionHandler):
     """
@@ -326,21 +621,53 @@ class IncomingConnection(ConnectionHandler):
 
     The methods of this class define procedures for dealing with connections
     from foreign nodes.
+
+    Requests are handled by the handlers registered in `handlers`, see
+    :class:`HandlerRegistry`. The cost class of a handler names the priority
+    lane it runs in, so that a manager can run cheap control messages apart
+    from expensive relaying.
     """
-    def __init__(self, log, sock, addr, fingerspace, local_finger, local_keys):
+    handlers = HANDLERS
+
+    def __init__(self, log, sock, addr, fingerspace, local_finger, local_keys,
+                 relays=None, circuits=None, transfers=None, receipts=None,
+                 inbox=None, mail=None):
         """
         :param log: Logger instance to output to.
-        :param sock: socket object of the incoming connection.
+        :param sock: socket object of the incoming connection, or an
+            :class:`AsyncSocket` to handle the connection with coroutines.
         :param addr: address of the connecting node.
         :param fingerspace: The FingerSpace instance of this node.
         :param local_finger: The Finger of this node.
         :param local_keys: The CipherWrapper of this node.
+        :param relays: :class:`RelayQueues` to queue relayed packages in. If
+            None, packages are relayed before the handler returns.
+        :param circuits: :class:`CircuitTable` of the circuits through this
+            node. If None, circuits can't be built through it.
+        :param transfers: :class:`Transfers` to pass the chunks and acks of
+            transfers to. If None, they're ignored.
+        :param receipts: :class:`Receipts` to pass delivery receipts to, and
+            to owe receipts for messages to. If None, they're ignored.
+        :param inbox: :class:`Inbox` to keep received messages in. If None,
+            they're only printed.
+        :param mail: :class:`MailStore` to hold mail for offline nodes in. If
+            None, no mail is held.
         """
         self.log = log.getChild("incoming@%s" % (addr[0],))
-        self.conn = SocketWrapper(sock)
+        if isinstance(sock, AsyncSocket):
+            self.conn = sock
+        else:
+            self.conn = SocketWrapper(sock)
         self.fingerspace = fingerspace
         self.local_finger = local_finger
         self.local_keys = local_keys
+        self.relays = relays
+        self.circuits = circuits
+        self.transfers = transfers
+        self.receipts = receipts
+        self.inbox = inbox
+        self.mail = mail
+        self.sync_point = None
 
     def _is_bootstrap_request(self, data):
         """
@@ -352,13 +679,20 @@ class IncomingConnection(ConnectionHandler):
         is assumed that it is an encrypted message from an existing node and
         will be handled appropriately.
 
+        A rejoining node appends the sync point it last received from this
+        node to its finger information.
+
         :param data: Raw data string received from the foreign node.
         :return: True if this is a bootstrap request, else False.
         """
         try:
             obj = pickle.loads(data)
             assert isinstance(obj, tuple)
-            assert len(obj) == 4
+            assert len(obj) in (4, 5)
+            if len(obj) == 5:
+                assert isinstance(obj[4], tuple) and len(obj[4]) == 2
+                self.sync_point = obj[4]
+                obj = obj[:4]
             self.foreign_finger = Finger(*obj)
             self.log.info("New node joining network with ID: %s", obj[-1])
             return True
@@ -371,66 +705,582 @@ class IncomingConnection(ConnectionHandler):
         """
         self.log.info("Sending welcome message to %s",
                       self.foreign_finger.ident)
-        self.foreign_key = self.foreign_finger.get_cipher()
-        parameters = {'NODES': self.fingerspace.export_nodes()}
-        self.send(Protocol.Welcome, parameters)
+        self.send(Protocol.Welcome, self._welcome_params())
         self.fingerspace.put(*self.foreign_finger.all)
 
-    def handle(self):
+    def _welcome_params(self):
+        """
+        Construct the parameters of the welcome message for a joining node.
+
+        A rejoining node is sent the changes since its sync point if they are
+        known, everybody else is sent the whole FingerSpace.
+        """
+        self.foreign_key = self.foreign_finger.get_cipher()
+        changes = None
+        if self.sync_point:
+            changes = self.fingerspace.changes_since(self.sync_point)
+        if changes:
+            version, added, removed = changes
+            parameters = {'ADDED': added, 'REMOVED': removed}
+        else:
+            version, nodes = self.fingerspace.export_state()
+            parameters = {'NODES': nodes}
+        parameters['VERSION'] = version
+        return parameters
+
+    def handle(self, data=None):
         """
         Perform handling of the incoming connection.
 
         Receives data from the foreign node and deciphers it, this will call
         one of the relevant handlers to deal with the connection based on what
         the message type is.
+
+        :param data: The first frame of the connection, if it has already
+            been received.
+        """
+        request = self.read_request(data)
+        if request:
+            self.dispatch(*request)
+
+    def read_request(self, data=None):
+        """
+        Receive and decipher the request of the foreign node.
+
+        Bootstrap requests are answered straight away.
+
+        :param data: The first frame of the connection, if it has already
+            been received.
+        :return: Tuple of the message type and its parameters, or None if
+            the request has been answered.
         """
-        data = self.conn.receive()
+        if data is None:
+            data = self.conn.receive()
+        request = self._read_raw(data)
+        if request:
+            return request
         if self._is_bootstrap_request(data):
             self._rendezvous()
+            return None
+        return self._read_message(data)
+
+    @staticmethod
+    def _read_raw(data):
+        """
+        Read a packet or cell the foreign node is passing on.
+
+        Packets and cells are sent as they are, without the encryption of
+        other messages, see :mod:`distrim.sphinx` and
+        :mod:`distrim.circuits`. The foreign node isn't known.
+
+        :param data: Raw data string received from the foreign node.
+        :return: Tuple of the message type and its parameters, or None if
+            this is neither.
+        """
+        if (len(data) == len(Protocol.Packet) + PACKET_SIZE
+                and data.startswith(Protocol.Packet)):
+            return Protocol.Packet, {'PACKET': data[len(Protocol.Packet):]}
+        if (len(data) > len(Protocol.Cell) + ID_SIZE + NONCE_SIZE
+                and data.startswith(Protocol.Cell)):
+            return Protocol.Cell, {'CELL': data[len(Protocol.Cell):]}
+        return None
+
+    @classmethod
+    def classify(cls, data):
+        """
+        Find the lane of a request from its framing, without deciphering it.
+
+        Packets and cells are known by their prefix, and other requests by
+        the lane they are tagged with, see :func:`tag_lane`.
+
+        :param data: Raw data string received from the foreign node.
+        :return: Name of the cost class of the request's handler, or
+            'control' if it isn't known.
+        """
+        request = cls._read_raw(data)
+        if request:
+            return cls.handlers.cost(request[0])
+        return split_lane(data)[0] or 'control'
+
+    def handler(self, msg_type):
+        """
+        Get the handler of a message type.
+
+        :param msg_type: The message type defined in :class:`Protocol`.
+        :return: The :class:`Handler`.
+        """
+        return self.handlers.get(msg_type)
+
+    def dispatch(self, msg_type, parameters):
+        """
+        Call the handler of a request.
+
+        :param msg_type: The message type defined in :class:`Protocol`.
+        :param parameters: Parameters of the message.
+        """
+        self.handler(msg_type).run(self, parameters)
+
+    def co_handle(self):
+        """Coroutine of :func:`handle`."""
+        data = yield self.conn.receive()
+        request = self._read_raw(data)
+        if request:
+            yield self.handler(request[0]).co_run(self, request[1])
             return
-        foreign, msg_type, parameters = self.unpack(data)
-        self._verify_foreign(foreign)
-        self._verify_message(msg_type, parameters, None)
-        if msg_type == Protocol.Announce:
-            self.handle_announcement(parameters)
-        if msg_type == Protocol.Quit:
-            self.handle_leaver(parameters)
-        if msg_type == Protocol.Relay:
-            self.handle_relay(parameters)
+        if self._is_bootstrap_request(data):
+            self.log.info("Sending welcome message to %s",
+                          self.foreign_finger.ident)
+            yield self.co_send(Protocol.Welcome, self._welcome_params())
+            self.fingerspace.put(*self.foreign_finger.all)
+            return
+        msg_type, parameters = self._read_message(data)
+        yield self.handler(msg_type).co_run(self, parameters)
 
+    @HANDLERS.register(Protocol.Announce, inline=True)
     def handle_announcement(self, params):
         """Put node information in the FingerSpace"""
         addr, port, key, ident = params.get('NODE')
         self.log.info("Announcement from %s", ident)
         self.fingerspace.put(addr, port, key, ident)
 
+    @HANDLERS.register(Protocol.Quit, inline=True)
     def handle_leaver(self, params):
         """Remove a foreign node from network"""
         ident = params.get('IDENT')
         self.log.info('Goodbye to %s', ident)
         self.fingerspace.remove(ident)
 
+    @HANDLERS.register(Protocol.Ping, inline=True)
+    def handle_ping(self, params):
+        """Reply to a liveness check, echoing its parameters"""
+        self.send(Protocol.Pong, params)
+
+    @HANDLERS.register_coroutine(Protocol.Ping)
+    def co_handle_ping(self, params):
+        """Coroutine of :func:`handle_ping`."""
+        yield self.co_send(Protocol.Pong, params)
+
+    @HANDLERS.register(Protocol.Message, inline=True)
+    def handle_message(self, params):
+        """Receive a message sent directly by the foreign node"""
+        self._deliver(self.foreign_finger.ident, params.get('MESSAGE'))
+
+    @HANDLERS.register(Protocol.Store, inline=True)
+    def handle_store(self, params):
+        """Hold mail for an offline node, if there's room for it"""
+        stored = bool(self.mail) and self.mail.store(
+            params['IDENT'], params['ID'], params['ITEM'], params['TTL'])
+        self.send(Protocol.Store, {'STORED': stored})
+
+    @HANDLERS.register_coroutine(Protocol.Store)
+    def co_handle_store(self, params):
+        """Coroutine of :func:`handle_store`."""
+        stored = bool(self.mail) and self.mail.store(
+            params['IDENT'], params['ID'], params['ITEM'], params['TTL'])
+        yield self.co_send(Protocol.Store, {'STORED': stored})
+
+    @HANDLERS.register(Protocol.Fetch, cost='relay')
+    def handle_fetch(self, params):
+        """
+        Hand over the mail held for the foreign node.
+
+        The mail is only dropped once the foreign node sends back the IDs of
+        the messages, which only the owner of its key can read from the
+        reply.
+        """
+        ident = self.foreign_finger.ident
+        items = self.mail.peek(ident) if self.mail else []
+        self.send(Protocol.Mail, {'ITEMS': items})
+        if items:
+            taken = self.receive(Protocol.Fetch)[1].get('TAKEN', [])
+            self.mail.take(ident, taken)
+
+    @HANDLERS.register_coroutine(Protocol.Fetch)
+    def co_handle_fetch(self, params):
+        """Coroutine of :func:`handle_fetch`."""
+        ident = self.foreign_finger.ident
+        items = self.mail.peek(ident) if self.mail else []
+        yield self.co_send(Protocol.Mail, {'ITEMS': items})
+        if items:
+            reply = yield self.co_receive(Protocol.Fetch)
+            self.mail.take(ident, reply[1].get('TAKEN', []))
+
+    @HANDLERS.register(Protocol.Sync, cost='relay', limit=CFG_SYNC_LIMIT)
+    def handle_sync(self, params):
+        """Reconcile FingerSpaces with the foreign node"""
+        self.log.info("Reconciling with %s", self.foreign_finger.ident)
+        self._reconcile(params)
+
+    @HANDLERS.register_coroutine(Protocol.Sync)
+    def co_handle_sync(self, params):
+        """Coroutine of :func:`handle_sync`."""
+        self.log.info("Reconciling with %s", self.foreign_finger.ident)
+        yield self._co_reconcile(params)
+
+    @HANDLERS.register(Protocol.Relay, cost='relay')
     def handle_relay(self, params):
         """Relay package from one node to another"""
-        package = params.get('PACKAGE')
-        unpacked = self._peel_onion_layer(package)
-        if unpacked.get('RECIPIENT') == self.local_finger.ident:
-            sender = unpacked.get('SENDER')
-            self.fingerspace.put(*sender)
-            self.log.info('Message Received from %s', sender[-1])
-            print '## Message: %s' % unpacked.get('MESSAGE')
-            return
-        else:
-            addr, port, key, ident = unpacked.get('NEXT')
-            self.fingerspace.put(addr, port, key, ident)
-            next_finger = self.fingerspace.get(ident)
-            self.log.info("Relaying message from %s to %s",
-                          self.foreign_finger.ident, next_finger.ident)
+        forward = self._peel_relay(params)
+        if forward and self.relays is not None:
+            self.relays.put(*forward)
+        elif forward:
+            next_finger, package = forward
+            out = MessageHandler(
+                self.log, self.fingerspace, self.local_finger,
+                self.local_keys, next_finger)
+            out.connect()
+            out.relay(package)
+
+    @HANDLERS.register_coroutine(Protocol.Relay)
+    def co_handle_relay(self, params):
+        """Coroutine of :func:`handle_relay`."""
+        forward = self._peel_relay(params)
+        if forward:
+            out = MessageHandler(
+                self.log, self.fingerspace, self.local_finger,
+                self.local_keys, forward[0])
+            yield out.co_relay(forward[1])
+
+    @HANDLERS.register(Protocol.Packet, cost='relay')
+    def handle_packet(self, params):
+        """Relay a packet to the next node, or receive it"""
+        forward = self._peel_packet(params)
+        if forward and self.relays is not None:
+            self.relays.put(*forward, procedure='packet')
+        elif forward:
+            next_finger, packet = forward
             out = MessageHandler(
                 self.log, self.fingerspace, self.local_finger,
                 self.local_keys, next_finger)
             out.connect()
-            out.relay(unpacked.get('PACKAGE'))
+            try:
+                out.packet(packet)
+            finally:
+                out.close()
+
+    @HANDLERS.register_coroutine(Protocol.Packet)
+    def co_handle_packet(self, params):
+        """Coroutine of :func:`handle_packet`."""
+        forward = self._peel_packet(params)
+        if forward:
+            out = MessageHandler(
+                self.log, self.fingerspace, self.local_finger,
+                self.local_keys, forward[0])
+            yield out.co_packet(forward[1])
+
+    @HANDLERS.register(Protocol.Circuit, cost='relay',
+                       limit=CFG_CIRCUIT_BUILD_LIMIT)
+    def handle_circuit(self, params):
+        """
+        Hold a circuit, and extend it to the next node.
+
+        The foreign node is answered once the rest of the circuit is built,
+        or told which node is down if it couldn't be.
+        """
+        circuit_id, forward = self._extend_circuit(params)
+        try:
+            if forward:
+                out = MessageHandler(
+                    self.log, self.fingerspace, self.local_finger,
+                    self.local_keys, forward[0])
+                try:
+                    out.connect()
+                    out.circuit(forward[1])
+                except SockWrapError:
+                    raise self._relay_down(forward[0])
+                finally:
+                    out.close()
+            self.send(Protocol.Circuit, {'CREATED': True})
+        except RelayDownError as exc:
+            self.circuits.remove(circuit_id)
+            self.send(Protocol.Down, {'IDENT': exc.ident})
+        except Exception:
+            self.circuits.remove(circuit_id)
+            raise
+
+    @HANDLERS.register_coroutine(Protocol.Circuit)
+    def co_handle_circuit(self, params):
+        """Coroutine of :func:`handle_circuit`."""
+        circuit_id, forward = self._extend_circuit(params)
+        try:
+            if forward:
+                out = MessageHandler(
+                    self.log, self.fingerspace, self.local_finger,
+                    self.local_keys, forward[0])
+                try:
+                    yield out.co_circuit(forward[1])
+                except SockWrapError:
+                    raise self._relay_down(forward[0])
+            yield self.co_send(Protocol.Circuit, {'CREATED': True})
+        except RelayDownError as exc:
+            self.circuits.remove(circuit_id)
+            yield self.co_send(Protocol.Down, {'IDENT': exc.ident})
+        except Exception:
+            self.circuits.remove(circuit_id)
+            raise
+
+    @HANDLERS.register(Protocol.Cell, cost='relay')
+    def handle_cell(self, params):
+        """Relay a cell along its circuit, or receive it"""
+        forward = self._peel_cell(params)
+        if forward and self.relays is not None:
+            self.relays.put(*forward, procedure='cell')
+        elif forward:
+            next_finger, cell = forward
+            out = MessageHandler(
+                self.log, self.fingerspace, self.local_finger,
+                self.local_keys, next_finger)
+            out.connect()
+            try:
+                out.cell(cell)
+            finally:
+                out.close()
+
+    @HANDLERS.register_coroutine(Protocol.Cell)
+    def co_handle_cell(self, params):
+        """Coroutine of :func:`handle_cell`."""
+        forward = self._peel_cell(params)
+        if forward:
+            out = MessageHandler(
+                self.log, self.fingerspace, self.local_finger,
+                self.local_keys, forward[0])
+            yield out.co_cell(forward[1])
+
+    @HANDLERS.register(Protocol.Stream, cost='relay', limit=CFG_STREAM_LIMIT)
+    def handle_stream(self, params):
+        """
+        Relay a streamed onion to the next node, or receive it.
+
+        The payload is forwarded as it arrives, see :mod:`distrim.onion`.
+        """
+        layer = OnionLayer(self.local_keys, params.get('HEADER'))
+        length = params.get('LENGTH')
+        self.send(Protocol.Stream, {'READY': True})
+        chunks = (layer.decrypt(chunk)
+                  for chunk in self._stream_chunks(length))
+        if layer.next is None:
+            self._receive_stream(''.join(chunks))
+            return
+        reader = HeaderReader()
+        for chunk in chunks:
+            if reader.feed(chunk):
+                break
+        else:
+            raise ProtocolError("Stream ended before the next header.")
+        out = MessageHandler(
+            self.log, self.fingerspace, self.local_finger, self.local_keys,
+            self._next_finger(layer.next))
+        out.connect()
+        try:
+            out.stream(reader.header, length - reader.size,
+                       chain([reader.leftover], chunks))
+        finally:
+            out.close()
+
+    @HANDLERS.register_coroutine(Protocol.Stream)
+    def co_handle_stream(self, params):
+        """Coroutine of :func:`handle_stream`."""
+        layer = OnionLayer(self.local_keys, params.get('HEADER'))
+        remaining = params.get('LENGTH')
+        yield self.co_send(Protocol.Stream, {'READY': True})
+        if layer.next is None:
+            data = []
+            while remaining > 0:
+                chunk = yield self.conn.receive()
+                remaining -= len(chunk)
+                data.append(layer.decrypt(chunk))
+            self._receive_stream(''.join(data))
+            return
+        reader = HeaderReader()
+        while remaining > 0:
+            chunk = yield self.conn.receive()
+            remaining -= len(chunk)
+            if reader.feed(layer.decrypt(chunk)):
+                break
+        else:
+            raise ProtocolError("Stream ended before the next header.")
+        out = MessageHandler(
+            self.log, self.fingerspace, self.local_finger, self.local_keys,
+            self._next_finger(layer.next))
+        yield out.co_connect()
+        try:
+            yield out.co_send(Protocol.Stream, {
+                'HEADER': reader.header,
+                'LENGTH': remaining + len(reader.leftover)})
+            yield out.co_receive(Protocol.Stream)
+            if reader.leftover:
+                yield out.conn.send(reader.leftover)
+            while remaining > 0:
+                chunk = yield self.conn.receive()
+                remaining -= len(chunk)
+                yield out.conn.send(layer.decrypt(chunk))
+        finally:
+            out.close()
+
+    def _stream_chunks(self, length):
+        """
+        Receive the chunks of a streamed payload.
+
+        :param length: Length of the payload.
+        :return: Generator of the chunks.
+        """
+        while length > 0:
+            chunk = self.conn.receive()
+            length -= len(chunk)
+            yield chunk
+
+    def _receive_stream(self, package):
+        """
+        Receive the package of a streamed onion this node is the
+        recipient of.
+
+        :param package: The package inside the last layer.
+        """
+        unpacked = pickle.loads(package)
+        if unpacked.get('RECIPIENT') != self.local_finger.ident:
+            raise ProtocolError("Streamed package isn't for this node.")
+        self._receive_body(unpacked)
+
+    def _next_finger(self, values):
+        """
+        Get the Finger of the next node of an onion, noting it in the
+        FingerSpace.
+
+        :param values: Values of the Finger.
+        """
+        self.fingerspace.put(*values)
+        next_finger = self.fingerspace.get(values[-1])
+        self.log.info("Relaying message from %s to %s",
+                      self.foreign_finger.ident, next_finger.ident)
+        return next_finger
+
+    def _receive_body(self, unpacked):
+        """
+        Receive the body of a message for this node, passing the chunks and
+        acks of transfers to `transfers`, and delivery receipts to
+        `receipts`.
+
+        :param unpacked: Dictionary of the body.
+        """
+        if 'DELIVERED' in unpacked:
+            if self.receipts:
+                self.receipts.delivered(unpacked['DELIVERED'])
+            return
+        sender = unpacked.get('SENDER')
+        self.fingerspace.put(*sender)
+        if 'RECEIPT' in unpacked and self.receipts:
+            self.receipts.acknowledge(unpacked['RECEIPT'])
+        if 'CHUNK' in unpacked and self.transfers:
+            self.transfers.receive(sender[-1], unpacked['CHUNK'])
+        elif 'ACK' in unpacked and self.transfers:
+            self.transfers.acknowledge(sender[-1], unpacked['ACK'])
+        else:
+            self._deliver(sender[-1], unpacked.get('MESSAGE'))
+
+    def _deliver(self, sender, message):
+        """
+        Receive a message for this node, keeping it in `inbox`.
+
+        :param sender: Ident of the sender.
+        :param message: The message.
+        """
+        self.log.info('Message Received from %s', sender)
+        if self.inbox:
+            self.inbox.add(sender, message)
+        print '## Message: %s' % message
+
+    def _peel_relay(self, params):
+        """
+        Peel a layer from a relayed package, and receive the message if this
+        node is the recipient.
+
+        :param params: Parameters of the Relay message.
+        :return: Tuple of the Finger of the next node and the package to
+            relay to it, or `None` if this node is the recipient.
+        """
+        package = params.get('PACKAGE')
+        unpacked = self._peel_onion_layer(package)
+        if unpacked.get('RECIPIENT') == self.local_finger.ident:
+            self._receive_body(unpacked)
+            return None
+        next_finger = self._next_finger(unpacked.get('NEXT'))
+        return next_finger, unpacked.get('PACKAGE')
+
+    def _peel_packet(self, params):
+        """
+        Peel a layer from a packet, and receive the message if this node is
+        the recipient.
+
+        :param params: Parameters of the Packet message.
+        :return: Tuple of the Finger of the next node and the packet to
+            relay to it, or `None` if this node is the recipient.
+        """
+        replies = self.receipts.reply_block if self.receipts else None
+        ident, result = peel_packet(self.local_keys, params.get('PACKET'),
+                                    replies)
+        if ident is None:
+            self._receive_body(pickle.loads(result))
+            return None
+        try:
+            next_finger = self.fingerspace.get(ident)
+        except ValueError:
+            next_finger = None
+        if next_finger is None:
+            raise ProtocolError("Next node of packet isn't known.")
+        self.log.info("Relaying packet to %s", next_finger.ident)
+        return next_finger, result
+
+    def _extend_circuit(self, params):
+        """
+        Peel a layer from the onion building a circuit, and hold the
+        circuit.
+
+        :param params: Parameters of the Circuit message.
+        :return: Tuple of the circuit's ID at this node, and a tuple of the
+            Finger of the next node and the onion to extend it with, or
+            `None` if this node is the recipient.
+        """
+        if self.circuits is None:
+            raise ProtocolError("Circuits can't be built through this node.")
+        layer = self._peel_onion_layer(params.get('PACKAGE'))
+        next_finger = None
+        if layer.get('NEXT'):
+            next_finger = self._next_finger(layer.get('NEXT'))
+        self.circuits.add(layer.get('CIRCUIT'), layer.get('KEY'),
+                          next_finger, layer.get('NEXT_CIRCUIT'))
+        if next_finger is None:
+            return layer.get('CIRCUIT'), None
+        return layer.get('CIRCUIT'), (next_finger, layer.get('PACKAGE'))
+
+    def _relay_down(self, finger):
+        """
+        Mark the next node of a route as down, to report to the foreign
+        node.
+
+        :param finger: Finger of the next node.
+        :return: A :class:`RelayDownError` to raise.
+        """
+        self.log.warning("Next node %s is down", finger.ident)
+        self.fingerspace.dead.mark(finger.ident)
+        return RelayDownError(finger.ident)
+
+    def _peel_cell(self, params):
+        """
+        Peel a layer from a cell, and receive the message if this node is
+        the recipient.
+
+        :param params: Parameters of the Cell message.
+        :return: Tuple of the Finger of the next node and the cell to relay
+            to it, or `None` if this node is the recipient.
+        """
+        if self.circuits is None:
+            raise ProtocolError("Circuits can't be built through this node.")
+        flag, next_finger, data = self.circuits.peel(params.get('CELL'))
+        if next_finger is not None:
+            return next_finger, data
+        if flag == MESSAGE:
+            self._receive_body(pickle.loads(data))
+        return None
 
     def _peel_onion_layer(self, package):
         """Strips a layer from a message package"""
@@ -461,20 +1311,275 @@ class MessageHandler(ConnectionHandler):
         self.local_finger = local_finger
         self.local_keys = local_keys
         self.foreign_finger = foreign_finger
+        # Fingers the last message sent passes through, once it's routed.
+        self.route = None
+        # Called with the route once it's chosen, before anything is sent.
+        self.routed = None
         if foreign_finger:
             self.foreign_key = foreign_finger.get_cipher()
 
-    def send_message(self, recipient, message):
+    def send_message(self, recipient, message, header=None, fields=None):
         """
         Send message.
+
+        Messages that fit are sent as a packet, see :mod:`distrim.sphinx`.
+
+        :param header: A :class:`PacketHeader` prepared for the recipient,
+            if there is one.
+        :param fields: Dictionary of other fields for the recipient, if any.
         """
-        final_pack = self._build_message(recipient, message)
+        packet = self._build_packet(recipient, message, header, fields)
+        if packet:
+            self.connect()
+            try:
+                self.packet(packet)
+            finally:
+                self.close()
+            return
+        final_pack = self._build_message(recipient, message, fields)
         next_node, params = self._build_onion(recipient, final_pack)
         self.foreign_finger = next_node
         self.foreign_key = next_node.get_cipher()
         self.connect()
         self.send(Protocol.Relay, params)
 
+    def co_send_message(self, recipient, message, header=None, fields=None):
+        """Coroutine of :func:`send_message`."""
+        packet = self._build_packet(recipient, message, header, fields)
+        if packet:
+            yield self.co_packet(packet)
+            return
+        final_pack = self._build_message(recipient, message, fields)
+        next_node, params = self._build_onion(recipient, final_pack)
+        self.foreign_finger = next_node
+        self.foreign_key = next_node.get_cipher()
+        yield self.co_connect()
+        try:
+            yield self.co_send(Protocol.Relay, params)
+        finally:
+            self.close()
+
+    def send_stream(self, recipient, message, fields=None):
+        """
+        Send a message as a streamed onion, see :mod:`distrim.onion`.
+
+        :param fields: Dictionary of other fields for the recipient, if any.
+        """
+        route = self._route(recipient)
+        self._set_route(route)
+        header, payload = build_onion(route, self._stream_package(
+            recipient, message, fields))
+        self.foreign_finger = route[0]
+        self.foreign_key = route[0].get_cipher()
+        self.connect()
+        try:
+            self.stream(header, len(payload),
+                        split_chunks(payload, CFG_STREAM_CHUNK_SIZE))
+        finally:
+            self.close()
+
+    def co_send_stream(self, recipient, message, fields=None):
+        """Coroutine of :func:`send_stream`."""
+        route = self._route(recipient)
+        self._set_route(route)
+        header, payload = build_onion(route, self._stream_package(
+            recipient, message, fields))
+        self.foreign_finger = route[0]
+        self.foreign_key = route[0].get_cipher()
+        yield self.co_connect()
+        try:
+            yield self.co_send(Protocol.Stream, {'HEADER': header,
+                                                 'LENGTH': len(payload)})
+            yield self.co_receive(Protocol.Stream)
+            for chunk in split_chunks(payload, CFG_STREAM_CHUNK_SIZE):
+                yield self.conn.send(chunk)
+        finally:
+            self.close()
+
+    def stream(self, header, length, chunks):
+        """
+        Send a streamed onion to the foreign node.
+
+        The header is sent first, and the chunks of the payload once the
+        foreign node is ready for them.
+
+        :param header: Encrypted header of the layer for the foreign node.
+        :param length: Length of the payload.
+        :param chunks: Iterable of the chunks of the payload.
+        """
+        self.send(Protocol.Stream, {'HEADER': header, 'LENGTH': length})
+        self.receive(Protocol.Stream)
+        for chunk in chunks:
+            if chunk:
+                self.conn.send(chunk)
+
+    def _route(self, recipient):
+        """
+        Choose the nodes for a message to pass through.
+
+        :param recipient: Finger of the recipient.
+        :return: List of the Fingers, in the order they are passed
+            through, the last being the recipient.
+        """
+        path = self.fingerspace.get_random_fingers(CFG_PATH_LENGTH)
+        try:
+            path.remove(recipient)
+        except ValueError:
+            pass  # We won't route a message to the recipient
+        return path + [recipient]
+
+    def _set_route(self, route):
+        """
+        Note the route of the message being sent, calling `routed` with it.
+
+        :param route: List of the Fingers the message passes through.
+        """
+        self.route = route
+        if self.routed:
+            self.routed(route)
+
+    def prepare(self, recipient):
+        """
+        Do the work of sending to a recipient that doesn't depend on the
+        message, see :class:`Precomputer`.
+
+        :param recipient: Finger of the recipient.
+        :return: A :class:`Circuit` with its onion built if messages are sent
+            along circuits, else a :class:`PacketHeader`.
+        """
+        route = self._route(recipient)
+        if CFG_CIRCUITS:
+            circuit = Circuit(route)
+            circuit.create_package()
+            return circuit
+        return PacketHeader(route)
+
+    def build_circuit(self, recipient, circuit=None):
+        """
+        Build a circuit to the recipient, see :mod:`distrim.circuits`.
+
+        :param recipient: Finger of the recipient.
+        :param circuit: A :class:`Circuit` prepared for the recipient, if
+            there is one.
+        :return: The :class:`Circuit`, once every node holds it.
+        """
+        circuit = circuit or Circuit(self._route(recipient))
+        self.foreign_finger = circuit.route[0]
+        self.foreign_key = circuit.route[0].get_cipher()
+        self.connect()
+        try:
+            self.circuit(circuit.create_package())
+        finally:
+            self.close()
+        circuit.created = time()
+        return circuit
+
+    def co_build_circuit(self, recipient, circuit=None):
+        """Coroutine of :func:`build_circuit`."""
+        circuit = circuit or Circuit(self._route(recipient))
+        self.foreign_finger = circuit.route[0]
+        self.foreign_key = circuit.route[0].get_cipher()
+        yield self.co_circuit(circuit.create_package())
+        circuit.created = time()
+        yield Return(circuit)
+
+    def send_cell(self, circuit, message, fields=None):
+        """
+        Send a message along a circuit.
+
+        :param circuit: The :class:`Circuit` to the recipient.
+        :param message: Textual message for the recipient to receive.
+        :param fields: Dictionary of other fields for the recipient, if any.
+        """
+        self.foreign_finger = circuit.route[0]
+        self.foreign_key = circuit.route[0].get_cipher()
+        self._set_route(circuit.route)
+        body = self._message_body(message, fields)
+        self.connect()
+        try:
+            self.cell(circuit.cell(MESSAGE, body))
+        finally:
+            self.close()
+
+    def co_send_cell(self, circuit, message, fields=None):
+        """Coroutine of :func:`send_cell`."""
+        self.foreign_finger = circuit.route[0]
+        self.foreign_key = circuit.route[0].get_cipher()
+        self._set_route(circuit.route)
+        body = self._message_body(message, fields)
+        yield self.co_cell(circuit.cell(MESSAGE, body))
+
+    def destroy_circuit(self, circuit):
+        """
+        Tear down a circuit.
+
+        :param circuit: The :class:`Circuit`.
+        """
+        self.foreign_finger = circuit.route[0]
+        self.foreign_key = circuit.route[0].get_cipher()
+        self.connect()
+        try:
+            self.cell(circuit.cell(DESTROY))
+        finally:
+            self.close()
+
+    def co_destroy_circuit(self, circuit):
+        """Coroutine of :func:`destroy_circuit`."""
+        self.foreign_finger = circuit.route[0]
+        self.foreign_key = circuit.route[0].get_cipher()
+        yield self.co_cell(circuit.cell(DESTROY))
+
+    def _message_body(self, message, fields=None):
+        """
+        Construct the body of a message carried by a packet or a circuit.
+        The recipient is known from the route.
+
+        :param message: Textual message for the recipient to receive.
+        :param fields: Dictionary of other fields for the recipient, if any.
+        """
+        contents = dict(fields or {})
+        contents.update({'MESSAGE': message, 'SENDER': self.local_finger.all})
+        return pickle.dumps(contents, CFG_PICKLE_PROTOCOL)
+
+    def _build_packet(self, recipient, message, header=None, fields=None):
+        """
+        Construct a packet of a message, routed to the recipient.
+
+        :param recipient: Finger of the recipient.
+        :param message: Textual message for the recipient to receive.
+        :param header: A :class:`PacketHeader` prepared for the recipient,
+            if there is one.
+        :param fields: Dictionary of other fields for the recipient, if any.
+        :return: The packet, or None if the message doesn't fit in one.
+            `foreign_finger` is set to the first node of its route.
+        """
+        body = self._message_body(message, fields)
+        if len(body) > MAX_BODY:
+            return None
+        try:
+            header = header or PacketHeader(self._route(recipient))
+            packet = header.packet(body)
+        except ValueError as exc:
+            self.log.debug("Not sending as a packet: %s", exc)
+            return None
+        self.foreign_finger = header.route[0]
+        self.foreign_key = header.route[0].get_cipher()
+        self._set_route(header.route)
+        return packet
+
+    def _stream_package(self, recipient, message, fields=None):
+        """
+        Construct the package received by the recipient of a streamed
+        onion. The onion layers encrypt it.
+        """
+        contents = dict(fields or {})
+        contents.update({
+            'MESSAGE': message,
+            'RECIPIENT': recipient.ident,
+            'SENDER': self.local_finger.all,
+        })
+        return pickle.dumps(contents, CFG_PICKLE_PROTOCOL)
+
     def _build_onion(self, recipient, package):
         """
         Construct the onion package
@@ -499,27 +1604,213 @@ class MessageHandler(ConnectionHandler):
                 pickle.dumps(contents, CFG_PICKLE_PROTOCOL))
             next_node = finger
 
+        self._set_route(list(reversed(path)) + [recipient])
         params = {'PACKAGE': package}
         return next_node, params
 
-    def _build_message(self, recipient, message):
+    def _build_message(self, recipient, message, fields=None):
         """
         Construct the final message package received by the recipient.
 
         :param recipient: Finger of the recipient.
         :param message: Textual message for the recipient to receive.
+        :param fields: Dictionary of other fields for the recipient, if any.
         """
-        contents = {
+        contents = dict(fields or {})
+        contents.update({
             'MESSAGE': message,
             'RECIPIENT': recipient.ident,
             'SENDER': self.local_finger.all,
-        }
+        })
         data = pickle.dumps(contents, CFG_PICKLE_PROTOCOL)
 
         cipher = recipient.get_cipher()
         cryptic_data = cipher.encrypt(data)
         return cryptic_data
 
+    def ping(self):
+        """
+        Check that the foreign node is alive.
+
+        :return: The round trip time in seconds.
+        """
+        started = time()
+        self.connect()
+        try:
+            self.send(Protocol.Ping, {'TIME': started})
+            self.receive(Protocol.Pong)
+        finally:
+            self.close()
+        return time() - started
+
+    def co_ping(self):
+        """Coroutine of :func:`ping`."""
+        started = time()
+        yield self.co_connect()
+        try:
+            yield self.co_send(Protocol.Ping, {'TIME': started})
+            yield self.co_receive(Protocol.Pong)
+        finally:
+            self.close()
+        yield Return(time() - started)
+
+    def store(self, recipient, item_id, item, ttl):
+        """
+        Leave mail for an offline node with the foreign node.
+
+        :param recipient: Ident of the offline node.
+        :param item_id: ID of the message, the same at every node holding it.
+        :param item: The message, encrypted for the offline node.
+        :param ttl: Seconds the message should be held for.
+        :return: True if the foreign node holds the message, else False.
+        """
+        self.connect()
+        try:
+            self.send(Protocol.Store, {'IDENT': recipient, 'ID': item_id,
+                                       'ITEM': item, 'TTL': ttl})
+            return self.receive(Protocol.Store)[1].get('STORED', False)
+        finally:
+            self.close()
+
+    def co_store(self, recipient, item_id, item, ttl):
+        """Coroutine of :func:`store`."""
+        yield self.co_connect()
+        try:
+            yield self.co_send(Protocol.Store, {'IDENT': recipient,
+                                                'ID': item_id, 'ITEM': item,
+                                                'TTL': ttl})
+            reply = yield self.co_receive(Protocol.Store)
+        finally:
+            self.close()
+        yield Return(reply[1].get('STORED', False))
+
+    def fetch(self):
+        """
+        Collect the mail the foreign node holds for this node, in one batch.
+
+        :return: List of tuples of the ID and item of each message.
+        """
+        self.connect()
+        try:
+            self.send(Protocol.Fetch, {})
+            items = self.receive(Protocol.Mail)[1].get('ITEMS', [])
+            if items:
+                self.send(Protocol.Fetch,
+                          {'TAKEN': [item_id for item_id, _ in items]})
+        finally:
+            self.close()
+        return items
+
+    def co_fetch(self):
+        """Coroutine of :func:`fetch`."""
+        yield self.co_connect()
+        try:
+            yield self.co_send(Protocol.Fetch, {})
+            reply = yield self.co_receive(Protocol.Mail)
+            items = reply[1].get('ITEMS', [])
+            if items:
+                taken = [item_id for item_id, _ in items]
+                yield self.co_send(Protocol.Fetch, {'TAKEN': taken})
+        finally:
+            self.close()
+        yield Return(items)
+
+    def packet(self, packet):
+        """Send a packet on to the next node, see :mod:`distrim.sphinx`."""
+        self.conn.send(Protocol.Packet + packet)
+
+    def co_packet(self, packet):
+        """Coroutine of :func:`packet`, connects to the next node first."""
+        yield self.co_connect()
+        try:
+            yield self.conn.send(Protocol.Packet + packet)
+        finally:
+            self.close()
+
+    def circuit(self, package):
+        """
+        Extend a circuit through the foreign node, waiting for the rest of
+        it to be built.
+
+        Raises a :class:`RelayDownError` if a node reports that the next
+        node of the circuit is down.
+        """
+        self.send(Protocol.Circuit, {'PACKAGE': package})
+        self._created(*self.receive())
+
+    def co_circuit(self, package):
+        """Coroutine of :func:`circuit`, connects to the next node first."""
+        yield self.co_connect()
+        try:
+            yield self.co_send(Protocol.Circuit, {'PACKAGE': package})
+            reply = yield self.co_receive()
+            self._created(*reply)
+        finally:
+            self.close()
+
+    @staticmethod
+    def _created(msg_type, params):
+        """
+        Check the reply to extending a circuit.
+
+        :param msg_type: Type of the reply.
+        :param params: Parameters of the reply.
+        """
+        if msg_type == Protocol.Down:
+            raise RelayDownError(params.get('IDENT'))
+        if msg_type != Protocol.Circuit:
+            raise ProcedureError("Expected message type '%s' but got '%s'"
+                                 % (Protocol.Circuit, msg_type))
+
+    def cell(self, cell):
+        """Send a cell on to the next node, see :mod:`distrim.circuits`."""
+        self.conn.send(Protocol.Cell + cell)
+
+    def co_cell(self, cell):
+        """Coroutine of :func:`cell`, connects to the next node first."""
+        yield self.co_connect()
+        try:
+            yield self.conn.send(Protocol.Cell + cell)
+        finally:
+            self.close()
+
     def relay(self, package):
+        """Send a package on to the next node."""
         params = {'PACKAGE': package}
         self.send(Protocol.Relay, params)
+
+    def co_relay(self, package):
+        """Coroutine of :func:`relay`, connects to the next node first."""
+        yield self.co_connect()
+        try:
+            yield self.co_send(Protocol.Relay, {'PACKAGE': package})
+        finally:
+            self.close()
+
+
+def tag_lane(data, lane):
+    """
+    Tag an encrypted frame with the lane its message is handled in.
+
+    :param data: String of the frame.
+    :param lane: Name of the lane, frames for 'control' aren't tagged.
+    :return: String of the tagged frame.
+    """
+    if lane == 'control':
+        return data
+    return Protocol.Lane + chr(len(lane)) + lane + data
+
+
+def split_lane(data):
+    """
+    Read the lane tag of a frame, see :func:`tag_lane`.
+
+    :param data: String of the frame.
+    :return: Tuple of the name of the lane, or None if it isn't tagged, and
+        the frame without its tag.
+    """
+    start = len(Protocol.Lane) + 1
+    if len(data) < start or not data.startswith(Protocol.Lane):
+        return None, data
+    end = start + ord(data[start - 1])
+    return data[start:end], data[end:]
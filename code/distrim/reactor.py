@@ -0,0 +1,502 @@
+# -*- coding: utf-8 -*-
+## This file is part of DistrIM.
+##
+## DistrIM is a DHT-based network for secured messaging.
+##
+##     Author: Graham Armstrong
+## Student ID: 11004764
+##      Email: graham.armstrong@northumbria.ac.uk
+##
+## Product for CM0645 Individual Project, academic year 2014/15.
+##
+## This product has been developed in partial fulfilment of the regulations
+## governing the award of the Degree of BSc (Honours) Computer Science
+## at the University of Northumbria at Newcastle.
+
+
+
+"""
+    Reactor, an event loop for non-blocking sockets.
+
+    Coroutines are generator functions that yield an :class:`Operation` when
+    they need to wait on a socket. The :class:`EventLoop` resumes them with
+    the result once the socket is ready, or throws the error into them. A
+    coroutine may also yield another coroutine to call it, :class:`Return` to
+    hand a value back to its caller, or :class:`Spawn` to start another
+    coroutine running alongside it.
+"""
+
+import os
+import sys
+import errno
+import select
+import socket
+import struct
+
+from time import time
+from types import GeneratorType
+from collections import deque
+from threading import Event, Lock
+
+from .assets.errors import SockWrapError
+from .utils.config import CFG_STRUCT_FMT, CFG_TIMEOUT, CFG_READ_SIZE
+
+
+READ = select.POLLIN
+WRITE = select.POLLOUT
+_BLOCKING = (errno.EAGAIN, errno.EWOULDBLOCK)
+_IN_PROGRESS = (errno.EINPROGRESS, errno.EALREADY, errno.EWOULDBLOCK)
+HEADER_SIZE = struct.calcsize(CFG_STRUCT_FMT)
+
+
+class Return(object):
+    """Yielded by a coroutine to return a value to its caller."""
+    def __init__(self, value=None):
+        """
+        :param value: The value to return.
+        """
+        self.value = value
+
+
+class Spawn(object):
+    """Yielded by a coroutine to start another alongside it."""
+    def __init__(self, coroutine):
+        """
+        :param coroutine: The generator to run.
+        """
+        self.coroutine = coroutine
+
+
+class FrameBuffer(object):
+    """
+    Reassembles length prefixed frames from data received in pieces.
+
+    Frames are packed in the same way as by :class:`SocketWrapper`. Received
+    data is only joined together once enough has arrived to complete the
+    length or the frame, so large frames aren't copied for every piece.
+    """
+    def __init__(self):
+        self.frames = deque()
+        self._chunks = []
+        self._buffered = 0
+        self._length = None
+
+    def feed(self, data):
+        """
+        Add received data, completing any frames that it can.
+
+        :param data: String of received data.
+        """
+        self._chunks.append(data)
+        self._buffered += len(data)
+        while True:
+            needed = HEADER_SIZE if self._length is None else self._length
+            if self._buffered < needed:
+                break
+            joined = ''.join(self._chunks)
+            if self._length is None:
+                self._length = struct.unpack(CFG_STRUCT_FMT,
+                                             joined[:HEADER_SIZE])[0]
+                rest = joined[HEADER_SIZE:]
+            else:
+                self.frames.append(joined[:needed])
+                self._length = None
+                rest = joined[needed:]
+            self._chunks = [rest] if rest else []
+            self._buffered = len(rest)
+
+    def pop(self):
+        """
+        Take the oldest complete frame.
+
+        :return: The frame, or `None` if no frame is complete.
+        """
+        return self.frames.popleft() if self.frames else None
+
+
+class Operation(object):
+    """
+    An operation on a non-blocking socket.
+
+    :func:`attempt` is called first straight away, and then each time the
+    socket becomes ready, until the operation is done.
+    """
+    events = READ
+    timeout = CFG_TIMEOUT
+
+    def __init__(self, sock):
+        """
+        :param sock: The non-blocking `socket` to operate on.
+        """
+        self.sock = sock
+        self.deadline = None
+
+    def fileno(self):
+        """File descriptor of the socket."""
+        return self.sock.fileno()
+
+    def attempt(self):
+        """
+        Try to perform the operation without blocking.
+
+        :return: Tuple of whether the operation is done, and its result.
+        """
+        raise NotImplementedError()
+
+
+class Accept(Operation):
+    """Accept a connection on a listening socket, result is (sock, addr)"""
+    timeout = None
+
+    def attempt(self):
+        try:
+            sock, address = self.sock.accept()
+        except socket.error as exc:
+            if exc.errno in _BLOCKING:
+                return False, None
+            raise
+        sock.setblocking(0)
+        return True, (sock, address)
+
+
+class Connect(Operation):
+    """Connect a socket to a remote address."""
+    events = WRITE
+
+    def __init__(self, sock, remote_address):
+        """
+        :param sock: The non-blocking `socket` to connect.
+        :param remote_address: IP and Port of the remote host.
+        """
+        super(Connect, self).__init__(sock)
+        self.remote_address = remote_address
+        self._started = False
+
+    def attempt(self):
+        if not self._started:
+            self._started = True
+            error = self.sock.connect_ex(self.remote_address)
+            if error in _IN_PROGRESS:
+                return False, None
+        else:
+            error = self.sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+        if error and error != errno.EISCONN:
+            raise socket.error(error, os.strerror(error))
+        return True, None
+
+
+class ReadFrame(Operation):
+    """Receive a whole frame, result is the frame."""
+    def __init__(self, stream):
+        """
+        :param stream: The :class:`AsyncSocket` to read from.
+        """
+        super(ReadFrame, self).__init__(stream.sock)
+        self.buffer = stream.buffer
+
+    def attempt(self):
+        while not self.buffer.frames:
+            try:
+                data = self.sock.recv(CFG_READ_SIZE)
+            except socket.error as exc:
+                if exc.errno in _BLOCKING:
+                    return False, None
+                raise
+            if not data:
+                raise socket.error(errno.ECONNRESET, "Connection closed")
+            self.buffer.feed(data)
+        return True, self.buffer.pop()
+
+
+class WriteData(Operation):
+    """Send all of some data."""
+    events = WRITE
+
+    def __init__(self, sock, data):
+        """
+        :param sock: The non-blocking `socket` to write to.
+        :param data: String of data to send.
+        """
+        super(WriteData, self).__init__(sock)
+        self.data = data
+
+    def attempt(self):
+        while self.data:
+            try:
+                sent = self.sock.send(self.data)
+            except socket.error as exc:
+                if exc.errno in _BLOCKING:
+                    return False, None
+                raise
+            self.data = self.data[sent:]
+        return True, None
+
+
+class AsyncSocket(object):
+    """
+    Non-blocking counterpart of :class:`SocketWrapper`.
+
+    The methods have the same names as those of :class:`SocketWrapper` but
+    return operations, which a coroutine yields to get the result.
+    """
+    def __init__(self, sock=None, remote_address=None):
+        """
+        :param sock: the `socket` object. If None, a socket is created using
+            the default values.
+        :param remote_address: IP and Port of the remote host.
+        """
+        if not sock:
+            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setblocking(0)
+        self.sock = sock
+        self.remote_address = remote_address
+        self.buffer = FrameBuffer()
+
+    def connect(self, remote_address=None):
+        """
+        Connect the socket to the remote address.
+
+        :param remote_address: IP and Port of the remote host.
+        :return: A :class:`Connect` operation.
+        """
+        remote_address = remote_address or self.remote_address
+        if not remote_address:
+            raise SockWrapError("Connect to what? No remote address.")
+        return Connect(self.sock, remote_address)
+
+    def receive(self):
+        """
+        Receive a frame from the foreign node.
+
+        :return: A :class:`ReadFrame` operation.
+        """
+        return ReadFrame(self)
+
+    def send(self, data):
+        """
+        Send a frame to the foreign node.
+
+        :param data: The data packet to send.
+        :return: A :class:`WriteData` operation.
+        """
+        return WriteData(self.sock,
+                         struct.pack(CFG_STRUCT_FMT, len(data)) + data)
+
+    def close(self):
+        """Close connection with the foreign node."""
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except socket.error:
+            pass
+        self.sock.close()
+
+
+class Task(object):
+    """A coroutine running in an :class:`EventLoop`."""
+    def __init__(self, coroutine, callback=None):
+        """
+        :param coroutine: The generator to run.
+        :param callback: Called with this task once it has finished.
+        """
+        self.stack = [coroutine]
+        self.callback = callback
+        self.result = None
+        self.error = None
+        self._finished = Event()
+
+    def finish(self, result=None, error=None):
+        """
+        Mark the task as finished.
+
+        :param result: Value returned by the coroutine.
+        :param error: Exception raised by the coroutine.
+        """
+        self.result = result
+        self.error = error
+        self._finished.set()
+        if self.callback:
+            self.callback(self)
+
+    def done(self):
+        """True once the task has finished."""
+        return self._finished.is_set()
+
+    def wait(self, timeout=None):
+        """
+        Block until the task has finished, from outside the event loop.
+
+        :param timeout: Seconds to wait, or `None` to wait indefinitely.
+        :return: The value returned by the coroutine.
+        """
+        if not self._finished.wait(timeout):
+            raise SockWrapError("Timed out waiting for task.")
+        if self.error:
+            raise self.error  # pylint: disable=raising-bad-type
+        return self.result
+
+
+class EventLoop(object):
+    """
+    Runs coroutines, waiting on all of their sockets at once with `epoll`,
+    or `poll` where `epoll` isn't available.
+
+    :func:`run` is the target of a thread, other threads hand coroutines to
+    the loop with :func:`spawn`.
+    """
+    def __init__(self, parent_log):
+        """
+        :param parent_log: logger object from the owner of the loop.
+        """
+        self.log = parent_log.getChild(__name__.rpartition('.')[2])
+        if hasattr(select, 'epoll'):
+            self._poller, self._poll_scale = select.epoll(), 1
+        else:
+            self._poller, self._poll_scale = select.poll(), 1000
+        self._waiting = {}
+        self._spawned = deque()
+        self._spawn_lock = Lock()
+        self._wake_read, self._wake_write = os.pipe()
+        self._poller.register(self._wake_read, READ)
+        self._running = False
+
+    def spawn(self, coroutine, callback=None):
+        """
+        Start running a coroutine. Safe to call from any thread.
+
+        :param coroutine: The generator to run.
+        :param callback: Called in the loop with the task once finished.
+        :return: The :class:`Task` running the coroutine.
+        """
+        task = Task(coroutine, callback)
+        with self._spawn_lock:
+            self._spawned.append(task)
+        os.write(self._wake_write, 'x')
+        return task
+
+    def stop(self):
+        """Stop the loop, tasks still waiting are abandoned."""
+        self._running = False
+        os.write(self._wake_write, 'x')
+
+    def run(self):
+        """
+        Run the loop until stopped.
+
+        This method is the target of a thread.
+        """
+        self._running = True
+        while self._running:
+            with self._spawn_lock:
+                spawned, self._spawned = self._spawned, deque()
+            for task in spawned:
+                self._step(task)
+
+            for fileno, _ in self._poller.poll(self._next_timeout()):
+                if fileno == self._wake_read:
+                    os.read(self._wake_read, 4096)
+                elif fileno in self._waiting:
+                    task, operation = self._waiting.pop(fileno)
+                    self._unregister(fileno)
+                    self._step(task, operation=operation)
+            self._expire()
+        self.log.debug("Event loop stopped.")
+
+    def _next_timeout(self):
+        """Time to poll for before the next operation times out."""
+        deadlines = [operation.deadline
+                     for _, operation in self._waiting.itervalues()
+                     if operation.deadline]
+        if not deadlines:
+            return -1
+        return max(0, min(deadlines) - time()) * self._poll_scale
+
+    def _expire(self):
+        """Throw an error into tasks whose operations have timed out."""
+        now = time()
+        for fileno, (task, operation) in self._waiting.items():
+            if operation.deadline and operation.deadline < now:
+                del self._waiting[fileno]
+                self._unregister(fileno)
+                error = SockWrapError("Timed out waiting on socket.")
+                self._step(task, error=(SockWrapError, error, None))
+
+    def _unregister(self, fileno):
+        """Stop polling a file descriptor, which may already be closed."""
+        try:
+            self._poller.unregister(fileno)
+        except (IOError, OSError, KeyError):
+            pass
+
+    def _wait(self, task, operation):
+        """Park a task until the socket of its operation is ready."""
+        if operation.timeout and not operation.deadline:
+            operation.deadline = time() + operation.timeout
+        fileno = operation.fileno()
+        self._waiting[fileno] = (task, operation)
+        self._poller.register(fileno, operation.events)
+
+    def _step(self, task, value=None, error=None, operation=None):
+        """
+        Advance a task until it waits on a socket or finishes.
+
+        :param task: The :class:`Task` to advance.
+        :param value: Value to send into the current coroutine.
+        :param error: Exception info to throw into the current coroutine.
+        :param operation: An operation to attempt before resuming.
+        """
+        while True:
+            if operation:
+                try:
+                    done, value = operation.attempt()
+                except socket.error as exc:
+                    error = (SockWrapError, SockWrapError(
+                        "Socket error: %s" % (exc.strerror or exc,)), None)
+                    done = True
+                if not done:
+                    self._wait(task, operation)
+                    return
+                operation = None
+
+            coroutine = task.stack[-1]
+            try:
+                if error:
+                    yielded = coroutine.throw(*error)
+                else:
+                    yielded = coroutine.send(value)
+                value, error = None, None
+            except StopIteration:
+                yielded = Return()
+                value, error = None, None
+            except Exception:  # pylint: disable=broad-except
+                task.stack.pop()
+                value, error = None, sys.exc_info()
+                if not task.stack:
+                    self._finish(task, error=error[1])
+                    return
+                continue
+
+            if isinstance(yielded, Return):
+                task.stack.pop().close()
+                value = yielded.value
+                if not task.stack:
+                    self._finish(task, result=value)
+                    return
+            elif isinstance(yielded, GeneratorType):
+                task.stack.append(yielded)
+            elif isinstance(yielded, Spawn):
+                value = Task(yielded.coroutine)
+                self._step(value)
+            elif isinstance(yielded, Operation):
+                operation = yielded
+            else:
+                error = (TypeError, TypeError(
+                    "Coroutine yielded %r" % (yielded,)), None)
+
+    def _finish(self, task, result=None, error=None):
+        """Finish a task, logging any error nobody will hear about."""
+        if error and not task.callback:
+            self.log.error("Task failed: %s", error)
+        try:
+            task.finish(result, error)
+        except Exception as exc:  # pylint: disable=broad-except
+            self.log.error("Task callback failed: %s", exc)
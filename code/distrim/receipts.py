@@ -0,0 +1,351 @@
+# -*- coding: utf-8 -*-
+## This file is part of DistrIM.
+##
+## DistrIM is a DHT-based network for secured messaging.
+##
+##     Author: Graham Armstrong
+## Student ID: 11004764
+##      Email: graham.armstrong@northumbria.ac.uk
+##
+## Product for CM0645 Individual Project, academic year 2014/15.
+##
+## This product has been developed in partial fulfilment of the regulations
+## governing the award of the Degree of BSc (Honours) Computer Science
+## at the University of Northumbria at Newcastle.
+
+
+
+"""
+    Delivery receipts, end-to-end acknowledgements of messages.
+
+    A message asking for a receipt carries a :class:`ReplyBlock`, a packet
+    header routed back to the sender through relays of its choosing. The
+    recipient replies along it with the ID of the receipt, without learning
+    the route back, and the sender notes the round trip time of the message
+    and of the route it was sent along.
+"""
+
+import pickle
+
+from time import time
+from collections import OrderedDict, deque
+from Queue import Queue, Empty
+from threading import Thread, Lock, Event
+
+from .protocol import MessageHandler
+from .sphinx import ReplyBlock, reply_packet, HEADER_SIZE, KEY_SIZE
+from .assets.errors import ProtocolError
+from .utils.config import (CFG_PATH_LENGTH, CFG_PICKLE_PROTOCOL,
+                           CFG_IDENT_LENGTH,
+                           CFG_RECEIPT_TIMEOUT, CFG_RECEIPT_SAMPLES,
+                           CFG_RECEIPT_PATHS, CFG_RECEIPT_SLOW)
+
+
+class Receipt(object):
+    """A receipt this node is waiting for."""
+    def __init__(self, recipient, block):
+        """
+        :param recipient: Finger of the recipient.
+        :param block: The :class:`ReplyBlock` the receipt comes back along.
+        """
+        self.id = block.id.encode('hex')
+        self.recipient = recipient
+        self.block = block
+        self.route = None
+        self.sent = time()
+        self.latency = None
+        self.event = Event()
+
+
+class Receipts(object):
+    """
+    The receipts asked for by this node, and those it owes to others.
+
+    Receipts not returned within `timeout` seconds are given up on, the
+    message or the receipt having been lost. Latencies are kept for the last
+    `samples` receipts, and averaged for each of the last `paths` routes
+    messages were sent along, so that slow routes can be told apart and
+    left for others.
+
+    Receipts owed to other nodes are sent by a thread, so that receiving a
+    message never waits on the route back.
+    """
+    def __init__(self, parent_log, fingerspace, local_finger, local_keys,
+                 timeout=CFG_RECEIPT_TIMEOUT, samples=CFG_RECEIPT_SAMPLES,
+                 paths=CFG_RECEIPT_PATHS, slow=CFG_RECEIPT_SLOW):
+        """
+        :param parent_log: Logger of the :class:`ConnectionsManager`.
+        :param fingerspace: The FingerSpace instance of this node.
+        :param local_finger: The Finger of this node.
+        :param local_keys: The CipherWrapper of this node.
+        :param timeout: Seconds a receipt is waited for.
+        :param samples: Latencies kept for the percentiles.
+        :param paths: Routes latencies are kept for.
+        :param slow: Times the median latency a route is slow at.
+        """
+        self.log = parent_log.getChild(__name__.rpartition('.')[2])
+        self.fingerspace = fingerspace
+        self.local_finger = local_finger
+        self.local_keys = local_keys
+        self.timeout = timeout
+        self.paths = paths
+        self.slow_factor = slow
+        self._waiting = {}
+        self._latencies = deque(maxlen=samples)
+        self._paths = OrderedDict()
+        self._owed = Queue()
+        self._lock = Lock()
+        self._running = False
+        self._thread = Thread(target=self._replying, name='Thread-Receipts')
+        self._thread.daemon = True
+
+        self.count_requested = 0
+        self.count_delivered = 0
+        self.count_expired = 0
+        self.count_replied = 0
+        self.count_failed = 0
+
+    def start(self):
+        """Begin the replying thread."""
+        self._running = True
+        self._thread.start()
+
+    def stop(self):
+        """End the replying thread, dropping receipts still owed."""
+        self._running = False
+
+    def request(self, recipient):
+        """
+        Ask for a receipt of a message.
+
+        The route back passes through other relays than the recipient.
+
+        :param recipient: Finger of the recipient.
+        :return: Tuple of the ID of the receipt, and the fields to send
+            with the message.
+        """
+        relays = [finger for finger
+                  in self.fingerspace.get_random_fingers(CFG_PATH_LENGTH + 1)
+                  if finger not in (recipient, self.local_finger)]
+        block = ReplyBlock(relays[:CFG_PATH_LENGTH] + [self.local_finger])
+        receipt = Receipt(recipient, block)
+        with self._lock:
+            self._purge()
+            self._waiting[receipt.id] = receipt
+            self.count_requested += 1
+        return receipt.id, {'RECEIPT': block.surb}
+
+    def sent(self, receipt_id, route):
+        """
+        Note the route a message asking for a receipt was sent along.
+
+        This is called before the message is sent, so that a receipt coming
+        straight back is measured against its route.
+
+        :param receipt_id: ID of the receipt.
+        :param route: List of the Fingers the message passes through, the
+            last being the recipient.
+        """
+        with self._lock:
+            receipt = self._waiting.get(receipt_id)
+            if receipt is not None:
+                receipt.route = tuple(finger.ident for finger in route)
+
+    def cancel(self, receipt_id):
+        """
+        Stop waiting for a receipt, as its message couldn't be sent.
+
+        :param receipt_id: ID of the receipt.
+        """
+        with self._lock:
+            self._waiting.pop(receipt_id, None)
+
+    def reply_block(self, reply_id):
+        """
+        Get the :class:`ReplyBlock` of a receipt arriving, see
+        :func:`peel_packet`.
+
+        :param reply_id: ID in the header of the receipt.
+        :return: The block, or None if the receipt isn't waited for.
+        """
+        with self._lock:
+            receipt = self._waiting.get(reply_id.encode('hex'))
+        return receipt.block if receipt else None
+
+    def delivered(self, receipt_id):
+        """
+        Note that a receipt has arrived.
+
+        :param receipt_id: ID of the receipt.
+        :return: The round trip time in seconds, or None if the receipt
+            wasn't waited for.
+        """
+        with self._lock:
+            receipt = self._waiting.pop(receipt_id, None)
+            if receipt is None:
+                return None
+            receipt.latency = time() - receipt.sent
+            self._latencies.append(receipt.latency)
+            if receipt.route:
+                count, mean = self._paths.pop(receipt.route, (0, 0.0))
+                count += 1
+                mean += (receipt.latency - mean) / count
+                self._paths[receipt.route] = (count, mean)
+                if len(self._paths) > self.paths:
+                    self._paths.popitem(last=False)
+            self.count_delivered += 1
+        receipt.event.set()
+        self.log.info("Message to %s delivered in %.3fs",
+                      receipt.recipient.ident, receipt.latency)
+        return receipt.latency
+
+    def wait(self, receipt_id, timeout=None):
+        """
+        Wait for a receipt to arrive.
+
+        :param receipt_id: ID of the receipt.
+        :param timeout: Seconds to wait, the receipt timeout if None.
+        :return: The round trip time in seconds, or None if the receipt
+            hasn't arrived.
+        """
+        with self._lock:
+            receipt = self._waiting.get(receipt_id)
+        if receipt is None:
+            return None
+        receipt.event.wait(self.timeout if timeout is None else timeout)
+        return receipt.latency
+
+    def latency(self, route):
+        """
+        Get the mean round trip time of messages sent along a route.
+
+        :param route: List of the Fingers of the route.
+        :return: The mean in seconds, or None if none have been measured.
+        """
+        with self._lock:
+            entry = self._paths.get(tuple(finger.ident for finger in route))
+        return entry[1] if entry else None
+
+    def slow(self, route):
+        """
+        Check whether messages sent along a route are slow, their mean round
+        trip time being over `slow_factor` times the median of all of them.
+
+        :param route: List of the Fingers of the route.
+        :return: True if the route is slow, else False.
+        """
+        mean = self.latency(route)
+        if mean is None:
+            return False
+        with self._lock:
+            latencies = sorted(self._latencies)
+        return mean > self.slow_factor * latencies[len(latencies) // 2]
+
+    def acknowledge(self, surb):
+        """
+        Queue a receipt owed for a message received by this node.
+
+        A reply block that isn't well formed is dropped.
+
+        :param surb: The reply block sent with the message, see
+            :attr:`ReplyBlock.surb`.
+        """
+        if not _valid_surb(surb):
+            self.count_failed += 1
+            self.log.warning("Dropping a malformed reply block.")
+            return
+        self._owed.put(surb)
+
+    def metrics(self):
+        """
+        Get the metrics of the receipts.
+
+        :return: Dictionary of the number of receipts waited for, the counts
+            of receipts, and the mean and percentiles of the latencies.
+        """
+        with self._lock:
+            latencies = sorted(self._latencies)
+            metrics = {'waiting': len(self._waiting),
+                       'requested': self.count_requested,
+                       'delivered': self.count_delivered,
+                       'expired': self.count_expired,
+                       'replied': self.count_replied,
+                       'failed': self.count_failed}
+        metrics['mean'] = (sum(latencies) / len(latencies)
+                           if latencies else 0.0)
+        for name, fraction in (('p50', 0.5), ('p95', 0.95)):
+            metrics[name] = (latencies[int(fraction * (len(latencies) - 1))]
+                             if latencies else 0.0)
+        return metrics
+
+    def _purge(self):
+        """Give up on receipts waited for too long. Lock must be held."""
+        now = time()
+        for receipt_id, receipt in self._waiting.items():
+            if now - receipt.sent >= self.timeout:
+                del self._waiting[receipt_id]
+                self.count_expired += 1
+
+    def _replying(self):
+        """
+        Send the receipts owed to other nodes, and give up on those waited
+        for too long.
+
+        This method is the target of `self._thread`
+        """
+        while self._running:
+            try:
+                surb = self._owed.get(timeout=1)
+            except Empty:
+                with self._lock:
+                    self._purge()
+                continue
+            try:
+                self._reply(surb)
+                self.count_replied += 1
+            except Exception as exc:  # pylint: disable=broad-except
+                self.count_failed += 1
+                self.log.warning("Couldn't send receipt: %s", exc)
+        self.log.debug("Receipt thread stopped.")
+
+    def _reply(self, surb):
+        """
+        Send a receipt back along a reply block.
+
+        :param surb: The reply block sent with the message.
+        """
+        receipt_id, first = surb[:2]
+        body = pickle.dumps({'DELIVERED': receipt_id.encode('hex')},
+                            CFG_PICKLE_PROTOCOL)
+        packet = reply_packet(surb, body)
+        self.fingerspace.put(*first)
+        finger = self.fingerspace.get(first[-1])
+        if finger is None:
+            raise ProtocolError("First node of receipt isn't known.")
+        out = MessageHandler(self.log, self.fingerspace, self.local_finger,
+                             self.local_keys, finger)
+        out.connect()
+        try:
+            out.packet(packet)
+        finally:
+            out.close()
+
+
+def _valid_surb(surb):
+    """
+    Check the shape of a reply block sent with a message.
+
+    :param surb: The reply block, see :attr:`ReplyBlock.surb`.
+    :return: True if it can be replied along, else False.
+    """
+    try:
+        reply_id, first, header, key = surb
+        addr, port, public_key, ident = first
+    except (TypeError, ValueError):
+        return False
+    return (isinstance(reply_id, str) and len(reply_id) == CFG_IDENT_LENGTH
+            and isinstance(port, int)
+            and all(isinstance(value, str)
+                    for value in (addr, public_key, ident))
+            and isinstance(header, str) and len(header) == HEADER_SIZE
+            and isinstance(key, str) and len(key) == KEY_SIZE)
@@ -0,0 +1,193 @@
+# -*- coding: utf-8 -*-
+## This file is part of DistrIM.
+##
+## DistrIM is a DHT-based network for secured messaging.
+##
+##     Author: Graham Armstrong
+## Student ID: 11004764
+##      Email: graham.armstrong@northumbria.ac.uk
+##
+## Product for CM0645 Individual Project, academic year 2014/15.
+##
+## This product has been developed in partial fulfilment of the regulations
+## governing the award of the Degree of BSc (Honours) Computer Science
+## at the University of Northumbria at Newcastle.
+
+
+"""
+    Relay Queues, store and forward relayed packages to the next node.
+"""
+
+from time import time, sleep
+from Queue import Queue, Empty, Full
+from threading import Thread, Lock
+
+from .protocol import MessageHandler
+from .assets.errors import BusyError, ProtocolError, SockWrapError
+from .utils.config import (CFG_RELAY_QUEUE_LENGTH, CFG_RELAY_RETRIES,
+                           CFG_RELAY_RETRY_DELAY, CFG_RELAY_IDLE_TIMEOUT,
+                           CFG_TIMEOUT)
+
+
+class RelayQueues(object):
+    """
+    Queues of packages waiting to be relayed, one for each next node.
+
+    A thread for each queue connects to its node and sends the packages in
+    turn, retrying failed sends with a growing delay. A thread whose queue
+    stays empty for `idle_timeout` seconds stops, and the queue is removed.
+
+    The thread handling an incoming relay only has to peel its layer and
+    queue it, so a slow next node doesn't hold it up.
+    """
+    def __init__(self, parent_log, fingerspace, local_finger, local_keys,
+                 length=CFG_RELAY_QUEUE_LENGTH, retries=CFG_RELAY_RETRIES,
+                 delay=CFG_RELAY_RETRY_DELAY,
+                 idle_timeout=CFG_RELAY_IDLE_TIMEOUT):
+        """
+        :param parent_log: Logger of the :class:`ConnectionsManager`.
+        :param fingerspace: The FingerSpace instance of this node.
+        :param local_finger: The Finger of this node.
+        :param local_keys: The CipherWrapper of this node.
+        :param length: Most packages queued for one node.
+        :param retries: Times to retry sending a package.
+        :param delay: Seconds before the first retry, doubled after each.
+        :param idle_timeout: Seconds before an empty queue is removed.
+        """
+        self.log = parent_log.getChild(__name__.rpartition('.')[2])
+        self.fingerspace = fingerspace
+        self.local_finger = local_finger
+        self.local_keys = local_keys
+        self.length = length
+        self.retries = retries
+        self.delay = delay
+        self.idle_timeout = idle_timeout
+        self._queues = {}
+        self._senders = {}
+        self._lock = Lock()
+        self._running = True
+
+        self.count_queued = 0
+        self.count_relayed = 0
+        self.count_retried = 0
+        self.count_dropped = 0
+
+    def put(self, finger, package, procedure='relay'):
+        """
+        Queue a package to be relayed.
+
+        Raises a :class:`BusyError` if the queue of the node is full.
+
+        :param finger: Finger of the next node.
+        :param package: The package to relay.
+        :param procedure: Name of the :class:`MessageHandler` method sending
+            it, 'relay', 'packet' or 'cell'.
+        """
+        with self._lock:
+            if not self._running:
+                raise BusyError("Relay queues have been stopped.")
+            queue = self._queues.get(finger.ident)
+            if queue is None:
+                queue = self._queues[finger.ident] = Queue(self.length)
+                sender = Thread(target=self._sending, args=(finger, queue),
+                                name='Thread-Relay-%s' % finger.ident)
+                sender.daemon = True
+                self._senders[finger.ident] = sender
+                sender.start()
+            try:
+                queue.put_nowait((package, procedure, time()))
+            except Full:
+                self.count_dropped += 1
+                raise BusyError("Relay queue to %s is full." % finger.ident)
+            self.count_queued += 1
+
+    def stop(self):
+        """
+        Stop the sending threads.
+
+        Packages being sent are finished, those still queued are dropped.
+        """
+        with self._lock:
+            self._running = False
+            senders = self._senders.values()
+        for sender in senders:
+            sender.join(CFG_TIMEOUT)
+        with self._lock:
+            for queue in self._queues.values():
+                self.count_dropped += queue.qsize()
+            self._queues.clear()
+
+    def metrics(self):
+        """
+        Get the metrics of the relay queues.
+
+        :return: Dictionary of the numbers of queues and packages waiting,
+            and the counts of packages.
+        """
+        with self._lock:
+            return {'queues': len(self._queues),
+                    'waiting': sum(queue.qsize()
+                                   for queue in self._queues.values()),
+                    'queued': self.count_queued,
+                    'relayed': self.count_relayed,
+                    'retried': self.count_retried,
+                    'dropped': self.count_dropped}
+
+    def _sending(self, finger, queue):
+        """
+        Relay the packages queued for a node.
+
+        This method is the target of each sending thread.
+
+        :param finger: Finger of the next node.
+        :param queue: Queue of the packages for it.
+        """
+        idle_since = time()
+        while self._running:
+            try:
+                package, procedure, queued = queue.get(timeout=1)
+            except Empty:
+                if time() - idle_since < self.idle_timeout:
+                    continue
+                with self._lock:
+                    if queue.empty():
+                        del self._queues[finger.ident]
+                        del self._senders[finger.ident]
+                        return
+                continue
+            self.log.debug("Relaying to %s, queued %.3fs", finger.ident,
+                           time() - queued)
+            self._relay(finger, package, procedure)
+            idle_since = time()
+
+    def _relay(self, finger, package, procedure='relay'):
+        """
+        Send a package to a node, retrying if it fails. A node that can't
+        be sent to at all is marked as down, so it's routed around.
+
+        :param finger: Finger of the next node.
+        :param package: The package to relay.
+        :param procedure: Name of the method sending it.
+        :return: True if it was sent, else False.
+        """
+        for attempt in xrange(self.retries + 1):
+            if attempt:
+                self.count_retried += 1
+                sleep(self.delay * 2 ** (attempt - 1))
+            out = MessageHandler(self.log, self.fingerspace,
+                                 self.local_finger, self.local_keys, finger)
+            try:
+                out.connect()
+                getattr(out, procedure)(package)
+                self.count_relayed += 1
+                return True
+            except (SockWrapError, ProtocolError) as exc:
+                self.log.warning("Relaying to %s failed, attempt %d: %s",
+                                 finger.ident, attempt + 1, exc.message)
+            finally:
+                out.close()
+        self.log.error("Dropping package for %s after %d attempts",
+                       finger.ident, self.retries + 1)
+        self.fingerspace.dead.mark(finger.ident)
+        self.count_dropped += 1
+        return False
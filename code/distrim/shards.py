@@ -0,0 +1,376 @@
+# -*- coding: utf-8 -*-
+## This file is part of DistrIM.
+##
+## DistrIM is a DHT-based network for secured messaging.
+##
+##     Author: Graham Armstrong
+## Student ID: 11004764
+##      Email: graham.armstrong@northumbria.ac.uk
+##
+## Product for CM0645 Individual Project, academic year 2014/15.
+##
+## This product has been developed in partial fulfilment of the regulations
+## governing the award of the Degree of BSc (Honours) Computer Science
+## at the University of Northumbria at Newcastle.
+
+
+"""
+    Listener Shards, spread incoming connections over several processes.
+"""
+
+import pickle
+import socket
+import itertools
+
+from Queue import Empty
+from functools import partial
+from threading import Thread, Event, Lock, local
+from multiprocessing import Process, Queue
+from Crypto import Random
+
+from .utils.config import CFG_TIMEOUT
+from .assets.errors import ProtocolError
+
+# Python 2 doesn't define the option, this is its value on Linux.
+SO_REUSEPORT = getattr(socket, 'SO_REUSEPORT', 15)
+
+# Methods of the state held by the node that workers call, by the key of the
+# state in `ConnectionsManager.state`.
+SHARED_STATE = {
+    'circuits': ('add', 'remove', 'peel'),
+    'transfers': ('receive', 'acknowledge'),
+    'receipts': ('reply_block', 'delivered', 'acknowledge'),
+    'inbox': ('add',),
+    'mail': ('store', 'peek', 'take'),
+}
+
+
+class ListenerShards(object):
+    """
+    Worker processes listening on the same port as the node.
+
+    Every socket bound to the port sets `SO_REUSEPORT`, so the kernel spreads
+    incoming connections between the node and its workers. The RSA work of
+    handling them then runs on several cores rather than behind one GIL.
+
+    Each worker holds the copy of the FingerSpace made when it was forked.
+    Changes made in a worker are sent up to the node, which applies them and
+    passes them down to every other worker, and changes made in the node are
+    passed down to all of them.
+
+    The rest of the state that requests change, such as the circuit table,
+    transfers, receipts, inbox and mail store, is only held by the node. A
+    worker calls its methods through :class:`SharedState`, so whichever
+    process a connection lands in, the node's threads see its effects.
+    """
+    def __init__(self, parent_log, manager, processes):
+        """
+        :param parent_log: Logger of the :class:`ConnectionsManager`.
+        :param manager: The :class:`ConnectionsManager` to fork workers of.
+        :param processes: Number of worker processes.
+        """
+        self.log = parent_log.getChild(__name__.rpartition('.')[2])
+        self.manager = manager
+        self.fingerspace = manager.fingerspace
+        self.processes = processes
+        self._workers = []
+        self._downstream = []
+        self._upstream = Queue()
+        self._calls = Queue()
+        self._replies = []
+        self._replaying = local()
+        self._running = False
+        self._thread = Thread(target=self._syncing, name='Thread-ShardSync')
+        self._thread.daemon = True
+        self._callers = []
+        for number in range(processes):
+            caller = Thread(target=self._calling,
+                            name='Thread-ShardState-%d' % number)
+            caller.daemon = True
+            self._callers.append(caller)
+
+        self.count_synced = 0
+        self.count_calls = 0
+
+    def start(self):
+        """
+        Fork the worker processes.
+
+        The observer is added before forking, so no change made while the
+        workers start up can be missed.
+        """
+        self._running = True
+        self._downstream = [Queue() for _ in range(self.processes)]
+        self._replies = [Queue() for _ in range(self.processes)]
+        self.fingerspace.observers.append(self._forward)
+        for number, downstream in enumerate(self._downstream):
+            worker = Process(target=_serve, name='Shard-%d' % number,
+                             args=(self.manager, number, downstream,
+                                   self._upstream, self._calls,
+                                   self._replies[number]))
+            worker.daemon = True
+            worker.start()
+            self._workers.append(worker)
+        self._thread.start()
+        for caller in self._callers:
+            caller.start()
+        self.log.info("Started %d listener shards", self.processes)
+
+    def stop(self):
+        """Tell the worker processes to stop, and wait for them."""
+        self._running = False
+        for downstream in self._downstream:
+            downstream.put(None)
+        for worker in self._workers:
+            worker.join(CFG_TIMEOUT)
+            if worker.is_alive():
+                self.log.warning("Terminating %s", worker.name)
+                worker.terminate()
+        try:
+            self.fingerspace.observers.remove(self._forward)
+        except ValueError:
+            pass
+
+    def _forward(self, version, operation, values):
+        """
+        Observer of the FingerSpace, passing changes down to the workers.
+
+        A change being replayed from a worker isn't passed back down to it.
+        """
+        origin = getattr(self._replaying, 'origin', None)
+        for number, downstream in enumerate(self._downstream):
+            if number != origin:
+                downstream.put((operation, values))
+
+    def _syncing(self):
+        """
+        Apply changes sent up by the workers.
+
+        This method is the target of `self._thread`
+        """
+        while self._running:
+            try:
+                origin, operation, values = self._upstream.get(timeout=1)
+            except Empty:
+                continue
+            self._replaying.origin = origin
+            try:
+                apply_change(self.fingerspace, operation, values)
+                self.count_synced += 1
+            except Exception as exc:  # pylint: disable=broad-except
+                self.log.error("Couldn't apply %s from shard %d: %s",
+                               operation, origin, exc)
+            finally:
+                self._replaying.origin = None
+        self.log.debug("Shard sync thread stopped.")
+
+    def _calling(self):
+        """
+        Call the methods of the node's state asked for by the workers.
+
+        This method is the target of the threads in `self._callers`
+        """
+        while self._running:
+            try:
+                origin, call_id, target, method, args = self._calls.get(
+                    timeout=1)
+            except Empty:
+                continue
+            result, error = self.call(target, method, args)
+            self._replies[origin].put((call_id, result, error))
+            self.count_calls += 1
+
+    def call(self, target, method, args):
+        """
+        Call a method of the state held by the node, for a worker.
+
+        An exception that can't be passed between processes is replaced by a
+        :class:`ProtocolError` with its message.
+
+        :param target: Key of the state in `ConnectionsManager.state`.
+        :param method: Name of the method, one of `SHARED_STATE`.
+        :param args: Tuple of the arguments.
+        :return: Tuple of the result and None, or of None and the exception
+            raised.
+        """
+        state = self.manager.state.get(target)
+        if state is None or method not in SHARED_STATE.get(target, ()):
+            return None, ProtocolError("%s.%s isn't shared." %
+                                       (target, method))
+        try:
+            return getattr(state, method)(*args), None
+        except Exception as exc:  # pylint: disable=broad-except
+            try:
+                pickle.loads(pickle.dumps(exc, -1))
+            except Exception:  # pylint: disable=broad-except
+                exc = ProtocolError(str(exc))
+            return None, exc
+
+
+def apply_change(fingerspace, operation, values):
+    """
+    Apply a change noted by the observers of another FingerSpace.
+
+    Applying the same change twice has no further effect.
+
+    :param fingerspace: The :class:`FingerSpace` to change.
+    :param operation: 'ADD' or 'DEL'.
+    :param values: Values of the finger added, or the ident removed.
+    """
+    if operation == 'ADD':
+        fingerspace.put(*values)
+    elif operation == 'DEL':
+        fingerspace.remove(values)
+
+
+class SharedState(object):
+    """
+    Calls the methods of the state held by the node, from a worker.
+
+    Each call is sent up to the node, and the calling thread waits for the
+    reply. Replies are read by `self._thread`, and handed to the thread
+    waiting for each.
+    """
+    def __init__(self, number, calls, replies):
+        """
+        :param number: Number of this worker.
+        :param calls: Queue of calls to the node.
+        :param replies: Queue of replies from the node.
+        """
+        self.number = number
+        self._calls = calls
+        self._replies = replies
+        self._ids = itertools.count()
+        self._waiting = {}
+        self._lock = Lock()
+        self._thread = Thread(target=self._replying,
+                              name='Thread-ShardReplies')
+        self._thread.daemon = True
+
+    def start(self):
+        """Begin reading replies."""
+        self._thread.start()
+
+    def stop(self):
+        """Stop reading replies."""
+        self._replies.put(None)
+
+    def state(self, held):
+        """
+        Stand-ins for the state held by the node.
+
+        :param held: Dictionary of the state, `ConnectionsManager.state`.
+        :return: Dictionary of a :class:`RemoteState` for each of the
+            state's keys, or None where the node holds none.
+        """
+        return dict((target, None if value is None else
+                     RemoteState(self, target))
+                    for target, value in held.items())
+
+    def call(self, target, method, *args):
+        """
+        Call a method of the state held by the node, waiting for the result.
+
+        Raises the exception raised by the method, or a
+        :class:`ProtocolError` if the node doesn't reply in time.
+
+        :param target: Key of the state in `ConnectionsManager.state`.
+        :param method: Name of the method.
+        :param args: Arguments of the method.
+        :return: The method's result.
+        """
+        reply = [Event(), None, None]
+        with self._lock:
+            call_id = next(self._ids)
+            self._waiting[call_id] = reply
+        self._calls.put((self.number, call_id, target, method, args))
+        done = reply[0].wait(CFG_TIMEOUT)
+        with self._lock:
+            self._waiting.pop(call_id, None)
+        if not done:
+            raise ProtocolError("No reply from the node to %s.%s." %
+                                (target, method))
+        if reply[2] is not None:
+            raise reply[2]
+        return reply[1]
+
+    def _replying(self):
+        """
+        Hand the replies of the node to the threads waiting for them.
+
+        This method is the target of `self._thread`
+        """
+        for call_id, result, error in iter(self._replies.get, None):
+            with self._lock:
+                reply = self._waiting.get(call_id)
+            if reply is not None:
+                reply[1], reply[2] = result, error
+                reply[0].set()
+
+
+class RemoteState(object):
+    """
+    Stands in for a part of the state held by the node, in a worker.
+
+    Only the methods listed in `SHARED_STATE` can be called.
+    """
+    def __init__(self, shared, target):
+        """
+        :param shared: The :class:`SharedState` to call through.
+        :param target: Key of the state in `ConnectionsManager.state`.
+        """
+        self._shared = shared
+        self._target = target
+
+    def __getattr__(self, name):
+        if name not in SHARED_STATE[self._target]:
+            raise AttributeError(name)
+        return partial(self._shared.call, self._target, name)
+
+
+def _serve(manager, number, downstream, upstream, calls, replies):
+    """
+    Target of a worker process, listening until told to stop.
+
+    Changes are sent up from whichever thread makes them, except for the
+    main thread, which only replays changes passed down from the node.
+    Requests change the rest of the node's state through a
+    :class:`SharedState`.
+
+    :param manager: The :class:`ConnectionsManager` forked from.
+    :param number: Number of this worker.
+    :param downstream: Queue of changes from the node.
+    :param upstream: Queue of changes to the node.
+    :param calls: Queue of calls to the node.
+    :param replies: Queue of replies from the node.
+    """
+    # PyCrypto's random pool must be reseeded after a fork.
+    Random.atfork()
+    fingerspace = manager.fingerspace
+    # Changes reach each process in its own order, so the same version means
+    # a different changelog here than in the node.
+    fingerspace.renew_epoch()
+    replaying = local()
+    replaying.active = True
+
+    def forward(version, operation, values):  # pylint: disable=W0613
+        """Observer of the FingerSpace, passing changes up to the node."""
+        if not getattr(replaying, 'active', False):
+            upstream.put((number, operation, values))
+
+    # Drop inherited observers, such as the journal of the node's store.
+    fingerspace.observers[:] = [forward]
+    shard = type(manager)(manager.log.parent.getChild('shard%d' % number),
+                          manager.local_ip, manager.local_port, fingerspace,
+                          manager.local_finger, manager.local_keys)
+    shared = SharedState(number, calls, replies)
+    shard.state = shared.state(manager.state)
+    shared.start()
+    shard.listen(reuse_port=True)
+    for operation, values in iter(downstream.get, None):
+        try:
+            apply_change(fingerspace, operation, values)
+        except Exception as exc:  # pylint: disable=broad-except
+            shard.log.error("Couldn't apply %s: %s", operation, exc)
+    shard.close()
+    shared.stop()
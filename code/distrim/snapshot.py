@@ -0,0 +1,183 @@
+# -*- coding: utf-8 -*-
+## This file is part of DistrIM.
+##
+## DistrIM is a DHT-based network for secured messaging.
+##
+##     Author: Graham Armstrong
+## Student ID: 11004764
+##      Email: graham.armstrong@northumbria.ac.uk
+##
+## Product for CM0645 Individual Project, academic year 2014/15.
+##
+## This product has been developed in partial fulfilment of the regulations
+## governing the award of the Degree of BSc (Honours) Computer Science
+## at the University of Northumbria at Newcastle.
+
+
+
+"""
+    Snapshots, persists the FingerSpace between runs of a node.
+"""
+
+import os
+import pickle
+
+from itertools import chain
+from time import sleep, time
+from threading import Thread, Lock
+
+from .fingerspace import Finger
+from .utils.config import (CFG_SNAPSHOT_INTERVAL, CFG_JOURNAL_SYNC_INTERVAL,
+                           CFG_JOURNAL_MAX_SIZE)
+from .utils.records import RecordLog, read_records, write_records
+
+
+class FingerStore(object):
+    """
+    Saves the FingerSpace to disk so a node can warm start.
+
+    Two files are kept in the data directory. The snapshot holds a header
+    record, with the epoch, version and sync points of the FingerSpace,
+    followed by a record for each finger. The journal holds a record for
+    every change made to the FingerSpace since the snapshot was written.
+
+    Journal records are buffered and synced every few seconds, a new snapshot
+    is written periodically or once the journal grows too large. Neither is
+    done with the FingerSpace locked, so lookups don't wait on the disk.
+    """
+    def __init__(self, parent_log, fingerspace, data_dir):
+        """
+        :param parent_log: logger object from Node instance.
+        :param fingerspace: The FingerSpace instance of this node.
+        :param data_dir: Directory to keep the files in.
+        """
+        self.log = parent_log.getChild(__name__.rpartition('.')[2])
+        self.fingerspace = fingerspace
+        self.snapshot_path = os.path.join(data_dir, 'fingers.snap')
+        self.journal_path = os.path.join(data_dir, 'fingers.log')
+        self.next_path = self.journal_path + '.next'
+        self._journal = None
+        self._writing = Lock()
+        self._running = False
+        self._thread = Thread(target=self._syncing, name='Thread-Snapshot')
+        self._thread.daemon = True
+
+    def load(self):
+        """
+        Load the snapshot and replay the journal into the FingerSpace.
+
+        :return: The number of fingers loaded.
+        """
+        records = read_records(self.snapshot_path)
+        header = next(records, None)
+        sync_point = None
+        if header:
+            header = pickle.loads(header)
+            sync_point = header['VERSION']
+            fingers = [pickle.loads(record) for record in records]
+            self.fingerspace.restore(fingers, sync_point)
+            self.fingerspace.sync_points.update(header['SYNC_POINTS'])
+
+        replayed = 0
+        for record in chain(read_records(self.journal_path),
+                            read_records(self.next_path)):
+            epoch, version, operation, values = pickle.loads(record)
+            if (sync_point and epoch == sync_point[0]
+                    and version <= sync_point[1]):
+                continue  # Already in the snapshot
+            if operation == 'ADD':
+                self.fingerspace.restore([Finger(*values)],
+                                         (epoch, version))
+            else:
+                self.fingerspace.remove(values, mark=False)
+                self.fingerspace.restore([], (epoch, version))
+            replayed += 1
+
+        count = len(self.fingerspace)
+        self.log.info("Loaded %d fingers, replayed %d changes.", count,
+                      replayed)
+        return count
+
+    def start(self):
+        """Begin journaling changes to the FingerSpace."""
+        self._journal = RecordLog(self.journal_path)
+        self.fingerspace.observers.append(self._note)
+        self._running = True
+        self._thread.start()
+
+    def stop(self):
+        """
+        Stop journaling and write a final snapshot.
+
+        Nothing is done if journaling was never started.
+        """
+        self._running = False
+        if self._journal is None:
+            return
+        self.fingerspace.observers.remove(self._note)
+        self.checkpoint()
+        self._journal.close()
+
+    def checkpoint(self):
+        """
+        Write a new snapshot and empty the journal.
+
+        The FingerSpace is only locked to copy its fingers and to start a new
+        journal, so no change is missed between the two. The snapshot is
+        written after, and the new journal then replaces the old one. Until
+        it does, both journals are replayed by :func:`load`.
+        """
+        space = self.fingerspace
+        with self._writing:
+            with space.access:
+                header = {'VERSION': (space.epoch, space.version),
+                          'SYNC_POINTS': dict(space.sync_points)}
+                # pylint: disable=protected-access
+                fingers = space._keyspace.values()
+                journal = self._journal
+                if os.path.exists(self.next_path):
+                    os.remove(self.next_path)
+                self._journal = RecordLog(self.next_path)
+            journal.close()
+            records = [pickle.dumps(header, pickle.HIGHEST_PROTOCOL)]
+            records.extend(pickle.dumps(finger, pickle.HIGHEST_PROTOCOL)
+                           for finger in fingers)
+            write_records(self.snapshot_path, records)
+            with space.access:
+                journal = self._journal
+                journal.flush()
+                os.rename(self.next_path, self.journal_path)
+                self._journal = RecordLog(self.journal_path)
+            journal.close()
+        self.log.debug("Snapshot of %d fingers written.", len(fingers))
+
+    def _note(self, version, operation, values):
+        """
+        Append a change to the journal, observer of the FingerSpace.
+
+        :param version: Version of the FingerSpace after the change.
+        :param operation: Either 'ADD' or 'DEL'.
+        :param values: The `all` tuple of an added finger, or the ident of a
+            removed finger.
+        """
+        record = (self.fingerspace.epoch, version, operation, values)
+        self._journal.append(pickle.dumps(record, pickle.HIGHEST_PROTOCOL))
+
+    def _syncing(self):
+        """
+        Sync the journal to disk, and periodically write a snapshot.
+
+        This method is the target of `self._thread`
+        """
+        last_snapshot = time()
+        while self._running:
+            sleep(CFG_JOURNAL_SYNC_INTERVAL)
+            if not self._running:
+                break
+            with self._writing:
+                self._journal.sync()
+            if (time() - last_snapshot > CFG_SNAPSHOT_INTERVAL
+                    or self._journal.size() > CFG_JOURNAL_MAX_SIZE):
+                self.checkpoint()
+                last_snapshot = time()
+        self.log.debug("Snapshot thread stopped.")
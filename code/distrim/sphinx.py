@@ -0,0 +1,316 @@
+# -*- coding: utf-8 -*-
+## This file is part of DistrIM.
+##
+## DistrIM is a DHT-based network for secured messaging.
+##
+##     Author: Graham Armstrong
+## Student ID: 11004764
+##      Email: graham.armstrong@northumbria.ac.uk
+##
+## Product for CM0645 Individual Project, academic year 2014/15.
+##
+## This product has been developed in partial fulfilment of the regulations
+## governing the award of the Degree of BSc (Honours) Computer Science
+## at the University of Northumbria at Newcastle.
+
+
+"""
+    Sphinx, a constant-size packet format for relaying short messages.
+
+    A packet is a header of `CFG_PACKET_HOPS` slots, each the size of one
+    RSA block, followed by a payload of `CFG_PACKET_PAYLOAD` bytes. The first
+    slot is encrypted to the node receiving the packet, and holds the ident
+    of the next node and a key. With the key, the node checks the rest of
+    the header, removes its layer of the payload, and shifts the header
+    along one slot, filling the end with bytes of the key stream. Every
+    packet is the same size at every hop, the header is re-encrypted at
+    each, and each hop does one RSA decryption however long the path or
+    message.
+
+    This follows the header construction of Sphinx (Danezis and Goldberg,
+    2009), with the node's RSA key in place of a blinded Diffie-Hellman
+    element, as fingers only carry RSA keys.
+
+    A :class:`ReplyBlock` is a header routed back to the node that built it,
+    handed to another node so that it can reply without learning the route.
+    The replying node only encrypts the payload, and the builder, holding
+    the keys of every hop, removes the layers when the reply arrives.
+"""
+
+import os
+import hmac
+import struct
+
+from time import time
+from hashlib import sha256
+
+from Crypto.Cipher import AES
+from Crypto.Util import Counter
+
+from .assets.errors import ProtocolError
+from .utils.config import (CFG_KEY_LENGTH, CFG_IDENT_LENGTH, CFG_STRUCT_FMT,
+                           CFG_PACKET_HOPS, CFG_PACKET_PAYLOAD)
+
+SLOT_SIZE = CFG_KEY_LENGTH // 8
+HEADER_SIZE = CFG_PACKET_HOPS * SLOT_SIZE
+PACKET_SIZE = HEADER_SIZE + CFG_PACKET_PAYLOAD
+LENGTH_SIZE = struct.calcsize(CFG_STRUCT_FMT)
+MAX_BODY = CFG_PACKET_PAYLOAD - LENGTH_SIZE
+KEY_SIZE = 16
+MAC_SIZE = 16
+# Bytes of each slot after the first kept in the header, the routing info.
+_ROUTING_SIZE = HEADER_SIZE - SLOT_SIZE
+
+_NEXT = 'N'
+_RECIPIENT = 'R'
+_REPLY = 'Y'
+
+
+class PacketHeader(object):
+    """
+    The header of a packet, built before the body it carries is known.
+
+    Building the header does all of the RSA work of a packet, leaving only
+    the payload to be encrypted once the body is known. A header carries one
+    packet only, as its keys encrypt the payload.
+    """
+    def __init__(self, route):
+        """
+        Raises a :class:`ValueError` if the route is too long.
+
+        :param route: List of the Fingers of the nodes to pass through, in
+            the order they are passed through, the last being the recipient.
+        """
+        hops = len(route)
+        if not 0 < hops <= CFG_PACKET_HOPS:
+            raise ValueError("Route must have 1 to %d nodes."
+                             % CFG_PACKET_HOPS)
+        self.route = route
+        self.created = time()
+        self._keys = [os.urandom(KEY_SIZE) for _ in route]
+
+        # The filler is what the shifts of the earlier nodes leave at the end
+        # of the header by the time it reaches the recipient.
+        filler = ''
+        for idx in xrange(1, hops):
+            stream = _header_stream(self._keys[idx - 1])
+            filler = _xor(filler + '\0' * SLOT_SIZE,
+                          stream[_ROUTING_SIZE - (idx - 1) * SLOT_SIZE:])
+
+        routing = os.urandom(_ROUTING_SIZE - len(filler)) + filler
+        slot = None
+        for idx in reversed(xrange(hops)):
+            key = self._keys[idx]
+            if slot is not None:
+                routing = _xor(slot + routing[:_ROUTING_SIZE - SLOT_SIZE],
+                               _header_stream(key)[:_ROUTING_SIZE])
+            if idx == hops - 1:
+                info = self._recipient_info()
+            else:
+                info = _NEXT + route[idx + 1].ident
+            info += key + _mac(key, routing)
+            slot = route[idx].get_cipher().encrypt_block(info)
+            if len(slot) != SLOT_SIZE:
+                raise ValueError("Key of %s isn't %d bits."
+                                 % (route[idx].ident, CFG_KEY_LENGTH))
+        self._header = slot + routing
+
+    def packet(self, body):
+        """
+        Build the packet carrying a body.
+
+        Raises a :class:`ValueError` if the body is too large to fit, or the
+        header has already carried a packet.
+
+        :param body: String of the body for the recipient.
+        :return: String of the packet for the first node.
+        """
+        if len(body) > MAX_BODY:
+            raise ValueError("Body must be at most %d bytes." % MAX_BODY)
+        if self._keys is None:
+            raise ValueError("Header has already been used.")
+        keys, self._keys = self._keys, None
+        payload = struct.pack(CFG_STRUCT_FMT, len(body)) + body
+        payload += os.urandom(CFG_PACKET_PAYLOAD - len(payload))
+        for key in reversed(keys):
+            payload = _payload_cipher(key).encrypt(payload)
+        return self._header + payload
+
+    def _recipient_info(self):
+        """Flag and ident of the recipient's slot, less the key and MAC."""
+        return _RECIPIENT + '\0' * CFG_IDENT_LENGTH
+
+
+class ReplyBlock(PacketHeader):
+    """
+    A header routed back to this node, for another node to reply with.
+
+    The recipient's slot carries the reply's `id` in place of an ident, so
+    the keys to read the reply with can be found when it arrives. The
+    replying node is given the :attr:`surb`, and builds the packet with
+    :func:`reply_packet`.
+    """
+    def __init__(self, route):
+        """
+        Raises a :class:`ValueError` if the route is too long.
+
+        :param route: List of the Fingers of the nodes to pass through, in
+            the order they are passed through, the last being this node.
+        """
+        self.id = os.urandom(CFG_IDENT_LENGTH)
+        self.key = os.urandom(KEY_SIZE)
+        super(ReplyBlock, self).__init__(route)
+        self._layers = self._keys
+
+    @property
+    def surb(self):
+        """
+        Tuple of the reply's ID, the values of the Finger of the first node,
+        the header and the key to encrypt the body with.
+        """
+        return self.id, self.route[0].all, self._header, self.key
+
+    def unwrap(self, payload):
+        """
+        Read the body of a reply, once this node has peeled its layer.
+
+        Each node's layer, this node's included, was added to the payload
+        rather than removed, as the replying node couldn't encrypt it.
+
+        Raises a :class:`ProtocolError` if the body isn't valid.
+
+        :param payload: String of the payload.
+        :return: String of the body.
+        """
+        for key in self._layers:
+            payload = _payload_cipher(key).decrypt(payload)
+        payload = _payload_cipher(self.key).decrypt(payload)
+        return _read_body(payload)
+
+    def _recipient_info(self):
+        """Flag and ID of the reply's slot, less the key and MAC."""
+        return _REPLY + self.id
+
+
+def reply_packet(surb, body):
+    """
+    Build a packet replying with a body along a :class:`ReplyBlock`.
+
+    Raises a :class:`ValueError` if the body is too large to fit.
+
+    :param surb: The :attr:`ReplyBlock.surb` to reply along.
+    :param body: String of the body for the node that built the block.
+    :return: String of the packet for the first node.
+    """
+    if len(body) > MAX_BODY:
+        raise ValueError("Body must be at most %d bytes." % MAX_BODY)
+    header, key = surb[2], surb[3]
+    if len(header) != HEADER_SIZE:
+        raise ValueError("Header must be %d bytes." % HEADER_SIZE)
+    payload = struct.pack(CFG_STRUCT_FMT, len(body)) + body
+    payload += os.urandom(CFG_PACKET_PAYLOAD - len(payload))
+    return header + _payload_cipher(key).encrypt(payload)
+
+
+def build_packet(route, body):
+    """
+    Build a packet.
+
+    Raises a :class:`ValueError` if the route is too long or the body too
+    large to fit.
+
+    :param route: List of the Fingers of the nodes to pass through, in the
+        order they are passed through, the last being the recipient.
+    :param body: String of the body for the recipient.
+    :return: String of the packet for the first node.
+    """
+    if len(body) > MAX_BODY:
+        raise ValueError("Body must be at most %d bytes." % MAX_BODY)
+    return PacketHeader(route).packet(body)
+
+
+def peel_packet(local_keys, packet, replies=None):
+    """
+    Remove this node's layer from a packet.
+
+    Raises a :class:`ProtocolError` if the packet isn't valid for this node,
+    or is a reply this node isn't waiting for.
+
+    :param local_keys: The CipherWrapper of this node.
+    :param packet: String of the packet.
+    :param replies: Function getting the :class:`ReplyBlock` of a reply
+        from its ID, or None if it isn't waited for. If None, replies are
+        refused.
+    :return: Tuple of the ident of the next node and the packet for it, or
+        of None and the body if this node is the recipient.
+    """
+    if len(packet) != PACKET_SIZE:
+        raise ProtocolError("Packet must be %d bytes." % PACKET_SIZE)
+    try:
+        info = local_keys.decrypt_block(packet[:SLOT_SIZE])
+    except ValueError:
+        raise ProtocolError("Packet isn't for this node.")
+    flag = info[0]
+    ident = info[1:1 + CFG_IDENT_LENGTH]
+    key = info[1 + CFG_IDENT_LENGTH:1 + CFG_IDENT_LENGTH + KEY_SIZE]
+    mac = info[1 + CFG_IDENT_LENGTH + KEY_SIZE:]
+    routing = packet[SLOT_SIZE:HEADER_SIZE]
+    if not _compare(_mac(key, routing), mac):
+        raise ProtocolError("Packet header has been tampered with.")
+
+    payload = _payload_cipher(key).decrypt(packet[HEADER_SIZE:])
+    if flag == _RECIPIENT:
+        return None, _read_body(payload)
+    if flag == _REPLY:
+        block = replies(ident) if replies else None
+        if block is None:
+            raise ProtocolError("Reply isn't waited for.")
+        return None, block.unwrap(payload)
+    header = _xor(routing + '\0' * SLOT_SIZE, _header_stream(key))
+    return ident, header + payload
+
+
+def _read_body(payload):
+    """Read the body from a payload with every layer removed."""
+    length = struct.unpack(CFG_STRUCT_FMT, payload[:LENGTH_SIZE])[0]
+    if length > MAX_BODY:
+        raise ProtocolError("Packet body is too long.")
+    return payload[LENGTH_SIZE:LENGTH_SIZE + length]
+
+
+def _header_stream(key):
+    """Key stream which the routing info is encrypted with."""
+    return _counter_cipher(key, 'header').encrypt('\0' * HEADER_SIZE)
+
+
+def _payload_cipher(key):
+    """Cipher which the payload is encrypted with."""
+    return _counter_cipher(key, 'payload')
+
+
+def _counter_cipher(key, purpose):
+    """Create an AES cipher in counter mode, keyed for a purpose."""
+    derived = sha256(key + purpose).digest()[:KEY_SIZE]
+    return AES.new(derived, AES.MODE_CTR, counter=Counter.new(128))
+
+
+def _mac(key, data):
+    """Message authentication code of the routing info."""
+    derived = sha256(key + 'mac').digest()
+    return hmac.new(derived, data, sha256).digest()[:MAC_SIZE]
+
+
+def _compare(first, second):
+    """Compare strings in constant time."""
+    if len(first) != len(second):
+        return False
+    result = 0
+    for char_a, char_b in zip(first, second):
+        result |= ord(char_a) ^ ord(char_b)
+    return result == 0
+
+
+def _xor(first, second):
+    """XOR two strings, to the length of the first."""
+    return ''.join(chr(ord(char_a) ^ ord(char_b))
+                   for char_a, char_b in zip(first, second))
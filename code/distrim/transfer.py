@@ -0,0 +1,595 @@
+# -*- coding: utf-8 -*-
+## This file is part of DistrIM.
+##
+## DistrIM is a DHT-based network for secured messaging.
+##
+##     Author: Graham Armstrong
+## Student ID: 11004764
+##      Email: graham.armstrong@northumbria.ac.uk
+##
+## Product for CM0645 Individual Project, academic year 2014/15.
+##
+## This product has been developed in partial fulfilment of the regulations
+## governing the award of the Degree of BSc (Honours) Computer Science
+## at the University of Northumbria at Newcastle.
+
+
+"""
+    Transfers, large payloads striped over several circuits.
+
+    A payload is split into chunks, coded in groups so that a group can be
+    rebuilt from any of its chunks numbering its data chunks. A circuit is
+    built to the recipient along each of several routes that share no
+    relays. A thread for each circuit sends chunks from a shared queue, so a
+    faster route carries more of them, and throughput grows with the number
+    of routes rather than being held to that of one chain of relays.
+
+    The recipient acknowledges the chunks it holds in batches, sent back as
+    packets. Chunks not acknowledged in time are queued again if their group
+    still needs them, and a circuit that fails stops taking chunks.
+    Duplicates are dropped by the recipient, which reassembles the payload
+    once every group can be rebuilt.
+"""
+
+import os
+import errno
+
+from time import time, sleep
+from collections import deque
+from Queue import Queue, Empty
+from threading import Thread, Lock, Event
+
+from .protocol import MessageHandler
+from .circuits import Circuit
+from .assets.errors import (BusyError, ProtocolError, SockWrapError,
+                            FingerSpaceError)
+from .utils import erasure
+from .utils.config import (CFG_PATH_LENGTH, CFG_TRANSFER_CHUNK_SIZE,
+                           CFG_TRANSFER_PATHS, CFG_TRANSFER_ACK_DELAY,
+                           CFG_TRANSFER_ACK_TIMEOUT, CFG_TRANSFER_TIMEOUT,
+                           CFG_TRANSFER_INCOMING, CFG_TRANSFER_INCOMING_BYTES,
+                           CFG_FEC_GROUP, CFG_FEC_PARITY)
+from .utils.utilities import split_chunks
+
+# Transfers completed, remembered so late duplicates aren't delivered again.
+_COMPLETED_MAX = 256
+# Longest transfer ID accepted, IDs are used in the names of saved payloads.
+_ID_MAX = 32
+
+
+class OutgoingTransfer(object):
+    """
+    A payload being sent by this node.
+
+    The chunks are coded in groups, each of `group` data chunks and
+    `parity` parity chunks, see :mod:`distrim.utils.erasure`. Once the
+    recipient holds as many chunks of a group as it has data chunks, the
+    rest of the group needn't be sent, so a chunk dropped by a relay doesn't
+    hold the transfer up.
+    """
+    def __init__(self, recipient, data, name='',
+                 chunk_size=CFG_TRANSFER_CHUNK_SIZE, group=CFG_FEC_GROUP,
+                 parity=CFG_FEC_PARITY):
+        """
+        :param recipient: Finger of the recipient.
+        :param data: String of the payload.
+        :param name: Name of the payload, such as its file name.
+        :param chunk_size: Bytes of each chunk.
+        :param group: Data chunks in each group.
+        :param parity: Parity chunks added to each group.
+        """
+        self.id = os.urandom(8).encode('hex')
+        self.recipient = recipient
+        self.name = name
+        self.size = len(data)
+        data_chunks = list(split_chunks(data, chunk_size)) or ['']
+        self.groups = []
+        self.chunks = []
+        for start in xrange(0, len(data_chunks), group):
+            shards = data_chunks[start:start + group]
+            length = len(shards[0])
+            shards = [shard.ljust(length, '\0') for shard in shards]
+            number = len(self.groups)
+            self.groups.append(len(shards))
+            for shard, data_shard in enumerate(
+                    shards + erasure.encode(shards, parity)):
+                self.chunks.append((number, shard, data_shard))
+        self.pending = Queue()
+        self.acked = set()
+        self.sent = {}
+        self.done = Event()
+        self._held = [0] * len(self.groups)
+        self._lock = Lock()
+        for index in xrange(len(self.chunks)):
+            self.pending.put(index)
+
+        self.count_resent = 0
+
+    @property
+    def complete(self):
+        """True once the recipient can rebuild every group."""
+        return all(held >= count
+                   for held, count in zip(self._held, self.groups))
+
+    def needed(self, index):
+        """
+        Check if a chunk still needs to be sent.
+
+        :param index: Index of the chunk.
+        :return: False if it's acked, or its group can be rebuilt already.
+        """
+        number = self.chunks[index][0]
+        return (index not in self.acked
+                and self._held[number] < self.groups[number])
+
+    def chunk(self, index):
+        """
+        Get the fields of the message carrying a chunk.
+
+        :param index: Index of the chunk.
+        """
+        number, shard, data = self.chunks[index]
+        return {'CHUNK': {'ID': self.id, 'INDEX': index, 'GROUP': number,
+                          'SHARD': shard, 'COUNT': self.groups[number],
+                          'GROUPS': len(self.groups), 'SIZE': self.size,
+                          'NAME': self.name, 'DATA': data}}
+
+    def mark_sent(self, index):
+        """Note the time a chunk was sent, to resend it if it isn't acked."""
+        with self._lock:
+            self.sent[index] = time()
+
+    def acknowledge(self, indices):
+        """
+        Note chunks the recipient holds.
+
+        :param indices: Indices of the chunks.
+        """
+        with self._lock:
+            for index in indices:
+                if index in self.acked or not 0 <= index < len(self.chunks):
+                    continue
+                self.acked.add(index)
+                self.sent.pop(index, None)
+                self._held[self.chunks[index][0]] += 1
+            if self.complete:
+                self.done.set()
+
+    def resend_overdue(self, timeout):
+        """
+        Queue again the chunks sent but not acked within the timeout, if
+        their group still needs them.
+
+        :param timeout: Seconds to wait for an ack.
+        """
+        now = time()
+        with self._lock:
+            overdue = [index for index, sent in self.sent.items()
+                       if now - sent >= timeout]
+            for index in overdue:
+                del self.sent[index]
+                if self.needed(index):
+                    self.pending.put(index)
+                    self.count_resent += 1
+
+
+class IncomingTransfer(object):
+    """
+    A payload being received by this node.
+
+    Each group is decoded as soon as enough of its chunks are held. The
+    number of data chunks and the length of the chunks of a group are taken
+    from its first chunk, and chunks that don't match it are refused.
+    """
+    def __init__(self, sender, transfer_id, groups, size, name):
+        """
+        :param sender: Ident of the sender.
+        :param transfer_id: ID of the transfer.
+        :param groups: Number of groups of chunks.
+        :param size: Length of the payload.
+        :param name: Name of the payload.
+        """
+        self.sender = sender
+        self.id = transfer_id
+        self.groups = groups
+        self.size = size
+        self.name = name
+        self.shards = {}
+        self.decoded = {}
+        self.layout = {}
+        self.held = 0
+        self.updated = time()
+
+    @property
+    def complete(self):
+        """True once every group is decoded."""
+        return len(self.decoded) >= self.groups
+
+    def add(self, chunk):
+        """
+        Hold a chunk, if its group isn't already decoded.
+
+        Raises a :class:`ValueError` if the chunk is malformed, or doesn't
+        match the first chunk of its group.
+
+        :param chunk: Fields of the chunk.
+        :return: True if the chunk was new, else False.
+        """
+        number, shard = chunk.get('GROUP'), chunk.get('SHARD')
+        count, data = chunk.get('COUNT'), chunk.get('DATA')
+        if (not isinstance(number, int) or not 0 <= number < self.groups
+                or not isinstance(shard, int)
+                or not 0 <= shard < erasure.MAX_SHARDS
+                or not isinstance(count, int)
+                or not 0 < count < erasure.MAX_SHARDS
+                or not isinstance(data, str)):
+            raise ValueError("Malformed chunk.")
+        if self.layout.setdefault(number, (count, len(data))) != (
+                count, len(data)):
+            raise ValueError("Chunk doesn't match the rest of group %d."
+                             % number)
+        self.updated = time()
+        if number in self.decoded:
+            return False
+        shards = self.shards.setdefault(number, {})
+        if shard in shards:
+            return False
+        shards[shard] = data
+        self.held += len(data)
+        if len(shards) >= count:
+            self.decoded[number] = ''.join(erasure.decode(shards, count))
+            del self.shards[number]
+        return True
+
+    def assemble(self):
+        """Join the decoded groups into the payload."""
+        data = ''.join(self.decoded[number] for number in xrange(self.groups))
+        return data[:self.size]
+
+
+class Transfers(object):
+    """
+    The transfers sent and received by this node.
+    """
+    def __init__(self, parent_log, fingerspace, local_finger, local_keys,
+                 directory=None, paths=CFG_TRANSFER_PATHS,
+                 ack_delay=CFG_TRANSFER_ACK_DELAY,
+                 ack_timeout=CFG_TRANSFER_ACK_TIMEOUT,
+                 timeout=CFG_TRANSFER_TIMEOUT,
+                 max_incoming=CFG_TRANSFER_INCOMING,
+                 max_bytes=CFG_TRANSFER_INCOMING_BYTES):
+        """
+        :param parent_log: Logger of the :class:`ConnectionsManager`.
+        :param fingerspace: The FingerSpace instance of this node.
+        :param local_finger: The Finger of this node.
+        :param local_keys: The CipherWrapper of this node.
+        :param directory: Directory to save received payloads in, if any.
+        :param paths: Number of routes to stripe a transfer over.
+        :param ack_delay: Seconds acks are batched for.
+        :param ack_timeout: Seconds before a chunk not acked is resent.
+        :param timeout: Seconds before a transfer is given up on.
+        :param max_incoming: Most transfers to receive at once.
+        :param max_bytes: Most bytes of chunks to hold for the transfers
+            being received.
+        """
+        self.log = parent_log.getChild(__name__.rpartition('.')[2])
+        self.fingerspace = fingerspace
+        self.local_finger = local_finger
+        self.local_keys = local_keys
+        self.directory = directory
+        self.paths = paths
+        self.ack_delay = ack_delay
+        self.ack_timeout = ack_timeout
+        self.timeout = timeout
+        self.max_incoming = max_incoming
+        self.max_bytes = max_bytes
+        self._outgoing = {}
+        self._incoming = {}
+        self._completed = deque(maxlen=_COMPLETED_MAX)
+        self._acks = {}
+        self._lock = Lock()
+        self._running = False
+        self._thread = Thread(target=self._acking, name='Thread-Acks')
+        self._thread.daemon = True
+
+        self.count_sent = 0
+        self.count_received = 0
+        self.count_failed = 0
+        self.count_duplicates = 0
+        self.count_refused = 0
+
+    def start(self):
+        """Begin the thread sending acks."""
+        self._running = True
+        self._thread.start()
+
+    def stop(self):
+        """End the thread sending acks, and give up on transfers."""
+        self._running = False
+        with self._lock:
+            for transfer in self._outgoing.values():
+                transfer.done.set()
+
+    def send(self, recipient, data, name=''):
+        """
+        Send a payload, waiting until every chunk is acked.
+
+        :param recipient: Finger of the recipient.
+        :param data: String of the payload.
+        :param name: Name of the payload, such as its file name.
+        :return: True if the recipient holds the payload, else False.
+        """
+        transfer = OutgoingTransfer(recipient, data, name)
+        try:
+            routes = disjoint_routes(self.fingerspace, recipient, self.paths)
+        except FingerSpaceError as exc:
+            self.log.error("No route for transfer to %s: %s",
+                           recipient.ident, exc.message)
+            return False
+        with self._lock:
+            self._outgoing[transfer.id] = transfer
+        self.log.info("Sending %d chunks to %s over %d routes",
+                      len(transfer.chunks), recipient.ident, len(routes))
+        stripes = [Thread(target=self._striping, args=(transfer, route),
+                          name='Thread-Stripe-%d' % number)
+                   for number, route in enumerate(routes)]
+        for stripe in stripes:
+            stripe.daemon = True
+            stripe.start()
+        started = time()
+        try:
+            while not transfer.done.wait(self.ack_delay):
+                if time() - started >= self.timeout:
+                    self.log.error("Transfer to %s timed out",
+                                   recipient.ident)
+                    break
+                if not any(stripe.is_alive() for stripe in stripes):
+                    self.log.error("Every route to %s failed",
+                                   recipient.ident)
+                    break
+                transfer.resend_overdue(self.ack_timeout)
+        finally:
+            with self._lock:
+                del self._outgoing[transfer.id]
+            transfer.done.set()
+        sent = transfer.complete
+        if sent:
+            self.count_sent += 1
+        else:
+            self.count_failed += 1
+        return sent
+
+    def acknowledge(self, sender, ack):
+        """
+        Receive an ack of chunks of a transfer sent by this node.
+
+        :param sender: Ident of the node acknowledging.
+        :param ack: Fields of the ack.
+        """
+        with self._lock:
+            transfer = self._outgoing.get(ack.get('ID'))
+        if transfer is None or transfer.recipient.ident != sender:
+            return
+        transfer.acknowledge(ack.get('INDICES', ()))
+
+    def receive(self, sender, chunk):
+        """
+        Receive a chunk of a transfer to this node.
+
+        The chunk is acked even if it's a duplicate, as the ack for the
+        first copy may have been lost. A chunk that is malformed, or would
+        take the transfers being received past `max_incoming` or
+        `max_bytes`, is refused without an ack.
+
+        :param sender: Ident of the sender.
+        :param chunk: Fields of the chunk.
+        """
+        key = (sender, chunk.get('ID'))
+        with self._lock:
+            if key in self._completed:
+                self._acks.setdefault(key, set()).add(chunk.get('INDEX'))
+                self.count_duplicates += 1
+                return
+            transfer = self._incoming.get(key)
+            try:
+                if transfer is None:
+                    transfer = self._open(sender, chunk)
+                if (sum(held.held for held in self._incoming.values())
+                        + len(chunk.get('DATA') or '') > self.max_bytes):
+                    raise ValueError("Holding %d bytes of transfers."
+                                     % self.max_bytes)
+                added = transfer.add(chunk)
+            except ValueError as exc:
+                self.count_refused += 1
+                self.log.warning("Refused chunk from %s: %s", sender,
+                                 exc.message)
+                return
+            self._incoming[key] = transfer
+            self._acks.setdefault(key, set()).add(chunk.get('INDEX'))
+            if not added:
+                self.count_duplicates += 1
+                return
+            if not transfer.complete:
+                return
+            del self._incoming[key]
+            self._completed.append(key)
+            self.count_received += 1
+        self._deliver(transfer)
+
+    def _open(self, sender, chunk):
+        """
+        Start receiving a transfer from its first chunk.
+
+        Raises a :class:`ValueError` if the chunk is malformed, or too many
+        transfers are being received. Must be called with `_lock` held.
+
+        :param sender: Ident of the sender.
+        :param chunk: Fields of the chunk.
+        :return: The :class:`IncomingTransfer`.
+        """
+        transfer_id, groups = chunk.get('ID'), chunk.get('GROUPS')
+        size, name = chunk.get('SIZE'), chunk.get('NAME')
+        if len(self._incoming) >= self.max_incoming:
+            raise ValueError("Receiving %d transfers." % self.max_incoming)
+        if (not isinstance(transfer_id, str) or not transfer_id.isalnum()
+                or len(transfer_id) > _ID_MAX
+                or not isinstance(size, int)
+                or not 0 <= size <= self.max_bytes
+                or not isinstance(groups, int)
+                or not 0 < groups <= max(size, 1)
+                or not isinstance(name, (str, unicode))):
+            raise ValueError("Malformed transfer.")
+        return IncomingTransfer(sender, transfer_id, groups, size, name)
+
+    def metrics(self):
+        """
+        Get the metrics of the transfers.
+
+        :return: Dictionary of the numbers of transfers under way, and the
+            counts of transfers and of duplicate and refused chunks.
+        """
+        with self._lock:
+            return {'sending': len(self._outgoing),
+                    'receiving': len(self._incoming),
+                    'sent': self.count_sent,
+                    'received': self.count_received,
+                    'failed': self.count_failed,
+                    'duplicates': self.count_duplicates,
+                    'refused': self.count_refused}
+
+    def _deliver(self, transfer):
+        """
+        Receive a complete payload, saving it if there's a directory.
+
+        :param transfer: The :class:`IncomingTransfer`.
+        """
+        data = transfer.assemble()
+        self.log.info("Transfer of %d bytes received from %s", len(data),
+                      transfer.sender)
+        if self.directory:
+            if not os.path.isdir(self.directory):
+                os.makedirs(self.directory)
+            name = transfer.id
+            if os.path.basename(transfer.name):
+                name += '-' + os.path.basename(transfer.name)
+            path, descriptor = _create(os.path.join(self.directory, name))
+            with os.fdopen(descriptor, 'wb') as handle:
+                handle.write(data)
+            print '## Transfer from %s: saved %s' % (transfer.sender, path)
+        else:
+            print '## Transfer from %s: %s, %d bytes' % (
+                transfer.sender, transfer.name, len(data))
+
+    def _striping(self, transfer, route):
+        """
+        Build a circuit along a route, and send chunks along it until the
+        transfer is done or the circuit fails.
+
+        This method is the target of each striping thread.
+
+        :param transfer: The :class:`OutgoingTransfer`.
+        :param route: List of the Fingers of the route.
+        """
+        circuit = Circuit(route)
+        try:
+            self._postman().build_circuit(transfer.recipient, circuit)
+        except (SockWrapError, ProtocolError) as exc:
+            self.log.warning("Couldn't build a circuit via %s: %s",
+                             route[0].ident, exc.message)
+            return
+        try:
+            while not transfer.done.is_set() and self._running:
+                try:
+                    index = transfer.pending.get(timeout=self.ack_delay)
+                except Empty:
+                    continue
+                if not transfer.needed(index):
+                    continue
+                try:
+                    self._postman().send_cell(circuit, None,
+                                              transfer.chunk(index))
+                except (SockWrapError, ProtocolError, BusyError) as exc:
+                    transfer.pending.put(index)
+                    self.log.warning("Circuit via %s failed: %s",
+                                     route[0].ident, exc.message)
+                    return
+                transfer.mark_sent(index)
+        finally:
+            try:
+                self._postman().destroy_circuit(circuit)
+            except (SockWrapError, ProtocolError):
+                pass
+
+    def _acking(self):
+        """
+        Send the acks batched since the last were sent, and forget
+        incoming transfers that have stalled.
+
+        This method is the target of `self._thread`
+        """
+        while self._running:
+            sleep(self.ack_delay)
+            with self._lock:
+                acks, self._acks = self._acks, {}
+                now = time()
+                for key, transfer in self._incoming.items():
+                    if now - transfer.updated >= self.timeout:
+                        del self._incoming[key]
+            for (sender, transfer_id), indices in acks.items():
+                finger = self.fingerspace.get(sender)
+                if finger is None:
+                    continue
+                try:
+                    self._postman().send_message(
+                        finger, None, fields={'ACK': {
+                            'ID': transfer_id, 'INDICES': sorted(indices)}})
+                except (SockWrapError, ProtocolError) as exc:
+                    self.log.warning("Couldn't ack transfer to %s: %s",
+                                     sender, exc.message)
+        self.log.debug("Ack thread stopped.")
+
+    def _postman(self):
+        """Create a :class:`MessageHandler` to send with."""
+        return MessageHandler(self.log, self.fingerspace, self.local_finger,
+                              self.local_keys)
+
+
+def disjoint_routes(fingerspace, recipient, number, length=CFG_PATH_LENGTH):
+    """
+    Choose routes to a recipient that share no relays.
+
+    Fewer routes are chosen if there aren't enough nodes for each to have at
+    least one relay.
+
+    :param fingerspace: The FingerSpace instance of this node.
+    :param recipient: Finger of the recipient.
+    :param number: Number of routes wanted.
+    :param length: Most relays on each route.
+    :return: List of routes, each a list of Fingers ending at the recipient.
+    """
+    relays = [finger for finger
+              in fingerspace.get_random_fingers(number * length + 1)
+              if finger != recipient][:number * length]
+    number = max(1, min(number, len(relays)))
+    return [relays[idx::number] + [recipient] for idx in xrange(number)]
+
+
+def _create(path):
+    """
+    Create a new file, without replacing one that already exists.
+
+    If the path is taken, a number is added to its end.
+
+    :param path: Path of the file.
+    :return: Tuple of the path of the file created, and its descriptor.
+    """
+    flags = os.O_WRONLY | os.O_CREAT | os.O_EXCL | getattr(os, 'O_BINARY', 0)
+    candidate, number = path, 0
+    while True:
+        try:
+            return candidate, os.open(candidate, flags, 0o644)
+        except OSError as exc:
+            if exc.errno != errno.EEXIST:
+                raise
+        number += 1
+        candidate = '%s.%d' % (path, number)
@@ -18,12 +18,16 @@
     Command Line User Interface
 """
 
+import os
 import sys
 import traceback
 
+from getpass import getpass
+
 from datetime import datetime as dto
 
 from .node import Node
+from .protocol import HANDLERS
 from .utils.utilities import get_local_ip, format_elapsed
 
 
@@ -31,6 +35,8 @@ COMMANDS = [
     (('help', 'h'), "Print this message."),
     (('print', 'p'), "Print some information."),
     (('send', 's'), "Send message to node."),
+    (('send-file', 'f'), "Send a file to node."),
+    (('inbox', 'i'), "Show messages received, from a node if given."),
     (('quit', 'q'), "Stop this node and exit."),
 ]
 
@@ -52,6 +58,8 @@ class CommandLine(object):
             'help': self.cmd_help,
             'print': self.cmd_print,
             'send': self.cmd_send,
+            'send-file': self.cmd_send_file,
+            'inbox': self.cmd_inbox,
             'quit': self.cmd_quit,
         }
 
@@ -150,15 +158,86 @@ class CommandLine(object):
             conn = self.node.conn_manager
             print "Succesful Incoming Conns:", conn.count_conn_success
             print "Failed Incoming Conns:", conn.count_conn_failure
+            print "Refused Incoming Conns:", conn.count_conn_refused
+            print "Rerouted Messages:", conn.count_rerouted
+            for lane, pool in sorted(conn.pool_metrics().items()):
+                print "Lane:", lane
+                print "    Threads:", "%(workers)d (%(idle)d idle)" % pool
+                print "    Queue Wait:", "%(mean_wait).3fs mean, " \
+                    "%(max_wait).3fs max" % pool
+                print "    Run Time:", "%(mean_run).3fs mean, " \
+                    "%(max_run).3fs max" % pool
+                print "    Rejections:", pool['rejected']
+            print "Relayed Packages:", "%(relayed)d relayed, " \
+                "%(waiting)d waiting, %(retried)d retried, " \
+                "%(dropped)d dropped" % conn.relays.metrics()
+            print "Circuits Built:", "%(open)d open, %(built)d built, " \
+                "%(failed)d failed, %(sent)d messages" \
+                % conn.circuits.metrics()
+            print "Circuits Relayed:", "%(circuits)d held, " \
+                "%(cells)d cells, %(expired)d expired" \
+                % conn.circuit_table.metrics()
+            print "Precomputed Routes:", "%(stocked)d stocked, " \
+                "%(hits)d hits, %(misses)d misses" \
+                % conn.precomputer.metrics()
+            print "Transfers:", "%(sent)d sent, %(received)d received, " \
+                "%(failed)d failed, %(duplicates)d duplicate chunks" \
+                % conn.transfers.metrics()
+            print "Receipts:", "%(delivered)d delivered, " \
+                "%(waiting)d waiting, %(expired)d expired, " \
+                "%(p50).3fs median, %(p95).3fs p95" % conn.receipts.metrics()
+            if self.node.outbox:
+                print "Outbox:", "%(waiting)d waiting, %(sent)d sent, " \
+                    "%(retried)d retried, %(failed)d failed" \
+                    % self.node.outbox.metrics()
+            print "Mailboxes:", "%(deposited)d deposited, " \
+                "%(collected)d collected" % conn.mailboxes.metrics()
+            print "Mail Held:", "%(items)d messages for %(boxes)d nodes, " \
+                "%(bytes)d bytes, %(refused)d refused, %(expired)d expired" \
+                % conn.mailboxes.held.metrics()
+            if conn.inbox:
+                print "Inbox:", "%(messages)d messages, " \
+                    "%(segments)d segments, %(bytes)d bytes, " \
+                    "%(expired)d expired" % conn.inbox.metrics()
+            for msg_type, handler in sorted(HANDLERS.metrics().items()):
+                print "Handler %s:" % msg_type, \
+                    "%(calls)d calls, %(errors)d errors, " \
+                    "%(rejected)d rejected, %(mean_time).3fs mean" % handler
             fsi = self.node.fingerspace
             print "Added Keys:", fsi.count_added
             print "Removed Keys:", fsi.count_removed
+            print "Dead Nodes:", "%(dead)d down, %(marked)d marked, " \
+                "%(expired)d expired" % fsi.dead.metrics()
 
     def cmd_send(self, params):
         """Input Command: Send a message"""
         ident, divider, message = params.partition(" ")
         self.node.send_message(ident, message)
 
+    def cmd_send_file(self, params):
+        """Input Command: Send a file"""
+        ident, divider, path = params.partition(" ")
+        if not os.path.isfile(path):
+            print "No such file '%s'." % (path,)
+            return
+        if self.node.send_file(ident, path):
+            print "Sent %s to %s." % (path, ident)
+        else:
+            print "Couldn't send %s to %s." % (path, ident)
+
+    def cmd_inbox(self, params):
+        """Input Command: Show received messages"""
+        if not self.node.conn_manager.inbox:
+            print "Messages are only kept with a data directory."
+            return
+        messages = self.node.read_messages(params.strip() or None, limit=20)
+        for received, sender, message in messages:
+            print "[%s] %s: %s" % (dto.fromtimestamp(received)
+                                   .strftime('%Y-%m-%d %H:%M:%S'),
+                                   sender, message)
+        if not messages:
+            print "No messages."
+
     def cmd_quit(self, params):
         """Input Command: Terminate the node and exit."""
         print "Shutting down..."
@@ -182,6 +261,18 @@ def run_application(args):
     params = {'local_ip': local_ip}
     if args.get('listen_on'):
         params['local_port'] = args['listen_on']
+    if args.get('data_dir'):
+        params['data_dir'] = args['data_dir']
+        if args.get('encrypt_key'):
+            params['passphrase'] = getpass("Key passphrase: ")
+        if args.get('new_identity'):
+            params['new_identity'] = True
+    if args.get('event_loop'):
+        params['event_loop'] = True
+    if args.get('processes'):
+        params['processes'] = args['processes']
+    if args.get('crypto_processes') is not None:
+        params['crypto_processes'] = args['crypto_processes'] or None
     if args.get('logger'):
         params['log_ip'] = args['logger'][0]
         if args['logger'][1]:
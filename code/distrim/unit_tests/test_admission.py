@@ -0,0 +1,82 @@
+# -*- coding: utf-8 -*-
+## This file is part of DistrIM.
+##
+## DistrIM is a DHT-based network for secured messaging.
+##
+##     Author: Graham Armstrong
+## Student ID: 11004764
+##      Email: graham.armstrong@northumbria.ac.uk
+##
+## Product for CM0645 Individual Project, academic year 2014/15.
+##
+## This product has been developed in partial fulfilment of the regulations
+## governing the award of the Degree of BSc (Honours) Computer Science
+## at the University of Northumbria at Newcastle.
+
+
+"""
+    Admission tests, ensures incoming connections are rate limited and shed.
+"""
+
+
+import unittest
+
+from time import time
+
+from ..admission import TokenBucket, AdmissionControl
+
+
+class TokenBucketTests(unittest.TestCase):
+    """Tests the :class:`TokenBucket` class"""
+    def test_burst_and_refill(self):
+        """A burst empties the bucket, which refills at the rate"""
+        bucket = TokenBucket(2, 3, now=0)
+        self.assertEqual([bucket.take(0) for _ in range(4)],
+                         [True, True, True, False])
+        self.assertFalse(bucket.take(0.4))
+        self.assertTrue(bucket.take(0.5))
+        self.assertFalse(bucket.full(1))
+        self.assertTrue(bucket.full(10))
+        self.assertEqual(bucket.tokens, 3)
+
+
+class AdmissionControlTests(unittest.TestCase):
+    """Tests the :class:`AdmissionControl` class"""
+    def test_admit(self):
+        """Each address is limited separately"""
+        admission = AdmissionControl(rate=0.001, burst=2)
+        self.assertTrue(admission.admit('10.0.0.1'))
+        self.assertTrue(admission.admit('10.0.0.1'))
+        self.assertFalse(admission.admit('10.0.0.1'))
+        self.assertTrue(admission.admit('10.0.0.2'))
+        self.assertEqual(admission.count_limited, 1)
+
+    def test_prune(self):
+        """Buckets are forgotten rather than kept past the limit"""
+        admission = AdmissionControl(rate=1000, burst=2, max_sources=2)
+        admission.admit('10.0.0.1')
+        admission.admit('10.0.0.2')
+        admission.admit('10.0.0.3')
+        self.assertLessEqual(len(admission._buckets), 2)
+        self.assertIn('10.0.0.3', admission._buckets)
+
+    def test_prune_keeps_limits(self):
+        """New addresses evict the least recently used bucket, not all"""
+        admission = AdmissionControl(rate=0.001, burst=1, max_sources=3)
+        self.assertTrue(admission.admit('10.0.0.1'))
+        for number in range(2, 10):
+            self.assertFalse(admission.admit('10.0.0.1'))
+            self.assertTrue(admission.admit('10.0.1.%d' % number))
+        self.assertEqual(len(admission._buckets), 3)
+        self.assertFalse(admission.admit('10.0.0.1'))
+
+    def test_expired(self):
+        """Connections queued too long are shed"""
+        admission = AdmissionControl(max_age=5)
+        self.assertFalse(admission.expired(time() - 1))
+        self.assertTrue(admission.expired(time() - 6))
+        self.assertEqual(admission.count_shed, 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,111 @@
+# -*- coding: utf-8 -*-
+## This file is part of DistrIM.
+##
+## DistrIM is a DHT-based network for secured messaging.
+##
+##     Author: Graham Armstrong
+## Student ID: 11004764
+##      Email: graham.armstrong@northumbria.ac.uk
+##
+## Product for CM0645 Individual Project, academic year 2014/15.
+##
+## This product has been developed in partial fulfilment of the regulations
+## governing the award of the Degree of BSc (Honours) Computer Science
+## at the University of Northumbria at Newcastle.
+
+
+"""
+    Circuit tests, ensures cells are peeled along circuits and torn down.
+"""
+
+
+import pickle
+import unittest
+
+from ..circuits import (Circuit, CircuitTable, CircuitPool, MESSAGE,
+                        DESTROY)
+from ..fingerspace import Finger
+from ..assets.errors import BusyError, ProtocolError
+from ..utils.utilities import CipherWrap
+
+
+class CircuitTests(unittest.TestCase):
+    """Tests building circuits and sending cells along them"""
+    def setUp(self):
+        test_data_path = (__file__.rpartition('/')[0]
+                          + "/_testdata_protocol.pickle")
+        with open(test_data_path) as handle:
+            test_data = pickle.load(handle)
+        self.nodes = [(Finger(val['ip'], val['port'], val['pub']),
+                       CipherWrap(val['priv'])) for val in test_data]
+        self.circuit = Circuit([finger for finger, keys in self.nodes])
+        self.tables = [CircuitTable() for _ in self.nodes]
+
+    def _build(self):
+        """Pass the onion building the circuit along it"""
+        package = self.circuit.create_package()
+        for (finger, keys), table in zip(self.nodes, self.tables):
+            layer = pickle.loads(keys.decrypt(package))
+            next_finger = None
+            if layer['NEXT']:
+                next_finger = Finger(*layer['NEXT'])
+            table.add(layer['CIRCUIT'], layer['KEY'], next_finger,
+                      layer['NEXT_CIRCUIT'])
+            package = layer['PACKAGE']
+
+    def _send(self, cell):
+        """Pass a cell along the circuit, returning the flag and body"""
+        lengths = set()
+        for idx, table in enumerate(self.tables):
+            lengths.add(len(cell))
+            flag, next_finger, cell = table.peel(cell)
+            if idx < len(self.tables) - 1:
+                self.assertEqual(next_finger, self.nodes[idx + 1][0])
+        self.assertIsNone(next_finger)
+        self.assertEqual(len(lengths), 1)
+        return flag, cell
+
+    def test_cells(self):
+        """Cells reach the recipient, the same size at every node"""
+        self._build()
+        for body in ('first', 'second' * 100):
+            self.assertEqual(self._send(self.circuit.cell(MESSAGE, body)),
+                             (MESSAGE, body))
+        self.assertEqual(self.circuit.count_sent, 2)
+        self.assertEqual(self.tables[2].metrics()['cells'], 2)
+
+    def test_destroy(self):
+        """A destroy cell makes every node forget the circuit"""
+        self._build()
+        self.assertEqual(self._send(self.circuit.cell(DESTROY)),
+                         (DESTROY, ''))
+        self.assertEqual([len(table) for table in self.tables],
+                         [0] * len(self.tables))
+        self.assertRaises(ProtocolError, self.tables[0].peel,
+                          self.circuit.cell(MESSAGE, 'late'))
+
+    def test_table_expiry(self):
+        """Idle circuits are forgotten, and make room for new ones"""
+        table = CircuitTable(lifetime=0, limit=1)
+        table.add('a' * 8, 'k' * 16)
+        table.add('b' * 8, 'k' * 16)
+        self.assertEqual(table.metrics()['expired'], 1)
+        table = CircuitTable(limit=1)
+        table.add('a' * 8, 'k' * 16)
+        self.assertRaises(BusyError, table.add, 'b' * 8, 'k' * 16)
+
+    def test_pool(self):
+        """Circuits are reused until they expire"""
+        pool = CircuitPool(messages=2)
+        ident = self.circuit.recipient.ident
+        self.assertIsNone(pool.get(ident))
+        pool.add(self.circuit)
+        self.assertIs(pool.get(ident), self.circuit)
+        self.circuit.cell(MESSAGE, 'one')
+        self.circuit.cell(MESSAGE, 'two')
+        self.assertIsNone(pool.get(ident))
+        self.assertEqual(pool.stale(), [self.circuit])
+        pool.add(self.circuit)
+        pool.discard(ident, failed=True)
+        self.assertEqual(pool.metrics()['failed'], 1)
+        self.assertEqual(pool.clear(), [])
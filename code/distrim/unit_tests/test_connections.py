@@ -0,0 +1,187 @@
+# -*- coding: utf-8 -*-
+## This file is part of DistrIM.
+##
+## DistrIM is a DHT-based network for secured messaging.
+##
+##     Author: Graham Armstrong
+## Student ID: 11004764
+##      Email: graham.armstrong@northumbria.ac.uk
+##
+## Product for CM0645 Individual Project, academic year 2014/15.
+##
+## This product has been developed in partial fulfilment of the regulations
+## governing the award of the Degree of BSc (Honours) Computer Science
+## at the University of Northumbria at Newcastle.
+
+
+
+
+"""
+    Connections tests, ensures messages fall back to the routes they can use.
+"""
+
+
+import pickle
+import socket
+import struct
+import unittest
+
+from time import sleep, time
+from threading import Event
+from mock import Mock, patch
+
+from ..connections import ConnectionsManager
+from ..fingerspace import Finger
+from ..protocol import tag_lane
+from ..assets.errors import ProtocolError
+from ..utils.config import CFG_SEND_ATTEMPTS
+from ..utils.utilities import CipherWrap
+
+
+class SendingTests(unittest.TestCase):
+    """Tests the ways :class:`ConnectionsManager` sends messages"""
+    def setUp(self):
+        test_data_path = (__file__.rpartition('/')[0]
+                          + "/_testdata_protocol.pickle")
+        with open(test_data_path) as handle:
+            test_data = pickle.load(handle)
+        self.nodes = [(Finger(val['ip'], val['port'], val['pub']),
+                       CipherWrap(val['priv'])) for val in test_data]
+        local, keys = self.nodes[0]
+        self.recipient = self.nodes[1][0]
+        fingerspace = Mock()
+        fingerspace.dead = set()
+        self.manager = ConnectionsManager(Mock(), local.addr, local.port,
+                                          fingerspace, local, keys)
+        self.addCleanup(self.manager._finish)
+        patcher = patch('distrim.connections.MessageHandler')
+        self.handler = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_lane_before_decipher(self):
+        """A tagged request is deciphered in the pool of its lane"""
+        frame = tag_lane('cryptic', 'relay')
+        with patch('distrim.connections.IncomingConnection') as incoming:
+            incoming.return_value.classify.return_value = 'relay'
+            self.manager._lanes['relay'] = Mock()
+            self.assertIsNone(self.manager.accept_new_connetion(
+                Mock(), ('127.0.0.1', 1), frame))
+        connection = incoming.return_value
+        connection.classify.assert_called_once_with(frame)
+        self.assertFalse(connection.read_request.called)
+        submit = self.manager._lanes['relay'].submit
+        self.assertEqual(submit.call_args[0][1:3], (connection, None))
+        self.assertEqual(submit.call_args[0][-1], frame)
+
+        self.manager.dispatch_connection(connection, frame=frame)
+        connection.read_request.assert_called_once_with(frame)
+        connection.dispatch.assert_called_once_with(
+            *connection.read_request.return_value)
+
+    def test_circuit_fallback(self):
+        """A message falls back to a packet without a stocked circuit"""
+        circuit = Mock()
+        self.manager.precomputer.take = Mock(return_value=circuit)
+        self.handler.return_value.build_circuit.side_effect = \
+            ProtocolError("Circuit refused.")
+        self.manager.send_by_circuit(self.recipient, 'message')
+        self.assertEqual(self.handler.return_value.build_circuit.call_count,
+                         CFG_SEND_ATTEMPTS)
+        self.handler.return_value.build_circuit.assert_any_call(
+            self.recipient, circuit)
+        self.handler.return_value.send_message.assert_called_once_with(
+            self.recipient, 'message', None, None)
+        self.manager.precomputer.take.assert_called_once_with(
+            self.recipient)
+
+    @patch('distrim.connections.CFG_CIRCUITS', False)
+    def test_packet_header(self):
+        """Without circuits, a stocked packet header is used"""
+        header = Mock()
+        self.manager.precomputer.take = Mock(return_value=header)
+        self.manager._send_routed(self.recipient, 'message')
+        self.handler.return_value.send_message.assert_called_once_with(
+            self.recipient, 'message', header, None)
+
+    def test_receipt_route(self):
+        """The route of a message is noted before it's sent"""
+        self.manager.fingerspace.get_random_fingers.return_value = [
+            finger for finger, keys in self.nodes]
+        route = [self.nodes[2][0], self.recipient]
+        postman = self.handler.return_value
+        noted = []
+
+        def send_cell(circuit, message, fields):
+            """Route the message, noting the route the receipt knows."""
+            postman.routed(route)
+            receipt, = self.manager.receipts._waiting.values()
+            noted.append(receipt.route)
+        postman.send_cell.side_effect = send_cell
+        receipt_id = self.manager.send_message(self.recipient, 'message',
+                                               receipt=True)
+        self.assertIsNotNone(receipt_id)
+        self.assertEqual(noted, [tuple(finger.ident for finger in route)])
+
+    def test_slow_circuit(self):
+        """A circuit whose receipts come back slowly is rebuilt"""
+        circuit = Mock(route=[self.nodes[2][0], self.recipient])
+        self.manager.circuits.get = Mock(return_value=circuit)
+        self.manager.circuits.discard = Mock()
+        self.manager.receipts.slow = Mock(return_value=True)
+        self.manager.send_by_circuit(self.recipient, 'message')
+        self.manager.receipts.slow.assert_called_once_with(circuit.route)
+        self.manager.circuits.discard.assert_called_once_with(
+            self.recipient.ident)
+        self.handler.return_value.destroy_circuit.assert_called_once_with(
+            circuit)
+        self.assertTrue(self.handler.return_value.build_circuit.called)
+
+
+class ListenerTests(unittest.TestCase):
+    """Tests how :class:`ConnectionsManager` accepts connections"""
+    def setUp(self):
+        test_data_path = (__file__.rpartition('/')[0]
+                          + "/_testdata_protocol.pickle")
+        with open(test_data_path) as handle:
+            val = pickle.load(handle)[0]
+        local = Finger(val['ip'], val['port'], val['pub'])
+        # Any free port is listened on
+        self.manager = ConnectionsManager(Mock(), '127.0.0.1', 0, Mock(),
+                                          local, CipherWrap(val['priv']))
+        self.pooled = Event()
+        self.manager.pool_new_connection = Mock(
+            side_effect=lambda *args: self.pooled.set() or True)
+        self.manager.listen()
+        self.addCleanup(self.manager.close)
+        self.client = socket.create_connection(
+            self.manager._sock.getsockname(), 5)
+        self.addCleanup(self.client.close)
+
+    def test_first_frame(self):
+        """A connection reaches the pool once its first frame is complete"""
+        frame = 'first frame'
+        data = struct.pack('>L', len(frame)) + frame
+        for piece in (data[:2], data[2:8]):
+            self.client.sendall(piece)
+            sleep(0.05)
+            self.assertFalse(self.pooled.is_set())
+        self.client.sendall(data[8:])
+        self.assertTrue(self.pooled.wait(5))
+        sock, _, received = self.manager.pool_new_connection.call_args[0]
+        self.addCleanup(sock.close)
+        self.assertEqual(received, frame)
+
+    def test_closed_on_error(self):
+        """A connection closed before its first frame is complete is closed"""
+        self.client.sendall(struct.pack('>L', 100) + 'partial')
+        self.client.shutdown(socket.SHUT_WR)
+        self.assertEqual(self.client.recv(1024), '')
+        deadline = time() + 5
+        while not self.manager.count_conn_failure and time() < deadline:
+            sleep(0.01)
+        self.assertEqual(self.manager.count_conn_failure, 1)
+        self.assertFalse(self.manager.pool_new_connection.called)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,62 @@
+# -*- coding: utf-8 -*-
+## This file is part of DistrIM.
+##
+## DistrIM is a DHT-based network for secured messaging.
+##
+##     Author: Graham Armstrong
+## Student ID: 11004764
+##      Email: graham.armstrong@northumbria.ac.uk
+##
+## Product for CM0645 Individual Project, academic year 2014/15.
+##
+## This product has been developed in partial fulfilment of the regulations
+## governing the award of the Degree of BSc (Honours) Computer Science
+## at the University of Northumbria at Newcastle.
+
+
+"""
+    Crypto Pool tests, ensures RSA work done by workers matches inline work.
+"""
+
+
+import unittest
+
+from mock import Mock, patch
+from Crypto.PublicKey import RSA
+
+from ..cryptopool import CryptoPool, PooledCipher
+from ..utils.utilities import CipherWrap
+
+
+class CryptoPoolTests(unittest.TestCase):
+    """Tests the :class:`CryptoPool` class"""
+    @classmethod
+    def setUpClass(cls):
+        cls.keys = CipherWrap(RSA.generate(1024))
+        cls.pool = CryptoPool(Mock(), cls.keys, 2)
+        cls.pool.start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.pool.stop()
+
+    def test_decrypt(self):
+        """Data encrypted inline is decrypted by a worker"""
+        cryptic = self.keys.encrypt('the data' * 40)
+        result = self.pool.submit_decrypt(cryptic)
+        self.assertEqual(result.get(5), 'the data' * 40)
+
+    def test_pooled_cipher(self):
+        """PooledCipher decrypts inline when the pool isn't available"""
+        cipher = PooledCipher(self.keys, self.pool)
+        self.assertEqual(cipher.export(), self.keys.export())
+        cryptic = cipher.encrypt('the data')
+        with patch.object(self.pool, 'submit_decrypt') as submit:
+            submit.return_value.get.return_value = 'pooled'
+            self.assertEqual(cipher.decrypt(cryptic), 'pooled')
+            with patch.object(self.pool, '_pid', -1):
+                self.assertEqual(cipher.decrypt(cryptic), 'the data')
+
+
+if __name__ == '__main__':
+    unittest.main()
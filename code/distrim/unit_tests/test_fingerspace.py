@@ -23,16 +23,17 @@
 """
 
 
+import time
 import unittest
 import itertools
 import socket
 
 from threading import Thread
-from mock import Mock
+from mock import Mock, patch
 from Crypto.PublicKey import RSA
 
 from ..utils.utilities import SocketWrapper
-from ..fingerspace import (FingerSpace, Finger, generate_hash,
+from ..fingerspace import (FingerSpace, Finger, DeadNodes, generate_hash,
                            finger_type_test, h2i)
 from ..assets.errors import FingerSpaceError, FingerError, HashMissmatchError
 
@@ -160,6 +161,14 @@ class FingerTests(unittest.TestCase):
         self.assertRaises(HashMissmatchError, Finger, '192.168.0.1',
                           2050, pubkey, 'Invalid Hash')
 
+    def test_compare(self):
+        """Equal fingers are not unequal, and different ones are"""
+        pubkey = RSA.generate(1024).publickey().exportKey(format='DER')
+        finger = Finger('192.168.0.1', 2000, pubkey)
+        self.assertFalse(finger != Finger('192.168.0.1', 2000, pubkey))
+        self.assertTrue(finger != Finger('192.168.0.1', 2001, pubkey))
+        self.assertTrue(finger != finger.all)
+
     def test_get_cipher(self):
         """Tests the :func:`get_cipher` method :class:`Finger`"""
         from ..utils.utilities import CipherWrap
@@ -329,6 +338,92 @@ class FingerSpaceTests(unittest.TestCase):
         path = fsi.get_random_fingers(5000)
         self.assertEqual(len(path), len(self.test_node_list))
 
+    def test_path_dead_nodes(self):
+        """Test that nodes found down are left out of paths"""
+        fsi = FingerSpace(self.mock_log, self.local_finger)
+        for addr, port, key in self.test_node_list:
+            fsi.put(addr, port, key)
+        dead = [finger.ident for finger in fsi.get_random_fingers(3)]
+        for ident in dead:
+            fsi.dead.mark(ident)
+        path = fsi.get_random_fingers(5000)
+        self.assertEqual(len(path), len(self.test_node_list) - 3)
+        self.assertFalse(any(finger.ident in dead for finger in path))
+
+    def test_get_closest(self):
+        """Test that the closest fingers are found by XOR of their idents"""
+        fsi = FingerSpace(self.mock_log, self.local_finger)
+        for addr, port, key in self.test_node_list:
+            fsi.put(addr, port, key)
+        target = fsi.get_random_fingers(1)[0]
+        closest = fsi.get_closest(target.ident, 4)
+        expected = sorted(fsi.get_all() + [self.local_finger],
+                          key=lambda fng: h2i(fng.ident) ^ h2i(target.ident))
+        self.assertEqual(closest, expected[1:5])
+
+        # The local finger is never left out, so mark another.
+        dead = [finger for finger in closest if finger != self.local_finger]
+        fsi.dead.mark(dead[0].ident)
+        self.assertNotIn(dead[0], fsi.get_closest(target.ident, 4))
+
+    def test_departed(self):
+        """Test that the fingers of removed nodes are kept"""
+        fsi = FingerSpace(self.mock_log, self.local_finger)
+        addr, port, key = self.test_node_list[0]
+        fsi.put(addr, port, key)
+        ident = generate_hash(addr, port, key)
+        self.assertIsNone(fsi.get_departed(ident))
+        fsi.remove(ident)
+        self.assertIsNone(fsi.get(ident))
+        self.assertEqual(fsi.get_departed(ident).ident, ident)
+        fsi.put(addr, port, key)
+        self.assertIsNone(fsi.get_departed(ident))
+
+    def test_tombstones(self):
+        """Test that removals leave tombstones, which keep nodes out"""
+        fsi = FingerSpace(self.mock_log, self.local_finger)
+        values = self.test_node_list[0]
+        ident = generate_hash(*values)
+        empty = fsi.digest('')
+        fsi.put(*values)
+        fsi.remove(ident)
+        self.assertEqual(fsi.digest('')[0], empty[0])
+        self.assertNotEqual(fsi.digest(''), empty)
+        self.assertEqual([tomb[0] for tomb in fsi.get_tombstones('')],
+                         [ident])
+
+        fsi.import_nodes([values])
+        self.assertIsNone(fsi.get(ident))
+        fsi.put(*values)
+        self.assertIsNotNone(fsi.get(ident))
+        self.assertEqual(fsi.get_tombstones(''), [])
+
+        fsi.remove(ident)
+        with patch('distrim.fingerspace.CFG_TOMBSTONE_TTL', 0):
+            self.assertEqual(fsi.digest(''), empty)
+        self.assertEqual(fsi.get_tombstones(''), [])
+
+    def test_apply_tombstones(self):
+        """Test that foreign tombstones remove nodes not seen since"""
+        fsi = FingerSpace(self.mock_log, self.local_finger)
+        heard, seen = self.test_node_list[:2]
+        heard_ident, seen_ident = generate_hash(*heard), generate_hash(*seen)
+        fsi.import_nodes([heard])
+        removed_at = round(time.time() - 1, 3)
+        fsi.put(*seen)
+        self.assertEqual(fsi.apply_tombstones([
+            (heard_ident, removed_at), (seen_ident, removed_at),
+            (self.local_finger.ident, removed_at), (heard_ident, 0.0)]), 1)
+        self.assertIsNone(fsi.get(heard_ident))
+        self.assertIsNotNone(fsi.get(seen_ident))
+        self.assertEqual(fsi.get_tombstones(''), [(heard_ident, removed_at)])
+
+        # The later of two removals is kept
+        fsi.apply_tombstones([(heard_ident, removed_at + 0.5)])
+        fsi.apply_tombstones([(heard_ident, removed_at)])
+        self.assertEqual(fsi.get_tombstones(''),
+                         [(heard_ident, removed_at + 0.5)])
+
     def test_import_and_export(self):
         """Tests importing and exporting values."""
         fs1 = FingerSpace(self.mock_log, self.local_finger)
@@ -345,6 +440,36 @@ class FingerSpaceTests(unittest.TestCase):
         self.assertDictEqual(fs1._keyspace, fs2._keyspace)
         self.assertFalse(self.mock_log.warning.called)
 
+    @patch('distrim.fingerspace.CFG_IMPORT_PARALLEL_MIN', 0)
+    def test_import_parallel(self):
+        """Tests importing in worker processes, with invalid entries."""
+        fs1 = FingerSpace(self.mock_log, self.local_finger)
+        for values in self.test_node_list:
+            fs1.put(*values)
+
+        addr, port, key = self.test_node_list[0]
+        invalid = [(addr, 'port', key), (addr, port, key, 'ffff')]
+        fs2 = FingerSpace(self.mock_log, self.local_finger)
+        failures = fs2.import_nodes(fs1.export_nodes() + invalid)
+        self.assertDictEqual(fs1._keyspace, fs2._keyspace)
+        self.assertListEqual([values for values, _ in failures], invalid)
+        self.assertEqual(fs2.log.error.call_count, 2)
+
+    @patch('distrim.fingerspace.CFG_IMPORT_PARALLEL_MIN', 0)
+    def test_import_daemonic(self):
+        """Tests importing in a daemonic process, which can't fork."""
+        fs1 = FingerSpace(self.mock_log, self.local_finger)
+        for values in self.test_node_list:
+            fs1.put(*values)
+
+        fs2 = FingerSpace(self.mock_log, self.local_finger)
+        with patch('distrim.fingerspace.current_process') as process, \
+                patch('distrim.fingerspace.Pool') as pool:
+            process.return_value.daemon = True
+            self.assertListEqual(fs2.import_nodes(fs1.export_nodes()), [])
+        self.assertFalse(pool.called)
+        self.assertDictEqual(fs1._keyspace, fs2._keyspace)
+
     def test_get_all(self):
         """Test the get_all function"""
         fsi = FingerSpace(self.mock_log, self.local_finger)
@@ -357,3 +482,51 @@ class FingerSpaceTests(unittest.TestCase):
         for finger in expected:
             out = fsi.get(finger.ident)
             self.assertIn(out, fingers)
+
+    def test_changes_since(self):
+        """Test the changelog used for delta synchronisation"""
+        fs1 = FingerSpace(self.mock_log, self.local_finger)
+        first, second = self.test_node_list[0:2]
+        fs1.put(*first)
+        sync_point = fs1.sync_point()
+
+        fs1.put(*second)
+        fs1.remove(Finger(*first).ident)
+        current, added, removed = fs1.changes_since(sync_point)
+        self.assertEqual(current, fs1.sync_point())
+        self.assertListEqual(added, [Finger(*second).all])
+        self.assertListEqual(removed, [Finger(*first).ident])
+
+        # Apply the delta to a FingerSpace that saw the sync point
+        fs2 = FingerSpace(self.mock_log, self.local_finger)
+        fs2.put(*first)
+        fs2.apply_changes(added, removed)
+        self.assertDictEqual(fs1._keyspace, fs2._keyspace)
+
+        # Nothing has changed since the current sync point
+        self.assertEqual(fs1.changes_since(current), (current, [], []))
+
+    def test_changes_since_unknown(self):
+        """Test that a full transfer is needed when no delta exists"""
+        fsi = FingerSpace(self.mock_log, self.local_finger)
+        for values in self.test_node_list:
+            fsi.put(*values)
+        self.assertIsNone(fsi.changes_since(('other', 0)))
+        self.assertIsNone(fsi.changes_since((fsi.epoch, fsi.version + 1)))
+
+        fsi._changelog.clear()
+        self.assertIsNone(fsi.changes_since((fsi.epoch, 0)))
+
+
+class DeadNodesTests(unittest.TestCase):
+    """Tests the DeadNodes class"""
+    def test_expiry(self):
+        """Test that nodes marked down are forgotten after their TTL"""
+        dead = DeadNodes(ttl=60)
+        dead.mark('abcd')
+        self.assertIn('abcd', dead)
+        self.assertNotIn('ef01', dead)
+        dead.ttl = 0
+        self.assertNotIn('abcd', dead)
+        self.assertEqual(dead.metrics(),
+                         {'dead': 0, 'marked': 1, 'expired': 1})
@@ -0,0 +1,162 @@
+# -*- coding: utf-8 -*-
+## This file is part of DistrIM.
+##
+## DistrIM is a DHT-based network for secured messaging.
+##
+##     Author: Graham Armstrong
+## Student ID: 11004764
+##      Email: graham.armstrong@northumbria.ac.uk
+##
+## Product for CM0645 Individual Project, academic year 2014/15.
+##
+## This product has been developed in partial fulfilment of the regulations
+## governing the award of the Degree of BSc (Honours) Computer Science
+## at the University of Northumbria at Newcastle.
+
+
+
+
+"""
+    Inbox tests, ensures received messages are kept, found and compacted.
+"""
+
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from time import time
+from threading import Event, Thread
+from mock import Mock, patch
+
+from ..inbox import Inbox, Segment
+
+
+class InboxTests(unittest.TestCase):
+    """Tests the :class:`Inbox` class"""
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.clock = [1000.0]
+        patcher = patch('distrim.inbox.time', lambda: self.clock[0])
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def _inbox(self, **kwargs):
+        """Create a loaded inbox that is closed once the test is done"""
+        inbox = Inbox(Mock(), self.directory, **kwargs)
+        inbox.load()
+        self.addCleanup(inbox.stop)
+        return inbox
+
+    def _fill(self, inbox, number, senders=('a9ad', 'b000')):
+        """Add messages a second apart, from each sender in turn"""
+        for count in xrange(number):
+            self.clock[0] += 1
+            inbox.add(senders[count % len(senders)], 'message %d' % count)
+
+    def test_query(self):
+        """Messages are found by sender and time, over every segment"""
+        inbox = self._inbox(segment_size=512)
+        self._fill(inbox, 40)
+        self.assertGreater(inbox.metrics()['segments'], 2)
+
+        found = inbox.query()
+        self.assertEqual([message for _, _, message in found],
+                         ['message %d' % count for count in xrange(40)])
+        found = inbox.query(sender='b000', since=1010, until=1020)
+        self.assertEqual([(received, sender) for received, sender, _
+                          in found],
+                         [(float(when), 'b000') for when in
+                          xrange(1010, 1021, 2)])
+        found = inbox.query(sender='a9ad', limit=3)
+        self.assertEqual([message for _, _, message in found],
+                         ['message 34', 'message 36', 'message 38'])
+        self.assertEqual(inbox.query(sender='c111'), [])
+        self.assertEqual(inbox.query(since=2000), [])
+
+    def test_reload(self):
+        """Messages are kept, and broken indexes and records are repaired"""
+        inbox = self._inbox(segment_size=512)
+        self._fill(inbox, 30)
+        expected = inbox.query()
+        inbox.stop()
+
+        index = sorted(name for name in os.listdir(self.directory)
+                       if name.endswith('.idx'))[0]
+        os.remove(os.path.join(self.directory, index))
+        newest = sorted(name for name in os.listdir(self.directory)
+                        if name.endswith('.seg'))[-1]
+        with open(os.path.join(self.directory, newest), 'ab') as handle:
+            handle.write('\x00\x00\x01\x00partial')
+
+        inbox = self._inbox(segment_size=512)
+        self.assertEqual(inbox.query(), expected)
+        inbox.add('a9ad', 'after')
+        self.assertEqual(inbox.query(limit=1)[0][1:], ('a9ad', 'after'))
+
+    def test_delete(self):
+        """Deleted messages are gone, and shrunk segments are merged"""
+        inbox = self._inbox(segment_size=512)
+        self._fill(inbox, 40, ('a9ad', 'b000', 'c111', 'd222'))
+        segments = inbox.metrics()['segments']
+
+        self.assertEqual(inbox.delete(sender='a9ad'), 10)
+        self.assertEqual(inbox.query(sender='a9ad'), [])
+        self.assertEqual(inbox.delete(until=1006), 4)
+        for sender in ('b000', 'c111'):
+            inbox.delete(sender=sender)
+        inbox.compact()
+        metrics = inbox.metrics()
+        self.assertLess(metrics['segments'], segments)
+        self.assertEqual((metrics['messages'], metrics['merged']), (9, 2))
+        self.assertEqual([received for received, _, _ in inbox.query()],
+                         [float(when) for when in xrange(1008, 1041, 4)])
+
+    def test_seal_unblocked(self):
+        """Messages are added and found while full segments are sealed"""
+        inbox = self._inbox(segment_size=512)
+        self._fill(inbox, 20)
+        self.assertEqual(len(inbox.query()), 20)
+        started, release = Event(), Event()
+        seal = Segment.seal.__func__
+
+        def sealing(cls, path, entries):
+            """Hold up writing the index"""
+            started.set()
+            release.wait(5)
+            return seal(cls, path, entries)
+
+        with patch.object(Segment, 'seal', classmethod(sealing)):
+            compacting = Thread(target=inbox.compact)
+            compacting.start()
+            self.assertTrue(started.wait(5))
+            began = time()
+            self._fill(inbox, 1, ('c111',))
+            self.assertEqual(len(inbox.query()), 21)
+            self.assertLess(time() - began, 1)
+            release.set()
+            compacting.join(5)
+        self.assertEqual(inbox.metrics()['messages'], 21)
+        self.assertEqual(inbox.query(sender='c111')[0][2], 'message 0')
+
+    def test_expire(self):
+        """Old segments, and segments over the size limit, are dropped"""
+        inbox = self._inbox(segment_size=512, max_age=100)
+        self._fill(inbox, 40)
+        self.clock[0] += 80
+        inbox.compact()
+        expired = inbox.metrics()['expired']
+        self.assertGreater(expired, 0)
+        self.assertEqual(inbox.query()[0][0], 1001.0 + expired)
+
+        inbox.max_size = 0
+        inbox.compact()
+        metrics = inbox.metrics()
+        self.assertEqual(metrics['segments'], 1)
+        self.assertEqual(metrics['messages'] + metrics['expired'], 40)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,68 @@
+# -*- coding: utf-8 -*-
+## This file is part of DistrIM.
+##
+## DistrIM is a DHT-based network for secured messaging.
+##
+##     Author: Graham Armstrong
+## Student ID: 11004764
+##      Email: graham.armstrong@northumbria.ac.uk
+##
+## Product for CM0645 Individual Project, academic year 2014/15.
+##
+## This product has been developed in partial fulfilment of the regulations
+## governing the award of the Degree of BSc (Honours) Computer Science
+## at the University of Northumbria at Newcastle.
+
+# Python testing module:
+#    http://docs.python-guide.org/en/latest/writing/tests/
+
+"""
+    Key Store tests, ensures identities survive a restart.
+"""
+
+
+import shutil
+import unittest
+
+from tempfile import mkdtemp
+from mock import Mock, patch
+
+from ..keystore import KeyStore
+from ..assets.errors import CipherError
+
+
+class KeyStoreTests(unittest.TestCase):
+    """Tests the :class:`KeyStore` class"""
+    def setUp(self):
+        self.directory = mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_load_or_create(self):
+        """The same key pair is loaded after it is created"""
+        store = KeyStore(Mock(), self.directory, 'secret')
+        self.assertIsNone(store.load())
+        keys = store.load_or_create()
+        self.assertEqual(store.load_or_create().export(key_type=1),
+                         keys.export(key_type=1))
+
+        with self.assertRaises(CipherError):
+            KeyStore(Mock(), self.directory, 'wrong').load()
+
+    @patch('distrim.keystore.CFG_KEY_SPARES', 1)
+    def test_rotate_spare(self):
+        """Rotating the identity promotes a pregenerated spare"""
+        store = KeyStore(Mock(), self.directory)
+        keys = store.load_or_create()
+        store._generating()
+        self.assertEqual(len(store.spares()), 1)
+        spare = store._read(store.spares()[0])
+
+        rotated = store.rotate()
+        self.assertEqual(rotated.export(key_type=1), spare.export(key_type=1))
+        self.assertNotEqual(rotated.export(key_type=1),
+                            keys.export(key_type=1))
+        self.assertEqual(store.load().export(key_type=1),
+                         rotated.export(key_type=1))
+        self.assertEqual(len(store.spares()), 0)
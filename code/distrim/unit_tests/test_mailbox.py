@@ -0,0 +1,159 @@
+# -*- coding: utf-8 -*-
+## This file is part of DistrIM.
+##
+## DistrIM is a DHT-based network for secured messaging.
+##
+##     Author: Graham Armstrong
+## Student ID: 11004764
+##      Email: graham.armstrong@northumbria.ac.uk
+##
+## Product for CM0645 Individual Project, academic year 2014/15.
+##
+## This product has been developed in partial fulfilment of the regulations
+## governing the award of the Degree of BSc (Honours) Computer Science
+## at the University of Northumbria at Newcastle.
+
+
+
+
+"""
+    Mailbox tests, ensures mail for offline nodes is held and collected.
+"""
+
+
+import pickle
+import unittest
+
+from mock import Mock, patch
+
+from ..mailbox import MailStore, Mailboxes
+from ..fingerspace import Finger
+from ..assets.errors import SockWrapError, MailboxError
+from ..utils.utilities import CipherWrap
+
+
+class MailStoreTests(unittest.TestCase):
+    """Tests the :class:`MailStore` class"""
+    def test_store_and_take(self):
+        """Mail is held until it's taken, and stored only once"""
+        store = MailStore()
+        self.assertTrue(store.store('a9ad', 'one', ('head', 'body'), 60))
+        self.assertTrue(store.store('a9ad', 'two', ('head', 'body'), 60))
+        self.assertTrue(store.store('a9ad', 'one', ('head', 'body'), 60))
+        self.assertEqual([item_id for item_id, _ in store.peek('a9ad')],
+                         ['one', 'two'])
+        self.assertEqual(store.peek('b000'), [])
+        store.take('a9ad', ['one', 'two', 'three'])
+        self.assertEqual(store.peek('a9ad'), [])
+        metrics = store.metrics()
+        self.assertEqual((metrics['stored'], metrics['fetched'],
+                          metrics['bytes'], metrics['boxes']), (2, 2, 0, 0))
+
+    def test_limits(self):
+        """Mail over the limits of a box or of the store is refused"""
+        store = MailStore(box_items=2, box_size=20, size=30)
+        self.assertTrue(store.store('a9ad', 'one', ('head', 'body'), 60))
+        self.assertTrue(store.store('a9ad', 'two', ('head', 'body'), 60))
+        self.assertFalse(store.store('a9ad', 'three', ('a', 'b'), 60))
+        self.assertFalse(store.store('b000', 'one', ('x' * 21, ''), 60))
+        self.assertTrue(store.store('b000', 'two', ('x' * 14, ''), 60))
+        self.assertFalse(store.store('c111', 'one', ('head', 'body'), 60))
+        metrics = store.metrics()
+        self.assertEqual((metrics['items'], metrics['bytes'],
+                          metrics['refused']), (3, 30, 3))
+
+    @patch('distrim.mailbox.time')
+    def test_expiry(self, clock):
+        """Mail is dropped once held for its TTL, or the store's"""
+        clock.return_value = 1000
+        store = MailStore(ttl=100)
+        store.store('a9ad', 'one', ('head', 'body'), 10)
+        store.store('a9ad', 'two', ('head', 'body'), 500)
+        clock.return_value = 1050
+        self.assertEqual([item_id for item_id, _ in store.peek('a9ad')],
+                         ['two'])
+        clock.return_value = 1100
+        self.assertEqual(store.peek('a9ad'), [])
+        self.assertEqual(store.metrics()['expired'], 2)
+
+
+class MailboxesTests(unittest.TestCase):
+    """Tests leaving mail for an offline node and collecting it"""
+    def setUp(self):
+        test_data_path = (__file__.rpartition('/')[0]
+                          + "/_testdata_protocol.pickle")
+        with open(test_data_path) as handle:
+            test_data = pickle.load(handle)
+        self.nodes = [(Finger(val['ip'], val['port'], val['pub']),
+                       CipherWrap(val['priv'])) for val in test_data]
+        self.delivered = []
+        self.down = set()
+        self.sender = self._mailboxes(0)
+        self.recipient = self._mailboxes(1)
+        self.stores = {self.nodes[0][0].ident: self.sender.held,
+                       self.nodes[2][0].ident: MailStore(),
+                       self.nodes[3][0].ident: MailStore()}
+
+    def _mailboxes(self, number):
+        """Create the mailboxes of a node, closest to the others"""
+        fingerspace = Mock()
+        closest = [self.nodes[idx][0] for idx in (2, 0, 3, 4)]
+        fingerspace.get_closest.side_effect = \
+            lambda ident, number: closest[:number]
+        return Mailboxes(Mock(), fingerspace, self.nodes[number][0],
+                         self.nodes[number][1], self._perform,
+                         lambda *args: self.delivered.append(args))
+
+    def _perform(self, handler, procedure, *args):
+        """Run a procedure against the store of the foreign node"""
+        ident = handler.foreign_finger.ident
+        if ident in self.down or ident not in self.stores:
+            raise SockWrapError("Connection refused.")
+        store = self.stores[ident]
+        if procedure == 'store':
+            return store.store(*args)
+        items = store.peek(handler.local_finger.ident)
+        store.take(handler.local_finger.ident,
+                   [item_id for item_id, _ in items])
+        return items
+
+    def test_deposit_and_collect(self):
+        """Mail is left with the closest nodes and collected only once"""
+        recipient = self.nodes[1][0]
+        self.assertEqual(self.sender.deposit(recipient, 'first'), 3)
+        self.down.add(self.nodes[2][0].ident)
+        self.assertEqual(self.sender.deposit(recipient, 'second'), 2)
+        self.sender.fingerspace.dead.mark.assert_called_with(
+            self.nodes[2][0].ident)
+        self.assertEqual(self.stores[self.nodes[3][0].ident].peek(
+            recipient.ident)[0][1][1].find('first'), -1)
+
+        self.down.clear()
+        self.assertEqual(self.recipient.collect(), 2)
+        sender = self.nodes[0][0].ident
+        self.assertEqual(self.delivered,
+                         [(sender, 'first'), (sender, 'second')])
+        self.recipient.fingerspace.put.assert_called_with(
+            *self.nodes[0][0].all)
+        self.assertEqual(self.recipient.collect(), 0)
+        self.assertTrue(all(not store.metrics()['items']
+                            for store in self.stores.values()))
+
+    def test_no_holders(self):
+        """Mail nobody will hold raises an error"""
+        self.down.update(self.stores)
+        self.sender.held.size = 0
+        with self.assertRaises(MailboxError):
+            self.sender.deposit(self.nodes[1][0], 'lost')
+        self.assertEqual(self.sender.held.metrics()['refused'], 1)
+
+    def test_unreadable(self):
+        """Mail that isn't for this node is dropped"""
+        self.stores[self.nodes[2][0].ident].store(
+            self.nodes[1][0].ident, 'forged', ('head', 'body'), 60)
+        self.assertEqual(self.recipient.collect(), 0)
+        self.assertEqual(self.recipient.metrics()['unreadable'], 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,70 @@
+# -*- coding: utf-8 -*-
+## This file is part of DistrIM.
+##
+## DistrIM is a DHT-based network for secured messaging.
+##
+##     Author: Graham Armstrong
+## Student ID: 11004764
+##      Email: graham.armstrong@northumbria.ac.uk
+##
+## Product for CM0645 Individual Project, academic year 2014/15.
+##
+## This product has been developed in partial fulfilment of the regulations
+## governing the award of the Degree of BSc (Honours) Computer Science
+## at the University of Northumbria at Newcastle.
+
+
+"""
+    Onion tests, ensures streamed onions can be peeled chunk by chunk.
+"""
+
+
+import pickle
+import unittest
+
+from ..onion import OnionLayer, HeaderReader, build_onion
+from ..fingerspace import Finger
+from ..assets.errors import ProtocolError
+from ..utils.utilities import CipherWrap, split_chunks
+
+
+class OnionTests(unittest.TestCase):
+    """Tests the streamed onion format"""
+    def setUp(self):
+        test_data_path = (__file__.rpartition('/')[0]
+                          + "/_testdata_protocol.pickle")
+        with open(test_data_path) as handle:
+            test_data = pickle.load(handle)
+        self.nodes = [(Finger(val['ip'], val['port'], val['pub']),
+                       CipherWrap(val['priv'])) for val in test_data]
+
+    def test_peel_route(self):
+        """Each node peels its layer and finds the next header"""
+        package = 'The quick brown fox jumped over the lazy dog.' * 500
+        route = [finger for finger, keys in self.nodes]
+        header, payload = build_onion(route, package)
+        for idx, (finger, keys) in enumerate(self.nodes):
+            layer = OnionLayer(keys, header)
+            chunks = [layer.decrypt(chunk)
+                      for chunk in split_chunks(payload, 1000)]
+            if idx == len(self.nodes) - 1:
+                self.assertIsNone(layer.next)
+                self.assertEqual(''.join(chunks), package)
+                break
+            self.assertEqual(layer.next, route[idx + 1].all)
+            reader = HeaderReader()
+            for count, chunk in enumerate(chunks, 1):
+                if reader.feed(chunk):
+                    break
+            header = reader.header
+            payload = reader.leftover + ''.join(chunks[count:])
+
+    def test_invalid_header(self):
+        """A header for another node can't be opened"""
+        (finger_a, keys_a), (finger_b, keys_b) = self.nodes[:2]
+        header, payload = build_onion([finger_a], 'package')
+        self.assertRaises(ProtocolError, OnionLayer, keys_b, header)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,187 @@
+# -*- coding: utf-8 -*-
+## This file is part of DistrIM.
+##
+## DistrIM is a DHT-based network for secured messaging.
+##
+##     Author: Graham Armstrong
+## Student ID: 11004764
+##      Email: graham.armstrong@northumbria.ac.uk
+##
+## Product for CM0645 Individual Project, academic year 2014/15.
+##
+## This product has been developed in partial fulfilment of the regulations
+## governing the award of the Degree of BSc (Honours) Computer Science
+## at the University of Northumbria at Newcastle.
+
+
+
+"""
+    Outbox tests, ensures queued messages are sent, retried and kept.
+"""
+
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from time import sleep, time
+from threading import Event, Thread
+from mock import Mock, patch
+
+from ..node import Node
+from ..outbox import Outbox
+from ..utils.records import RecordLog
+from ..assets.errors import ExecutorError
+
+
+class OutboxTests(unittest.TestCase):
+    """Tests the :class:`Outbox` class"""
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.sent = []
+        self.failures = 0
+
+    def _send(self, recipient, message):
+        """Send a message, failing the first `failures` times"""
+        if self.failures:
+            self.failures -= 1
+            raise ValueError("Recipient is down.")
+        self.sent.append((recipient, message))
+        return 'receipt %d' % len(self.sent)
+
+    def _outbox(self, **kwargs):
+        """Create an outbox that is stopped once the test is done"""
+        options = {'workers': 2, 'delay': 0.01, 'sync_interval': 0.01}
+        options.update(kwargs)
+        outbox = Outbox(Mock(), self.directory, self._send, **options)
+        self.addCleanup(outbox.stop)
+        return outbox
+
+    def _wait_sent(self, outbox, number):
+        """Wait for messages to be done with"""
+        deadline = time() + 5
+        while outbox.metrics()['waiting'] and time() < deadline:
+            sleep(0.01)
+        self.assertEqual(len(self.sent), number)
+
+    def test_send(self):
+        """Queued messages are sent, and retried until they are"""
+        outbox = self._outbox()
+        outbox.start()
+        self.failures = 2
+        outbox.enqueue('a9ad', 'first')
+        outbox.enqueue('b000', 'second')
+        self._wait_sent(outbox, 2)
+        self.assertEqual(sorted(self.sent),
+                         [('a9ad', 'first'), ('b000', 'second')])
+        metrics = outbox.metrics()
+        self.assertEqual((metrics['sent'], metrics['retried']), (2, 2))
+
+    def test_give_up(self):
+        """Messages are given up on once their retries are used"""
+        outbox = self._outbox(retries=1)
+        outbox.start()
+        self.failures = 2
+        outbox.enqueue('a9ad', 'lost')
+        self._wait_sent(outbox, 0)
+        self.assertEqual(outbox.metrics()['failed'], 1)
+
+    def test_restart(self):
+        """Messages not sent before stopping are sent after a restart"""
+        outbox = self._outbox(delay=60)
+        outbox.start()
+        self.failures = 1
+        outbox.enqueue('a9ad', 'kept')
+        deadline = time() + 5
+        while not outbox.metrics()['retried'] and time() < deadline:
+            sleep(0.01)
+        outbox.stop()
+
+        outbox = self._outbox()
+        self.assertEqual(outbox.load(), 1)
+        outbox.start()
+        self._wait_sent(outbox, 1)
+        self.assertEqual(self.sent, [('a9ad', 'kept')])
+        outbox.stop()
+        self.assertEqual(self._outbox().load(), 0)
+
+    def test_compact(self):
+        """The spool is rewritten with only the messages waiting"""
+        outbox = self._outbox(compact_size=1024)
+        outbox.start()
+        for number in xrange(50):
+            outbox.enqueue('a9ad', 'message %d' % number)
+        self._wait_sent(outbox, 50)
+        sleep(0.1)
+        self.assertLess(os.path.getsize(outbox.path), 1024)
+
+    def test_wait(self):
+        """Waiting on a message gives what sending it returned"""
+        outbox = self._outbox()
+        outbox.start()
+        message_id = outbox.enqueue('a9ad', 'first')
+        self.assertEqual(outbox.wait(message_id, 5), 'receipt 1')
+        self.assertIsNone(outbox.wait('unknown', 5))
+
+    def test_compact_unblocked(self):
+        """Messages are queued while the spool is rewritten"""
+        outbox = self._outbox(workers=0)
+        outbox.start()
+        outbox.enqueue('a9ad', 'before')
+        release = Event()
+        sync = RecordLog.sync
+
+        def slow_sync(log):
+            """Hold up syncing the rewritten spool"""
+            if log.path.endswith('.tmp'):
+                release.wait(5)
+            sync(log)
+
+        with patch.object(RecordLog, 'sync', autospec=True,
+                          side_effect=slow_sync):
+            compacting = Thread(target=outbox._compact)
+            compacting.start()
+            sleep(0.05)
+            self.assertTrue(compacting.is_alive())
+            started = time()
+            outbox.enqueue('a9ad', 'during')
+            self.assertLess(time() - started, 1)
+            release.set()
+            compacting.join(5)
+        outbox.enqueue('a9ad', 'after')
+        outbox.stop()
+        self.assertEqual(self._outbox().load(), 3)
+        self.assertFalse(os.path.exists(outbox.next_path))
+
+    def test_limits(self):
+        """Messages can't be queued while stopped, or once full"""
+        outbox = self._outbox(limit=1, workers=0)
+        self.assertRaises(ExecutorError, outbox.enqueue, 'a9ad', 'early')
+        outbox.start()
+        outbox.enqueue('a9ad', 'first')
+        self.assertRaises(ExecutorError, outbox.enqueue, 'a9ad', 'second')
+
+
+class NodeOutboxTests(unittest.TestCase):
+    """Tests sending messages through the outbox of a :class:`Node`"""
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+
+    def test_wait_delivered(self):
+        """A message queued in the outbox is waited on by its receipt"""
+        node = Node('127.0.0.1', 6050, data_dir=self.directory,
+                    crypto_processes=0)
+        self.addCleanup(node.conn_manager._finish)
+        node._recipient = Mock()
+        node.conn_manager.send_message = Mock(return_value='receipt')
+        node.conn_manager.receipts.wait = Mock(return_value=0.25)
+        node.outbox.start()
+        self.addCleanup(node.outbox.stop)
+        message_id = node.send_message('a9ad', 'hello')
+        self.assertNotEqual(message_id, 'receipt')
+        self.assertEqual(node.wait_delivered(message_id, 5), 0.25)
+        self.assertEqual(
+            node.conn_manager.receipts.wait.call_args[0][0], 'receipt')
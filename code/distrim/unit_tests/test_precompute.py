@@ -0,0 +1,91 @@
+# -*- coding: utf-8 -*-
+## This file is part of DistrIM.
+##
+## DistrIM is a DHT-based network for secured messaging.
+##
+##     Author: Graham Armstrong
+## Student ID: 11004764
+##      Email: graham.armstrong@northumbria.ac.uk
+##
+## Product for CM0645 Individual Project, academic year 2014/15.
+##
+## This product has been developed in partial fulfilment of the regulations
+## governing the award of the Degree of BSc (Honours) Computer Science
+## at the University of Northumbria at Newcastle.
+
+
+
+"""
+    Precompute tests, ensures routes are prepared and taken for recipients.
+"""
+
+
+import unittest
+
+from time import sleep, time
+from mock import Mock
+
+from ..precompute import Precomputer
+
+
+class PrecomputerTests(unittest.TestCase):
+    """Tests the :class:`Precomputer` class"""
+    def setUp(self):
+        self.recipient = Mock(ident='a9ad')
+        self.fingerspace = Mock()
+        self.fingerspace.get.side_effect = lambda ident: (
+            self.recipient if ident == 'a9ad' else None)
+        self.fingerspace.dead = set()
+        self.precomputer = Precomputer(Mock(), self.fingerspace,
+                                       self._prepare, stock=2, recipients=1,
+                                       max_age=60, idle=0.01)
+        self.addCleanup(self.precomputer.stop)
+
+    def _prepare(self, recipient):
+        """Prepare a route straight to the recipient"""
+        return Mock(route=[recipient], created=time())
+
+    def _wait_stocked(self, number):
+        """Wait for the stock to be refilled"""
+        for _ in range(100):
+            if self.precomputer.metrics()['stocked'] >= number:
+                return
+            sleep(0.01)
+        self.fail("Stock wasn't refilled.")
+
+    def test_take(self):
+        """The first send misses, later sends take prepared routes"""
+        self.precomputer.start()
+        self.assertIsNone(self.precomputer.take(self.recipient))
+        self._wait_stocked(2)
+        route = self.precomputer.take(self.recipient)
+        self.assertEqual(route.route, [self.recipient])
+        self._wait_stocked(2)
+        metrics = self.precomputer.metrics()
+        self.assertEqual((metrics['hits'], metrics['misses']), (1, 1))
+        self.assertEqual(metrics['prepared'], 3)
+
+    def test_discarded(self):
+        """Stale routes, and routes through departed nodes, aren't taken"""
+        self.precomputer.start()
+        self.precomputer.take(self.recipient)
+        self._wait_stocked(2)
+        for route in self.precomputer._routes['a9ad']:
+            route.created -= 60
+        self.assertIsNone(self.precomputer.take(self.recipient))
+        self.assertEqual(self.precomputer.metrics()['discarded'], 2)
+
+    def test_dead_nodes(self):
+        """Routes through nodes found down aren't taken"""
+        self.precomputer.start()
+        self.precomputer.take(self.recipient)
+        self._wait_stocked(2)
+        self.fingerspace.dead.add('a9ad')
+        self.assertIsNone(self.precomputer.take(self.recipient))
+        self.assertEqual(self.precomputer.metrics()['discarded'], 2)
+
+    def test_recipients(self):
+        """Only the most recent recipients are kept"""
+        self.precomputer.take(Mock(ident='b000'))
+        self.precomputer.take(self.recipient)
+        self.assertEqual(self.precomputer.metrics()['recipients'], 1)
@@ -22,15 +22,19 @@
 
 
 import unittest
-from mock import Mock
+from mock import Mock, patch
 from itertools import product
 
 import pickle
 
 from ..protocol import (Protocol, ConnectionHandler, IncomingConnection,
                         MessageHandler)
-from ..fingerspace import Finger
-from ..assets.errors import ProtocolError, ProcedureError
+from ..fingerspace import Finger, FingerSpace
+from ..handlers import HandlerRegistry
+from ..mailbox import MailStore
+from ..sphinx import PACKET_SIZE
+from ..assets.errors import (ProtocolError, ProcedureError, BusyError,
+                             SockWrapError, RelayDownError)
 from ..utils.utilities import CipherWrap
 
 
@@ -151,6 +155,26 @@ class ConnectionHandlerFuncTests(unittest.TestCase):
             self.assertEqual(Protocol.Message, msg)
             self.assertEqual(test_data_2, decryptic['td'])
 
+    def test_lane_tag(self):
+        """Requests are tagged with their lane, and classified by it"""
+        (keys_a, finger_a), (keys_b, finger_b) = self.nodes[0:2]
+        node_a = ConnHandleInit(keys_a, finger_a, finger_b)
+        node_b = ConnHandleInit(keys_b, finger_b, finger_a)
+
+        cryptic = node_a.package(Protocol.Fetch, {'td': 'data'})
+        self.assertTrue(cryptic.startswith(Protocol.Lane))
+        self.assertEqual(IncomingConnection.classify(cryptic), 'relay')
+        _, msg, params = node_b.unpack(cryptic)
+        self.assertEqual(msg, Protocol.Fetch)
+        self.assertEqual(params['td'], 'data')
+
+        cryptic = node_a.package(Protocol.Message, {'td': 'data'})
+        self.assertFalse(cryptic.startswith(Protocol.Lane))
+        self.assertEqual(IncomingConnection.classify(cryptic), 'control')
+
+        packet = Protocol.Packet + '\0' * PACKET_SIZE
+        self.assertEqual(IncomingConnection.classify(packet), 'relay')
+
     def test_send_invalid_data(self):
         """Ensure that sending invalid data causes an error."""
         data_a, data_b = self.nodes[0:2]
@@ -198,3 +222,152 @@ class MessageHandlingTests(unittest.TestCase):
 
             unpacked = node_b._peel_onion_layer(cryptic_data)
             self.assertEqual(test_msg, unpacked['MESSAGE'])
+
+    def test_handlers(self):
+        """Requests are sorted by the cost class of their handler"""
+        finger, keys = self.nodes[0]
+        conn = IncomingConnection(Mock(), None, finger.address, None,
+                                  finger, keys)
+        self.assertEqual(conn.handler(Protocol.Relay).cost, 'relay')
+        self.assertFalse(conn.handler(Protocol.Relay).inline)
+        for msg_type in (Protocol.Ping, Protocol.Quit, Protocol.Announce):
+            self.assertEqual(conn.handler(msg_type).cost, 'control')
+            self.assertTrue(conn.handler(msg_type).inline)
+        self.assertRaises(ProcedureError, conn.handler, Protocol.Pong)
+
+    def test_handler_metrics(self):
+        """Handlers are counted, timed and limited"""
+        registry = HandlerRegistry()
+        calls = []
+        registry.register(Protocol.Ping, limit=1)(
+            lambda conn, params: calls.append(params))
+        handler = registry.get(Protocol.Ping)
+        handler.run(None, {'N': 1})
+        self.assertEqual(calls, [{'N': 1}])
+        handler._slots.acquire()
+        self.assertRaises(BusyError, handler.run, None, {})
+        handler._slots.release()
+        metrics = registry.metrics()[Protocol.Ping]
+        self.assertEqual(metrics['calls'], 1)
+        self.assertEqual(metrics['rejected'], 1)
+
+    def test_relay_down(self):
+        """A relay that can't extend a circuit reports the node down"""
+        finger, keys = self.nodes[0]
+        next_finger = self.nodes[1][0]
+        fingerspace = Mock()
+        conn = IncomingConnection(Mock(), None, finger.address, fingerspace,
+                                  finger, keys, circuits=Mock())
+        conn._extend_circuit = Mock(return_value=('id', (next_finger, 'x')))
+        conn.send = Mock()
+        with patch('distrim.protocol.MessageHandler') as handler:
+            handler.return_value.connect.side_effect = SockWrapError()
+            conn.handle_circuit({})
+        conn.send.assert_called_once_with(Protocol.Down,
+                                          {'IDENT': next_finger.ident})
+        conn.circuits.remove.assert_called_once_with('id')
+        fingerspace.dead.mark.assert_called_once_with(next_finger.ident)
+
+        with self.assertRaises(RelayDownError) as exc:
+            MessageHandler._created(Protocol.Down, {'IDENT': 'abcd'})
+        self.assertEqual(exc.exception.ident, 'abcd')
+        self.assertRaises(ProcedureError, MessageHandler._created,
+                          Protocol.Pong, {})
+        MessageHandler._created(Protocol.Circuit, {'CREATED': True})
+
+    def test_mail_handlers(self):
+        """Mail is held for offline nodes, and handed over once taken"""
+        finger, keys = self.nodes[0]
+        owner = self.nodes[1][0]
+        conn = IncomingConnection(Mock(), None, finger.address, Mock(),
+                                  finger, keys, mail=MailStore())
+        conn.send = Mock()
+        conn.handle_store({'IDENT': owner.ident, 'ID': 'one',
+                           'ITEM': ('head', 'body'), 'TTL': 60})
+        conn.send.assert_called_once_with(Protocol.Store, {'STORED': True})
+
+        conn.foreign_finger = owner
+        conn.receive = Mock(return_value=(Protocol.Fetch,
+                                          {'TAKEN': ['one']}))
+        conn.handle_fetch({})
+        conn.send.assert_called_with(
+            Protocol.Mail, {'ITEMS': [('one', ('head', 'body'))]})
+        conn.receive.assert_called_once_with(Protocol.Fetch)
+        self.assertEqual(conn.mail.peek(owner.ident), [])
+
+        conn.mail = None
+        conn.handle_store({'IDENT': owner.ident, 'ID': 'two',
+                           'ITEM': ('head', 'body'), 'TTL': 60})
+        conn.send.assert_called_with(Protocol.Store, {'STORED': False})
+
+class SyncHandler(ConnectionHandler):
+    """Extends the abstract class ConnectionHandler for reconciliation"""
+    def __init__(self, fingerspace, local_finger):
+        self.fingerspace = fingerspace
+        self.local_finger = local_finger
+        self.log = Mock()
+
+
+class ReconcileTests(unittest.TestCase):
+    """Test the anti-entropy exchange of Sync messages"""
+    def setUp(self):
+        test_data_path = (__file__.rpartition('/')[0]
+                          + "/_testdata_fingerspace.pickle")
+        with open(test_data_path) as handle:
+            self.nodes = pickle.load(handle)
+
+    def _exchange(self, side_a, side_b):
+        """Pass Sync messages between two sides until one ends it"""
+        params = {'DIGESTS': {'': side_a.fingerspace.digest('')},
+                  'NODES': [], 'WANT': []}
+        sides = [side_b, side_a]
+        rounds = 0
+        while True:
+            reply = sides[0]._sync_step(params)
+            if not (params['DIGESTS'] or params['WANT']):
+                return rounds
+            params = reply
+            sides.reverse()
+            rounds += 1
+
+    def test_reconcile(self):
+        """Two drifted FingerSpaces end up with the same nodes"""
+        finger_a, finger_b = Finger(*self.nodes[0]), Finger(*self.nodes[1])
+        space_a = FingerSpace(Mock(), finger_a)
+        space_b = FingerSpace(Mock(), finger_b)
+        for values in self.nodes[2:12]:
+            space_a.put(*values)
+        for values in self.nodes[6:]:
+            space_b.put(*values)
+        space_a.put(*finger_b.values)
+        space_b.put(*finger_a.values)
+        self.assertNotEqual(space_a.digest(''), space_b.digest(''))
+
+        self._exchange(SyncHandler(space_a, finger_a),
+                       SyncHandler(space_b, finger_b))
+        self.assertEqual(space_a.digest(''), space_b.digest(''))
+        self.assertEqual(len(space_a), len(self.nodes) - 1)
+        self.assertEqual(len(space_b), len(self.nodes) - 1)
+
+        # Once in agreement, a single message settles it
+        rounds = self._exchange(SyncHandler(space_b, finger_b),
+                                SyncHandler(space_a, finger_a))
+        self.assertEqual(rounds, 1)
+
+    def test_reconcile_removal(self):
+        """A node removed by one side is removed by the other, not revived"""
+        finger_a, finger_b = Finger(*self.nodes[0]), Finger(*self.nodes[1])
+        space_a = FingerSpace(Mock(), finger_a)
+        space_b = FingerSpace(Mock(), finger_b)
+        space_a.import_nodes(self.nodes[2:] + [finger_b.all])
+        space_b.import_nodes(self.nodes[2:] + [finger_a.all])
+        gone = Finger(*self.nodes[2]).ident
+        space_a.remove(gone)
+
+        self._exchange(SyncHandler(space_b, finger_b),
+                       SyncHandler(space_a, finger_a))
+        self.assertIsNone(space_a.get(gone))
+        self.assertIsNone(space_b.get(gone))
+        self.assertEqual(space_a.digest(''), space_b.digest(''))
+        self.assertEqual(space_b.get_tombstones(''),
+                         space_a.get_tombstones(''))
@@ -0,0 +1,98 @@
+# -*- coding: utf-8 -*-
+## This file is part of DistrIM.
+##
+## DistrIM is a DHT-based network for secured messaging.
+##
+##     Author: Graham Armstrong
+## Student ID: 11004764
+##      Email: graham.armstrong@northumbria.ac.uk
+##
+## Product for CM0645 Individual Project, academic year 2014/15.
+##
+## This product has been developed in partial fulfilment of the regulations
+## governing the award of the Degree of BSc (Honours) Computer Science
+## at the University of Northumbria at Newcastle.
+
+# Python testing module:
+#    http://docs.python-guide.org/en/latest/writing/tests/
+
+"""
+    Reactor tests, ensures coroutines run in the event loop as expected.
+"""
+
+
+import socket
+import struct
+import unittest
+
+from threading import Thread
+from mock import Mock
+
+from ..reactor import EventLoop, FrameBuffer, AsyncSocket, Accept, Return
+from ..assets.errors import SockWrapError
+
+
+class FrameBufferTests(unittest.TestCase):
+    """Tests the :class:`FrameBuffer` class"""
+    def test_pieces(self):
+        """Frames are reassembled from data received in any pieces"""
+        frames = ['first frame', '', 'x' * 5000]
+        data = ''.join(struct.pack('>L', len(frame)) + frame
+                       for frame in frames)
+        for size in [1, 3, 7, 4096, len(data)]:
+            buff = FrameBuffer()
+            for idx in xrange(0, len(data), size):
+                buff.feed(data[idx:idx + size])
+            received = [buff.pop() for _ in frames]
+            self.assertListEqual(received, frames)
+            self.assertIsNone(buff.pop())
+
+
+class EventLoopTests(unittest.TestCase):
+    """Tests the :class:`EventLoop` class with local sockets"""
+    def setUp(self):
+        self.loop = EventLoop(Mock())
+        self.thread = Thread(target=self.loop.run)
+        self.thread.start()
+        self.listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.listener.bind(('127.0.0.1', 0))
+        self.listener.listen(8)
+        self.listener.setblocking(0)
+        self.address = self.listener.getsockname()
+
+    def tearDown(self):
+        self.loop.stop()
+        self.thread.join()
+        self.listener.close()
+
+    def _echo(self):
+        """Coroutine echoing one frame back on each accepted connection"""
+        for _ in xrange(3):
+            sock, _ = yield Accept(self.listener)
+            stream = AsyncSocket(sock)
+            frame = yield stream.receive()
+            yield stream.send(frame)
+            stream.close()
+
+    def _client(self, data):
+        """Coroutine sending a frame and returning the reply"""
+        stream = AsyncSocket()
+        yield stream.connect(self.address)
+        yield stream.send(data)
+        reply = yield stream.receive()
+        stream.close()
+        yield Return(reply)
+
+    def test_concurrent_clients(self):
+        """Several clients are served at once by a single thread"""
+        self.loop.spawn(self._echo())
+        payloads = ['hello', 'y' * 300000, '']
+        tasks = [self.loop.spawn(self._client(data)) for data in payloads]
+        for task, data in zip(tasks, payloads):
+            self.assertEqual(task.wait(5), data)
+
+    def test_error(self):
+        """Socket errors are raised within the coroutine"""
+        self.listener.close()
+        task = self.loop.spawn(self._client('hello'))
+        self.assertRaises(SockWrapError, task.wait, 5)
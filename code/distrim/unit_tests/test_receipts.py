@@ -0,0 +1,136 @@
+# -*- coding: utf-8 -*-
+## This file is part of DistrIM.
+##
+## DistrIM is a DHT-based network for secured messaging.
+##
+##     Author: Graham Armstrong
+## Student ID: 11004764
+##      Email: graham.armstrong@northumbria.ac.uk
+##
+## Product for CM0645 Individual Project, academic year 2014/15.
+##
+## This product has been developed in partial fulfilment of the regulations
+## governing the award of the Degree of BSc (Honours) Computer Science
+## at the University of Northumbria at Newcastle.
+
+
+
+"""
+    Receipt tests, ensures receipts come back and their latencies are kept.
+"""
+
+
+import time
+import pickle
+import unittest
+
+from mock import Mock, patch
+
+from ..receipts import Receipts
+from ..sphinx import peel_packet
+from ..fingerspace import Finger
+from ..utils.utilities import CipherWrap
+
+
+class ReceiptsTests(unittest.TestCase):
+    """Tests asking for receipts and receiving them"""
+    def setUp(self):
+        test_data_path = (__file__.rpartition('/')[0]
+                          + "/_testdata_protocol.pickle")
+        with open(test_data_path) as handle:
+            test_data = pickle.load(handle)
+        self.nodes = [(Finger(val['ip'], val['port'], val['pub']),
+                       CipherWrap(val['priv'])) for val in test_data]
+        self.local, self.keys = self.nodes[0]
+        self.recipient = self.nodes[1][0]
+        self.fingerspace = Mock()
+        self.fingerspace.get_random_fingers.return_value = [
+            finger for finger, keys in self.nodes]
+        self.receipts = Receipts(Mock(), self.fingerspace, self.local,
+                                 self.keys, timeout=10)
+
+    def test_round_trip(self):
+        """A receipt sent back along the block is delivered"""
+        receipt_id, fields = self.receipts.request(self.recipient)
+        surb = fields['RECEIPT']
+        self.receipts.sent(receipt_id, [self.nodes[2][0], self.recipient])
+        fingers = dict((finger.ident, finger) for finger, keys in self.nodes)
+        self.fingerspace.get.side_effect = fingers.get
+        with patch('distrim.receipts.MessageHandler') as handler:
+            self.receipts._reply(surb)
+        packet = handler.return_value.packet.call_args[0][0]
+        keys = dict((finger.ident, keys) for finger, keys in self.nodes)
+        ident = surb[1][-1]
+        while ident is not None:
+            ident, packet = peel_packet(keys[ident], packet,
+                                        self.receipts.reply_block)
+        self.assertEqual(pickle.loads(packet),
+                         {'DELIVERED': receipt_id})
+        self.assertIsNotNone(self.receipts.delivered(receipt_id))
+        self.assertIsNotNone(self.receipts.latency(
+            [self.nodes[2][0], self.recipient]))
+        self.assertIsNone(self.receipts.delivered(receipt_id))
+        metrics = self.receipts.metrics()
+        self.assertEqual(metrics['delivered'], 1)
+        self.assertEqual(metrics['waiting'], 0)
+
+    def test_route_back(self):
+        """The route back ends at this node and avoids the recipient"""
+        receipt_id, fields = self.receipts.request(self.recipient)
+        block = self.receipts.reply_block(fields['RECEIPT'][0])
+        self.assertEqual(block.route[-1], self.local)
+        self.assertNotIn(self.recipient, block.route)
+        self.assertEqual(block.route.count(self.local), 1)
+
+    def test_expired(self):
+        """Receipts waited for too long are given up on"""
+        self.receipts.timeout = 0
+        receipt_id, fields = self.receipts.request(self.recipient)
+        self.assertIsNone(self.receipts.wait(receipt_id, 0))
+        self.receipts.request(self.recipient)
+        self.assertIsNone(self.receipts.delivered(receipt_id))
+        self.assertEqual(self.receipts.metrics()['expired'], 1)
+
+    def test_malformed_surb(self):
+        """Malformed reply blocks aren't queued to be replied along"""
+        receipt_id, fields = self.receipts.request(self.recipient)
+        surb = fields['RECEIPT']
+        for bad in (None, surb[:3], surb[:3] + (surb[3][1:],),
+                    (surb[0], surb[1][:3]) + surb[2:]):
+            self.receipts.acknowledge(bad)
+        self.assertTrue(self.receipts._owed.empty())
+        self.assertEqual(self.receipts.count_failed, 4)
+        self.receipts.acknowledge(surb)
+        self.assertEqual(self.receipts._owed.get_nowait(), surb)
+
+    def test_reply_failure(self):
+        """A receipt that can't be sent doesn't stop those after it"""
+        receipt_id, fields = self.receipts.request(self.recipient)
+        with patch.object(self.receipts, '_reply') as reply:
+            reply.side_effect = [IndexError("Bad node"), None]
+            self.receipts.acknowledge(fields['RECEIPT'])
+            self.receipts.acknowledge(fields['RECEIPT'])
+            self.receipts.start()
+            for _ in range(50):
+                if self.receipts.count_replied:
+                    break
+                time.sleep(0.1)
+            self.receipts.stop()
+        self.assertEqual(self.receipts.count_failed, 1)
+        self.assertEqual(self.receipts.count_replied, 1)
+
+    def test_slow(self):
+        """Routes much slower than the median are slow"""
+        routes = [[finger, self.recipient] for finger, keys in self.nodes[2:]]
+        with patch('distrim.receipts.time') as clock:
+            for route, latency in zip(routes, (1.0, 1.5, 10.0)):
+                clock.return_value = 0
+                receipt_id, fields = self.receipts.request(self.recipient)
+                self.receipts.sent(receipt_id, route)
+                clock.return_value = latency
+                self.receipts.delivered(receipt_id)
+        self.assertEqual(self.receipts.latency(routes[2]), 10.0)
+        self.assertFalse(self.receipts.slow(routes[0]))
+        self.assertFalse(self.receipts.slow(routes[1]))
+        self.assertTrue(self.receipts.slow(routes[2]))
+        self.assertFalse(self.receipts.slow([self.local, self.recipient]))
@@ -0,0 +1,115 @@
+# -*- coding: utf-8 -*-
+## This file is part of DistrIM.
+##
+## DistrIM is a DHT-based network for secured messaging.
+##
+##     Author: Graham Armstrong
+## Student ID: 11004764
+##      Email: graham.armstrong@northumbria.ac.uk
+##
+## Product for CM0645 Individual Project, academic year 2014/15.
+##
+## This product has been developed in partial fulfilment of the regulations
+## governing the award of the Degree of BSc (Honours) Computer Science
+## at the University of Northumbria at Newcastle.
+
+
+"""
+    Relay tests, ensures relayed packages are queued, retried and dropped.
+"""
+
+
+import unittest
+
+from time import sleep
+from threading import Event
+from mock import Mock, patch
+
+from ..relay import RelayQueues
+from ..protocol import IncomingConnection
+from ..assets.errors import BusyError, SockWrapError
+
+
+class RelayQueuesTests(unittest.TestCase):
+    """Tests the :class:`RelayQueues` class"""
+    def setUp(self):
+        self.finger = Mock(ident='a9ad')
+        self.relays = RelayQueues(Mock(), Mock(), Mock(), Mock(), length=2,
+                                  retries=2, delay=0.01, idle_timeout=0.1)
+        patcher = patch('distrim.relay.MessageHandler')
+        self.handler = patcher.start()
+        self.addCleanup(patcher.stop)
+        self.addCleanup(self.relays.stop)
+
+    def test_relayed(self):
+        """Queued packages are sent, then the idle queue is removed"""
+        self.relays.put(self.finger, 'package')
+        sleep(0.1)
+        self.handler.return_value.relay.assert_called_once_with('package')
+        self.assertEqual(self.relays.metrics()['relayed'], 1)
+        sleep(1.2)
+        self.assertEqual(self.relays.metrics()['queues'], 0)
+
+    def test_retried(self):
+        """Failed sends are retried, then dropped"""
+        self.handler.return_value.connect.side_effect = SockWrapError('no')
+        self.relays.put(self.finger, 'package')
+        sleep(0.2)
+        metrics = self.relays.metrics()
+        self.assertEqual(self.handler.return_value.connect.call_count, 3)
+        self.assertEqual(metrics['retried'], 2)
+        self.assertEqual(metrics['dropped'], 1)
+
+    def test_full(self):
+        """Packages beyond the length of a queue are refused"""
+        release = Event()
+        self.handler.return_value.relay.side_effect = \
+            lambda package: release.wait(1)
+        self.relays.put(self.finger, 0)
+        sleep(0.1)
+        self.relays.put(self.finger, 1)
+        self.relays.put(self.finger, 2)
+        self.assertRaises(BusyError, self.relays.put, self.finger, 3)
+        release.set()
+
+
+class RelayHandlingTests(unittest.TestCase):
+    """Tests that incoming connections queue what they relay"""
+    def setUp(self):
+        self.finger = Mock(ident='a9ad')
+        self.relays = RelayQueues(Mock(), Mock(), Mock(), Mock())
+        self.relays.put = Mock()
+        self.addCleanup(self.relays.stop)
+        self.conn = IncomingConnection(Mock(), None, ('127.0.0.1', 0),
+                                       Mock(), Mock(), Mock(),
+                                       relays=self.relays)
+        patcher = patch('distrim.protocol.MessageHandler')
+        self.handler = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_handle_relay(self):
+        """Relayed packages are queued, even with the queues empty"""
+        self.conn._peel_relay = Mock(return_value=(self.finger, 'package'))
+        self.conn.handle_relay({})
+        self.relays.put.assert_called_once_with(self.finger, 'package')
+        self.assertFalse(self.handler.called)
+
+    def test_handle_packet(self):
+        """Relayed packets are queued, even with the queues empty"""
+        self.conn._peel_packet = Mock(return_value=(self.finger, 'packet'))
+        self.conn.handle_packet({})
+        self.relays.put.assert_called_once_with(self.finger, 'packet',
+                                                procedure='packet')
+        self.assertFalse(self.handler.called)
+
+    def test_handle_cell(self):
+        """Relayed cells are queued, even with the queues empty"""
+        self.conn._peel_cell = Mock(return_value=(self.finger, 'cell'))
+        self.conn.handle_cell({})
+        self.relays.put.assert_called_once_with(self.finger, 'cell',
+                                                procedure='cell')
+        self.assertFalse(self.handler.called)
+
+
+if __name__ == '__main__':
+    unittest.main()
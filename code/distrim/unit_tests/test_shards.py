@@ -0,0 +1,173 @@
+# -*- coding: utf-8 -*-
+## This file is part of DistrIM.
+##
+## DistrIM is a DHT-based network for secured messaging.
+##
+##     Author: Graham Armstrong
+## Student ID: 11004764
+##      Email: graham.armstrong@northumbria.ac.uk
+##
+## Product for CM0645 Individual Project, academic year 2014/15.
+##
+## This product has been developed in partial fulfilment of the regulations
+## governing the award of the Degree of BSc (Honours) Computer Science
+## at the University of Northumbria at Newcastle.
+
+# Python testing module:
+"""
+    Shards tests, ensures FingerSpace changes are passed between processes.
+"""
+
+
+import pickle
+import unittest
+
+from Queue import Queue
+from mock import Mock
+
+from ..fingerspace import Finger, FingerSpace
+from ..shards import (ListenerShards, SharedState, RemoteState, apply_change,
+                      _serve)
+from ..assets.errors import BusyError, ProtocolError
+
+
+class ListenerShardsTests(unittest.TestCase):
+    """Tests the :class:`ListenerShards` class"""
+    def setUp(self):
+        test_data_path = (__file__.rpartition('/')[0]
+                          + '/_testdata_fingerspace.pickle')
+        with open(test_data_path) as hand:
+            nodes = pickle.load(hand)
+        self.local_finger = Finger(*nodes[0])
+        self.test_node_list = nodes[1:]
+        self.space = FingerSpace(Mock(), self.local_finger)
+        manager = Mock(fingerspace=self.space)
+        self.shards = ListenerShards(Mock(), manager, 3)
+        self.shards._downstream = [Mock(), Mock(), Mock()]
+        self.space.observers.append(self.shards._forward)
+
+    def test_apply_change(self):
+        """Changes are applied, and applying them twice does nothing more"""
+        values = self.test_node_list[0]
+        apply_change(self.space, 'ADD', values)
+        apply_change(self.space, 'ADD', values)
+        self.assertEqual(len(self.space), 1)
+        self.assertEqual(self.space.version, 1)
+        ident = Finger(*values).ident
+        apply_change(self.space, 'DEL', ident)
+        apply_change(self.space, 'DEL', ident)
+        self.assertEqual(len(self.space), 0)
+        self.assertEqual(self.space.version, 2)
+
+    def test_worker_epoch(self):
+        """A worker's sync points aren't mistaken for the node's"""
+        first, second = self.test_node_list[:2]
+        self.space.put(*self.test_node_list[2])
+        forked = self.space.sync_point()
+        # The worker starts with a copy of the node's FingerSpace
+        worker = FingerSpace(Mock(), self.local_finger)
+        worker.restore(self.space._keyspace.values(), forked)
+        downstream = Queue()
+        for change in (('ADD', Finger(*first).all), None):
+            downstream.put(change)
+        manager = _Shard()
+        manager.fingerspace = worker
+        _serve(manager, 0, downstream, Queue(), Queue(), Queue())
+        handed_out = worker.sync_point()
+        self.assertNotEqual(handed_out[0], forked[0])
+
+        # The node applies the worker's change before its own
+        self.space.put(*second)
+        self.space.put(*first)
+        self.assertEqual(self.space.version, worker.version + 1)
+        self.assertIsNone(self.space.changes_since(handed_out))
+        worker.put(*second)
+        self.assertIsNone(worker.changes_since(forked))
+
+    def test_forward_local(self):
+        """Changes made in the node are passed to every shard"""
+        self.space.put(*self.test_node_list[0])
+        for downstream in self.shards._downstream:
+            downstream.put.assert_called_once_with(
+                ('ADD', Finger(*self.test_node_list[0]).all))
+
+    def test_forward_replayed(self):
+        """Changes from a shard aren't passed back to it"""
+        self.shards._replaying.origin = 1
+        self.space.put(*self.test_node_list[0])
+        first, second, third = self.shards._downstream
+        self.assertEqual(first.put.call_count, 1)
+        self.assertEqual(second.put.call_count, 0)
+        self.assertEqual(third.put.call_count, 1)
+
+
+
+class _Shard(object):
+    """Stands in for the :class:`ConnectionsManager` a worker runs"""
+    def __init__(self, *args):
+        self.fingerspace = None
+        self.log = Mock()
+        self.local_ip, self.local_port = '127.0.0.1', 6050
+        self.local_finger = self.local_keys = None
+        self.state = {}
+
+    def listen(self, reuse_port=False):
+        """Listen for nothing"""
+
+    def close(self):
+        """Close nothing"""
+
+
+class SharedStateTests(unittest.TestCase):
+    """Tests calling the node's state from a worker"""
+    def setUp(self):
+        self.mail = Mock()
+        manager = Mock(state={'mail': self.mail, 'inbox': None})
+        self.shards = ListenerShards(Mock(), manager, 1)
+        self.shards._calls = Queue()
+        self.shards._replies = [Queue()]
+        self.shards._running = True
+        self.shards._callers[0].start()
+        self.shared = SharedState(0, self.shards._calls,
+                                  self.shards._replies[0])
+        self.shared.start()
+        self.state = self.shared.state(manager.state)
+
+    def tearDown(self):
+        self.shards._running = False
+        self.shared.stop()
+
+    def test_state(self):
+        """Stand-ins are made for the state the node holds"""
+        self.assertIsInstance(self.state['mail'], RemoteState)
+        self.assertIsNone(self.state['inbox'])
+
+    def test_call(self):
+        """Calls are made on the node's state, and their results returned"""
+        self.mail.peek.return_value = [('id', 'item')]
+        self.assertEqual(self.state['mail'].peek('ident'), [('id', 'item')])
+        self.mail.peek.assert_called_once_with('ident')
+        self.assertEqual(self.shards.count_calls, 1)
+
+    def test_call_error(self):
+        """Exceptions raised by the node's state are raised in the worker"""
+        self.mail.store.side_effect = BusyError("Full")
+        with self.assertRaises(BusyError):
+            self.state['mail'].store('ident', 'id', 'item', 60)
+        self.mail.store.side_effect = Exception(lambda: None)
+        with self.assertRaises(ProtocolError):
+            self.state['mail'].store('ident', 'id', 'item', 60)
+
+    def test_not_shared(self):
+        """Only the shared methods of the node's state can be called"""
+        with self.assertRaises(AttributeError):
+            self.state['mail'].metrics()
+        _, error = self.shards.call('mail', 'metrics', ())
+        self.assertIsInstance(error, ProtocolError)
+        _, error = self.shards.call('inbox', 'add', ('ident', 'message'))
+        self.assertIsInstance(error, ProtocolError)
+        self.assertFalse(self.mail.metrics.called)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,110 @@
+# -*- coding: utf-8 -*-
+## This file is part of DistrIM.
+##
+## DistrIM is a DHT-based network for secured messaging.
+##
+##     Author: Graham Armstrong
+## Student ID: 11004764
+##      Email: graham.armstrong@northumbria.ac.uk
+##
+## Product for CM0645 Individual Project, academic year 2014/15.
+##
+## This product has been developed in partial fulfilment of the regulations
+## governing the award of the Degree of BSc (Honours) Computer Science
+## at the University of Northumbria at Newcastle.
+
+# Python testing module:
+#    http://docs.python-guide.org/en/latest/writing/tests/
+
+"""
+    Snapshot tests, ensures the FingerSpace survives a restart.
+"""
+
+
+import os
+import shutil
+import pickle
+import unittest
+
+from tempfile import mkdtemp
+from mock import Mock, patch
+
+from ..fingerspace import Finger, FingerSpace
+from ..snapshot import FingerStore
+from ..utils.records import write_records
+
+
+class FingerStoreTests(unittest.TestCase):
+    """Tests the :class:`FingerStore` class"""
+    def setUp(self):
+        test_data_path = (__file__.rpartition('/')[0]
+                          + '/_testdata_fingerspace.pickle')
+        with open(test_data_path) as hand:
+            nodes = pickle.load(hand)
+        self.local_finger = Finger(*nodes[0])
+        self.test_node_list = nodes[1:]
+        self.directory = mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def _restart(self):
+        """Load a new FingerSpace from the data directory"""
+        space = FingerSpace(Mock(), self.local_finger)
+        store = FingerStore(Mock(), space, self.directory)
+        store.load()
+        return space, store
+
+    def test_snapshot_and_journal(self):
+        """Fingers from both the snapshot and the journal are restored"""
+        space, store = self._restart()
+        self.assertEqual(len(space), 0)
+        store.start()
+        for values in self.test_node_list[:5]:
+            space.put(*values)
+        space.sync_points[('10.0.0.1', 2000)] = ('abcd', 3)
+        store.checkpoint()
+        for values in self.test_node_list[5:]:
+            space.put(*values)
+        space.remove(Finger(*self.test_node_list[0]).ident)
+        store._journal.sync()
+
+        restored, _ = self._restart()
+        self.assertDictEqual(space._keyspace, restored._keyspace)
+        self.assertEqual(space.sync_point(), restored.sync_point())
+        # Tombstones aren't kept, only being passed on for a while
+        with patch('distrim.fingerspace.CFG_TOMBSTONE_TTL', 0):
+            self.assertEqual(space.digest(''), restored.digest(''))
+        self.assertDictEqual(restored.sync_points,
+                             {('10.0.0.1', 2000): ('abcd', 3)})
+
+        store.stop()
+        restored, _ = self._restart()
+        self.assertDictEqual(space._keyspace, restored._keyspace)
+
+    def test_checkpoint_unlocked(self):
+        """The snapshot is written without holding the FingerSpace"""
+        space, store = self._restart()
+        store.start()
+        space.put(*self.test_node_list[0])
+        write = write_records
+
+        def writing(path, records):
+            """Change the FingerSpace while the snapshot is written"""
+            space.put(*self.test_node_list[1])
+            write(path, records)
+
+        with patch('distrim.snapshot.write_records', side_effect=writing):
+            store.checkpoint()
+        self.assertFalse(os.path.exists(store.next_path))
+        store._journal.sync()
+        restored, _ = self._restart()
+        self.assertDictEqual(space._keyspace, restored._keyspace)
+        self.assertEqual(len(restored), 2)
+        store.stop()
+
+    def test_stop_unstarted(self):
+        """A store that was never started can be stopped"""
+        space, store = self._restart()
+        store.stop()
+        self.assertEqual(space.observers, [])
@@ -0,0 +1,106 @@
+# -*- coding: utf-8 -*-
+## This file is part of DistrIM.
+##
+## DistrIM is a DHT-based network for secured messaging.
+##
+##     Author: Graham Armstrong
+## Student ID: 11004764
+##      Email: graham.armstrong@northumbria.ac.uk
+##
+## Product for CM0645 Individual Project, academic year 2014/15.
+##
+## This product has been developed in partial fulfilment of the regulations
+## governing the award of the Degree of BSc (Honours) Computer Science
+## at the University of Northumbria at Newcastle.
+
+
+"""
+    Sphinx tests, ensures packets keep their size as they are peeled.
+"""
+
+
+import pickle
+import unittest
+
+from ..sphinx import (build_packet, peel_packet, reply_packet, ReplyBlock,
+                      PACKET_SIZE, MAX_BODY)
+from ..fingerspace import Finger
+from ..assets.errors import ProtocolError
+from ..utils.utilities import CipherWrap
+
+
+class SphinxTests(unittest.TestCase):
+    """Tests the constant-size packet format"""
+    def setUp(self):
+        test_data_path = (__file__.rpartition('/')[0]
+                          + "/_testdata_protocol.pickle")
+        with open(test_data_path) as handle:
+            test_data = pickle.load(handle)
+        self.nodes = [(Finger(val['ip'], val['port'], val['pub']),
+                       CipherWrap(val['priv'])) for val in test_data]
+
+    def _peel_route(self, nodes, body):
+        """Pass a packet along the nodes, returning what each received"""
+        packet = build_packet([finger for finger, keys in nodes], body)
+        received = []
+        for idx, (finger, keys) in enumerate(nodes):
+            received.append(packet)
+            ident, packet = peel_packet(keys, packet)
+            if idx == len(nodes) - 1:
+                self.assertIsNone(ident)
+            else:
+                self.assertEqual(ident, nodes[idx + 1][0].ident)
+        return received, packet
+
+    def test_peel_route(self):
+        """Each node peels its layer, every packet is the same size"""
+        body = 'The quick brown fox jumped over the lazy dog.'
+        received, result = self._peel_route(self.nodes, body)
+        self.assertEqual(result, body)
+        self.assertTrue(all(len(packet) == PACKET_SIZE
+                            for packet in received))
+
+    def test_route_lengths(self):
+        """Shorter routes, and a full body, make packets of the same size"""
+        body = 'x' * MAX_BODY
+        for hops in range(1, len(self.nodes) + 1):
+            received, result = self._peel_route(self.nodes[:hops], body)
+            self.assertEqual(result, body)
+            self.assertEqual(len(received[0]), PACKET_SIZE)
+
+    def test_limits(self):
+        """Bodies and routes that don't fit are refused"""
+        route = [finger for finger, keys in self.nodes]
+        self.assertRaises(ValueError, build_packet, route,
+                          'x' * (MAX_BODY + 1))
+        self.assertRaises(ValueError, build_packet, [], 'x')
+
+    def test_wrong_node(self):
+        """A packet can't be peeled by a node it isn't for"""
+        packet = build_packet([self.nodes[0][0]], 'body')
+        self.assertRaises(ProtocolError, peel_packet, self.nodes[1][1], packet)
+        self.assertRaises(ProtocolError, peel_packet, self.nodes[0][1],
+                          packet[:-1])
+
+    def test_tampered_header(self):
+        """A packet with a changed header is refused"""
+        route = [finger for finger, keys in self.nodes[:2]]
+        packet = build_packet(route, 'body')
+        tampered = packet[:300] + chr(ord(packet[300]) ^ 1) + packet[301:]
+        self.assertRaises(ProtocolError, peel_packet, self.nodes[0][1],
+                          tampered)
+
+    def test_reply_block(self):
+        """A reply is peeled along the block, and read by its builder"""
+        route = [finger for finger, keys in self.nodes[:3]]
+        block = ReplyBlock(route)
+        packet = reply_packet(block.surb, 'reply')
+        for finger, keys in self.nodes[:2]:
+            self.assertEqual(len(packet), PACKET_SIZE)
+            ident, packet = peel_packet(keys, packet)
+        self.assertRaises(ProtocolError, peel_packet, self.nodes[2][1],
+                          packet)
+        replies = {block.id: block}.get
+        ident, body = peel_packet(self.nodes[2][1], packet, replies)
+        self.assertIsNone(ident)
+        self.assertEqual(body, 'reply')
@@ -0,0 +1,148 @@
+# -*- coding: utf-8 -*-
+## This file is part of DistrIM.
+##
+## DistrIM is a DHT-based network for secured messaging.
+##
+##     Author: Graham Armstrong
+## Student ID: 11004764
+##      Email: graham.armstrong@northumbria.ac.uk
+##
+## Product for CM0645 Individual Project, academic year 2014/15.
+##
+## This product has been developed in partial fulfilment of the regulations
+## governing the award of the Degree of BSc (Honours) Computer Science
+## at the University of Northumbria at Newcastle.
+
+
+
+"""
+    Transfer tests, ensures payloads are striped, acked and reassembled.
+"""
+
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from mock import Mock
+
+from ..transfer import OutgoingTransfer, Transfers, disjoint_routes
+
+
+class TransferTests(unittest.TestCase):
+    """Tests the chunking and reassembly of transfers"""
+    def setUp(self):
+        self.recipient = Mock(ident='a9ad')
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.transfers = Transfers(Mock(), Mock(), Mock(), Mock(),
+                                   directory=self.directory)
+
+    def test_disjoint_routes(self):
+        """Routes share no relays, and all end at the recipient"""
+        nodes = [Mock(ident='%04x' % idx) for idx in range(10)]
+        fingerspace = Mock()
+        fingerspace.get_random_fingers.return_value = nodes + [self.recipient]
+        routes = disjoint_routes(fingerspace, self.recipient, 3, 2)
+        self.assertEqual(len(routes), 3)
+        relays = [finger for route in routes for finger in route[:-1]]
+        self.assertEqual(len(relays), len(set(relays)))
+        self.assertTrue(all(route[-1] is self.recipient for route in routes))
+        self.assertTrue(all(len(route) == 3 for route in routes))
+        fingerspace.get_random_fingers.return_value = [self.recipient]
+        self.assertEqual(disjoint_routes(fingerspace, self.recipient, 3),
+                         [[self.recipient]])
+
+    def test_acks(self):
+        """Chunks not acked in time are queued again"""
+        transfer = OutgoingTransfer(self.recipient, 'x' * 10, chunk_size=4,
+                                    parity=0)
+        self.assertEqual(len(transfer.chunks), 3)
+        for _ in range(3):
+            transfer.mark_sent(transfer.pending.get_nowait())
+        transfer.acknowledge([0, 2])
+        transfer.resend_overdue(0)
+        self.assertEqual(transfer.pending.get_nowait(), 1)
+        self.assertFalse(transfer.done.is_set())
+        transfer.acknowledge([1])
+        self.assertTrue(transfer.done.is_set())
+
+    def test_groups(self):
+        """A group is done once enough of its chunks are acked"""
+        transfer = OutgoingTransfer(self.recipient, 'x' * 10, chunk_size=2,
+                                    group=3, parity=1)
+        self.assertEqual(transfer.groups, [3, 2])
+        self.assertEqual(len(transfer.chunks), 7)
+        transfer.acknowledge([1, 2, 3])
+        self.assertFalse(transfer.needed(0))
+        self.assertTrue(transfer.needed(4))
+        transfer.acknowledge([6, 5])
+        self.assertTrue(transfer.done.is_set())
+
+    def test_reassembly(self):
+        """Chunks are reassembled in order, and duplicates dropped"""
+        transfer = OutgoingTransfer(self.recipient, 'abcdefghij',
+                                    name='../file.txt', chunk_size=4)
+        for index in (2, 0, 2, 1, 0):
+            self.transfers.receive('b000', transfer.chunk(index)['CHUNK'])
+        path = os.path.join(self.directory, transfer.id + '-file.txt')
+        with open(path) as handle:
+            self.assertEqual(handle.read(), 'abcdefghij')
+        metrics = self.transfers.metrics()
+        self.assertEqual(metrics['received'], 1)
+        self.assertEqual(metrics['duplicates'], 2)
+        self.assertEqual(self.transfers._acks[('b000', transfer.id)],
+                         set([0, 1, 2]))
+
+    def test_lost_chunks(self):
+        """A payload is rebuilt from parity chunks in place of lost ones"""
+        data = os.urandom(1000)
+        transfer = OutgoingTransfer(self.recipient, data, name='lost',
+                                    chunk_size=100, group=4, parity=2)
+        lost = set([0, 3, 7, 13])
+        for index in xrange(len(transfer.chunks)):
+            if index not in lost:
+                self.transfers.receive('b000',
+                                       transfer.chunk(index)['CHUNK'])
+        path = os.path.join(self.directory, transfer.id + '-lost')
+        with open(path) as handle:
+            self.assertEqual(handle.read(), data)
+
+    def test_no_overwrite(self):
+        """A payload never replaces a file that is already saved"""
+        for data in ('first', 'second'):
+            transfer = OutgoingTransfer(self.recipient, data, name='same')
+            transfer.id = 'a1'
+            self.transfers._completed.clear()
+            for index in xrange(len(transfer.chunks)):
+                self.transfers.receive('b000',
+                                       transfer.chunk(index)['CHUNK'])
+        with open(os.path.join(self.directory, 'a1-same')) as handle:
+            self.assertEqual(handle.read(), 'first')
+        with open(os.path.join(self.directory, 'a1-same.1')) as handle:
+            self.assertEqual(handle.read(), 'second')
+
+    def test_limits(self):
+        """Transfers past the limits, and mismatched chunks, are refused"""
+        transfers = Transfers(Mock(), Mock(), Mock(), Mock(),
+                              max_incoming=2, max_bytes=100)
+        transfer = OutgoingTransfer(self.recipient, 'x' * 40, chunk_size=10)
+        for sender in ('b000', 'b001', 'b002'):
+            transfers.receive(sender, transfer.chunk(0)['CHUNK'])
+        self.assertEqual(len(transfers._incoming), 2)
+        self.assertNotIn(('b002', transfer.id), transfers._acks)
+
+        chunk = dict(transfer.chunk(1)['CHUNK'], COUNT=1)
+        transfers.receive('b001', chunk)
+        chunk = dict(transfer.chunk(1)['CHUNK'], DATA='x' * 90)
+        transfers.receive('b001', chunk)
+        self.assertEqual(transfers._incoming[('b001', transfer.id)].held, 10)
+        for index in (1, 2, 3, 4):
+            transfers.receive('b001', transfer.chunk(index)['CHUNK'])
+        self.assertEqual(transfers.count_refused, 3)
+        self.assertEqual(transfers.metrics()['received'], 1)
+
+        big = OutgoingTransfer(self.recipient, 'x' * 200, chunk_size=100)
+        transfers.receive('b003', big.chunk(0)['CHUNK'])
+        self.assertEqual(transfers.count_refused, 4)
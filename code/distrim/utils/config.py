@@ -23,18 +23,120 @@
 CFG_LISTENING_PORT = 2000
 
 # Connection Manager
-CFG_LISTENING_QUEUE = 8
-CFG_THREAD_POOL_LENGTH = 8
+CFG_LISTENING_QUEUE = 128
+CFG_THREAD_POOL_MIN = 2
+CFG_THREAD_POOL_MAX = 32
+CFG_THREAD_POOL_QUEUE = 256
+CFG_THREAD_IDLE_TIMEOUT = 30
+# Priority lanes of incoming connections, min and max threads and max queue
+CFG_LANES = {'control': (2, 16, 256), 'relay': (2, 16, 128)}
+
+# Admission Control
+CFG_ADMISSION_RATE = 20  # Connections per second from one address
+CFG_ADMISSION_BURST = 40
+CFG_ADMISSION_SOURCES = 4096
+CFG_ADMISSION_MAX_AGE = 5  # Seconds queued before a connection is shed
+CFG_LISTENER_PROCESSES = 0
 
 # Crypto
 CFG_KEY_LENGTH = 1024
+CFG_KEY_SPARES = 2
+CFG_CRYPTO_PROCESSES = 0  # 0 to decrypt inline, None for one per CPU
 
 # Protocol
 CFG_PICKLE_PROTOCOL = 0
 CFG_STRUCT_FMT = ">L"
 CFG_CRYPT_CHUNK_SIZE = 128
 CFG_TIMEOUT = 15
+CFG_READ_SIZE = 65536
 CFG_PATH_LENGTH = 5
+CFG_PACKET_HOPS = CFG_PATH_LENGTH + 1  # Slots in a packet header
+CFG_PACKET_PAYLOAD = 4096  # Bytes, messages that fit are sent as packets
+
+# FingerSpace
+CFG_IDENT_LENGTH = 4
+CFG_CHANGELOG_LENGTH = 1024
+CFG_IMPORT_PARALLEL_MIN = 64
+CFG_IMPORT_PROCESSES = None  # None for one per CPU
+
+# Persistence
+CFG_SNAPSHOT_INTERVAL = 300
+CFG_JOURNAL_SYNC_INTERVAL = 2
+CFG_JOURNAL_MAX_SIZE = 1024 * 1024
+
+# Anti-entropy
+CFG_SYNC_INTERVAL = 60
+CFG_SYNC_LEAF_SIZE = 8
+CFG_SYNC_LIMIT = 4  # Reconciliations handled at once
+CFG_TOMBSTONE_TTL = 600  # Seconds the removal of a node is passed on
+CFG_TOMBSTONES = 4096  # Removals passed on at once
+
+# Relaying
+CFG_RELAY_QUEUE_LENGTH = 64  # Packages queued for one next node
+CFG_RELAY_RETRIES = 3
+CFG_RELAY_RETRY_DELAY = 0.5  # Seconds, doubled after each retry
+CFG_RELAY_IDLE_TIMEOUT = 10
+CFG_SEND_ATTEMPTS = 3  # Routes tried before a message is given up on
+CFG_DEAD_NODE_TTL = 120  # Seconds a node found down is routed around
+CFG_DEPARTED_NODES = 1024  # Fingers of departed nodes kept
+CFG_STREAM_THRESHOLD = 64 * 1024  # Messages this long are streamed
+CFG_STREAM_CHUNK_SIZE = 16 * 1024
+CFG_STREAM_LIMIT = 16  # Streams relayed at once
+
+# Circuits
+CFG_CIRCUITS = True  # Send messages along reusable circuits
+CFG_CIRCUIT_LIFETIME = 600  # Seconds a circuit is used for
+CFG_CIRCUIT_MESSAGES = 1000  # Messages a circuit is used for
+CFG_CIRCUIT_LIMIT = 4096  # Circuits held by a relaying node
+CFG_CIRCUIT_BUILD_LIMIT = 8  # Circuits extended at once
+
+# Precomputation
+CFG_PRECOMPUTE_STOCK = 2  # Routes prepared for each recipient
+CFG_PRECOMPUTE_RECIPIENTS = 16  # Recent recipients routes are prepared for
+CFG_PRECOMPUTE_MAX_AGE = 300  # Seconds a prepared route is kept
+CFG_PRECOMPUTE_IDLE = 0.5  # Seconds without sending before preparing
+
+# Transfers
+CFG_TRANSFER_CHUNK_SIZE = 32 * 1024
+CFG_TRANSFER_PATHS = 3  # Routes a transfer is striped over
+CFG_TRANSFER_ACK_DELAY = 0.2  # Seconds acks are batched for
+CFG_TRANSFER_ACK_TIMEOUT = 5  # Seconds before a chunk is resent
+CFG_TRANSFER_TIMEOUT = 300  # Seconds before a transfer is given up on
+CFG_TRANSFER_INCOMING = 16  # Most transfers received at once
+CFG_TRANSFER_INCOMING_BYTES = 64 * 1024 * 1024  # Most bytes held for them
+CFG_RECEIVED_DIR = 'received'  # Under the data directory
+CFG_FEC_GROUP = 8  # Data chunks in each group of erasure coded chunks
+CFG_FEC_PARITY = 2  # Parity chunks added to each group
+
+# Delivery receipts
+CFG_RECEIPTS = False  # Ask recipients to acknowledge messages
+CFG_RECEIPT_TIMEOUT = 60  # Seconds a receipt is waited for
+CFG_RECEIPT_SAMPLES = 1024  # Latencies kept for the percentiles
+CFG_RECEIPT_PATHS = 256  # Routes latencies are kept for
+CFG_RECEIPT_SLOW = 3  # Times the median latency a route is slow at
+
+# Outbox
+CFG_OUTBOX_WORKERS = 4  # Threads sending queued messages
+CFG_OUTBOX_RETRIES = 8
+CFG_OUTBOX_RETRY_DELAY = 1  # Seconds, doubled after each retry
+CFG_OUTBOX_LIMIT = 100000  # Messages waiting to be sent
+CFG_OUTBOX_SYNC_INTERVAL = 0.1  # Seconds between syncs of the spool
+CFG_OUTBOX_COMPACT_SIZE = 4 * 1024 * 1024  # Bytes before compacting
+
+# Inbox
+CFG_INBOX_DIR = 'inbox'  # Under the data directory
+CFG_INBOX_SEGMENT_SIZE = 4 * 1024 * 1024  # Bytes before a new segment
+CFG_INBOX_MAX_AGE = 30 * 24 * 60 * 60  # Seconds messages are kept for
+CFG_INBOX_MAX_SIZE = 256 * 1024 * 1024  # Bytes of segments kept
+CFG_INBOX_SYNC_INTERVAL = 1  # Seconds between syncs of the segment
+CFG_INBOX_COMPACT_INTERVAL = 60  # Seconds between compactions
+
+# Mailboxes
+CFG_MAIL_REPLICAS = 3  # Nodes holding each message for an offline node
+CFG_MAIL_TTL = 7 * 24 * 60 * 60  # Seconds mail is held for, at most
+CFG_MAILBOX_ITEMS = 256  # Messages held for one node
+CFG_MAILBOX_SIZE = 1024 * 1024  # Bytes held for one node
+CFG_MAIL_STORE_SIZE = 64 * 1024 * 1024  # Bytes held for all nodes
 
 # Salting
 CFG_SALT_LEN_MIN = 64
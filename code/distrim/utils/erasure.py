@@ -0,0 +1,200 @@
+# -*- coding: utf-8 -*-
+## This file is part of DistrIM.
+##
+## DistrIM is a DHT-based network for secured messaging.
+##
+##     Author: Graham Armstrong
+## Student ID: 11004764
+##      Email: graham.armstrong@northumbria.ac.uk
+##
+## Product for CM0645 Individual Project, academic year 2014/15.
+##
+## This product has been developed in partial fulfilment of the regulations
+## governing the award of the Degree of BSc (Honours) Computer Science
+## at the University of Northumbria at Newcastle.
+
+
+"""
+    Erasure, a Reed-Solomon code over GF(256) for shards of equal length.
+
+    The code is systematic: the `k` data shards are sent as they are,
+    followed by parity shards, each a combination of every data shard
+    weighted by a row of a Cauchy matrix. Any `k` of the shards rebuild the
+    data, as every square matrix taken from the rows of the identity and
+    Cauchy matrices is invertible.
+
+    Shards are multiplied by a constant with :func:`str.translate`, and
+    added by XOR of long integers, so the work per byte is done in C.
+"""
+
+# Generator of GF(256), x^8 + x^4 + x^3 + x^2 + 1.
+_POLYNOMIAL = 0x11d
+MAX_SHARDS = 256
+
+_EXP = [0] * 512
+_LOG = [0] * 256
+_value = 1
+for _power in xrange(255):
+    _EXP[_power] = _value
+    _LOG[_value] = _power
+    _value <<= 1
+    if _value & 0x100:
+        _value ^= _POLYNOMIAL
+for _power in xrange(255, 512):
+    _EXP[_power] = _EXP[_power - 255]
+del _value, _power
+
+# Tables for str.translate multiplying every byte by a constant.
+_MUL_TABLES = {}
+
+
+def encode(shards, parity):
+    """
+    Create the parity shards of data shards.
+
+    :param shards: List of the data shards, strings of equal length.
+    :param parity: Number of parity shards to create.
+    :return: List of the parity shards.
+    """
+    _check(len(shards), parity)
+    length = _length(shards)
+    values = [_to_long(shard) for shard in shards]
+    return [_combine(_cauchy_row(row, len(shards)), shards, values, length)
+            for row in xrange(parity)]
+
+
+def decode(shards, count):
+    """
+    Rebuild the data shards from any `count` of the shards.
+
+    Raises a :class:`ValueError` if fewer than `count` shards are given.
+
+    :param shards: Dictionary of the shards held by their index, data shards
+        first then parity shards, as from :func:`encode`.
+    :param count: Number of data shards.
+    :return: List of the data shards.
+    """
+    if len(shards) < count:
+        raise ValueError("Need %d shards, have %d." % (count, len(shards)))
+    if all(index in shards for index in xrange(count)):
+        return [shards[index] for index in xrange(count)]
+    _check(count, max(shards) + 1 - count)
+    indices = sorted(shards)[:count]
+    held = [shards[index] for index in indices]
+    length = _length(held)
+    values = [_to_long(shard) for shard in held]
+    matrix = [_row(index, count) for index in indices]
+    inverse = _invert(matrix)
+    data = []
+    for index in xrange(count):
+        if index in shards:
+            data.append(shards[index])
+        else:
+            data.append(_combine(inverse[index], held, values, length))
+    return data
+
+
+def multiply(first, second):
+    """Multiply two elements of GF(256)."""
+    if not first or not second:
+        return 0
+    return _EXP[_LOG[first] + _LOG[second]]
+
+
+def divide(first, second):
+    """Divide two elements of GF(256)."""
+    if not second:
+        raise ZeroDivisionError("Division by zero in GF(256).")
+    if not first:
+        return 0
+    return _EXP[_LOG[first] + 255 - _LOG[second]]
+
+
+def _check(count, parity):
+    """Check the shards fit in the field."""
+    if count < 1 or parity < 0 or count + parity > MAX_SHARDS:
+        raise ValueError("Need 1 to %d shards in all." % MAX_SHARDS)
+
+
+def _length(shards):
+    """Length of shards, which must all be equal."""
+    lengths = set(len(shard) for shard in shards)
+    if len(lengths) != 1:
+        raise ValueError("Shards must be of equal length.")
+    return lengths.pop()
+
+
+def _cauchy_row(row, count):
+    """
+    Row of the Cauchy matrix for a parity shard, 1 / (x + y) with x the
+    row's element and y each column's, all distinct.
+    """
+    return [divide(1, (count + row) ^ column) for column in xrange(count)]
+
+
+def _row(index, count):
+    """Row of the encoding matrix for the shard at an index."""
+    if index < count:
+        return [int(column == index) for column in xrange(count)]
+    return _cauchy_row(index - count, count)
+
+
+def _invert(matrix):
+    """Invert a square matrix over GF(256) by Gauss-Jordan elimination."""
+    size = len(matrix)
+    work = [row[:] + [int(column == idx) for column in xrange(size)]
+            for idx, row in enumerate(matrix)]
+    for column in xrange(size):
+        pivot = next((idx for idx in xrange(column, size)
+                      if work[idx][column]), None)
+        if pivot is None:
+            raise ValueError("Shards can't be decoded.")
+        work[column], work[pivot] = work[pivot], work[column]
+        scale = divide(1, work[column][column])
+        work[column] = [multiply(scale, value) for value in work[column]]
+        for idx in xrange(size):
+            factor = work[idx][column]
+            if idx != column and factor:
+                work[idx] = [value ^ multiply(factor, pivot_value)
+                             for value, pivot_value
+                             in zip(work[idx], work[column])]
+    return [row[size:] for row in work]
+
+
+def _combine(coefficients, shards, values, length):
+    """
+    Sum shards weighted by coefficients.
+
+    :param coefficients: Element of GF(256) for each shard.
+    :param shards: The shards.
+    :param values: The shards as long integers, for those weighted by one.
+    :param length: Length of the shards.
+    """
+    total = 0
+    for coefficient, shard, value in zip(coefficients, shards, values):
+        if coefficient == 1:
+            total ^= value
+        elif coefficient:
+            total ^= _to_long(shard.translate(_mul_table(coefficient)))
+    return _from_long(total, length)
+
+
+def _mul_table(coefficient):
+    """Table for str.translate, multiplying each byte by a coefficient."""
+    table = _MUL_TABLES.get(coefficient)
+    if table is None:
+        table = _MUL_TABLES[coefficient] = ''.join(
+            chr(multiply(coefficient, value)) for value in xrange(256))
+    return table
+
+
+def _to_long(shard):
+    """Convert a string to a long integer."""
+    return int(shard.encode('hex'), 16) if shard else 0
+
+
+def _from_long(value, length):
+    """Convert a long integer to a string of a length."""
+    if not length:
+        return ''
+    return ('%0*x' % (length * 2, value)).decode('hex')
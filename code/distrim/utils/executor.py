@@ -0,0 +1,287 @@
+# -*- coding: utf-8 -*-
+## This file is part of DistrIM.
+##
+## DistrIM is a DHT-based network for secured messaging.
+##
+##     Author: Graham Armstrong
+## Student ID: 11004764
+##      Email: graham.armstrong@northumbria.ac.uk
+##
+## Product for CM0645 Individual Project, academic year 2014/15.
+##
+## This product has been developed in partial fulfilment of the regulations
+## governing the award of the Degree of BSc (Honours) Computer Science
+## at the University of Northumbria at Newcastle.
+
+
+"""
+    Executor, a pool of threads which grows and shrinks with its queue.
+"""
+
+from time import time
+from Queue import Queue, Empty
+from threading import Thread, Lock, Event, current_thread
+
+from .config import (CFG_THREAD_POOL_MIN, CFG_THREAD_POOL_MAX,
+                     CFG_THREAD_POOL_QUEUE, CFG_THREAD_IDLE_TIMEOUT)
+from ..assets.errors import ExecutorError
+
+
+class Future(object):
+    """
+    The eventual result of a task given to a :class:`ScalingExecutor`.
+
+    This follows the interface of `concurrent.futures.Future`, which isn't
+    available in Python 2.
+    """
+    def __init__(self):
+        self._done = Event()
+        self._lock = Lock()
+        self._result = None
+        self._error = None
+        self._callbacks = []
+
+    def done(self):
+        """True if the task has finished."""
+        return self._done.is_set()
+
+    def result(self, timeout=None):
+        """
+        Wait for the result of the task.
+
+        :param timeout: Seconds to wait, or None to wait forever.
+        :return: The return value of the task, or raises its exception.
+        """
+        self.exception(timeout)
+        if self._error:
+            raise self._error
+        return self._result
+
+    def exception(self, timeout=None):
+        """
+        Wait for the exception raised by the task.
+
+        :param timeout: Seconds to wait, or None to wait forever.
+        :return: The exception, or None if the task succeeded.
+        """
+        if not self._done.wait(timeout):
+            raise ExecutorError("Timed out waiting for task.")
+        return self._error
+
+    def add_done_callback(self, callback):
+        """
+        Call a function with this future once the task has finished.
+
+        If the task has already finished, it is called immediately.
+
+        :param callback: Function taking the future.
+        """
+        with self._lock:
+            if not self._done.is_set():
+                self._callbacks.append(callback)
+                return
+        callback(self)
+
+    def set_result(self, result):
+        """Finish the task with its return value."""
+        self._result = result
+        self._finish()
+
+    def set_exception(self, error):
+        """Finish the task with the exception it raised."""
+        self._error = error
+        self._finish()
+
+    def _finish(self):
+        """Wake waiters and call the callbacks."""
+        with self._lock:
+            self._done.set()
+            callbacks, self._callbacks = self._callbacks, []
+        for callback in callbacks:
+            callback(self)
+
+
+class ScalingExecutor(object):
+    """
+    Runs tasks in a pool of threads.
+
+    A thread is added whenever a task is queued with no idle thread to take
+    it, up to `max_workers`. Threads left idle for `idle_timeout` seconds
+    stop, down to `min_workers`. If `max_queue` tasks are already waiting,
+    further tasks are rejected.
+
+    Timings are kept of how long tasks wait in the queue and how long they
+    run, see :func:`metrics`.
+    """
+    def __init__(self, parent_log, min_workers=CFG_THREAD_POOL_MIN,
+                 max_workers=CFG_THREAD_POOL_MAX,
+                 max_queue=CFG_THREAD_POOL_QUEUE,
+                 idle_timeout=CFG_THREAD_IDLE_TIMEOUT):
+        """
+        :param parent_log: Logger of the owner of the executor.
+        :param min_workers: Number of threads always kept.
+        :param max_workers: Most threads to run at once.
+        :param max_queue: Most tasks to queue, 0 for no limit.
+        :param idle_timeout: Seconds before an idle thread stops.
+        """
+        self.log = parent_log.getChild(__name__.rpartition('.')[2])
+        self.min_workers = min_workers
+        self.max_workers = max_workers
+        self.max_queue = max_queue
+        self.idle_timeout = idle_timeout
+        self._queue = Queue()
+        self._lock = Lock()
+        self._running = True
+        self._workers = set()
+        self._pending = 0
+        self._number = 0
+
+        # Metrics
+        self.count_submitted = 0
+        self.count_completed = 0
+        self.count_failed = 0
+        self.count_rejected = 0
+        self.total_wait = 0.0
+        self.total_run = 0.0
+        self.max_wait = 0.0
+        self.max_run = 0.0
+
+        with self._lock:
+            for _ in range(min_workers):
+                self._add_worker()
+
+    def __len__(self):
+        """Number of tasks waiting in the queue."""
+        return self._queue.qsize()
+
+    @property
+    def workers(self):
+        """Number of running threads."""
+        return len(self._workers)
+
+    def submit(self, function, *args, **kwargs):
+        """
+        Queue a task to be run.
+
+        Raises an :class:`ExecutorError` if the queue is full, or the
+        executor has been shut down.
+
+        :param function: The function to call.
+        :param args: Arguments of the function.
+        :param kwargs: Keyword arguments of the function.
+        :return: :class:`Future` of the result.
+        """
+        with self._lock:
+            if not self._running:
+                raise ExecutorError("Executor has been shut down.")
+            queued = self._queue.qsize()
+            if self.max_queue and queued >= self.max_queue:
+                self.count_rejected += 1
+                raise ExecutorError("Queue is full, %d tasks." % queued)
+            if (self._pending >= len(self._workers)
+                    and len(self._workers) < self.max_workers):
+                self._add_worker()
+            self._pending += 1
+            self.count_submitted += 1
+            future = Future()
+            self._queue.put((future, function, args, kwargs, time()))
+        return future
+
+    def shutdown(self, wait=True):
+        """
+        Stop the threads once the tasks already queued have been run.
+
+        :param wait: If True, wait for the threads to stop.
+        """
+        with self._lock:
+            self._running = False
+            workers = list(self._workers)
+        for _ in workers:
+            self._queue.put(None)
+        if wait:
+            for worker in workers:
+                worker.join()
+
+    def metrics(self):
+        """
+        Get the metrics of the executor.
+
+        :return: Dictionary of the thread and task counts, and the mean and
+            max times, in seconds, tasks have waited in the queue and run.
+        """
+        with self._lock:
+            finished = (self.count_completed + self.count_failed) or 1
+            return {'workers': len(self._workers),
+                    'idle': max(len(self._workers) - self._pending, 0),
+                    'queued': self._queue.qsize(),
+                    'submitted': self.count_submitted,
+                    'completed': self.count_completed,
+                    'failed': self.count_failed,
+                    'rejected': self.count_rejected,
+                    'mean_wait': self.total_wait / finished,
+                    'max_wait': self.max_wait,
+                    'mean_run': self.total_run / finished,
+                    'max_run': self.max_run}
+
+    def _add_worker(self):
+        """Start another thread. Must be called with `_lock` held."""
+        self._number += 1
+        worker = Thread(target=self._working,
+                        name='Thread-Pool-%d' % self._number)
+        worker.daemon = True
+        self._workers.add(worker)
+        worker.start()
+
+    def _working(self):
+        """
+        Run queued tasks until idle for too long, or shut down.
+
+        This method is the target of each worker thread.
+        """
+        while True:
+            try:
+                task = self._queue.get(timeout=self.idle_timeout)
+            except Empty:
+                with self._lock:
+                    if (self._running
+                            and len(self._workers) <= self.min_workers):
+                        continue
+                    self._retire()
+                return
+            if task is None:
+                with self._lock:
+                    self._retire()
+                return
+            self._run(*task)
+
+    def _run(self, future, function, args, kwargs, queued):
+        """Run a task and note how long it took."""
+        started = time()
+        try:
+            result = function(*args, **kwargs)
+            error = None
+        except Exception as exc:  # pylint: disable=broad-except
+            error = exc
+        finished = time()
+        with self._lock:
+            self._pending -= 1
+            waited, ran = started - queued, finished - started
+            self.total_wait += waited
+            self.total_run += ran
+            self.max_wait = max(self.max_wait, waited)
+            self.max_run = max(self.max_run, ran)
+            if error is None:
+                self.count_completed += 1
+            else:
+                self.count_failed += 1
+        try:
+            if error is None:
+                future.set_result(result)
+            else:
+                future.set_exception(error)
+        except Exception as exc:  # pylint: disable=broad-except
+            self.log.error("Task callback failed: %s", exc)
+
+    def _retire(self):
+        """Remove the current thread. Must be called with `_lock` held."""
+        self._workers.discard(current_thread())
@@ -75,8 +75,22 @@ def create_logger(name, log_ip='', log_port=1999, show_debug=True, ident=''):
     new_logger.addHandler(stream)
 
     if log_ip:
-        extra = {'ident': ident}
-        remote_handler = CustomUDPHandler(log_ip, log_port, extra)
-        new_logger.addHandler(remote_handler)
+        add_remote_handler(new_logger, log_ip, log_port, ident)
 
     return new_logger
+
+
+def add_remote_handler(logger, log_ip, log_port=1999, ident=''):
+    """
+    Send the messages of a logger to a remote server.
+
+    This allows the logger to be created before the node knows its ident.
+
+    :param logger: An instance of ``logging.Logger``.
+    :param log_ip: IP address of the remote server.
+    :param log_port: Port on remote server to send log messages to.
+    :param ident: Unique ident for this node.
+    """
+    extra = {'ident': ident}
+    remote_handler = CustomUDPHandler(log_ip, log_port, extra)
+    logger.addHandler(remote_handler)
@@ -0,0 +1,148 @@
+# -*- coding: utf-8 -*-
+## This file is part of DistrIM.
+##
+## DistrIM is a DHT-based network for secured messaging.
+##
+##     Author: Graham Armstrong
+## Student ID: 11004764
+##      Email: graham.armstrong@northumbria.ac.uk
+##
+## Product for CM0645 Individual Project, academic year 2014/15.
+##
+## This product has been developed in partial fulfilment of the regulations
+## governing the award of the Degree of BSc (Honours) Computer Science
+## at the University of Northumbria at Newcastle.
+
+
+
+"""
+    Record Logs, append-only files of length prefixed records.
+"""
+
+import os
+import mmap
+import struct
+
+from .config import CFG_STRUCT_FMT
+
+
+HEADER_SIZE = struct.calcsize(CFG_STRUCT_FMT)
+
+
+class RecordLog(object):
+    """
+    An append-only file of records.
+
+    Each record is stored with its length packed in front of it, in the same
+    way as :class:`SocketWrapper` frames data. Records are buffered by the
+    file object until :func:`sync` is called, so many appends can share a
+    single `fsync`.
+
+    If the process dies while writing, the file may end with a partial
+    record. This is ignored when reading.
+    """
+    def __init__(self, path):
+        """
+        :param path: Path of the file, it is created if it doesn't exist.
+        """
+        self.path = path
+        self._file = open(path, 'ab')
+
+    def __iter__(self):
+        """Iterate over the records in the file."""
+        self._file.flush()
+        return read_records(self.path)
+
+    def append(self, data):
+        """
+        Append a record to the file.
+
+        :param data: String of the record.
+        :return: Offset of the record in the file.
+        """
+        offset = self._file.tell()
+        self._file.write(struct.pack(CFG_STRUCT_FMT, len(data)) + data)
+        return offset
+
+    def size(self):
+        """Size of the file in bytes, including buffered records."""
+        return self._file.tell()
+
+    def flush(self):
+        """Flush buffered records, so that they can be read from the file."""
+        self._file.flush()
+
+    def sync(self):
+        """Flush buffered records and force them onto disk."""
+        self._file.flush()
+        os.fsync(self._file.fileno())
+
+    def truncate(self):
+        """Remove all records from the file."""
+        self._file.seek(0)
+        self._file.truncate()
+        self.sync()
+
+    def close(self):
+        """Sync and close the file."""
+        if not self._file.closed:
+            self.sync()
+            self._file.close()
+
+
+def read_records(path):
+    """
+    Read the records of a file.
+
+    The file is memory mapped, so records are sliced straight out of the page
+    cache without reading the file into memory first.
+
+    :param path: Path of the file.
+    :return: Generator function that yields each record.
+    """
+    for _, record in read_records_at(path):
+        yield record
+
+
+def read_records_at(path, offset=0):
+    """
+    Read the records of a file along with their offsets.
+
+    :param path: Path of the file.
+    :param offset: Offset of the first record to read.
+    :return: Generator function that yields tuples of offset and record.
+    """
+    if not os.path.exists(path) or not os.path.getsize(path):
+        return
+    with open(path, 'rb') as handle:
+        mapped = mmap.mmap(handle.fileno(), 0, access=mmap.ACCESS_READ)
+    try:
+        while offset + HEADER_SIZE <= len(mapped):
+            start = offset + HEADER_SIZE
+            length = struct.unpack(CFG_STRUCT_FMT, mapped[offset:start])[0]
+            if start + length > len(mapped):
+                break  # Partially written record
+            yield offset, mapped[start:start + length]
+            offset = start + length
+    finally:
+        mapped.close()
+
+
+def write_records(path, records):
+    """
+    Atomically replace a file with a sequence of records.
+
+    The records are written to a temporary file which is synced to disk and
+    then renamed over the original, so either the old or the new file is
+    found after a crash.
+
+    :param path: Path of the file.
+    :param records: Iterable of strings.
+    """
+    temp_path = path + '.tmp'
+    with open(temp_path, 'wb') as handle:
+        for data in records:
+            handle.write(struct.pack(CFG_STRUCT_FMT, len(data)) + data)
+        handle.flush()
+        os.fsync(handle.fileno())
+    os.rename(temp_path, path)
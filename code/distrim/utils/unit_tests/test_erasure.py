@@ -0,0 +1,57 @@
+# -*- coding: utf-8 -*-
+## This file is part of DistrIM.
+##
+## DistrIM is a DHT-based network for secured messaging.
+##
+##     Author: Graham Armstrong
+## Student ID: 11004764
+##      Email: graham.armstrong@northumbria.ac.uk
+##
+## Product for CM0645 Individual Project, academic year 2014/15.
+##
+## This product has been developed in partial fulfilment of the regulations
+## governing the award of the Degree of BSc (Honours) Computer Science
+## at the University of Northumbria at Newcastle.
+
+
+
+"""
+    Test cases for the Reed-Solomon erasure code.
+"""
+
+
+import os
+import unittest
+
+from itertools import combinations
+
+from ..erasure import encode, decode, multiply, divide
+
+
+class ErasureTests(unittest.TestCase):
+    """Tests the :mod:`erasure` module"""
+    def test_field(self):
+        """Division undoes multiplication in GF(256)"""
+        for first in range(1, 256, 7):
+            for second in range(1, 256, 11):
+                product = multiply(first, second)
+                self.assertEqual(divide(product, second), first)
+        self.assertEqual(multiply(0, 9), 0)
+        self.assertRaises(ZeroDivisionError, divide, 9, 0)
+
+    def test_any_shards(self):
+        """Data is rebuilt from every choice of enough shards"""
+        data = [os.urandom(16) for _ in range(4)]
+        shards = dict(enumerate(data + encode(data, 3)))
+        for indices in combinations(range(7), 4):
+            held = dict((index, shards[index]) for index in indices)
+            self.assertEqual(decode(held, 4), data)
+
+    def test_errors(self):
+        """Too few or unequal shards are refused"""
+        data = [os.urandom(16) for _ in range(3)]
+        shards = dict(enumerate(data + encode(data, 2)))
+        del shards[0], shards[1], shards[2]
+        self.assertRaises(ValueError, decode, shards, 3)
+        self.assertRaises(ValueError, encode, ['ab', 'abc'], 1)
+        self.assertRaises(ValueError, encode, ['a'] * 200, 100)
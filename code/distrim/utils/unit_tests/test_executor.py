@@ -0,0 +1,92 @@
+# -*- coding: utf-8 -*-
+## This file is part of DistrIM.
+##
+## DistrIM is a DHT-based network for secured messaging.
+##
+##     Author: Graham Armstrong
+## Student ID: 11004764
+##      Email: graham.armstrong@northumbria.ac.uk
+##
+## Product for CM0645 Individual Project, academic year 2014/15.
+##
+## This product has been developed in partial fulfilment of the regulations
+## governing the award of the Degree of BSc (Honours) Computer Science
+## at the University of Northumbria at Newcastle.
+
+# Python testing module:
+"""
+    Test cases for the scaling executor.
+"""
+
+
+import unittest
+
+from time import sleep
+from threading import Event
+from mock import Mock
+
+from ..executor import ScalingExecutor, Future
+from ...assets.errors import ExecutorError
+
+
+class TestScalingExecutor(unittest.TestCase):
+    """Tests the :class:`ScalingExecutor` and :class:`Future` classes."""
+    def setUp(self):
+        self.executor = ScalingExecutor(Mock(), min_workers=1, max_workers=3,
+                                        max_queue=2, idle_timeout=0.1)
+        self.release = Event()
+
+    def tearDown(self):
+        self.release.set()
+        self.executor.shutdown()
+
+    def _block(self, count):
+        """Submit tasks that block, waiting for threads to take them."""
+        for _ in range(count):
+            self.executor.submit(self.release.wait)
+            for _ in range(100):
+                if not len(self.executor):
+                    break
+                sleep(0.01)
+
+    def test_results(self):
+        """Results and exceptions reach the futures and their callbacks"""
+        done = []
+        future = self.executor.submit(sum, [1, 2, 3])
+        future.add_done_callback(done.append)
+        self.assertEqual(future.result(1), 6)
+        failed = self.executor.submit(int, 'nan')
+        self.assertRaises(ValueError, failed.result, 1)
+        self.assertIsInstance(failed.exception(), ValueError)
+        self.assertEqual(done, [future])
+        metrics = self.executor.metrics()
+        self.assertEqual(metrics['completed'], 1)
+        self.assertEqual(metrics['failed'], 1)
+
+    def test_scaling(self):
+        """Threads are added for queued tasks, then retire once idle"""
+        self._block(3)
+        self.assertEqual(self.executor.workers, 3)
+        self.release.set()
+        sleep(0.5)
+        self.assertEqual(self.executor.workers, 1)
+
+    def test_rejection(self):
+        """Tasks are rejected once the queue is full"""
+        self._block(3)
+        for _ in range(2):
+            self.executor.submit(self.release.wait)
+        self.assertRaises(ExecutorError, self.executor.submit, sum, [])
+        self.assertEqual(self.executor.metrics()['rejected'], 1)
+
+    def test_future_timeout(self):
+        """Waiting on an unfinished future times out"""
+        future = Future()
+        self.assertRaises(ExecutorError, future.result, 0.01)
+        future.set_result(1)
+        self.assertTrue(future.done())
+        self.assertEqual(future.result(), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
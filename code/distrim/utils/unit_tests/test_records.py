@@ -0,0 +1,76 @@
+# -*- coding: utf-8 -*-
+## This file is part of DistrIM.
+##
+## DistrIM is a DHT-based network for secured messaging.
+##
+##     Author: Graham Armstrong
+## Student ID: 11004764
+##      Email: graham.armstrong@northumbria.ac.uk
+##
+## Product for CM0645 Individual Project, academic year 2014/15.
+##
+## This product has been developed in partial fulfilment of the regulations
+## governing the award of the Degree of BSc (Honours) Computer Science
+## at the University of Northumbria at Newcastle.
+
+# Python testing module:
+#    http://docs.python-guide.org/en/latest/writing/tests/
+
+"""
+    Test cases for record logs.
+"""
+
+
+import os
+import shutil
+import unittest
+
+from tempfile import mkdtemp
+
+from ..records import (RecordLog, read_records, read_records_at,
+                       write_records)
+
+
+class TestRecordLog(unittest.TestCase):
+    """Tests the :class:`RecordLog` class and record reading functions."""
+    def setUp(self):
+        self.directory = mkdtemp()
+        self.path = os.path.join(self.directory, 'test.log')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_append_read(self):
+        """Records read back in the order they were appended."""
+        records = ['first', '', 'third' * 1000]
+        log = RecordLog(self.path)
+        offsets = [log.append(record) for record in records]
+        self.assertListEqual(list(log), records)
+        log.close()
+
+        self.assertListEqual(list(read_records(self.path)), records)
+        self.assertListEqual(list(read_records_at(self.path, offsets[2])),
+                             [(offsets[2], records[2])])
+
+    def test_partial_record(self):
+        """A partially written record at the end is ignored."""
+        log = RecordLog(self.path)
+        log.append('complete')
+        log.append('partial')
+        log.close()
+        with open(self.path, 'r+b') as handle:
+            handle.truncate(os.path.getsize(self.path) - 2)
+        self.assertListEqual(list(read_records(self.path)), ['complete'])
+
+    def test_truncate_and_replace(self):
+        """Truncating empties the log, writing replaces the file."""
+        log = RecordLog(self.path)
+        log.append('record')
+        log.truncate()
+        self.assertListEqual(list(log), [])
+        self.assertEqual(log.size(), 0)
+        log.close()
+
+        write_records(self.path, ['one', 'two'])
+        self.assertListEqual(list(read_records(self.path)), ['one', 'two'])
+        self.assertListEqual(list(read_records(self.path + '.none')), [])
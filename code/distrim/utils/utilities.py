@@ -27,6 +27,7 @@ import pickle
 from random import randint, SystemRandom
 from argparse import ArgumentTypeError
 
+from Crypto.Cipher import PKCS1_OAEP
 from Crypto.PublicKey import RSA
 from netifaces import gateways, ifaddresses, AF_INET
 
@@ -120,15 +121,31 @@ class SocketWrapper(object):
         :param read_length: How many bytes to read at a time.
         """
         self._test_connection()
-        received_data = ''
         try:
-            length = struct.unpack(CFG_STRUCT_FMT, self.sock.recv(4))[0]
-            while length > len(received_data):
-                stream_out = self.sock.recv(read_length)
-                received_data += stream_out
+            header = self._receive_exactly(struct.calcsize(CFG_STRUCT_FMT),
+                                           read_length)
+            length = struct.unpack(CFG_STRUCT_FMT, header)[0]
+            return self._receive_exactly(length, read_length)
         except (socket.error, socket.timeout):
             raise SockWrapError("Error attempting to receive data.")
-        return received_data
+
+    def _receive_exactly(self, length, read_length):
+        """
+        Receive a number of bytes, and no more, so that frames sent one
+        after another aren't read into each other.
+
+        :param length: Number of bytes to receive.
+        :param read_length: Most bytes to read at a time.
+        """
+        received = []
+        remaining = length
+        while remaining > 0:
+            stream_out = self.sock.recv(min(read_length, remaining))
+            if not stream_out:
+                raise SockWrapError("Connection closed while receiving.")
+            received.append(stream_out)
+            remaining -= len(stream_out)
+        return ''.join(received)
 
     def send(self, data):
         """
@@ -229,6 +246,31 @@ class CipherWrap(object):
             data.append(self.rsa_instance.decrypt(chunk))
         return ''.join(data)
 
+    def encrypt_block(self, data):
+        """
+        Encrypt a short string into a single block, padded with OAEP.
+
+        The block is always the size of the key, so it can fill a fixed slot.
+
+        :param data: The data to encrypt, at most 86 bytes for a 1024 bit key.
+        :return: The encrypted block.
+        """
+        return PKCS1_OAEP.new(self.rsa_instance).encrypt(data)
+
+    def decrypt_block(self, block):
+        """
+        Decrypt a block made by :func:`encrypt_block`.
+
+        Raises a :class:`ValueError` if the block wasn't encrypted with this
+        key.
+
+        :param block: The encrypted block.
+        :return: The decrypted data.
+        """
+        if not self._has_private:
+            raise CipherError("Can't decrypt, no private key!")
+        return PKCS1_OAEP.new(self.rsa_instance).decrypt(block)
+
 
 def split_address(address):
     """
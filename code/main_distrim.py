@@ -43,6 +43,18 @@ def init():
                         help='Address for a bootstrap node in form IP:Port.')
     parser.add_argument('-l', '--logger', type=split_address,
                         help='Address for a remote logger in form IP:Port.')
+    parser.add_argument('-d', '--data-dir',
+                        help='Directory to keep node state in between runs.')
+    parser.add_argument('-a', '--event-loop', action='store_true',
+                        help='Handle connections in a single event loop.')
+    parser.add_argument('-w', '--processes', type=int,
+                        help='Extra processes to listen for connections in.')
+    parser.add_argument('-c', '--crypto-processes', type=int,
+                        help='Processes to decrypt in, 0 for one per CPU.')
+    parser.add_argument('-e', '--encrypt-key', action='store_true',
+                        help='Prompt for a passphrase for the stored keys.')
+    parser.add_argument('-n', '--new-identity', action='store_true',
+                        help='Replace the stored keys with new ones.')
 
     args = parser.parse_args()
     run_application(args.__dict__)